@@ -0,0 +1,221 @@
+# audit_writer.py - буферизованная запись аудита модерации в JSONL с ротацией и сжатием
+import os
+import gzip
+import json
+import time
+import atexit
+import shutil
+import logging
+import threading
+from collections import deque
+from typing import Any, Deque, Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+# orjson в несколько раз быстрее json.dumps; без него — стандартный модуль
+try:
+    import orjson  # type: ignore
+except Exception:
+    orjson = None
+
+
+def _env_float(name: str, default: float) -> float:
+    try:
+        return float(os.getenv(name, str(default)))
+    except Exception:
+        return default
+
+
+AUDIT_MAX_BYTES = int(_env_float("AUDIT_MAX_MB", 50) * 1024 * 1024)
+AUDIT_BACKUP_COUNT = int(_env_float("AUDIT_BACKUP_COUNT", 5))
+AUDIT_FLUSH_INTERVAL_SECONDS = _env_float("AUDIT_FLUSH_INTERVAL_SECONDS", 1.0)
+AUDIT_BATCH_BYTES = int(_env_float("AUDIT_BATCH_KB", 64) * 1024)
+AUDIT_QUEUE_MAX_BYTES = int(_env_float("AUDIT_QUEUE_MAX_MB", 16) * 1024 * 1024)
+AUDIT_FSYNC = os.getenv("AUDIT_FSYNC", "false").lower() == "true"
+
+
+def dumps_line(entry: Dict[str, Any]) -> bytes:
+    """Одна строка JSONL в UTF-8 (не-JSON значения приводятся к строке)"""
+    if orjson is not None:
+        try:
+            return orjson.dumps(entry, default=str) + b"\n"
+        except TypeError:
+            pass  # например, нестроковые ключи — отдаём стандартному модулю
+    return (json.dumps(entry, ensure_ascii=False, default=str) + "\n").encode("utf-8")
+
+
+class AuditWriter:
+    """
+    Запись аудита без файлового ввода-вывода в потоке запроса.
+    write() сериализует запись и кладёт её в буфер; фоновый поток сбрасывает буфер одним
+    write() (group commit), когда накопилось batch_bytes или прошло flush_interval.
+    Файл держится открытым; при превышении max_bytes он ротируется в <path>.1.gz
+    (старые копии сдвигаются, сверх backup_count — удаляются). При переполнении буфера
+    (диск не успевает) новые записи отбрасываются и учитываются в dropped.
+    """
+
+    def __init__(self, path: str, max_bytes: int = AUDIT_MAX_BYTES, backup_count: int = AUDIT_BACKUP_COUNT,
+                 flush_interval: float = AUDIT_FLUSH_INTERVAL_SECONDS, batch_bytes: int = AUDIT_BATCH_BYTES,
+                 max_queue_bytes: int = AUDIT_QUEUE_MAX_BYTES, fsync: bool = AUDIT_FSYNC):
+        self.path = path
+        self.max_bytes = max(0, int(max_bytes))
+        self.backup_count = max(0, int(backup_count))
+        self.flush_interval = max(0.05, float(flush_interval))
+        self.batch_bytes = max(1, int(batch_bytes))
+        self.max_queue_bytes = max(self.batch_bytes, int(max_queue_bytes))
+        self.fsync = fsync
+
+        self._buffer: Deque[bytes] = deque()
+        self._buffered = 0
+        self._cond = threading.Condition()
+        self._flush_requested = False
+        # Номер последней принятой записи и последней записанной на диск (для flush)
+        self._accepted_seq = 0
+        self._written_seq = 0
+        self._thread: Optional[threading.Thread] = None
+        self._closed = False
+        self._file = None
+        self._size = 0
+
+        self.written = 0
+        self.dropped = 0
+        self.failed = 0
+        self.rotations = 0
+        self._last_error_log = 0.0
+
+    def _ensure_started(self):
+        if self._thread is not None:
+            return
+        with self._cond:
+            if self._thread is None and not self._closed:
+                self._thread = threading.Thread(target=self._run, name="audit-writer", daemon=True)
+                self._thread.start()
+                atexit.register(self.close)
+
+    def write(self, entry: Dict[str, Any]):
+        line = dumps_line(entry)
+        self._ensure_started()
+        with self._cond:
+            if self._closed or self._buffered + len(line) > self.max_queue_bytes:
+                self.dropped += 1
+                return
+            self._buffer.append(line)
+            self._buffered += len(line)
+            self._accepted_seq += 1
+            if self._buffered >= self.batch_bytes:
+                self._cond.notify()
+
+    def flush(self, timeout: float = 5.0):
+        """Дожидается записи всего, что было в буфере на момент вызова"""
+        if self._thread is None:
+            return
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            target = self._accepted_seq
+            self._flush_requested = True
+            self._cond.notify_all()
+            while self._written_seq < target and self._thread.is_alive():
+                left = deadline - time.monotonic()
+                if left <= 0:
+                    break
+                self._cond.wait(left)
+
+    def _take(self) -> bytes:
+        data = b"".join(self._buffer)
+        self._buffer.clear()
+        self._buffered = 0
+        return data
+
+    def _run(self):
+        while True:
+            with self._cond:
+                if not self._closed and not self._flush_requested and self._buffered < self.batch_bytes:
+                    self._cond.wait(self.flush_interval)
+                data = self._take()
+                upto = self._accepted_seq
+                self._flush_requested = False
+                closing = self._closed
+            if data:
+                self._write(data)
+            with self._cond:
+                self._written_seq = upto
+                self._cond.notify_all()
+            if closing:
+                break
+        self._close_file()
+
+    # ---------- файл ----------
+
+    def _open(self):
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._file = open(self.path, "ab")
+        self._size = self._file.tell()
+
+    def _close_file(self):
+        if self._file is not None:
+            try:
+                self._file.close()
+            except Exception:
+                pass
+            self._file = None
+
+    def _write(self, data: bytes):
+        try:
+            if self._file is None:
+                self._open()
+            if self.max_bytes and self._size > 0 and self._size + len(data) > self.max_bytes:
+                self._rotate()
+            self._file.write(data)
+            self._file.flush()
+            if self.fsync:
+                os.fsync(self._file.fileno())
+            self._size += len(data)
+            self.written += data.count(b"\n")
+        except Exception as e:
+            self.failed += data.count(b"\n")
+            self._close_file()
+            # Не засоряем лог: одно предупреждение в минуту
+            now = time.monotonic()
+            if now - self._last_error_log > 60.0:
+                self._last_error_log = now
+                logger.warning("Audit write failed (%s): %s; failed entries so far: %d", self.path, e, self.failed)
+
+    def _rotate(self):
+        """path -> path.1.gz, path.N.gz -> path.N+1.gz; сжатие в этом же фоновом потоке"""
+        self._close_file()
+        if self.backup_count > 0:
+            for i in range(self.backup_count - 1, 0, -1):
+                src = f"{self.path}.{i}.gz"
+                if os.path.exists(src):
+                    os.replace(src, f"{self.path}.{i + 1}.gz")
+            rotated = f"{self.path}.1"
+            os.replace(self.path, rotated)
+            try:
+                with open(rotated, "rb") as src_f, gzip.open(rotated + ".gz", "wb", compresslevel=6) as dst_f:
+                    shutil.copyfileobj(src_f, dst_f, 1024 * 1024)
+                os.remove(rotated)
+            except Exception as e:
+                logger.warning("Audit rotation: compression of %s failed: %s", rotated, e)
+        else:
+            os.remove(self.path)
+        self.rotations += 1
+        self._open()
+
+    def close(self, timeout: float = 5.0):
+        """Сбрасывает остаток буфера и останавливает поток (вызывается и через atexit)"""
+        with self._cond:
+            if self._closed:
+                return
+            self._closed = True
+            self._cond.notify_all()
+        if self._thread is not None:
+            self._thread.join(timeout=timeout)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._cond:
+            buffered, pending = self._buffered, len(self._buffer)
+        return {"path": self.path, "pending": pending, "pending_bytes": buffered, "written": self.written,
+                "dropped": self.dropped, "failed": self.failed, "rotations": self.rotations,
+                "encoder": "orjson" if orjson is not None else "json"}
@@ -8,6 +8,7 @@ from typing import List, Dict, Optional
 import boto3
 import fitz
 from settings import S3_ENDPOINT, S3_ACCESS_KEY, S3_SECRET_KEY
+from quota_scheduler import BULK, priority
 
 logger = logging.getLogger(__name__)
 
@@ -206,6 +207,7 @@ def chunk_text(text: str, max_chars: int = 1500) -> List[str]:
 
     return chunks
 
+@priority(BULK)  # индексация расходует только свободную квоту Yandex API
 def build_bartender_index_from_bucket(bucket: str, prefix: str = "", embedding_model_uri: Optional[str] = None,
                                     max_chunk_chars: Optional[int] = None):
     """
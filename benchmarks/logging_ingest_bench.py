@@ -0,0 +1,141 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Бенчмарк приёма логов logging-сервисом.
+
+Режимы:
+  inproc — LogStorage напрямую (кольцевой буфер против прежнего списка с обрезкой срезом);
+  http   — POST /log и /log/batch в запущенный сервис с несколькими параллельными отправителями.
+
+Примеры:
+  python benchmarks/logging_ingest_bench.py inproc --entries 200000 --capacity 10000
+  python benchmarks/logging_ingest_bench.py http --url http://localhost:8005 --entries 20000 --batch 200 --workers 6
+"""
+
+import os
+import sys
+import json
+import time
+import logging
+import argparse
+import threading
+import urllib.request
+from datetime import datetime
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SERVICES = ["gateway", "rag", "validation", "yandex", "telegram"]
+
+
+def _entry(i: int) -> dict:
+    return {
+        "level": "INFO",
+        "message": f"benchmark entry {i}",
+        "service": SERVICES[i % len(SERVICES)],
+        "user_id": str(i % 500),
+        "request_id": f"{i:032x}",
+    }
+
+
+class _ListStorage:
+    """Прежняя схема: list.append + self.logs = self.logs[-max_entries:] при переполнении"""
+
+    def __init__(self, max_entries: int):
+        self.logs = []
+        self.max_entries = max_entries
+
+    def add_log(self, log_dict: dict):
+        self.logs.append(log_dict)
+        if len(self.logs) > self.max_entries:
+            self.logs = self.logs[-self.max_entries:]
+
+
+def bench_inproc(entries: int, capacity: int, batch: int):
+    sys.path.insert(0, os.path.join(ROOT, "services", "logging"))
+    import main as logging_service  # type: ignore
+
+    # Измеряем хранилище, а не вывод в stdout
+    logging.disable(logging.CRITICAL)
+    payload = [logging_service.LogEntry(**_entry(i)) for i in range(entries)]
+
+    old = _ListStorage(capacity)
+    start = time.perf_counter()
+    for e in payload:
+        old.add_log({"level": e.level.value, "message": e.message, "service": e.service,
+                     "timestamp": datetime.now(), "user_id": e.user_id, "request_id": e.request_id})
+    old_rate = entries / (time.perf_counter() - start)
+
+    ring = logging_service.LogStorage(max_entries=capacity)
+    start = time.perf_counter()
+    for e in payload:
+        ring.add_log(e)
+    ring_rate = entries / (time.perf_counter() - start)
+
+    ring_batch = logging_service.LogStorage(max_entries=capacity)
+    start = time.perf_counter()
+    for i in range(0, entries, batch):
+        ring_batch.add_logs(payload[i:i + batch])
+    batch_rate = entries / (time.perf_counter() - start)
+
+    print(f"entries={entries} capacity={capacity}")
+    print(f"  list + slice trim : {old_rate:>12,.0f} entries/s")
+    print(f"  ring add_log      : {ring_rate:>12,.0f} entries/s")
+    print(f"  ring add_logs({batch}) : {batch_rate:>12,.0f} entries/s")
+
+
+def _post(url: str, body: dict):
+    data = json.dumps(body).encode("utf-8")
+    req = urllib.request.Request(url, data=data, method="POST", headers={"Content-Type": "application/json"})
+    with urllib.request.urlopen(req, timeout=30) as resp:
+        resp.read()
+
+
+def bench_http(url: str, entries: int, batch: int, workers: int):
+    url = url.rstrip("/")
+    per_worker = entries // workers
+    errors = []
+
+    def run(worker: int, batched: bool):
+        base = worker * per_worker
+        try:
+            if batched:
+                for i in range(0, per_worker, batch):
+                    n = min(batch, per_worker - i)
+                    _post(f"{url}/log/batch", {"entries": [_entry(base + i + j) for j in range(n)]})
+            else:
+                for i in range(per_worker):
+                    _post(f"{url}/log", _entry(base + i))
+        except Exception as e:
+            errors.append(e)
+
+    for batched in (False, True):
+        threads = [threading.Thread(target=run, args=(w, batched)) for w in range(workers)]
+        start = time.perf_counter()
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        elapsed = time.perf_counter() - start
+        mode = f"/log/batch (batch={batch})" if batched else "/log"
+        print(f"{mode:<24} workers={workers}: {per_worker * workers / elapsed:>10,.0f} entries/s")
+    if errors:
+        print(f"errors: {len(errors)} (first: {errors[0]})")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("mode", choices=["inproc", "http"])
+    parser.add_argument("--entries", type=int, default=100000)
+    parser.add_argument("--capacity", type=int, default=10000)
+    parser.add_argument("--batch", type=int, default=200)
+    parser.add_argument("--workers", type=int, default=6)
+    parser.add_argument("--url", default=os.getenv("LOGGING_SERVICE_URL", "http://localhost:8005"))
+    args = parser.parse_args()
+
+    if args.mode == "inproc":
+        bench_inproc(args.entries, args.capacity, args.batch)
+    else:
+        bench_http(args.url, args.entries, args.batch, args.workers)
+
+
+if __name__ == "__main__":
+    main()
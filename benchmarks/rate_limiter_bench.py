@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Бенчмарк пер-пользовательского лимитера под конкуренцией потоков.
+
+Сравниваются:
+  deque  — прежний RateLimiter (deque меток времени на пользователя, один глобальный lock);
+  gcra   — GCRALimiter в памяти процесса (одно число на пользователя);
+  redis  — RedisGCRALimiter (Lua-скрипт), если указан --redis-url.
+
+Примеры:
+  python benchmarks/rate_limiter_bench.py --threads 32 --users 10000 --ops 20000
+  python benchmarks/rate_limiter_bench.py --threads 16 --redis-url redis://localhost:6379/0
+"""
+
+import os
+import sys
+import time
+import random
+import argparse
+import threading
+from collections import deque
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from rate_limiter import GCRALimiter, RedisGCRALimiter  # noqa: E402
+
+
+class _DequeLimiter:
+    """Прежняя схема: deque меток времени на пользователя под одним глобальным lock"""
+
+    def __init__(self, rpm: int, window_seconds: float, cooldown_seconds: float):
+        self.rpm, self.window, self.cooldown = rpm, window_seconds, cooldown_seconds
+        self._lock = threading.Lock()
+        self._state = {}
+
+    def is_allowed(self, user_id):
+        now = time.time()
+        with self._lock:
+            st = self._state.get(user_id)
+            if st is None:
+                st = self._state[user_id] = {"hits": deque(), "cooldown_until": 0.0}
+            if now < st["cooldown_until"]:
+                return False, st["cooldown_until"] - now, "cooldown"
+            hits = st["hits"]
+            while hits and hits[0] < now - self.window:
+                hits.popleft()
+            if len(hits) < self.rpm:
+                hits.append(now)
+                return True, 0.0, "ok"
+            st["cooldown_until"] = now + self.cooldown
+            return False, self.cooldown, "rate_limit"
+
+    def tracked_users(self) -> int:
+        return len(self._state)
+
+
+def run(limiter, threads: int, users: int, ops: int):
+    per_thread = ops // threads
+    allowed = [0] * threads
+    barrier = threading.Barrier(threads + 1)
+
+    def worker(n: int):
+        rnd = random.Random(n)
+        ids = [rnd.randrange(users) for _ in range(per_thread)]
+        barrier.wait()
+        ok = 0
+        for uid in ids:
+            if limiter.is_allowed(uid)[0]:
+                ok += 1
+        allowed[n] = ok
+
+    pool = [threading.Thread(target=worker, args=(i,)) for i in range(threads)]
+    for t in pool:
+        t.start()
+    barrier.wait()
+    start = time.perf_counter()
+    for t in pool:
+        t.join()
+    elapsed = time.perf_counter() - start
+    total = per_thread * threads
+    return total / elapsed, sum(allowed) / total
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--threads", type=int, default=32)
+    parser.add_argument("--users", type=int, default=10000)
+    parser.add_argument("--ops", type=int, default=200000)
+    parser.add_argument("--rpm", type=int, default=10)
+    parser.add_argument("--window", type=float, default=60)
+    parser.add_argument("--cooldown", type=float, default=15)
+    parser.add_argument("--redis-url", default="")
+    args = parser.parse_args()
+
+    limiters = [
+        ("deque", _DequeLimiter(args.rpm, args.window, args.cooldown)),
+        ("gcra", GCRALimiter(args.rpm, args.window, args.cooldown)),
+    ]
+    if args.redis_url:
+        limiters.append(("redis", RedisGCRALimiter(args.rpm, args.window, args.cooldown,
+                                                   url=args.redis_url, key_prefix="bench:rl:")))
+
+    print(f"threads={args.threads} users={args.users} ops={args.ops} rpm={args.rpm}/{args.window:g}s")
+    for name, limiter in limiters:
+        rate, share = run(limiter, args.threads, args.users, args.ops)
+        tracked = limiter.tracked_users() if name != "redis" else "-"
+        print(f"  {name:<6} {rate:>12,.0f} checks/s  allowed={share:6.1%}  tracked_users={tracked}")
+
+
+if __name__ == "__main__":
+    main()
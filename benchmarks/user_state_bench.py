@@ -0,0 +1,122 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Бенчмарк пер-пользовательского состояния RAG-воркера под конкуренцией потоков.
+
+Каждый поток имитирует запрос: проверка лимита, чтение истории, запись новой пары.
+Сравниваются:
+  global  — прежняя схема: dict + один глобальный lock (список с пересборкой на каждую запись);
+  striped — GCRALimiter + InMemoryHistory поверх StripedUserStore (user_state.py).
+
+Примеры:
+  python benchmarks/user_state_bench.py --threads 32 --users 5000 --ops 100000
+  python benchmarks/user_state_bench.py --threads 64 --stripes 1   # striped с одной полосой
+"""
+
+import os
+import sys
+import time
+import random
+import argparse
+import threading
+from datetime import datetime, timedelta
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+
+
+class _GlobalLockState:
+    """Прежние RateLimiter/MessageHistory: общий lock, история пересобирается срезом и фильтром"""
+
+    def __init__(self, max_messages: int = 10, rpm: int = 1000, window: float = 60):
+        self.max_messages, self.rpm, self.window = max_messages, rpm, window
+        self._rl_lock = threading.Lock()
+        self._hits = {}
+        self._h_lock = threading.Lock()
+        self._history = {}
+
+    def is_allowed(self, user_id):
+        now = time.time()
+        with self._rl_lock:
+            hits = self._hits.setdefault(user_id, [])
+            hits[:] = [t for t in hits if t >= now - self.window]
+            if len(hits) < self.rpm:
+                hits.append(now)
+                return True, 0.0, "ok"
+            return False, 1.0, "rate_limit"
+
+    def get_history(self, user_id):
+        with self._h_lock:
+            return self._history.get(user_id, []).copy()
+
+    def add_message(self, user_id, user_message, bot_response):
+        now = datetime.now()
+        with self._h_lock:
+            history = self._history.setdefault(user_id, [])
+            history.append((now, user_message, bot_response))
+            if len(history) > self.max_messages:
+                history = history[-self.max_messages:]
+            cutoff = now - timedelta(hours=24)
+            self._history[user_id] = [(ts, um, br) for ts, um, br in history if ts > cutoff]
+
+
+class _StripedState:
+    def __init__(self, max_messages: int = 10, rpm: int = 1000, window: float = 60):
+        # Импорт после разбора аргументов: число полос читается из USER_STATE_STRIPES
+        from rate_limiter import GCRALimiter
+        from message_history import InMemoryHistory
+
+        self.limiter = GCRALimiter(rpm=rpm, window_seconds=window, cooldown_seconds=0)
+        self.history = InMemoryHistory(max_messages=max_messages)
+
+    def is_allowed(self, user_id):
+        return self.limiter.is_allowed(user_id)
+
+    def get_history(self, user_id):
+        return self.history.get_history(user_id)
+
+    def add_message(self, user_id, user_message, bot_response):
+        self.history.add_message(user_id, user_message, bot_response)
+
+
+def run(state, threads: int, users: int, ops: int) -> float:
+    per_thread = ops // threads
+    barrier = threading.Barrier(threads + 1)
+    answer = "ответ " * 200
+
+    def worker(n: int):
+        rnd = random.Random(n)
+        ids = [rnd.randrange(users) for _ in range(per_thread)]
+        barrier.wait()
+        for uid in ids:
+            if state.is_allowed(uid)[0]:
+                state.get_history(uid)
+                state.add_message(uid, "вопрос", answer)
+
+    pool = [threading.Thread(target=worker, args=(i,)) for i in range(threads)]
+    for t in pool:
+        t.start()
+    barrier.wait()
+    start = time.perf_counter()
+    for t in pool:
+        t.join()
+    return per_thread * threads / (time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--threads", type=int, default=32)
+    parser.add_argument("--users", type=int, default=5000)
+    parser.add_argument("--ops", type=int, default=100000)
+    parser.add_argument("--stripes", type=int, default=int(os.getenv("USER_STATE_STRIPES", "64")))
+    args = parser.parse_args()
+    os.environ["USER_STATE_STRIPES"] = str(args.stripes)
+
+    print(f"threads={args.threads} users={args.users} ops={args.ops} stripes={args.stripes}")
+    for name, state in (("global", _GlobalLockState()), ("striped", _StripedState())):
+        print(f"  {name:<8} {run(state, args.threads, args.users, args.ops):>10,.0f} requests/s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,159 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Нагрузочный тест yandex-сервиса: перекрываются ли одновременные запросы или встают в очередь.
+
+Режимы:
+  mock — имитатор Yandex Foundation Models API (/textEmbedding, /completion) с заданной задержкой;
+  run  — N одновременных запросов к сервису; печатает wall time, сумму латентностей,
+         коэффициент перекрытия (сумма / wall: ~1 — запросы шли по очереди, ~N — параллельно)
+         и максимальное число одновременно обслуживаемых запросов.
+
+Пример (три терминала):
+  python benchmarks/yandex_service_load.py mock --port 9999 --latency-ms 500
+  YANDEX_API_BASE_URL=http://localhost:9999 YANDEX_API_KEY=test FOLDER_ID=test python services/yandex/main.py
+  python benchmarks/yandex_service_load.py run --url http://localhost:8004 --endpoint embedding --concurrency 50
+
+Если обработчик блокирует event loop, 50 запросов по 0.5 с идут по очереди (~25 с, перекрытие ~1);
+с асинхронным клиентом wall time близок к задержке имитатора, пока concurrency не превышает
+YANDEX_SERVICE_<ENDPOINT>_CONCURRENCY (сверх лимита запросы ждут слот или получают 503).
+
+Для batch_embedding: --encoding base64_f32|base64_f16 или --binary (Accept: application/octet-stream)
+сравнивают размер ответа с JSON-списками; --duplicates доля повторяющихся текстов в пакете.
+"""
+
+import json
+import time
+import random
+import argparse
+import threading
+import urllib.error
+import urllib.request
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+PAYLOADS = {
+    "embedding": lambda i, args: {"text": f"load test query {i}"},
+    "completion": lambda i, args: {"prompt": f"Рецепт коктейля номер {i}", "max_tokens": 50},
+    "batch_embedding": lambda i, args: {
+        # Первые duplicates * batch_size текстов пакета повторяют один и тот же текст
+        "texts": [f"load test doc {i}-{0 if j < args.duplicates * args.batch_size else j}"
+                  for j in range(args.batch_size)],
+        "encoding": args.encoding,
+    },
+}
+
+
+def serve_mock(port: int, latency_ms: float, dim: int):
+    class Handler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            body = self.rfile.read(int(self.headers.get("Content-Length", 0)) or 0)
+            time.sleep(latency_ms / 1000.0 * random.uniform(0.9, 1.1))
+            if self.path.endswith("/textEmbedding"):
+                rnd = random.Random(body)
+                resp = {"embedding": [rnd.uniform(-1, 1) for _ in range(dim)], "numTokens": "3"}
+            elif self.path.endswith("/completion"):
+                resp = {"result": {"alternatives": [{"message": {"role": "assistant", "text": "SAFE"},
+                                                     "status": "ALTERNATIVE_STATUS_FINAL"}]}}
+            else:
+                self.send_error(404)
+                return
+            data = json.dumps(resp).encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("0.0.0.0", port), Handler)
+    server.daemon_threads = True
+    print(f"mock Yandex API on :{port}, latency={latency_ms:g}ms, dim={dim}")
+    server.serve_forever()
+
+
+def run_load(url: str, endpoint: str, concurrency: int, timeout: float, args: argparse.Namespace):
+    target = f"{url.rstrip('/')}/{endpoint}"
+    spans = [None] * concurrency
+    statuses = [0] * concurrency
+    sizes = [0] * concurrency
+    barrier = threading.Barrier(concurrency + 1)
+    headers = {"Content-Type": "application/json"}
+    if args.binary:
+        headers["Accept"] = "application/octet-stream"
+
+    def worker(i: int):
+        data = json.dumps(PAYLOADS[endpoint](i, args)).encode("utf-8")
+        req = urllib.request.Request(target, data=data, headers=headers)
+        barrier.wait()
+        start = time.perf_counter()
+        try:
+            with urllib.request.urlopen(req, timeout=timeout) as resp:
+                sizes[i] = len(resp.read())
+                statuses[i] = resp.status
+        except urllib.error.HTTPError as e:
+            statuses[i] = e.code
+        except Exception:
+            statuses[i] = -1
+        spans[i] = (start, time.perf_counter())
+
+    pool = [threading.Thread(target=worker, args=(i,)) for i in range(concurrency)]
+    for t in pool:
+        t.start()
+    barrier.wait()
+    t0 = time.perf_counter()
+    for t in pool:
+        t.join()
+    wall = time.perf_counter() - t0
+
+    latencies = sorted(end - start for start, end in spans)
+    # Максимум одновременно обслуживаемых запросов: проход по событиям начала/конца
+    events = sorted([(s, 1) for s, _ in spans] + [(e, -1) for _, e in spans])
+    current = peak = 0
+    for _, delta in events:
+        current += delta
+        peak = max(peak, current)
+    codes = {}
+    for code in statuses:
+        codes[code] = codes.get(code, 0) + 1
+
+    print(f"{endpoint}: {concurrency} concurrent requests -> {target}")
+    print(f"  wall            {wall:8.3f} s")
+    print(f"  sum latency     {sum(latencies):8.3f} s")
+    print(f"  overlap factor  {sum(latencies) / wall if wall else 0:8.1f}  (1 = serialized, {concurrency} = fully parallel)")
+    print(f"  peak in flight  {peak:8d}")
+    print(f"  latency p50/p95/max  {latencies[len(latencies) // 2]:.3f} / "
+          f"{latencies[min(len(latencies) - 1, int(0.95 * len(latencies)))]:.3f} / {latencies[-1]:.3f} s")
+    print(f"  status codes    {codes}")
+    ok = [size for size, code in zip(sizes, statuses) if code == 200]
+    if ok:
+        print(f"  response bytes  {sum(ok) / len(ok):8.0f} avg")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    sub = parser.add_subparsers(dest="mode", required=True)
+    mock = sub.add_parser("mock")
+    mock.add_argument("--port", type=int, default=9999)
+    mock.add_argument("--latency-ms", type=float, default=500)
+    mock.add_argument("--dim", type=int, default=256)
+    run = sub.add_parser("run")
+    run.add_argument("--url", default="http://localhost:8004")
+    run.add_argument("--endpoint", choices=sorted(PAYLOADS), default="embedding")
+    run.add_argument("--concurrency", type=int, default=50)
+    run.add_argument("--timeout", type=float, default=120)
+    run.add_argument("--batch-size", type=int, default=8)
+    run.add_argument("--duplicates", type=float, default=0.0)
+    run.add_argument("--encoding", choices=("json", "base64_f32", "base64_f16"), default="json")
+    run.add_argument("--binary", action="store_true")
+    args = parser.parse_args()
+
+    if args.mode == "mock":
+        serve_mock(args.port, args.latency_ms, args.dim)
+    else:
+        run_load(args.url, args.endpoint, args.concurrency, args.timeout, args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,165 @@
+# bounded_executor.py - выделенный пул потоков с ограниченной очередью и отказом при перегрузке (+ лимит для корутин)
+import math
+import time
+import asyncio
+import logging
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Callable, Dict
+
+from pipeline_metrics import REGISTRY
+
+logger = logging.getLogger(__name__)
+
+EXECUTOR_QUEUE_DEPTH = REGISTRY.gauge(
+    "executor_queue_depth", "Задачи, ожидающие свободного потока", ["executor"])
+EXECUTOR_ACTIVE = REGISTRY.gauge(
+    "executor_active", "Задачи, выполняющиеся в пуле", ["executor"])
+EXECUTOR_QUEUE_WAIT = REGISTRY.histogram(
+    "executor_queue_wait_seconds", "Время ожидания задачи в очереди пула", ["executor"],
+    buckets=(0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0))
+EXECUTOR_REJECTED = REGISTRY.counter(
+    "executor_rejected_total", "Задачи, отклонённые из-за заполненной очереди", ["executor"])
+
+
+class ExecutorOverloaded(Exception):
+    """Очередь пула заполнена: запрос нужно отклонить сразу (503 + Retry-After), а не ждать таймаута"""
+
+    def __init__(self, executor: str, queued: int, retry_after: float):
+        super().__init__(f"executor {executor} is overloaded ({queued} queued)")
+        self.executor = executor
+        self.queued = queued
+        self.retry_after = retry_after
+
+    @property
+    def retry_after_header(self) -> str:
+        return str(max(1, int(math.ceil(self.retry_after))))
+
+
+class BoundedExecutor:
+    """
+    Пул из max_workers потоков и очередь не длиннее max_queue.
+    Если все потоки заняты и очередь полна, run() сразу бросает ExecutorOverloaded с оценкой
+    Retry-After (средняя длительность задачи * очередь / потоки). Глубина очереди, число
+    активных задач, время ожидания и отказы экспортируются в pipeline_metrics.REGISTRY.
+    """
+
+    def __init__(self, name: str, max_workers: int = 16, max_queue: int = 32):
+        self.name = name
+        self.max_workers = max(1, int(max_workers))
+        self.max_queue = max(0, int(max_queue))
+        self._executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix=name)
+        self._lock = threading.Lock()
+        self._queued = 0
+        self._active = 0
+        # Экспоненциальное среднее длительности выполнения (для Retry-After)
+        self._avg_run = 1.0
+        self.rejected = 0
+
+    def _retry_after(self) -> float:
+        waves = (self._queued + 1) / self.max_workers
+        return max(1.0, self._avg_run * max(1.0, waves))
+
+    def _admit(self):
+        with self._lock:
+            if self._active + self._queued >= self.max_workers + self.max_queue:
+                self.rejected += 1
+                EXECUTOR_REJECTED.inc(executor=self.name)
+                raise ExecutorOverloaded(self.name, self._queued, self._retry_after())
+            self._queued += 1
+            EXECUTOR_QUEUE_DEPTH.set(self._queued, executor=self.name)
+
+    def _wrap(self, fn: Callable[..., Any], enqueued: float) -> Callable[..., Any]:
+        def task(*args, **kwargs):
+            started = time.monotonic()
+            with self._lock:
+                self._queued -= 1
+                self._active += 1
+                EXECUTOR_QUEUE_DEPTH.set(self._queued, executor=self.name)
+                EXECUTOR_ACTIVE.set(self._active, executor=self.name)
+            EXECUTOR_QUEUE_WAIT.observe(started - enqueued, executor=self.name)
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                elapsed = time.monotonic() - started
+                with self._lock:
+                    self._active -= 1
+                    self._avg_run = 0.8 * self._avg_run + 0.2 * elapsed
+                    EXECUTOR_ACTIVE.set(self._active, executor=self.name)
+        return task
+
+    def _release_queued(self):
+        with self._lock:
+            self._queued -= 1
+            EXECUTOR_QUEUE_DEPTH.set(self._queued, executor=self.name)
+
+    def _on_done(self, fut: Future):
+        # Отменённая в очереди задача так и не запустится: её место в очереди освобождаем здесь,
+        # иначе _queued навсегда остался бы завышенным и пул начал бы отказывать без нагрузки
+        if fut.cancelled():
+            self._release_queued()
+
+    def _submit(self, fn: Callable[..., Any], *args) -> Future:
+        self._admit()
+        try:
+            fut = self._executor.submit(self._wrap(fn, time.monotonic()), *args)
+        except BaseException:
+            self._release_queued()
+            raise
+        fut.add_done_callback(self._on_done)
+        return fut
+
+    async def run(self, fn: Callable[..., Any], *args) -> Any:
+        """
+        Выполняет fn(*args) в пуле; при переполнении — ExecutorOverloaded без ожидания.
+        Отмена ожидающей корутины отменяет и задачу, если та ещё в очереди.
+        """
+        return await asyncio.wrap_future(self._submit(fn, *args))
+
+    def submit(self, fn: Callable[..., Any], *args) -> Future:
+        """Синхронный run(): Future задачи; при переполнении — ExecutorOverloaded без ожидания"""
+        return self._submit(fn, *args)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {"name": self.name, "max_workers": self.max_workers, "max_queue": self.max_queue,
+                    "active": self._active, "queued": self._queued, "rejected": self.rejected,
+                    "avg_run_seconds": round(self._avg_run, 3)}
+
+
+class InflightLimiter:
+    """
+    Ограничение числа одновременно выполняющихся корутин — аналог BoundedExecutor для пайплайна
+    на asyncio: потоки не заняты, но неограниченный приём запросов всё равно исчерпал бы память
+    и квоту Yandex API. Сверх max_inflight run() сразу бросает ExecutorOverloaded.
+    Метрики — те же, что у BoundedExecutor (executor_active, executor_rejected_total).
+    Вызывается только из event loop, поэтому счётчики без блокировок.
+    """
+
+    def __init__(self, name: str, max_inflight: int = 256):
+        self.name = name
+        self.max_inflight = max(1, int(max_inflight))
+        self._active = 0
+        self._avg_run = 1.0
+        self.rejected = 0
+
+    async def run(self, fn: Callable[..., Any], *args) -> Any:
+        """Выполняет await fn(*args); при max_inflight активных — ExecutorOverloaded без ожидания"""
+        if self._active >= self.max_inflight:
+            self.rejected += 1
+            EXECUTOR_REJECTED.inc(executor=self.name)
+            # Все активные выполняются одновременно: место освободится примерно через среднее время запроса
+            raise ExecutorOverloaded(self.name, 0, max(1.0, self._avg_run))
+        self._active += 1
+        EXECUTOR_ACTIVE.set(self._active, executor=self.name)
+        started = time.monotonic()
+        try:
+            return await fn(*args)
+        finally:
+            self._active -= 1
+            self._avg_run = 0.8 * self._avg_run + 0.2 * (time.monotonic() - started)
+            EXECUTOR_ACTIVE.set(self._active, executor=self.name)
+
+    def stats(self) -> Dict[str, Any]:
+        return {"name": self.name, "max_inflight": self.max_inflight, "active": self._active,
+                "rejected": self.rejected, "avg_run_seconds": round(self._avg_run, 3)}
@@ -0,0 +1,205 @@
+# conversation_context.py - контекст диалога для промпта в пределах бюджета токенов + сводка старых реплик
+import os
+import time
+import logging
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from typing import Any, Callable, Dict, List, Optional, Sequence, Tuple, Union
+
+logger = logging.getLogger(__name__)
+
+UserId = Union[str, int]
+# (время, сообщение пользователя, ответ бота) — как в message_history
+HistoryItem = Tuple[datetime, str, str]
+# summarizer(предыдущая сводка, новые пары для включения в неё) -> новая сводка ("" при ошибке)
+Summarizer = Callable[[str, Sequence[HistoryItem]], str]
+
+
+def _env_float(name: str, default: float) -> float:
+    try:
+        return float(os.getenv(name, str(default)))
+    except Exception:
+        return default
+
+
+CONTEXT_HISTORY_TOKEN_BUDGET = int(_env_float("CONTEXT_HISTORY_TOKEN_BUDGET", 1200))
+CONTEXT_SUMMARY_MAX_TOKENS = int(_env_float("CONTEXT_SUMMARY_MAX_TOKENS", 200))
+CONTEXT_MESSAGE_MAX_TOKENS = int(_env_float("CONTEXT_MESSAGE_MAX_TOKENS", 350))
+CONTEXT_MIN_RECENT_PAIRS = int(_env_float("CONTEXT_MIN_RECENT_PAIRS", 1))
+# Для кириллицы токенизатор YandexGPT даёт ~3 символа на токен; оценка намеренно с запасом
+CONTEXT_CHARS_PER_TOKEN = max(1.0, _env_float("CONTEXT_CHARS_PER_TOKEN", 3.0))
+CONTEXT_SUMMARY_CACHE_SIZE = int(_env_float("CONTEXT_SUMMARY_CACHE_SIZE", 10000))
+CONTEXT_SUMMARY_WORKERS = int(_env_float("CONTEXT_SUMMARY_WORKERS", 2))
+
+# Накладные расходы на сообщение (роль, разметка)
+_MESSAGE_OVERHEAD_TOKENS = 4
+SUMMARY_PREFIX = "Краткое содержание предыдущей части разговора: "
+
+
+def estimate_tokens(text: str) -> int:
+    """Грубая оценка числа токенов по длине текста"""
+    if not text:
+        return 0
+    return int(len(text) / CONTEXT_CHARS_PER_TOKEN) + 1
+
+
+def _clip(text: str, max_tokens: int) -> str:
+    max_chars = int(max_tokens * CONTEXT_CHARS_PER_TOKEN)
+    if len(text) <= max_chars:
+        return text
+    return text[:max(0, max_chars - 1)].rstrip() + "…"
+
+
+class _Summary:
+    __slots__ = ("text", "covered_until")
+
+    def __init__(self, text: str, covered_until: datetime):
+        self.text = text
+        self.covered_until = covered_until
+
+
+class ContextBuilder:
+    """
+    Собирает историю для промпта: последние пары — дословно, пока укладываются в бюджет
+    токенов; более старые пары заменяются скользящей сводкой.
+
+    Сводка кешируется на пользователя вместе с временем последней охваченной пары и
+    обновляется инкрементально (старая сводка + выпавшие из окна пары) в фоновом пуле —
+    запрос не ждёт модель: до готовности используется предыдущая сводка, а непокрытые
+    ею старые пары в промпт не попадают. Размер промпта ограничен бюджетом при любой длине чата.
+    """
+
+    def __init__(self, summarizer: Optional[Summarizer] = None,
+                 budget_tokens: int = CONTEXT_HISTORY_TOKEN_BUDGET,
+                 summary_max_tokens: int = CONTEXT_SUMMARY_MAX_TOKENS,
+                 message_max_tokens: int = CONTEXT_MESSAGE_MAX_TOKENS,
+                 min_recent_pairs: int = CONTEXT_MIN_RECENT_PAIRS,
+                 cache_size: int = CONTEXT_SUMMARY_CACHE_SIZE,
+                 workers: int = CONTEXT_SUMMARY_WORKERS):
+        self.summarizer = summarizer
+        self.budget_tokens = max(1, int(budget_tokens))
+        self.summary_max_tokens = max(0, int(summary_max_tokens))
+        self.message_max_tokens = max(1, int(message_max_tokens))
+        self.min_recent_pairs = max(0, int(min_recent_pairs))
+        self.cache_size = max(1, int(cache_size))
+        self._summaries: "OrderedDict[UserId, _Summary]" = OrderedDict()
+        self._inflight: set = set()
+        self._lock = threading.Lock()
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._workers = max(1, int(workers))
+        self.summaries_generated = 0
+        self.summaries_failed = 0
+
+    # ---------- сборка контекста ----------
+
+    def build(self, user_id: UserId, history: Sequence[HistoryItem]) -> Tuple[List[Dict[str, str]], Dict[str, Any]]:
+        """
+        history — пары от старых к новым. Возвращает (сообщения для модели, сведения для meta).
+        """
+        summary = self._get_summary(user_id)
+        summary_budget = self.summary_max_tokens if (self.summarizer or summary) else 0
+        budget = self.budget_tokens
+
+        recent: List[Tuple[str, str]] = []
+        used = 0
+        cut = len(history)  # индекс первой пары, вошедшей дословно
+        for i in range(len(history) - 1, -1, -1):
+            _, user_msg, bot_resp = history[i]
+            user_msg = _clip(user_msg or "", self.message_max_tokens)
+            bot_resp = _clip(bot_resp or "", self.message_max_tokens)
+            cost = estimate_tokens(user_msg) + estimate_tokens(bot_resp) + 2 * _MESSAGE_OVERHEAD_TOKENS
+            # Если есть более старые пары, резервируем место под сводку
+            reserve = summary_budget if i > 0 else 0
+            if used + cost + reserve > budget and len(recent) >= self.min_recent_pairs:
+                break
+            recent.append((user_msg, bot_resp))
+            used += cost
+            cut = i
+        recent.reverse()
+
+        older = history[:cut]
+        messages: List[Dict[str, str]] = []
+        summarized = 0
+        if older:
+            newest_older = older[-1][0]
+            if summary is not None and summary.text:
+                text = _clip(summary.text, self.summary_max_tokens or 1)
+                messages.append({"role": "system", "text": SUMMARY_PREFIX + text})
+                used += estimate_tokens(messages[0]["text"]) + _MESSAGE_OVERHEAD_TOKENS
+                summarized = sum(1 for ts, _, _ in older if ts <= summary.covered_until)
+            if summary is None or summary.covered_until < newest_older:
+                pending = [item for item in older if summary is None or item[0] > summary.covered_until]
+                self._schedule_summary(user_id, summary, pending)
+
+        for user_msg, bot_resp in recent:
+            messages.append({"role": "user", "text": user_msg})
+            messages.append({"role": "assistant", "text": bot_resp})
+
+        info = {
+            "pairs_verbatim": len(recent),
+            "pairs_summarized": summarized,
+            "pairs_dropped": len(older) - summarized,
+            "summary": bool(messages and messages[0]["role"] == "system"),
+            "tokens_estimate": used,
+            "budget_tokens": self.budget_tokens,
+        }
+        return messages, info
+
+    # ---------- сводка ----------
+
+    def _get_summary(self, user_id: UserId) -> Optional[_Summary]:
+        with self._lock:
+            summary = self._summaries.get(user_id)
+            if summary is not None:
+                self._summaries.move_to_end(user_id)
+            return summary
+
+    def _schedule_summary(self, user_id: UserId, previous: Optional[_Summary], pending: List[HistoryItem]):
+        if self.summarizer is None or not pending:
+            return
+        with self._lock:
+            if user_id in self._inflight:
+                return
+            self._inflight.add(user_id)
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self._workers, thread_name_prefix="ctx-summary")
+            executor = self._executor
+        executor.submit(self._summarize, user_id, previous, list(pending))
+
+    def _summarize(self, user_id: UserId, previous: Optional[_Summary], pending: List[HistoryItem]):
+        start = time.perf_counter()
+        try:
+            text = self.summarizer(previous.text if previous else "", pending) if self.summarizer else ""
+            if text:
+                with self._lock:
+                    current = self._summaries.get(user_id)
+                    # Не затираем более свежую сводку (например, после clear и нового диалога)
+                    if current is None or current.covered_until <= pending[-1][0]:
+                        self._summaries[user_id] = _Summary(text.strip(), pending[-1][0])
+                        self._summaries.move_to_end(user_id)
+                        while len(self._summaries) > self.cache_size:
+                            self._summaries.popitem(last=False)
+                self.summaries_generated += 1
+                logger.debug("Context summary for %s updated in %.0f ms (%d pairs)",
+                             user_id, (time.perf_counter() - start) * 1000.0, len(pending))
+            else:
+                self.summaries_failed += 1
+        except Exception as e:
+            self.summaries_failed += 1
+            logger.warning("Context summary for %s failed: %s", user_id, e)
+        finally:
+            with self._lock:
+                self._inflight.discard(user_id)
+
+    def forget(self, user_id: UserId):
+        with self._lock:
+            self._summaries.pop(user_id, None)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            cached, inflight = len(self._summaries), len(self._inflight)
+        return {"cached_summaries": cached, "inflight": inflight,
+                "generated": self.summaries_generated, "failed": self.summaries_failed,
+                "budget_tokens": self.budget_tokens}
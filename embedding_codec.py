@@ -0,0 +1,69 @@
+# embedding_codec.py - компактная передача матриц эмбеддингов: base64 float32/float16 или сырые байты
+import base64
+from typing import Dict, List, Mapping, Sequence, Tuple
+
+import numpy as np
+
+# Форматы ответа /batch_embedding: "json" — списки чисел (как раньше), остальные — бинарные
+ENCODING_JSON = "json"
+ENCODING_BASE64_F32 = "base64_f32"
+ENCODING_BASE64_F16 = "base64_f16"
+ENCODINGS = (ENCODING_JSON, ENCODING_BASE64_F32, ENCODING_BASE64_F16)
+
+OCTET_STREAM = "application/octet-stream"
+# Заголовки бинарного ответа: форма "строки,столбцы" и тип элементов (little-endian)
+SHAPE_HEADER = "X-Embedding-Shape"
+DTYPE_HEADER = "X-Embedding-Dtype"
+
+# Явный little-endian: получатель может быть на другой архитектуре
+_DTYPES = {"float32": np.dtype("<f4"), "float16": np.dtype("<f2")}
+
+
+def dtype_for(encoding: str) -> str:
+    return "float16" if encoding == ENCODING_BASE64_F16 else "float32"
+
+
+def to_matrix(embeddings: Sequence[Sequence[float]], dtype: str = "float32") -> np.ndarray:
+    """Список векторов одной размерности -> матрица (n, dim) нужного типа"""
+    if not embeddings:
+        return np.zeros((0, 0), dtype=_DTYPES[dtype])
+    return np.asarray(embeddings, dtype=np.float32).astype(_DTYPES[dtype], copy=False)
+
+
+def encode_base64(matrix: np.ndarray) -> str:
+    return base64.b64encode(np.ascontiguousarray(matrix).tobytes()).decode("ascii")
+
+
+def binary_headers(matrix: np.ndarray, dtype: str) -> Dict[str, str]:
+    rows, cols = matrix.shape
+    return {SHAPE_HEADER: f"{rows},{cols}", DTYPE_HEADER: dtype}
+
+
+def decode(data: bytes, dtype: str, shape: Tuple[int, int]) -> np.ndarray:
+    """Сырые байты (little-endian) -> матрица float32 формы shape"""
+    matrix = np.frombuffer(data, dtype=_DTYPES[dtype]).reshape(shape)
+    return matrix.astype(np.float32)
+
+
+def decode_base64(data: str, dtype: str, shape: Sequence[int]) -> np.ndarray:
+    return decode(base64.b64decode(data), dtype, (int(shape[0]), int(shape[1])))
+
+
+def decode_response(body: bytes, headers: Mapping[str, str]) -> np.ndarray:
+    """Матрица из ответа application/octet-stream по заголовкам формы и типа"""
+    rows, cols = (int(x) for x in headers[SHAPE_HEADER].split(","))
+    return decode(body, headers.get(DTYPE_HEADER, "float32"), (rows, cols))
+
+
+def dedupe(texts: Sequence[str]) -> Tuple[List[str], List[int]]:
+    """(уникальные тексты в порядке появления, индекс уникального текста для каждого исходного)"""
+    positions: Dict[str, int] = {}
+    unique: List[str] = []
+    index: List[int] = []
+    for text in texts:
+        pos = positions.get(text)
+        if pos is None:
+            pos = positions[text] = len(unique)
+            unique.append(text)
+        index.append(pos)
+    return unique, index
@@ -4,6 +4,7 @@ import pickle
 import numpy as np
 from typing import List, Optional, Tuple
 from yandex_api import yandex_batch_embeddings
+from quota_scheduler import BULK, priority
 import logging
 
 logger = logging.getLogger(__name__)
@@ -21,6 +22,7 @@ IDX_FILE = os.path.join(INDEX_DIR, "index.faiss")
 os.makedirs(INDEX_DIR, exist_ok=True)
 os.makedirs(VECTORSTORE_DIR, exist_ok=True)
 
+@priority(BULK)  # индексация расходует только свободную квоту Yandex API
 def build_index(docs: List[dict], model_uri: Optional[str] = None, embeddings: Optional[np.ndarray] = None) -> bool:
     """
     Создает FAISS индекс и сохраняет эмбеддинги
@@ -118,7 +120,8 @@ def load_index() -> Tuple[faiss.Index, np.ndarray, List[dict]]:
         logger.exception("Ошибка при загрузке FAISS индекса: %s", e)
         raise
 
-def semantic_search(query: str, k: int = 3, model_uri: Optional[str] = None) -> List[dict]:
+def semantic_search(query: str, k: int = 3, model_uri: Optional[str] = None,
+                    query_embedding: Optional[List[float]] = None) -> List[dict]:
     """
     Выполняет семантический поиск по индексу
 
@@ -126,6 +129,7 @@ def semantic_search(query: str, k: int = 3, model_uri: Optional[str] = None) ->
         query: поисковый запрос
         k: количество результатов
         model_uri: URI модели для эмбеддингов
+        query_embedding: уже посчитанный эмбеддинг запроса (чтобы не вызывать API повторно)
 
     Returns:
         List[dict]: список найденных документов с оценками
@@ -134,8 +138,11 @@ def semantic_search(query: str, k: int = 3, model_uri: Optional[str] = None) ->
         # Загружаем индекс
         index, vectors, docs = load_index()
 
-        # Получаем эмбеддинг запроса
-        emb_list = yandex_batch_embeddings([query], model_uri=model_uri)
+        # Получаем эмбеддинг запроса (или переиспользуем переданный)
+        if query_embedding is not None and len(query_embedding) > 0:
+            emb_list = [list(query_embedding)]
+        else:
+            emb_list = yandex_batch_embeddings([query], model_uri=model_uri)
         # Валидируем результат
         if not emb_list or not isinstance(emb_list, list) or not emb_list[0] or len(emb_list[0]) == 0:
             logger.error("Не удалось получить эмбеддинг для запроса или он пустой")
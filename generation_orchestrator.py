@@ -0,0 +1,284 @@
+# generation_orchestrator.py - цепочка генераций с общим дедлайном и хеджированием
+import os
+import time
+import asyncio
+import logging
+import threading
+import contextvars
+from collections import deque
+from concurrent.futures import Future, wait, FIRST_COMPLETED
+from typing import Awaitable, Callable, Deque, Dict, List, Optional, Tuple, Any
+
+import request_deadline
+from bounded_executor import BoundedExecutor, ExecutorOverloaded
+
+logger = logging.getLogger(__name__)
+
+# Шаг цепочки: (имя стратегии, функция без аргументов, возвращающая текст или "" при неудаче)
+GenerationStep = Tuple[str, Callable[[], str]]
+# То же для асинхронного пайплайна: функция возвращает корутину
+AsyncGenerationStep = Tuple[str, Callable[[], Awaitable[str]]]
+
+
+class LatencyTracker:
+    """Скользящее окно латентностей по имени стратегии для оценки p95"""
+
+    def __init__(self, window: int = 200, min_samples: int = 20, default_p95: float = 8.0):
+        self.window = max(1, int(window))
+        self.min_samples = max(1, int(min_samples))
+        self.default_p95 = float(default_p95)
+        self._lock = threading.Lock()
+        self._samples: Dict[str, Deque[float]] = {}
+
+    def record(self, name: str, seconds: float):
+        with self._lock:
+            samples = self._samples.get(name)
+            if samples is None:
+                samples = deque(maxlen=self.window)
+                self._samples[name] = samples
+            samples.append(seconds)
+
+    def p95(self, name: str) -> float:
+        with self._lock:
+            samples = list(self._samples.get(name, ()))
+        if len(samples) < self.min_samples:
+            return self.default_p95
+        samples.sort()
+        return samples[min(len(samples) - 1, int(0.95 * len(samples)))]
+
+    def snapshot(self) -> Dict[str, Dict[str, float]]:
+        with self._lock:
+            names = list(self._samples.keys())
+        return {n: {"p95": self.p95(n), "samples": len(self._samples.get(n, ()))} for n in names}
+
+
+class GenerationOrchestrator:
+    """
+    Выполняет цепочку fallback-генераций (primary -> fallback -> ...) в пределах общего бюджета.
+    - если шаг вернул пустой результат или упал — сразу запускается следующий;
+    - если шаг работает дольше своего p95 — следующий запускается спекулятивно (хедж);
+    - возвращается первый непустой результат; по истечении бюджета — пустая строка.
+    Шаги выполняются в BoundedExecutor: при заполненной очереди шаг не запускается (хедж пропускается,
+    а если запустить нечего — run() возвращает пустой результат), а не ждёт за чужой брошенной работой.
+    Незавершённый запрос requests прервать нельзя, но шаг работает под дедлайном бюджета генерации,
+    а после победы другого шага или истечения бюджета его дедлайн считается исчерпанным — вызовы
+    Yandex API внутри прекращаются на ближайшей проверке (повтор, fallback на REST).
+    run_async() делает то же для корутин и отменяет незавершённые шаги.
+    """
+
+    def __init__(self, max_workers: int = 16, max_queue: int = 16, min_hedge_delay: float = 1.0,
+                 tracker: Optional[LatencyTracker] = None):
+        self.min_hedge_delay = max(0.0, float(min_hedge_delay))
+        self.tracker = tracker or LatencyTracker()
+        self._executor = BoundedExecutor("generation", max_workers=max_workers, max_queue=max_queue)
+
+    def _timed(self, name: str, fn: Callable[[], str], deadline: float, abandoned: threading.Event) -> str:
+        # Выполняется в копии контекста вызывающего: дедлайн и отмена меняются только для шага.
+        # Бюджет — до конца бюджета генерации (время в очереди пула уже потрачено), не дольше дедлайна запроса
+        budget = max(0.0, deadline - time.monotonic())
+        rem = request_deadline.remaining()
+        request_deadline.set_budget(budget if rem is None else min(budget, rem))
+        request_deadline.set_abandon_event(abandoned)
+        start = time.monotonic()
+        try:
+            return fn() or ""
+        finally:
+            # Брошенный шаг прерван на середине — его время исказило бы p95
+            if not abandoned.is_set():
+                self.tracker.record(name, time.monotonic() - start)
+
+    def _submit(self, name: str, fn: Callable[[], str], deadline: float, abandoned: threading.Event) -> Future:
+        # Копируем контекст, чтобы contextvars (дедлайн, трассировка) дошли до рабочего потока
+        ctx = contextvars.copy_context()
+        return self._executor.submit(ctx.run, self._timed, name, fn, deadline, abandoned)
+
+    def run(self, chain: List[GenerationStep], budget_seconds: float) -> Tuple[str, Dict[str, Any]]:
+        """Возвращает (текст, info) — info описывает победителя, хеджи и попытки"""
+        start = time.monotonic()
+        deadline = start + max(0.0, float(budget_seconds))
+        info: Dict[str, Any] = {"winner": None, "attempts": [], "hedged": 0, "deadline_exceeded": False}
+        if not chain:
+            return "", info
+
+        pending: Dict[Future, str] = {}
+        next_idx = 0
+        hedge_at = deadline
+        abandoned = threading.Event()
+
+        def launch(reason: str):
+            nonlocal next_idx, hedge_at
+            name, fn = chain[next_idx]
+            try:
+                fut = self._submit(name, fn, deadline, abandoned)
+            except ExecutorOverloaded as e:
+                info["rejected"] = info.get("rejected", 0) + 1
+                if reason == "hedge":
+                    # Хедж — необязательная работа: при перегрузке не хеджируем, шаг остаётся fallback'ом
+                    hedge_at = deadline
+                    return
+                logger.warning("Generation step %s rejected: %s", name, e)
+                next_idx += 1
+                info["attempts"].append({"name": name, "reason": reason, "rejected": True,
+                                         "at": round(time.monotonic() - start, 3)})
+                return
+            next_idx += 1
+            pending[fut] = name
+            if reason == "hedge":
+                info["hedged"] += 1
+            info["attempts"].append({"name": name, "reason": reason,
+                                     "at": round(time.monotonic() - start, 3)})
+            hedge_at = time.monotonic() + max(self.min_hedge_delay, self.tracker.p95(name))
+
+        try:
+            launch("primary")
+            while True:
+                now = time.monotonic()
+                if now >= deadline:
+                    info["deadline_exceeded"] = True
+                    break
+                if not pending:
+                    if next_idx >= len(chain):
+                        break
+                    launch("fallback")
+                    continue
+
+                wait_until = min(deadline, hedge_at) if next_idx < len(chain) else deadline
+                done, _ = wait(list(pending), timeout=max(0.0, wait_until - now), return_when=FIRST_COMPLETED)
+
+                for fut in done:
+                    name = pending.pop(fut)
+                    try:
+                        result = fut.result()
+                    except Exception as e:
+                        logger.exception("Generation step %s failed: %s", name, e)
+                        result = ""
+                    if result:
+                        info["winner"] = name
+                        info["elapsed"] = round(time.monotonic() - start, 3)
+                        return result, info
+                    if next_idx < len(chain):
+                        launch("fallback")
+
+                if not done and next_idx < len(chain) and time.monotonic() >= hedge_at:
+                    launch("hedge")
+        finally:
+            # Проигравшие и не уложившиеся в бюджет шаги больше не нужны: их вызовы API прекращаются
+            abandoned.set()
+
+        info["elapsed"] = round(time.monotonic() - start, 3)
+        if info["deadline_exceeded"]:
+            logger.warning("Generation budget %.1fs exceeded (attempts=%s)", budget_seconds,
+                           [a["name"] for a in info["attempts"]])
+        return "", info
+
+    async def _timed_async(self, name: str, fn: Callable[[], Awaitable[str]]) -> str:
+        start = time.monotonic()
+        cancelled = False
+        try:
+            return await fn() or ""
+        except asyncio.CancelledError:
+            cancelled = True
+            raise
+        finally:
+            # Отменённый проигравший не дошёл до конца — его время исказило бы p95
+            if not cancelled:
+                self.tracker.record(name, time.monotonic() - start)
+
+    async def run_async(self, chain: List[AsyncGenerationStep], budget_seconds: float) -> Tuple[str, Dict[str, Any]]:
+        """
+        Асинхронный run(): та же логика fallback/хеджа/бюджета и тот же info, но шаги — asyncio-задачи.
+        После победы или истечения бюджета незавершённые шаги отменяются (httpx-запрос прерывается).
+        """
+        start = time.monotonic()
+        deadline = start + max(0.0, float(budget_seconds))
+        info: Dict[str, Any] = {"winner": None, "attempts": [], "hedged": 0, "deadline_exceeded": False}
+        if not chain:
+            return "", info
+
+        pending: Dict["asyncio.Task[str]", str] = {}
+        next_idx = 0
+        hedge_at = deadline
+
+        def launch(reason: str):
+            nonlocal next_idx, hedge_at
+            name, fn = chain[next_idx]
+            next_idx += 1
+            # create_task копирует контекст: дедлайн и трассировка видны внутри шага
+            pending[asyncio.create_task(self._timed_async(name, fn))] = name
+            info["attempts"].append({"name": name, "reason": reason,
+                                     "at": round(time.monotonic() - start, 3)})
+            hedge_at = time.monotonic() + max(self.min_hedge_delay, self.tracker.p95(name))
+
+        try:
+            launch("primary")
+            while True:
+                now = time.monotonic()
+                if now >= deadline:
+                    info["deadline_exceeded"] = True
+                    break
+                if not pending:
+                    if next_idx >= len(chain):
+                        break
+                    launch("fallback")
+                    continue
+
+                wait_until = min(deadline, hedge_at) if next_idx < len(chain) else deadline
+                done, _ = await asyncio.wait(list(pending), timeout=max(0.0, wait_until - now),
+                                             return_when=asyncio.FIRST_COMPLETED)
+
+                for task in done:
+                    name = pending.pop(task)
+                    try:
+                        result = task.result()
+                    except Exception as e:
+                        logger.exception("Generation step %s failed: %s", name, e)
+                        result = ""
+                    if result:
+                        info["winner"] = name
+                        info["elapsed"] = round(time.monotonic() - start, 3)
+                        return result, info
+                    if next_idx < len(chain):
+                        launch("fallback")
+
+                if not done and next_idx < len(chain) and time.monotonic() >= hedge_at:
+                    info["hedged"] += 1
+                    launch("hedge")
+        finally:
+            for task in pending:
+                task.cancel()
+
+        info["elapsed"] = round(time.monotonic() - start, 3)
+        if info["deadline_exceeded"]:
+            logger.warning("Generation budget %.1fs exceeded (attempts=%s)", budget_seconds,
+                           [a["name"] for a in info["attempts"]])
+        return "", info
+
+
+try:
+    GENERATION_BUDGET_SECONDS = float(os.getenv("RAG_GENERATION_BUDGET_SECONDS", "40"))
+except Exception:
+    GENERATION_BUDGET_SECONDS = 40.0
+try:
+    _WORKERS = int(os.getenv("RAG_GENERATION_WORKERS", "16"))
+except Exception:
+    _WORKERS = 16
+try:
+    # Шаги сверх потоков ждут в очереди не больше этого числа; дальше — отказ, а не бесконечная очередь
+    _QUEUE = int(os.getenv("RAG_GENERATION_QUEUE", "16"))
+except Exception:
+    _QUEUE = 16
+try:
+    _MIN_HEDGE = float(os.getenv("RAG_HEDGE_MIN_DELAY_SECONDS", "1.0"))
+except Exception:
+    _MIN_HEDGE = 1.0
+try:
+    _DEFAULT_P95 = float(os.getenv("RAG_HEDGE_DEFAULT_P95_SECONDS", "8.0"))
+except Exception:
+    _DEFAULT_P95 = 8.0
+
+GENERATION_ORCHESTRATOR = GenerationOrchestrator(
+    max_workers=_WORKERS,
+    max_queue=_QUEUE,
+    min_hedge_delay=_MIN_HEDGE,
+    tracker=LatencyTracker(default_p95=_DEFAULT_P95),
+)
@@ -14,6 +14,7 @@ from settings import VECTORSTORE_DIR, S3_ENDPOINT, S3_ACCESS_KEY, S3_SECRET_KEY
 from bartender_file_handler import extract_text_from_file, chunk_text, download_file_bytes
 from faiss_index_yandex import build_index, load_index, semantic_search, VECTORS_FILE, METADATA_FILE
 from yandex_api import yandex_batch_embeddings
+from quota_scheduler import BULK, priority
 
 logger = logging.getLogger(__name__)
 
@@ -198,6 +199,7 @@ def process_new_files(bucket_name: str, new_files: List[Dict]) -> Tuple[List[np.
 
     return all_vectors, all_docs
 
+@priority(BULK)  # индексация расходует только свободную квоту Yandex API
 def update_rag_incremental(bucket_name: str) -> bool:
     """
     Выполняет инкрементальное обновление RAG индекса
@@ -0,0 +1,314 @@
+# intent_router.py - маршрутизация запросов по намерению (mood / recipe / menu / smalltalk)
+import os
+import json
+import time
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple, TypedDict
+
+import numpy as np
+
+from yandex_api import yandex_batch_embeddings
+from yandex_api_async import yandex_batch_embeddings_async
+from settings import VECTORSTORE_DIR, EMB_MODEL_URI
+from pipeline_metrics import REGISTRY, StageTimer
+
+logger = logging.getLogger(__name__)
+
+INTENT_MOOD = "mood"
+INTENT_RECIPE = "recipe"
+INTENT_MENU = "menu"
+INTENT_SMALLTALK = "smalltalk"
+INTENT_UNKNOWN = "unknown"
+
+# Намерения, для которых нужен поиск по базе (эмбеддинг запроса уже посчитан — поиск почти бесплатный)
+RETRIEVAL_INTENTS = {INTENT_RECIPE, INTENT_MENU}
+
+# Быстрый keyword pre-pass: те же списки, что раньше сканировались в answer_user_query_sync
+MOOD_KEYWORDS = ["настроение", "веселое", "спокойное", "энергичное", "романтичное",
+                 "уверенное", "расслабленное", "грустн", "радост", "злост",
+                 "устал", "стресс", "расслаб", "отдохн", "релакс"]
+MOOD_EMOJIS = ["😊", "😌", "🔥", "💭", "😎", "🌊"]
+
+# Опорные фразы для центроидов намерений
+INTENT_SEEDS: Dict[str, List[str]] = {
+    INTENT_MOOD: [
+        "Хочу что-нибудь под грустное настроение",
+        "Посоветуй напиток, чтобы расслабиться после тяжёлого дня",
+        "Какой коктейль подойдёт для романтического вечера",
+        "У меня отличное настроение, хочется чего-то яркого",
+        "Я устал, нужен напиток чтобы взбодриться",
+        "Что выпить, когда скучно и хочется праздника",
+    ],
+    INTENT_RECIPE: [
+        "Рецепт Маргариты",
+        "Как приготовить мохито",
+        "Коктейли с джином и тоником",
+        "Из чего делают Негрони и в каких пропорциях",
+        "Что можно смешать с водкой и лимоном",
+        "Классические коктейли и их рецепты",
+        "Предложи случайный коктейль",
+    ],
+    INTENT_MENU: [
+        "Что есть в вашем меню",
+        "Сколько стоит коктейль в баре",
+        "Перечисли фирменные напитки",
+        "Есть ли у вас безалкогольные позиции в наличии",
+        "Какой ассортимент виски в баре",
+        "Что написано в документе про коктейльную карту",
+    ],
+    INTENT_SMALLTALK: [
+        "Привет, как дела?",
+        "Спасибо, было вкусно",
+        "Кто ты такой?",
+        "Расскажи анекдот",
+        "Доброй ночи",
+        "Что ты умеешь?",
+    ],
+}
+
+try:
+    INTENT_MIN_SIMILARITY = float(os.getenv("RAG_INTENT_MIN_SIMILARITY", "0.35"))
+except Exception:
+    INTENT_MIN_SIMILARITY = 0.35
+try:
+    INTENT_MIN_CONFIDENCE = float(os.getenv("RAG_INTENT_MIN_CONFIDENCE", "0.45"))
+except Exception:
+    INTENT_MIN_CONFIDENCE = 0.45
+# Температура softmax по косинусным близостям (меньше — резче)
+try:
+    INTENT_SOFTMAX_TEMPERATURE = float(os.getenv("RAG_INTENT_SOFTMAX_TEMPERATURE", "0.05"))
+except Exception:
+    INTENT_SOFTMAX_TEMPERATURE = 0.05
+
+# Эмбеддинги последних запросов: повторный вопрос не платит за вызов эмбеддингов
+try:
+    INTENT_EMBEDDING_CACHE_SIZE = int(os.getenv("RAG_INTENT_EMBEDDING_CACHE_SIZE", "1024"))
+except Exception:
+    INTENT_EMBEDDING_CACHE_SIZE = 1024
+
+CENTROIDS_FILE = os.path.join(VECTORSTORE_DIR, "intent_centroids.npz")
+# Пауза перед повторной попыткой построить центроиды после ошибки эмбеддингов
+_CENTROIDS_RETRY_SECONDS = 60.0
+
+EMBEDDING_CACHE_REQUESTS = REGISTRY.counter(
+    "rag_cache_requests_total", "Обращения к кешам (vectorstore, эмбеддинг запроса из роутера)", ("cache", "result"))
+
+
+class IntentResult(TypedDict):
+    intent: str
+    confidence: float
+    via: str  # "keyword" | "embedding" | "fallback"
+    scores: Dict[str, float]
+
+
+def keyword_prepass(text: str) -> Optional[IntentResult]:
+    """
+    Дешёвая проверка по ключевым словам/эмодзи. Возвращает результат только для однозначных случаев.
+    """
+    raw = text or ""
+    low = raw.lower()
+    if any(k in low for k in MOOD_KEYWORDS) or any(e in raw for e in MOOD_EMOJIS):
+        return {"intent": INTENT_MOOD, "confidence": 1.0, "via": "keyword", "scores": {}}
+    return None
+
+
+class IntentRouter:
+    """
+    Классификатор намерений по близости эмбеддинга запроса к предрасчитанным центроидам.
+    Центроиды строятся один раз из INTENT_SEEDS и кешируются на диске (инвалидация по хешу фраз и модели).
+    Построение (~по вызову эмбеддингов на намерение) идёт в фоновом потоке: пока центроиды не готовы,
+    запросы не ждут, а маршрутизируются keyword pre-pass'ом и ответом персоны (via="fallback").
+    Эмбеддинги запросов кешируются (LRU на embedding_cache_size текстов).
+    """
+
+    def __init__(self, seeds: Dict[str, List[str]], model_uri: Optional[str] = None,
+                 cache_file: Optional[str] = CENTROIDS_FILE,
+                 embedding_cache_size: int = INTENT_EMBEDDING_CACHE_SIZE):
+        self.seeds = seeds
+        self.model_uri = model_uri or EMB_MODEL_URI
+        self.cache_file = cache_file
+        self.embedding_cache_size = max(0, int(embedding_cache_size))
+        self._lock = threading.Lock()
+        self._names: List[str] = []
+        self._centroids: Optional[np.ndarray] = None
+        self._building = False
+        self._last_failure = 0.0
+        self._embeddings: "OrderedDict[str, np.ndarray]" = OrderedDict()
+
+    def _seeds_hash(self) -> str:
+        payload = json.dumps({"model": self.model_uri, "seeds": self.seeds}, ensure_ascii=False, sort_keys=True)
+        return hashlib.md5(payload.encode("utf-8")).hexdigest()
+
+    def _load_cached(self, digest: str) -> bool:
+        if not self.cache_file or not os.path.exists(self.cache_file):
+            return False
+        try:
+            data = np.load(self.cache_file, allow_pickle=False)
+            if str(data["digest"]) != digest:
+                return False
+            self._names = [str(n) for n in data["names"]]
+            self._centroids = data["centroids"].astype(np.float32)
+            logger.info("Intent centroids loaded from %s (%d intents)", self.cache_file, len(self._names))
+            return True
+        except Exception as e:
+            logger.warning("Не удалось загрузить центроиды намерений: %s", e)
+            return False
+
+    def _build(self, digest: str) -> bool:
+        names: List[str] = []
+        rows: List[np.ndarray] = []
+        for name, phrases in self.seeds.items():
+            embs = [e for e in yandex_batch_embeddings(phrases, model_uri=self.model_uri) if e]
+            if not embs:
+                logger.error("Intent router: нет эмбеддингов для намерения %s", name)
+                return False
+            mat = np.array(embs, dtype=np.float32)
+            mat /= np.maximum(np.linalg.norm(mat, axis=1, keepdims=True), 1e-12)
+            centroid = mat.mean(axis=0)
+            centroid /= max(float(np.linalg.norm(centroid)), 1e-12)
+            names.append(name)
+            rows.append(centroid)
+        self._names = names
+        self._centroids = np.vstack(rows).astype(np.float32)
+        if self.cache_file:
+            try:
+                np.savez(self.cache_file, digest=np.array(digest), names=np.array(names),
+                         centroids=self._centroids)
+            except Exception as e:
+                logger.warning("Не удалось сохранить центроиды намерений: %s", e)
+        logger.info("Intent centroids built (%d intents)", len(names))
+        return True
+
+    def _load_or_build(self):
+        ok = False
+        try:
+            digest = self._seeds_hash()
+            ok = self._load_cached(digest) or self._build(digest)
+        except Exception as e:
+            logger.exception("Intent router: ошибка построения центроидов: %s", e)
+        finally:
+            with self._lock:
+                self._building = False
+                if not ok:
+                    self._last_failure = time.time()
+
+    def start_background_build(self) -> bool:
+        """
+        Запускает загрузку/построение центроидов в фоновом потоке (при старте сервиса или после
+        паузы _CENTROIDS_RETRY_SECONDS после ошибки). False — если построение уже идёт или на паузе.
+        """
+        with self._lock:
+            if self._centroids is not None or self._building:
+                return False
+            if time.time() - self._last_failure < _CENTROIDS_RETRY_SECONDS:
+                return False
+            self._building = True
+        threading.Thread(target=self._load_or_build, name="intent-centroids", daemon=True).start()
+        return True
+
+    def ready(self) -> bool:
+        """Готовы ли центроиды. Не блокирует: если их нет — запускает фоновое построение и возвращает False."""
+        if self._centroids is not None:
+            return True
+        self.start_background_build()
+        return False
+
+    def _cached_embedding(self, text: str) -> Optional[np.ndarray]:
+        with self._lock:
+            emb = self._embeddings.get(text)
+            if emb is not None:
+                self._embeddings.move_to_end(text)
+        EMBEDDING_CACHE_REQUESTS.inc(cache="intent_embedding", result="hit" if emb is not None else "miss")
+        return emb
+
+    def _remember_embedding(self, text: str, emb_list: List[List[float]]) -> Optional[np.ndarray]:
+        if not emb_list or not emb_list[0]:
+            logger.warning("Intent router: пустой эмбеддинг запроса — используем keyword-решение")
+            return None
+        q_emb = np.array(emb_list[0], dtype=np.float32)
+        if self.embedding_cache_size:
+            with self._lock:
+                self._embeddings[text] = q_emb
+                self._embeddings.move_to_end(text)
+                while len(self._embeddings) > self.embedding_cache_size:
+                    self._embeddings.popitem(last=False)
+        return q_emb
+
+    def classify_embedding(self, embedding: np.ndarray) -> IntentResult:
+        """Классифицирует нормированный эмбеддинг запроса по центроидам"""
+        if not self.ready() or self._centroids is None:
+            return {"intent": INTENT_UNKNOWN, "confidence": 0.0, "via": "fallback", "scores": {}}
+        q = np.asarray(embedding, dtype=np.float32).reshape(-1)
+        if q.shape[0] != self._centroids.shape[1]:
+            logger.error("Intent router: размерность эмбеддинга %s != %s", q.shape[0], self._centroids.shape[1])
+            return {"intent": INTENT_UNKNOWN, "confidence": 0.0, "via": "fallback", "scores": {}}
+        norm = float(np.linalg.norm(q))
+        if norm == 0:
+            return {"intent": INTENT_UNKNOWN, "confidence": 0.0, "via": "fallback", "scores": {}}
+        sims = self._centroids @ (q / norm)
+        logits = (sims - sims.max()) / max(INTENT_SOFTMAX_TEMPERATURE, 1e-6)
+        probs = np.exp(logits)
+        probs /= probs.sum()
+        top = int(np.argmax(sims))
+        scores = {n: round(float(s), 4) for n, s in zip(self._names, sims)}
+        confidence = float(probs[top])
+        if float(sims[top]) < INTENT_MIN_SIMILARITY or confidence < INTENT_MIN_CONFIDENCE:
+            return {"intent": INTENT_UNKNOWN, "confidence": confidence, "via": "embedding", "scores": scores}
+        return {"intent": self._names[top], "confidence": confidence, "via": "embedding", "scores": scores}
+
+    def route(self, text: str, use_embedding: bool = True,
+              timer: Optional[StageTimer] = None) -> Tuple[IntentResult, Optional[np.ndarray]]:
+        """
+        Возвращает (результат, эмбеддинг запроса или None).
+        Сначала keyword pre-pass; эмбеддинг считается только если pre-pass не дал ответа.
+        Эмбеддинг отдаётся наружу, чтобы переиспользовать его для семантического поиска.
+        timer — StageTimer запроса: время вызова эмбеддинга пишется в этап "embedding".
+        """
+        pre = keyword_prepass(text)
+        if pre is not None or not use_embedding:
+            return pre or {"intent": INTENT_UNKNOWN, "confidence": 0.0, "via": "keyword", "scores": {}}, None
+        if not self.ready():
+            return {"intent": INTENT_UNKNOWN, "confidence": 0.0, "via": "fallback", "scores": {}}, None
+
+        q_emb = self._cached_embedding(text)
+        if q_emb is None:
+            if timer is not None:
+                with timer.stage("embedding"):
+                    emb_list = yandex_batch_embeddings([text], model_uri=self.model_uri)
+            else:
+                emb_list = yandex_batch_embeddings([text], model_uri=self.model_uri)
+            q_emb = self._remember_embedding(text, emb_list)
+        if q_emb is None:
+            return {"intent": INTENT_UNKNOWN, "confidence": 0.0, "via": "fallback", "scores": {}}, None
+        return self.classify_embedding(q_emb), q_emb
+
+    async def route_async(self, text: str, use_embedding: bool = True,
+                          timer: Optional[StageTimer] = None) -> Tuple[IntentResult, Optional[np.ndarray]]:
+        """
+        Асинхронный route(): эмбеддинг запроса — через yandex_batch_embeddings_async.
+        ready() не блокирует, поэтому вызывается прямо в event loop.
+        """
+        pre = keyword_prepass(text)
+        if pre is not None or not use_embedding:
+            return pre or {"intent": INTENT_UNKNOWN, "confidence": 0.0, "via": "keyword", "scores": {}}, None
+        if not self.ready():
+            return {"intent": INTENT_UNKNOWN, "confidence": 0.0, "via": "fallback", "scores": {}}, None
+
+        q_emb = self._cached_embedding(text)
+        if q_emb is None:
+            if timer is not None:
+                with timer.stage("embedding"):
+                    emb_list = await yandex_batch_embeddings_async([text], model_uri=self.model_uri)
+            else:
+                emb_list = await yandex_batch_embeddings_async([text], model_uri=self.model_uri)
+            q_emb = self._remember_embedding(text, emb_list)
+        if q_emb is None:
+            return {"intent": INTENT_UNKNOWN, "confidence": 0.0, "via": "fallback", "scores": {}}, None
+        return self.classify_embedding(q_emb), q_emb
+
+
+# Глобальный роутер
+INTENT_ROUTER = IntentRouter(INTENT_SEEDS)
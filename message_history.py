@@ -0,0 +1,285 @@
+# message_history.py - история диалога пользователей: в памяти процесса или в Redis (общая для реплик)
+import os
+import json
+import time
+import logging
+from abc import ABC, abstractmethod
+from collections import deque
+from datetime import datetime
+from typing import Any, Deque, Dict, Iterable, List, Optional, Tuple, Union
+
+from redis_outage import RedisOutageGuard
+from user_state import StripedUserStore, UserRecord
+
+logger = logging.getLogger(__name__)
+
+try:
+    import redis  # type: ignore
+except Exception:
+    redis = None
+
+UserId = Union[str, int]
+# (время, сообщение пользователя, ответ бота)
+HistoryItem = Tuple[datetime, str, str]
+
+
+def _env_float(name: str, default: float) -> float:
+    try:
+        return float(os.getenv(name, str(default)))
+    except Exception:
+        return default
+
+
+MESSAGE_HISTORY_BACKEND = os.getenv("MESSAGE_HISTORY_BACKEND", "memory").lower()
+MESSAGE_HISTORY_MAX = int(_env_float("MESSAGE_HISTORY_MAX", 10))
+MESSAGE_HISTORY_CLEANUP_HOURS = _env_float("MESSAGE_HISTORY_CLEANUP_HOURS", 24)
+MESSAGE_HISTORY_SWEEP_MINUTES = _env_float("MESSAGE_HISTORY_SWEEP_MINUTES", 10)
+MESSAGE_HISTORY_REDIS_URL = os.getenv("MESSAGE_HISTORY_REDIS_URL", os.getenv("REDIS_URL", "redis://redis:6379/0"))
+MESSAGE_HISTORY_KEY_PREFIX = os.getenv("MESSAGE_HISTORY_KEY_PREFIX", "rag:history:")
+# После стольких ошибок Redis подряд история временно берётся только из памяти процесса,
+# а Redis проверяется одним пробным вызовом раз в MESSAGE_HISTORY_REDIS_RETRY_SECONDS
+MESSAGE_HISTORY_REDIS_FAILURES = int(_env_float("MESSAGE_HISTORY_REDIS_FAILURES", 3))
+MESSAGE_HISTORY_REDIS_RETRY_SECONDS = _env_float("MESSAGE_HISTORY_REDIS_RETRY_SECONDS", 30)
+
+
+class HistoryBackend(ABC):
+    """
+    Общий интерфейс хранилищ истории: не больше max_messages последних пар на пользователя,
+    пары старше ttl_seconds не возвращаются и со временем удаляются.
+    """
+
+    name = "base"
+
+    def __init__(self, max_messages: int = MESSAGE_HISTORY_MAX,
+                 ttl_seconds: float = MESSAGE_HISTORY_CLEANUP_HOURS * 3600):
+        self.max_messages = max(1, int(max_messages))
+        self.ttl_seconds = max(1.0, float(ttl_seconds))
+
+    @abstractmethod
+    def add_message(self, user_id: UserId, user_message: str, bot_response: str):
+        ...
+
+    @abstractmethod
+    def get_history(self, user_id: UserId) -> List[HistoryItem]:
+        """Пары от старых к новым"""
+
+    def get_histories(self, user_ids: Iterable[UserId]) -> Dict[UserId, List[HistoryItem]]:
+        return {uid: self.get_history(uid) for uid in user_ids}
+
+    @abstractmethod
+    def clear(self, user_id: UserId):
+        ...
+
+    def cleanup_old_users(self) -> int:
+        """Удаляет пользователей без активности дольше ttl; возвращает число удалённых"""
+        return 0
+
+    def stats(self) -> Dict[str, Any]:
+        return {"backend": self.name, "max_messages": self.max_messages, "ttl_seconds": self.ttl_seconds}
+
+    def close(self):
+        pass
+
+    def get_context_messages(self, user_id: UserId, max_pairs: int = 9) -> List[Dict[str, str]]:
+        """Возвращает историю в формате для передачи в модель"""
+        messages = []
+        # По умолчанию последние 9 пар (оставляем место для текущего сообщения)
+        for _, user_msg, bot_resp in self.get_history(user_id)[-max_pairs:]:
+            messages.append({"role": "user", "text": user_msg})
+            messages.append({"role": "assistant", "text": bot_resp})
+        return messages
+
+
+class _HistoryState(UserRecord):
+    __slots__ = ("items",)
+
+    def __init__(self, max_messages: int):
+        super().__init__()
+        self.items: Deque[HistoryItem] = deque(maxlen=max_messages)
+
+
+class InMemoryHistory(HistoryBackend):
+    """
+    История в памяти процесса: deque(maxlen) на пользователя — добавление O(1) без пересборки списка.
+    Записи лежат в хранилище с блокировками по полосам (user_state.py), так что пользователи
+    не сериализуются на одном lock. Устаревшие пары отбрасываются при чтении, неактивные
+    пользователи удаляются фоновым потоком.
+    """
+
+    name = "memory"
+
+    def __init__(self, max_messages: int = MESSAGE_HISTORY_MAX,
+                 ttl_seconds: float = MESSAGE_HISTORY_CLEANUP_HOURS * 3600,
+                 sweep_interval: float = MESSAGE_HISTORY_SWEEP_MINUTES * 60):
+        super().__init__(max_messages, ttl_seconds)
+        self._store: StripedUserStore[_HistoryState] = StripedUserStore(
+            lambda: _HistoryState(self.max_messages), sweep_interval=sweep_interval, name="history",
+            is_idle=lambda r, now: not r.items or r.items[-1][0].timestamp() <= now - self.ttl_seconds,
+        )
+
+    @property
+    def swept_users(self) -> int:
+        return self._store.evicted
+
+    def add_message(self, user_id: UserId, user_message: str, bot_response: str):
+        """Добавляет новое сообщение в историю пользователя"""
+        item = (datetime.now(), user_message, bot_response)
+        with self._store.locked(user_id) as state:
+            state.items.append(item)
+
+    def get_history(self, user_id: UserId) -> List[HistoryItem]:
+        cutoff = datetime.fromtimestamp(time.time() - self.ttl_seconds)
+        with self._store.locked(user_id, create=False) as state:
+            if state is None:
+                return []
+            items = state.items
+            # Старые пары — в начале deque: отбрасываем их на месте
+            while items and items[0][0] <= cutoff:
+                items.popleft()
+            return list(items)
+
+    def clear(self, user_id: UserId):
+        self._store.pop(user_id)
+
+    def cleanup_old_users(self) -> int:
+        return self._store.sweep()
+
+    def stats(self) -> Dict[str, Any]:
+        return {**super().stats(), "users": len(self._store), "stripes": self._store.stripes,
+                "swept_users": self.swept_users}
+
+    def close(self):
+        self._store.close()
+
+
+class RedisHistory(HistoryBackend):
+    """
+    История в Redis, общая для всех воркеров и реплик RAG.
+    Список на пользователя: LPUSH новой пары + LTRIM до max_messages + EXPIRE ttl — одним
+    конвейером (один round-trip); чтение — LRANGE, для нескольких пользователей тоже конвейером.
+    TTL продлевается при каждой записи, так что неактивные пользователи удаляются самим Redis.
+    При недоступности Redis используется история в памяти процесса (как и в telegram-сервисе);
+    после failure_threshold ошибок подряд Redis не вызывается вовсе (каждый вызов при сбое стоил бы
+    таймаута сокета), а раз в retry_seconds один пробный вызов проверяет, не восстановился ли он.
+    """
+
+    name = "redis"
+
+    def __init__(self, url: str = MESSAGE_HISTORY_REDIS_URL, max_messages: int = MESSAGE_HISTORY_MAX,
+                 ttl_seconds: float = MESSAGE_HISTORY_CLEANUP_HOURS * 3600,
+                 key_prefix: str = MESSAGE_HISTORY_KEY_PREFIX,
+                 fallback: Optional[HistoryBackend] = None,
+                 failure_threshold: int = MESSAGE_HISTORY_REDIS_FAILURES,
+                 retry_seconds: float = MESSAGE_HISTORY_REDIS_RETRY_SECONDS):
+        super().__init__(max_messages, ttl_seconds)
+        if redis is None:
+            raise RuntimeError("redis package is not installed")
+        self.url = url
+        self.key_prefix = key_prefix
+        self._client = redis.Redis.from_url(url, decode_responses=True, socket_timeout=1.0,
+                                            socket_connect_timeout=1.0, health_check_interval=30)
+        self._fallback = fallback or InMemoryHistory(max_messages, ttl_seconds)
+        self._guard = RedisOutageGuard("history", "in-memory fallback", failure_threshold, retry_seconds)
+
+    def _key(self, user_id: UserId) -> str:
+        return f"{self.key_prefix}{user_id}"
+
+    @property
+    def available(self) -> bool:
+        """False — Redis отключён после серии ошибок (ждёт пробного вызова)"""
+        return self._guard.available
+
+    def add_message(self, user_id: UserId, user_message: str, bot_response: str):
+        if not self._guard.allow():
+            self._fallback.add_message(user_id, user_message, bot_response)
+            return
+        item = json.dumps({"ts": time.time(), "u": user_message, "a": bot_response}, ensure_ascii=False)
+        key = self._key(user_id)
+        try:
+            pipe = self._client.pipeline(transaction=False)
+            pipe.lpush(key, item)
+            pipe.ltrim(key, 0, self.max_messages - 1)
+            pipe.expire(key, int(self.ttl_seconds))
+            pipe.execute()
+        except Exception as e:
+            self._guard.record_error("write", e)
+            self._fallback.add_message(user_id, user_message, bot_response)
+            return
+        self._guard.record_ok()
+
+    def _decode(self, raw: List[str]) -> List[HistoryItem]:
+        cutoff = time.time() - self.ttl_seconds
+        items: List[HistoryItem] = []
+        # В списке новые пары первыми — разворачиваем в хронологический порядок
+        for value in reversed(raw or []):
+            try:
+                data = json.loads(value)
+                ts = float(data["ts"])
+            except Exception:
+                continue
+            if ts > cutoff:
+                items.append((datetime.fromtimestamp(ts), data.get("u", ""), data.get("a", "")))
+        return items
+
+    def get_history(self, user_id: UserId) -> List[HistoryItem]:
+        if not self._guard.allow():
+            return self._fallback.get_history(user_id)
+        try:
+            raw = self._client.lrange(self._key(user_id), 0, self.max_messages - 1)
+        except Exception as e:
+            self._guard.record_error("read", e)
+            return self._fallback.get_history(user_id)
+        self._guard.record_ok()
+        return self._decode(raw)
+
+    def get_histories(self, user_ids: Iterable[UserId]) -> Dict[UserId, List[HistoryItem]]:
+        user_ids = list(user_ids)
+        if not self._guard.allow():
+            return self._fallback.get_histories(user_ids)
+        try:
+            pipe = self._client.pipeline(transaction=False)
+            for uid in user_ids:
+                pipe.lrange(self._key(uid), 0, self.max_messages - 1)
+            raws = pipe.execute()
+        except Exception as e:
+            self._guard.record_error("read", e)
+            return self._fallback.get_histories(user_ids)
+        self._guard.record_ok()
+        return {uid: self._decode(raw) for uid, raw in zip(user_ids, raws)}
+
+    def clear(self, user_id: UserId):
+        self._fallback.clear(user_id)
+        if not self._guard.allow():
+            return
+        try:
+            self._client.delete(self._key(user_id))
+        except Exception as e:
+            self._guard.record_error("delete", e)
+            return
+        self._guard.record_ok()
+
+    def cleanup_old_users(self) -> int:
+        # Ключи истекают сами (EXPIRE); чистим только резервную память
+        return self._fallback.cleanup_old_users()
+
+    def stats(self) -> Dict[str, Any]:
+        return {**super().stats(), **self._guard.stats(), "fallback": self._fallback.stats()}
+
+    def close(self):
+        self._fallback.close()
+        try:
+            self._client.close()
+        except Exception:
+            pass
+
+
+def create_history_backend(backend: str = MESSAGE_HISTORY_BACKEND) -> HistoryBackend:
+    """Хранилище по MESSAGE_HISTORY_BACKEND (memory | redis); при ошибке настройки Redis — память"""
+    if backend == "redis":
+        try:
+            return RedisHistory()
+        except Exception as e:
+            logger.warning("Redis message history unavailable (%s) — using in-memory history", e)
+    elif backend != "memory":
+        logger.warning("Unknown MESSAGE_HISTORY_BACKEND=%s — using in-memory history", backend)
+    return InMemoryHistory()
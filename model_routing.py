@@ -0,0 +1,147 @@
+# model_routing.py - выбор модели и лимита токенов по задаче (генерация / модерация / сводка),
+# учёт латентности, токенов и стоимости вызовов по задачам
+import os
+import logging
+from typing import Any, Dict, Optional, Tuple
+
+from settings import FOLDER_ID, TEXT_MODEL_NAME, TEXT_MODEL_VERSION, TEXT_MODEL_URI
+from pipeline_metrics import REGISTRY
+
+logger = logging.getLogger(__name__)
+
+TASK_GENERATION = "generation"
+TASK_MODERATION = "moderation"
+TASK_SUMMARY = "summary"
+
+LITE_MODEL_NAME = os.getenv("YAND_LITE_MODEL_NAME", "yandexgpt-lite")
+LITE_MODEL_VERSION = os.getenv("YAND_LITE_MODEL_VERSION", "latest")
+
+
+def _env_float(name: str, default: float) -> float:
+    try:
+        return float(os.getenv(name, str(default)))
+    except Exception:
+        return default
+
+
+def _model_uri(name: str, version: str) -> Optional[str]:
+    return f"gpt://{FOLDER_ID}/{name}/{version}" if FOLDER_ID else None
+
+
+class TaskProfile:
+    """
+    Настройки модели для задачи. model_name/model_version — модель SDK, rest_model_uri — модель
+    REST fallback (и асинхронного клиента); max_tokens — лимит ответа, если вызывающий не задал свой;
+    price_per_1k — стоимость 1000 токенов (вход + выход) для отчёта о расходах.
+    """
+
+    __slots__ = ("task", "model_name", "model_version", "rest_model_uri", "max_tokens", "price_per_1k")
+
+    def __init__(self, task: str, model_name: str, model_version: str, rest_model_uri: Optional[str],
+                 max_tokens: int, price_per_1k: float):
+        self.task = task
+        self.model_name = model_name
+        self.model_version = model_version
+        self.rest_model_uri = rest_model_uri
+        self.max_tokens = max_tokens
+        self.price_per_1k = price_per_1k
+
+    @property
+    def sdk_model_uri(self) -> Optional[str]:
+        """Та же модель, что у SDK, в виде modelUri для REST"""
+        return _model_uri(self.model_name, self.model_version)
+
+
+def _profile(task: str, model_name: str, model_version: str, rest_model_uri: Optional[str],
+             max_tokens: int, price_per_1k: float) -> TaskProfile:
+    """Профиль задачи с переопределениями из YANDEX_TASK_<TASK>_{MODEL,MODEL_VERSION,MODEL_URI,MAX_TOKENS,PRICE_PER_1K}"""
+    prefix = f"YANDEX_TASK_{task.upper()}_"
+    name = os.getenv(prefix + "MODEL", model_name)
+    version = os.getenv(prefix + "MODEL_VERSION", model_version)
+    # Если модель задачи переопределена, REST по умолчанию идёт в неё же
+    default_uri = rest_model_uri if name == model_name and version == model_version else _model_uri(name, version)
+    return TaskProfile(
+        task=task,
+        model_name=name,
+        model_version=version,
+        rest_model_uri=os.getenv(prefix + "MODEL_URI") or default_uri,
+        max_tokens=max(1, int(_env_float(prefix + "MAX_TOKENS", max_tokens))),
+        price_per_1k=max(0.0, _env_float(prefix + "PRICE_PER_1K", price_per_1k)),
+    )
+
+
+_LITE_URI = _model_uri(LITE_MODEL_NAME, LITE_MODEL_VERSION)
+
+# Цены по умолчанию — ₽ за 1000 токенов синхронного режима (Pro / Lite); уточняются через env
+TASK_PROFILES: Dict[str, TaskProfile] = {
+    # Рецепты и ответы бармена — полная модель, как раньше (SDK: TEXT_MODEL_NAME, REST: TEXT_MODEL_URI)
+    TASK_GENERATION: _profile(TASK_GENERATION, TEXT_MODEL_NAME, TEXT_MODEL_VERSION, TEXT_MODEL_URI, 2000, 1.2),
+    # Ответ одним словом SAFE/UNSAFE
+    TASK_MODERATION: _profile(TASK_MODERATION, LITE_MODEL_NAME, LITE_MODEL_VERSION, _LITE_URI, 8, 0.2),
+    TASK_SUMMARY: _profile(TASK_SUMMARY, LITE_MODEL_NAME, LITE_MODEL_VERSION, _LITE_URI, 256, 0.2),
+}
+
+
+def task_profile(task: Optional[str]) -> TaskProfile:
+    profile = TASK_PROFILES.get(task or TASK_GENERATION)
+    if profile is None:
+        logger.warning("Unknown completion task %r — using %s profile", task, TASK_GENERATION)
+        profile = TASK_PROFILES[TASK_GENERATION]
+    return profile
+
+
+TASK_DURATION = REGISTRY.histogram(
+    "yandex_task_duration_seconds", "Длительность вызова completion по задаче и модели", ["task", "model"],
+    buckets=(0.1, 0.25, 0.5, 1.0, 2.0, 3.0, 5.0, 8.0, 13.0, 20.0, 30.0, 60.0))
+TASK_CALLS = REGISTRY.counter(
+    "yandex_task_calls_total", "Вызовы completion по задаче, модели и результату (ok/error)", ["task", "model", "result"])
+TASK_TOKENS = REGISTRY.counter(
+    "yandex_task_tokens_total", "Токены completion по задаче и модели (input/completion)", ["task", "model", "kind"])
+TASK_COST = REGISTRY.counter(
+    "yandex_task_cost_total", "Оценка стоимости completion по задаче (₽ по price_per_1k)", ["task", "model"])
+
+
+def completion_usage(result: Any) -> Tuple[int, int]:
+    """(входные, выходные) токены из ответа REST ({result: {usage}} или {usage}) или SDK (result.usage)"""
+    usage: Any = None
+    if isinstance(result, dict):
+        usage = (result.get("result") or {}).get("usage") if isinstance(result.get("result"), dict) else None
+        usage = usage or result.get("usage")
+    else:
+        usage = getattr(result, "usage", None)
+    if usage is None:
+        return 0, 0
+
+    def _get(*names: str) -> int:
+        for name in names:
+            value = usage.get(name) if isinstance(usage, dict) else getattr(usage, name, None)
+            if value is not None:
+                try:
+                    return int(value)
+                except (TypeError, ValueError):
+                    return 0
+        return 0
+
+    return _get("inputTextTokens", "input_text_tokens"), _get("completionTokens", "completion_tokens")
+
+
+def record_task_call(profile: TaskProfile, model: str, seconds: float, result: Dict[str, Any]):
+    """Латентность, токены и стоимость вызова; usage берётся из ответа (для SDK — из result["usage"])"""
+    ok = isinstance(result, dict) and not result.get("error")
+    TASK_CALLS.inc(task=profile.task, model=model, result="ok" if ok else "error")
+    TASK_DURATION.observe(seconds, task=profile.task, model=model)
+    if not ok:
+        return
+    input_tokens, output_tokens = completion_usage(result)
+    if input_tokens:
+        TASK_TOKENS.inc(input_tokens, task=profile.task, model=model, kind="input")
+    if output_tokens:
+        TASK_TOKENS.inc(output_tokens, task=profile.task, model=model, kind="completion")
+    if input_tokens or output_tokens:
+        TASK_COST.inc((input_tokens + output_tokens) / 1000.0 * profile.price_per_1k, task=profile.task, model=model)
+
+
+def task_stats() -> Dict[str, Any]:
+    return {task: {"model": f"{p.model_name}/{p.model_version}", "rest_model_uri": p.rest_model_uri,
+                   "max_tokens": p.max_tokens, "price_per_1k": p.price_per_1k}
+            for task, p in TASK_PROFILES.items()}
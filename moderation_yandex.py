@@ -1,8 +1,11 @@
 # moderation_yandex.py
 import logging
 import re
-from typing import Tuple
-from yandex_api import yandex_completion
+from typing import Dict, List, Optional, Tuple
+from yandex_api import is_deadline_exceeded, is_degraded, yandex_completion
+from yandex_api_async import yandex_completion_async
+from quota_scheduler import MODERATION, priority
+from model_routing import TASK_MODERATION
 import json
 
 logger = logging.getLogger(__name__)
@@ -37,6 +40,24 @@ SAFE_BARTENDER_PATTERNS = [
 ]
 SAFE_COMPILED = [re.compile(p, re.IGNORECASE | re.UNICODE) for p in SAFE_BARTENDER_PATTERNS]
 
+# Общая политика LLM-модерации (для одиночных и пакетных проверок)
+MODERATION_POLICY_PROMPT = (
+    "Ты модератор контента для бармен-бота. Определи, безопасно ли содержимое текста. "
+    "РАЗРЕШЕНО: запросы про коктейли, алкогольные и безалкогольные напитки, рецепты, еду, "
+    "развлечения, настроение, обычные вопросы про барное дело, ингредиенты, способы приготовления. "
+    "ЗАПРЕЩЕНО только: наркотики, насилие, самоповреждение, незаконная деятельность, "
+    "экстремистский контент, порнография. "
+    "Для обычных безопасных запросов всегда отвечай SAFE. "
+)
+
+# Ограничение длины одного текста внутри пакетного промпта (ответы бота ~1200 символов)
+BATCH_ITEM_MAX_CHARS = 2000
+# Модерация не выполнена (Yandex API перегружен, открыт circuit breaker, истёк дедлайн): текст
+# блокируется (fail-closed), причина начинается с этого префикса — вызывающие отвечают «повторите позже», а не «запрещено»
+UNAVAILABLE_REASON = "UNAVAILABLE"
+# Строка вердикта в пакетном ответе: "3: UNSAFE", "3. SAFE", "3) SAFE", "[3] SAFE"
+_BATCH_VERDICT_RE = re.compile(r"^\s*\[?(\d+)\]?\s*[\.\):\-—]?\s*(UNSAFE|SAFE)\b", re.IGNORECASE | re.MULTILINE)
+
 def preprocess_bartender_query(user_text: str) -> str:
     """
     Предварительная обработка запроса пользователя для обхода модерации Yandex GPT.
@@ -88,6 +109,58 @@ def quick_check(text: str) -> Tuple[bool, str]:
             return False, f"pattern:{pat.pattern}"
     return True, "pass"
 
+def _moderation_prompt(text: str) -> List[Dict[str, str]]:
+    return [
+        {"role": "system", "text": MODERATION_POLICY_PROMPT + "Верни ровно одно слово: SAFE или UNSAFE."},
+        {"role": "user", "text": f"Проверить текст: \"{text}\". Только одно слово: SAFE или UNSAFE."}
+    ]
+
+
+def moderation_unavailable(reason: str) -> bool:
+    """Текст заблокирован не по содержанию, а потому что модерацию не удалось выполнить"""
+    return isinstance(reason, str) and reason.startswith(UNAVAILABLE_REASON)
+
+
+def _unavailable_verdict(cresp: dict) -> Optional[Tuple[bool, str]]:
+    """
+    Вызов модели отклонён защитой Yandex API (yandex_resilience) или не выполнен из-за истёкшего
+    дедлайна — fail-closed: под нагрузкой, при открытом breaker или нехватке времени модерация
+    не должна пропускать всё подряд.
+    """
+    if is_degraded(cresp):
+        logger.warning("llm moderation unavailable (%s) — blocking text", cresp.get("error"))
+        return False, f"{UNAVAILABLE_REASON}:degraded"
+    if is_deadline_exceeded(cresp):
+        logger.warning("llm moderation skipped: request deadline exceeded — blocking text")
+        return False, f"{UNAVAILABLE_REASON}:deadline_exceeded"
+    return None
+
+
+def _moderation_verdict(cresp: dict) -> Tuple[bool, str]:
+    """
+    Вердикт по ответу модели. Вызов не выполнен (перегрузка API, истёк дедлайн) — блокировка;
+    ошибка самого API или пустой ответ — SAFE (как и раньше)
+    """
+    unavailable = _unavailable_verdict(cresp)
+    if unavailable is not None:
+        return unavailable
+    if cresp.get("error"):
+        logger.warning("llm_moderation_yandex: completion returned error: %s", cresp)
+        return True, "SAFE:completion_error"
+
+    # log raw response for debugging
+    logger.debug("llm_moderation raw json: %s", json.dumps(cresp, ensure_ascii=False))
+
+    txt = extract_text_from_yandex_completion(cresp)
+    # If model returned nothing sensible, treat as SAFE by default (for user queries)
+    if not txt or txt.strip() == "" or txt.strip().lower() == "assistant":
+        logger.info("llm_moderation_yandex: model returned empty text; treating as SAFE")
+        return True, "SAFE:empty"
+
+    label = "SAFE" if "SAFE" in txt.upper() else "UNSAFE"
+    return (label == "SAFE"), label
+
+
 def llm_moderation_yandex(text: str) -> Tuple[bool, str]:
     """
     Всегда возвращает (ok: bool, reason: str) для совместимости с Pydantic-моделью ModerationResponse.
@@ -95,38 +168,89 @@ def llm_moderation_yandex(text: str) -> Tuple[bool, str]:
     """
     try:
         # quick pattern check already handled outside; here only LLM check
+        # Модерация — отдельный класс квоты: не вытесняет генерацию ответов, но важнее индексации
+        with priority(MODERATION):
+            return _moderation_verdict(yandex_completion(_moderation_prompt(text), coalesce=True,
+                                                         task=TASK_MODERATION))
+    except Exception as e:
+        logger.exception("llm_moderation_yandex exception: %s", e)
+        # безопасный fallback — считать текст безопасным, но показать причину в строке
+        return True, f"SAFE:exception:{str(e)[:200]}"
+
+
+async def llm_moderation_yandex_async(text: str) -> Tuple[bool, str]:
+    """Асинхронный вариант llm_moderation_yandex (yandex_completion_async), те же вердикты и fallback"""
+    try:
+        with priority(MODERATION):
+            return _moderation_verdict(await yandex_completion_async(_moderation_prompt(text), coalesce=True,
+                                                                     task=TASK_MODERATION))
+    except Exception as e:
+        logger.exception("llm_moderation_yandex_async exception: %s", e)
+        return True, f"SAFE:exception:{str(e)[:200]}"
+
+def _parse_batch_verdicts(txt: str, n: int) -> Optional[Dict[int, str]]:
+    """
+    Разбирает ответ пакетной модерации вида "1: SAFE\n2: UNSAFE".
+    Возвращает {номер: метка} или None, если не удалось получить вердикт для каждого пункта.
+    """
+    if not txt:
+        return None
+    verdicts: Dict[int, str] = {}
+    for m in _BATCH_VERDICT_RE.finditer(txt):
+        idx = int(m.group(1))
+        if 1 <= idx <= n and idx not in verdicts:
+            verdicts[idx] = m.group(2).upper()
+    if len(verdicts) != n:
+        return None
+    return verdicts
+
+
+def llm_moderation_yandex_batch(texts: List[str]) -> List[Tuple[bool, str]]:
+    """
+    Пакетная LLM-модерация: один вызов yandex_completion на несколько текстов.
+    Тексты нумеруются в одном промпте, модель возвращает по строке "N: SAFE|UNSAFE".
+    Если ответ не удалось разобрать — откатываемся на одиночные вызовы llm_moderation_yandex.
+    Возвращает список (ok, reason) в том же порядке, что и texts.
+    """
+    if not texts:
+        return []
+    if len(texts) == 1:
+        return [llm_moderation_yandex(texts[0])]
+
+    n = len(texts)
+    try:
+        items = []
+        for i, t in enumerate(texts, start=1):
+            item = t if len(t) <= BATCH_ITEM_MAX_CHARS else t[:BATCH_ITEM_MAX_CHARS] + "..."
+            items.append(f"{i}. \"\"\"{item}\"\"\"")
         prompt = [
             {"role": "system", "text": (
-                "Ты модератор контента для бармен-бота. Определи, безопасно ли содержимое текста. "
-                "РАЗРЕШЕНО: запросы про коктейли, алкогольные и безалкогольные напитки, рецепты, еду, "
-                "развлечения, настроение, обычные вопросы про барное дело, ингредиенты, способы приготовления. "
-                "ЗАПРЕЩЕНО только: наркотики, насилие, самоповреждение, незаконная деятельность, "
-                "экстремистский контент, порнография. "
-                "Для обычных безопасных запросов всегда отвечай SAFE. "
-                "Верни ровно одно слово: SAFE или UNSAFE."
+                MODERATION_POLICY_PROMPT +
+                f"Тебе пришлют {n} пронумерованных текстов. Оцени каждый текст независимо. "
+                f"Верни ровно {n} строк в формате \"<номер>: SAFE\" или \"<номер>: UNSAFE\" без пояснений."
             )},
-            {"role": "user", "text": f"Проверить текст: \"{text}\". Только одно слово: SAFE или UNSAFE."}
+            {"role": "user", "text": "Проверить тексты:\n\n" + "\n\n".join(items)}
         ]
-        cresp = yandex_completion(prompt)
+        with priority(MODERATION):
+            cresp = yandex_completion(prompt, max_tokens=max(16, 8 * n), temperature=0.0, coalesce=True,
+                                      task=TASK_MODERATION)
+        unavailable = _unavailable_verdict(cresp)
+        if unavailable is not None:
+            return [unavailable] * n
         if cresp.get("error"):
-            logger.warning("llm_moderation_yandex: completion returned error: %s", cresp)
-            return True, "SAFE:completion_error"
-
-        # log raw response for debugging
-        logger.debug("llm_moderation raw json: %s", json.dumps(cresp, ensure_ascii=False))
+            logger.warning("llm_moderation_yandex_batch: completion returned error: %s", cresp)
+            return [(True, "SAFE:completion_error")] * n
 
         txt = extract_text_from_yandex_completion(cresp)
-        # If model returned nothing sensible, treat as SAFE by default (for user queries)
-        if not txt or txt.strip() == "" or txt.strip().lower() == "assistant":
-            logger.info("llm_moderation_yandex: model returned empty text; treating as SAFE")
-            return True, "SAFE:empty"
+        verdicts = _parse_batch_verdicts(txt, n)
+        if verdicts is None:
+            logger.info("llm_moderation_yandex_batch: failed to parse %d verdicts, falling back to single calls", n)
+            return [llm_moderation_yandex(t) for t in texts]
 
-        label = "SAFE" if "SAFE" in txt.upper() else "UNSAFE"
-        return (label == "SAFE"), label
+        return [(verdicts[i] == "SAFE", verdicts[i]) for i in range(1, n + 1)]
     except Exception as e:
-        logger.exception("llm_moderation_yandex exception: %s", e)
-        # безопасный fallback — считать текст безопасным, но показать причину в строке
-        return True, f"SAFE:exception:{str(e)[:200]}"
+        logger.exception("llm_moderation_yandex_batch exception: %s", e)
+        return [llm_moderation_yandex(t) for t in texts]
 
 def pre_moderate_input(text: str) -> Tuple[bool, str]:
     """
@@ -147,14 +271,45 @@ def pre_moderate_input(text: str) -> Tuple[bool, str]:
         # по безопасности — пусть запрос пройдёт модерацию (можно поменять поведение)
         return True, f"SAFE:exception:{str(e)[:200]}"
 
+async def pre_moderate_input_async(text: str) -> Tuple[bool, str]:
+    """Асинхронный pre_moderate_input: quick_check + llm_moderation_yandex_async"""
+    try:
+        ok, reason = quick_check(text)
+        if not ok:
+            return False, reason
+        ok2, reason2 = await llm_moderation_yandex_async(text)
+        if not isinstance(ok2, bool) or not isinstance(reason2, str):
+            logger.warning("pre_moderate_input_async: llm moderation returned unexpected value: %r, %r", ok2, reason2)
+            return True, "SAFE:fallback"
+        return ok2, reason2
+    except Exception as e:
+        logger.exception("pre_moderate_input_async exception: %s", e)
+        return True, f"SAFE:exception:{str(e)[:200]}"
+
 def post_moderate_output(text: str) -> Tuple[bool, str]:
     """
     Постмодерация текста ответа. Возвращает (ok, reason_str). Если найден запрещённый паттерн — блокируем.
     """
+    ok, reason = quick_check_output(text)
+    if not ok:
+        return False, reason
+    return llm_moderation_yandex(text)
+
+async def post_moderate_output_async(text: str) -> Tuple[bool, str]:
+    """Асинхронный post_moderate_output"""
+    ok, reason = quick_check_output(text)
+    if not ok:
+        return False, reason
+    return await llm_moderation_yandex_async(text)
+
+def quick_check_output(text: str) -> Tuple[bool, str]:
+    """
+    Быстрая проверка ответа бота по запрещённым паттернам (без белого списка и без LLM).
+    """
     for pat in COMPILED:
         if pat.search(text):
             return False, f"post_pattern:{pat.pattern}"
-    return llm_moderation_yandex(text)
+    return True, "pass"
 
 
 def extract_text_from_yandex_completion(resp_json: dict) -> str:
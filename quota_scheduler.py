@@ -0,0 +1,203 @@
+# quota_scheduler.py - общий token bucket квоты Yandex API с классами приоритета:
+# интерактивные запросы > фоновая модерация > массовая индексация (только свободная ёмкость)
+import os
+import time
+import asyncio
+import logging
+import threading
+import contextvars
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, Optional
+
+from pipeline_metrics import REGISTRY
+from request_deadline import remaining as deadline_remaining
+
+logger = logging.getLogger(__name__)
+
+
+def _env_float(name: str, default: float) -> float:
+    try:
+        return float(os.getenv(name, str(default)))
+    except Exception:
+        return default
+
+
+INTERACTIVE, MODERATION, BULK = "interactive", "moderation", "bulk"
+PRIORITIES = (INTERACTIVE, MODERATION, BULK)
+
+YANDEX_QUOTA_SCHEDULER = os.getenv("YANDEX_QUOTA_SCHEDULER", "true").lower() == "true"
+# Квота процесса, запросов в секунду (при нескольких репликах — доля общей квоты облака на реплику)
+YANDEX_QUOTA_RPS = {
+    "embedding": _env_float("YANDEX_QUOTA_EMBEDDING_RPS", 10.0),
+    "completion": _env_float("YANDEX_QUOTA_COMPLETION_RPS", 10.0),
+}
+YANDEX_QUOTA_BURST_SECONDS = _env_float("YANDEX_QUOTA_BURST_SECONDS", 2.0)
+# Доля ёмкости, которую класс не может занять: фоновая модерация оставляет 10% интерактивным,
+# индексация берёт только то, что выше половины ведра (и ждёт, пока ждут более важные запросы)
+QUOTA_RESERVE = {
+    INTERACTIVE: 0.0,
+    MODERATION: _env_float("YANDEX_QUOTA_MODERATION_RESERVE", 0.1),
+    BULK: _env_float("YANDEX_QUOTA_BULK_RESERVE", 0.5),
+}
+# Сколько класс ждёт токен; дольше — интерактивный и модерация идут без токена (квотой займётся
+# circuit breaker / лимит API), индексация ждёт без ограничения (в пределах своего дедлайна)
+QUOTA_MAX_WAIT = {
+    INTERACTIVE: _env_float("YANDEX_QUOTA_INTERACTIVE_MAX_WAIT_SECONDS", 0.5),
+    MODERATION: _env_float("YANDEX_QUOTA_MODERATION_MAX_WAIT_SECONDS", 2.0),
+    BULK: None,
+}
+
+QUOTA_WAIT = REGISTRY.histogram(
+    "yandex_quota_wait_seconds", "Ожидание токена квоты Yandex API по классу приоритета", ["endpoint", "priority"],
+    buckets=(0.001, 0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0))
+QUOTA_WAITING = REGISTRY.gauge(
+    "yandex_quota_waiting", "Вызовы, ожидающие токена квоты", ["endpoint", "priority"])
+QUOTA_OVERDRAFT = REGISTRY.counter(
+    "yandex_quota_overdraft_total", "Вызовы, ушедшие без токена после максимального ожидания", ["endpoint", "priority"])
+
+_priority: contextvars.ContextVar[str] = contextvars.ContextVar("yandex_priority", default=INTERACTIVE)
+
+
+def current_priority() -> str:
+    return _priority.get()
+
+
+@contextmanager
+def priority(cls: str) -> Iterator[None]:
+    """
+    Класс приоритета для вызовов Yandex API внутри блока (и в порождённых задачах/to_thread).
+    Работает и как декоратор: @priority(BULK).
+    """
+    if cls not in PRIORITIES:
+        raise ValueError(f"unknown priority class: {cls}")
+    token = _priority.set(cls)
+    try:
+        yield
+    finally:
+        _priority.reset(token)
+
+
+class QuotaScheduler:
+    """
+    Token bucket на эндпоинт: rate токенов в секунду, ёмкость burst. Класс может взять токен,
+    только если после этого в ведре останется не меньше его резерва (QUOTA_RESERVE * burst),
+    и только если не ждут вызовы более важного класса. Поэтому индексация расходует лишь
+    свободную ёмкость: как только растёт интерактивный трафик, уровень ведра падает ниже
+    резерва индексации, и она сама притормаживает до следующего затишья.
+    """
+
+    def __init__(self, name: str, rate: float, burst_seconds: float = YANDEX_QUOTA_BURST_SECONDS):
+        self.name = name
+        self.rate = max(0.1, float(rate))
+        self.burst = max(1.0, self.rate * max(0.1, float(burst_seconds)))
+        self._tokens = self.burst
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+        self._waiting = {cls: 0 for cls in PRIORITIES}
+        self.granted = {cls: 0 for cls in PRIORITIES}
+        self.overdraft = {cls: 0 for cls in PRIORITIES}
+
+    def _refill(self, now: float):
+        self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def _try_take(self, cls: str) -> float:
+        """0 — токен взят; иначе через сколько секунд пробовать снова"""
+        with self._lock:
+            self._refill(time.monotonic())
+            rank = PRIORITIES.index(cls)
+            if any(self._waiting[c] for c in PRIORITIES[:rank]):
+                return 1.0 / self.rate
+            floor = QUOTA_RESERVE[cls] * self.burst
+            if self._tokens - 1.0 >= floor:
+                self._tokens -= 1.0
+                self.granted[cls] += 1
+                return 0.0
+            return (floor + 1.0 - self._tokens) / self.rate
+
+    def _set_waiting(self, cls: str, delta: int):
+        with self._lock:
+            self._waiting[cls] += delta
+            QUOTA_WAITING.set(self._waiting[cls], endpoint=self.name, priority=cls)
+
+    def _max_wait(self, cls: str) -> Optional[float]:
+        limits = [w for w in (QUOTA_MAX_WAIT[cls], deadline_remaining()) if w is not None]
+        return min(limits) if limits else None
+
+    def _overdraft(self, cls: str):
+        with self._lock:
+            self.overdraft[cls] += 1
+        QUOTA_OVERDRAFT.inc(endpoint=self.name, priority=cls)
+
+    def acquire(self, cls: Optional[str] = None) -> float:
+        """Ждёт токен (блокирует поток); возвращает время ожидания"""
+        cls = cls or current_priority()
+        wait = self._try_take(cls)
+        if wait == 0.0:
+            QUOTA_WAIT.observe(0.0, endpoint=self.name, priority=cls)
+            return 0.0
+        start = time.monotonic()
+        max_wait = self._max_wait(cls)
+        self._set_waiting(cls, 1)
+        try:
+            while wait > 0.0:
+                waited = time.monotonic() - start
+                if max_wait is not None and waited + wait > max_wait:
+                    self._overdraft(cls)
+                    break
+                time.sleep(min(wait, 0.25))
+                wait = self._try_take(cls)
+        finally:
+            self._set_waiting(cls, -1)
+        waited = time.monotonic() - start
+        QUOTA_WAIT.observe(waited, endpoint=self.name, priority=cls)
+        return waited
+
+    async def acquire_async(self, cls: Optional[str] = None) -> float:
+        """Асинхронный acquire(): ожидание не блокирует event loop"""
+        cls = cls or current_priority()
+        wait = self._try_take(cls)
+        if wait == 0.0:
+            QUOTA_WAIT.observe(0.0, endpoint=self.name, priority=cls)
+            return 0.0
+        start = time.monotonic()
+        max_wait = self._max_wait(cls)
+        self._set_waiting(cls, 1)
+        try:
+            while wait > 0.0:
+                waited = time.monotonic() - start
+                if max_wait is not None and waited + wait > max_wait:
+                    self._overdraft(cls)
+                    break
+                await asyncio.sleep(min(wait, 0.25))
+                wait = self._try_take(cls)
+        finally:
+            self._set_waiting(cls, -1)
+        waited = time.monotonic() - start
+        QUOTA_WAIT.observe(waited, endpoint=self.name, priority=cls)
+        return waited
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            self._refill(time.monotonic())
+            return {"rate": self.rate, "burst": round(self.burst, 1), "tokens": round(self._tokens, 2),
+                    "waiting": dict(self._waiting), "granted": dict(self.granted), "overdraft": dict(self.overdraft)}
+
+
+QUOTAS: Dict[str, QuotaScheduler] = {name: QuotaScheduler(name, rps) for name, rps in YANDEX_QUOTA_RPS.items()}
+
+
+def acquire_quota(endpoint: str) -> float:
+    if not YANDEX_QUOTA_SCHEDULER:
+        return 0.0
+    return QUOTAS[endpoint].acquire()
+
+
+async def acquire_quota_async(endpoint: str) -> float:
+    if not YANDEX_QUOTA_SCHEDULER:
+        return 0.0
+    return await QUOTAS[endpoint].acquire_async()
+
+
+def quota_stats() -> Dict[str, Any]:
+    return {name: q.stats() for name, q in QUOTAS.items()}
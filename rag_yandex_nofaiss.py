@@ -1,23 +1,34 @@
 # rag_yandex_nofaiss.py
 import os
-import json
 import time
 import pickle
 import logging
-import numpy as np
 import asyncio
-from typing import List, Dict, Tuple, Optional, Deque, TypedDict, Union, Any, cast
+import numpy as np
+import contextvars
+from typing import List, Dict, Tuple, Optional, Any
 import boto3
 import fitz
 from faiss_index_yandex import build_index, load_index, semantic_search, VECTORS_FILE, METADATA_FILE
 from yandex_api import yandex_batch_embeddings, yandex_completion
-from moderation_yandex import pre_moderate_input, post_moderate_output, extract_text_from_yandex_completion
+from yandex_api_async import yandex_batch_embeddings_async, yandex_completion_async
+from moderation_yandex import (pre_moderate_input, post_moderate_output, extract_text_from_yandex_completion,
+                               pre_moderate_input_async, post_moderate_output_async, moderation_unavailable)
 from settings import VECTORSTORE_DIR, S3_ENDPOINT, S3_ACCESS_KEY, S3_SECRET_KEY
-
-# --- new imports for rate limiting ---
-from collections import deque
-import threading
-from datetime import datetime, timedelta
+from generation_orchestrator import (GENERATION_ORCHESTRATOR, GENERATION_BUDGET_SECONDS, GenerationStep,
+                                     AsyncGenerationStep)
+import request_deadline
+import tracing
+from intent_router import INTENT_ROUTER, INTENT_MOOD, INTENT_SMALLTALK, INTENT_UNKNOWN, RETRIEVAL_INTENTS
+from pipeline_metrics import REGISTRY, StageTimer
+from audit_writer import AuditWriter
+from message_history import create_history_backend
+from conversation_context import ContextBuilder, CONTEXT_SUMMARY_MAX_TOKENS
+from rate_limiter import create_rate_limiter
+from bounded_executor import BoundedExecutor, InflightLimiter
+from yandex_resilience import GUARDS as YANDEX_GUARDS
+from quota_scheduler import BULK, priority
+from model_routing import TASK_SUMMARY
 
 logger = logging.getLogger(__name__)
 logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
@@ -38,75 +49,6 @@ SYSTEM_PROMPT_BARTENDER = (
         "- Структурируй ответ четко и читаемо"
     )
 
-# --- Rate limiter implementation (per-user) ---
-class _RLState(TypedDict):
-    hits: Deque[float]
-    cooldown_until: float
-
-
-class RateLimiter:
-    """
-    Простой пер-пользовательский лимитер: не более N запросов за окно WINDOW секунд.
-    При превышении выставляет кулдаун на COOLDOWN секунд.
-
-    Конфиг через переменные окружения:
-      - RAG_RATE_LIMIT_RPM (int, по умолчанию 10)
-      - RAG_RATE_LIMIT_WINDOW_SECONDS (int, по умолчанию 60)
-      - RAG_RATE_LIMIT_COOLDOWN_SECONDS (int, по умолчанию 15)
-    """
-
-    def __init__(self, rpm: int = 10, window_seconds: int = 60, cooldown_seconds: int = 15):
-        self.rpm = max(1, int(rpm))
-        self.window = max(1, int(window_seconds))
-        self.cooldown = max(1, int(cooldown_seconds))
-        self._lock = threading.Lock()
-        # per-user state: { user_id: {"hits": deque[timestamps], "cooldown_until": float } }
-        self._state: Dict[Union[str, int], _RLState] = {}
-
-    def _now(self) -> float:
-        return time.time()
-
-    def is_allowed(self, user_id: int | str) -> Tuple[bool, float, str]:
-        """
-        Возвращает (allowed, wait_seconds, reason).
-        - allowed: можно ли пропускать запрос сейчас
-        - wait_seconds: сколько подождать до следующей попытки (округлено вверх)
-        - reason: причина блокировки ("cooldown" или "rate_limit") или "ok"
-        """
-        now = self._now()
-        with self._lock:
-            st = self._state.get(user_id)
-            if st is None:
-                st = cast(_RLState, {"hits": deque(), "cooldown_until": 0.0})
-                self._state[user_id] = st
-            hits: Deque[float] = st["hits"]
-            cooldown_until: float = st.get("cooldown_until", 0.0)
-
-            # Проверка кулдауна
-            if now < cooldown_until:
-                wait = max(0.0, cooldown_until - now)
-                return False, wait, "cooldown"
-
-            # Очистка старых хитов
-            window_start = now - self.window
-            while hits and hits[0] < window_start:
-                hits.popleft()
-
-            if len(hits) < self.rpm:
-                hits.append(now)
-                st["hits"] = hits
-                return True, 0.0, "ok"
-
-            # Превышение лимита — ставим кулдаун
-            st["cooldown_until"] = now + self.cooldown
-            # Подсчёт времени до следующего окна (для информирования)
-            next_allowed_in = min(
-                max(0.0, st["cooldown_until"] - now),
-                max(0.0, (hits[0] + self.window) - now)
-            )
-            return False, next_allowed_in, "rate_limit"
-
-
 # Создаём глобальный лимитер с конфигом из ENV
 try:
     _RPM = int(os.getenv("RAG_RATE_LIMIT_RPM", "10"))
@@ -121,13 +63,25 @@ try:
 except Exception:
     _CD = 15
 
-RATE_LIMITER = RateLimiter(rpm=_RPM, window_seconds=_WIN, cooldown_seconds=_CD)
+# GCRA: RAG_RATE_LIMIT_BACKEND=redis — общий лимит для всех реплик, memory — в пределах процесса
+RATE_LIMITER = create_rate_limiter(rpm=_RPM, window_seconds=_WIN, cooldown_seconds=_CD)
 
 # Режим использования RAG: "auto" | "always" | "never"
 _RETRIEVAL_MODE = os.getenv("RAG_RETRIEVAL_MODE", "auto").strip().lower()
 if _RETRIEVAL_MODE not in {"auto", "always", "never"}:
     _RETRIEVAL_MODE = "auto"
 
+# Запас времени под пост-модерацию при расчёте бюджета генерации
+try:
+    _POST_MODERATION_RESERVE_SECONDS = float(os.getenv("RAG_POST_MODERATION_RESERVE_SECONDS", "3"))
+except Exception:
+    _POST_MODERATION_RESERVE_SECONDS = 3.0
+
+# Маршрутизация намерений: "embedding" (keyword pre-pass + центроиды) | "keyword" (только ключевые слова)
+_INTENT_ROUTER_MODE = os.getenv("RAG_INTENT_ROUTER", "embedding").strip().lower()
+if _INTENT_ROUTER_MODE not in {"embedding", "keyword"}:
+    _INTENT_ROUTER_MODE = "embedding"
+
 
 def download_pdf_bytes(bucket: str, key: str, endpoint: str = S3_ENDPOINT,
                        access_key: Optional[str] = None, secret_key: Optional[str] = None) -> bytes:
@@ -229,6 +183,7 @@ def should_use_retrieval(user_text: str, context_messages: Optional[List[Dict[st
     return False, "default_no_rag"
 
 
+@priority(BULK)  # индексация расходует только свободную квоту Yandex API
 def build_index_from_bucket(bucket: str, prefix: str = "", embedding_model_uri: Optional[str] = None,
                             max_chunk_chars: Optional[int] = None):
     """
@@ -301,6 +256,7 @@ def extract_text_from_pdf(pdf_bytes: bytes) -> str:
     return "\n".join(texts)
 
 
+@priority(BULK)  # индексация расходует только свободную квоту Yandex API
 def build_vectorstore_from_docs(docs: List[Dict], embedding_model_uri: Optional[str] = None):
     """
     Делегируем построение индекса модулю faiss_index_yandex.build_index.
@@ -353,13 +309,15 @@ def load_vectorstore():
     return mat, docs
 
 
-def semantic_search_in_memory(query: str, k: int = 3, embedding_model_uri: Optional[str] = None) -> List[Dict]:
+def semantic_search_in_memory(query: str, k: int = 3, embedding_model_uri: Optional[str] = None,
+                              query_embedding: Optional[List[float]] = None) -> List[Dict]:
     """
     Делегируем поиск faiss_adapter.semantic_search (ожидаем список dict с полем 'score').
     Если адаптер падает — делаем in-memory fallback.
+    query_embedding — уже посчитанный эмбеддинг запроса (например, из intent router).
     """
     try:
-        results = semantic_search(query, k=k, model_uri=embedding_model_uri)
+        results = semantic_search(query, k=k, model_uri=embedding_model_uri, query_embedding=query_embedding)
         if isinstance(results, list):
             return results
         logger.warning("faiss_adapter.semantic_search returned unexpected type: %r", type(results))
@@ -367,7 +325,10 @@ def semantic_search_in_memory(query: str, k: int = 3, embedding_model_uri: Optio
         logger.exception("faiss_adapter.semantic_search failed: %s. Falling back to in-memory dot-product search.", e)
 
     mat, docs = load_vectorstore()
-    emb_list = yandex_batch_embeddings([query], model_uri=embedding_model_uri)
+    if query_embedding is not None and len(query_embedding) > 0:
+        emb_list = [list(query_embedding)]
+    else:
+        emb_list = yandex_batch_embeddings([query], model_uri=embedding_model_uri)
     if not emb_list or not emb_list[0]:
         logger.error("semantic_search_in_memory: пустой эмбеддинг запроса; возвращаю []")
         return []
@@ -392,15 +353,15 @@ def semantic_search_in_memory(query: str, k: int = 3, embedding_model_uri: Optio
 
 
 AUDIT_FILE = os.path.join(VECTORSTORE_DIR, "moderation_audit.log")
+# Запись на диск — в фоновом потоке пачками, с ротацией и сжатием (см. audit_writer.py)
+AUDIT_WRITER = AuditWriter(AUDIT_FILE)
 
 
 def audit_log(entry: dict):
-    entry_out = {"ts": time.time(), **entry}
-    with open(AUDIT_FILE, "a", encoding="utf-8") as f:
-        f.write(json.dumps(entry_out, ensure_ascii=False) + "\n")
+    AUDIT_WRITER.write({"ts": time.time(), "trace_id": tracing.current_trace_id(), **entry})
 
 
-# --- RAG pipeline: answer_user_query (sync) + async wrapper ---
+# --- RAG pipeline: answer_user_query_sync + answer_user_query_async ---
 def _normalize_bartender_format(text: str, max_len: Optional[int] = None) -> str:
     """Приводит ответ к аккуратному, читабельному виду.
     - убирает лишние пробелы в концах строк
@@ -551,10 +512,8 @@ def generate_mood_based_cocktail(query: str, context: str = "", max_tokens: int
     return _normalize_bartender_format(text, max_len=1200)
 
 
-def generate_mood_based_cocktail_with_history(query: str, context: str = "", context_messages: List[Dict[str, str]] = None, max_tokens: int = 400, temp: float = 0.3) -> str:
-    """
-    Генерирует коктейль на основе настроения пользователя с учетом истории сообщений.
-    """
+def _mood_messages(query: str, context: str = "", context_messages: Optional[List[Dict[str, str]]] = None) -> List[Dict[str, str]]:
+    """Промпт mood-генерации с учётом истории сообщений"""
     if context_messages is None:
         context_messages = []
 
@@ -622,174 +581,550 @@ def generate_mood_based_cocktail_with_history(query: str, context: str = "", con
         f"Подбери идеальный напиток под это настроение и создай подробный рецепт."
     )
     messages.append({"role": "user", "text": user_prompt})
+    return messages
+
+
+def generate_mood_based_cocktail_with_history(query: str, context: str = "", context_messages: List[Dict[str, str]] = None, max_tokens: int = 400, temp: float = 0.3) -> str:
+    """
+    Генерирует коктейль на основе настроения пользователя с учетом истории сообщений.
+    """
+    resp = yandex_completion(_mood_messages(query, context, context_messages), temperature=temp, max_tokens=max_tokens)
+    return _answer_from_completion(resp, "generate_mood_based_cocktail_with_history", max_len=1200)
 
-    resp = yandex_completion(messages, temperature=temp, max_tokens=max_tokens)
 
+def _answer_from_completion(resp: Dict[str, Any], label: str, max_len: Optional[int] = None) -> str:
+    """Нормализованный текст ответа модели или "" при ошибке/пустом ответе"""
     if resp.get("error"):
-        logger.error("generate_mood_based_cocktail_with_history: completion error %s", resp)
+        logger.error("%s: completion error %s", label, resp)
         return ""
-
     text = extract_text_from_yandex_completion(resp)
     if not text:
-        logger.warning("generate_mood_based_cocktail_with_history: empty response")
+        logger.warning("%s: empty response", label)
         return ""
+    return _normalize_bartender_format(text, max_len=max_len)
 
-    return _normalize_bartender_format(text, max_len=1200)
 
+def _completion_to_answer(messages: List[Dict[str, str]], **kwargs) -> str:
+    """Вызывает модель и возвращает нормализованный текст или "" при ошибке/пустом ответе"""
+    return _answer_from_completion(yandex_completion(messages, **kwargs), "completion")
 
-def answer_user_query_sync(user_text: str, user_id: int, k: int = 3) -> Tuple[str, dict]:
-    meta: Dict[str, Any] = {"user_id": user_id, "query": user_text}
 
-    # 0) rate limiting & cooldowns
+async def _completion_to_answer_async(messages: List[Dict[str, str]], label: str = "completion",
+                                      max_len: Optional[int] = None, **kwargs) -> str:
+    """Асинхронный _completion_to_answer (yandex_completion_async)"""
+    return _answer_from_completion(await yandex_completion_async(messages, **kwargs), label, max_len=max_len)
+
+
+def _rag_messages(query: str, context: str, context_messages: List[Dict[str, str]]) -> List[Dict[str, str]]:
+    messages = [{"role": "system", "text": SYSTEM_PROMPT_BARTENDER}]
+    messages.extend(context_messages)
+    context_part = f"\n\nКонтекст документов:\n{context}\n\n" if context else "\n\n"
+    current_prompt = f"{context_part}Вопрос пользователя: {query}\nОтветь как профессиональный бармен: рекомендации, рецепты, советы."
+    messages.append({"role": "user", "text": current_prompt})
+    return messages
+
+
+def _persona_messages(query: str, context_messages: List[Dict[str, str]]) -> List[Dict[str, str]]:
+    messages = [{"role": "system", "text": SYSTEM_PROMPT_BARTENDER}]
+    messages.extend(context_messages)
+    messages.append({"role": "user", "text": query})
+    return messages
+
+
+def generate_rag_answer_with_history(query: str, context: str, context_messages: List[Dict[str, str]]) -> str:
+    """Стандартная RAG-ветка: ответ по найденному контексту с учётом истории"""
+    return _completion_to_answer(_rag_messages(query, context, context_messages))
+
+
+def generate_persona_answer_with_history(query: str, context_messages: List[Dict[str, str]]) -> str:
+    """
+    Общий ответ персоны бармена без контекста документов, но с историей диалога: для small talk
+    это основная стратегия, и без истории бот терял бы нить разговора
+    """
+    return _completion_to_answer(_persona_messages(query, context_messages))
+
+
+def _generation_plan(is_mood_query: bool, has_good_context: bool, is_smalltalk: bool) -> List[str]:
+    """Имена стратегий генерации в порядке приоритета (primary, затем fallback'и)"""
+    if is_mood_query:
+        return ["mood", "compact"]
+    if has_good_context:
+        return ["rag", "compact"]
+    if is_smalltalk:
+        return ["persona"]
+    return ["compact", "persona"]
+
+
+def build_generation_chain(query: str, context: str, context_messages: List[Dict[str, str]],
+                           is_mood_query: bool, has_good_context: bool,
+                           is_smalltalk: bool = False) -> List[GenerationStep]:
+    """
+    Цепочка стратегий генерации в порядке приоритета (primary, затем fallback'и).
+    Каждый шаг возвращает "" при неудаче, чтобы оркестратор перешёл к следующему.
+    """
+    def compact() -> str:
+        text = generate_compact_cocktail_with_history(query, context_messages)
+        return "" if text == _COMPACT_FAILURE_TEXT else text
+
+    steps = {
+        "mood": lambda: generate_mood_based_cocktail_with_history(query, context, context_messages),
+        "rag": lambda: generate_rag_answer_with_history(query, context, context_messages),
+        "compact": compact,
+        "persona": lambda: generate_persona_answer_with_history(query, context_messages),
+    }
+    return [(name, steps[name]) for name in _generation_plan(is_mood_query, has_good_context, is_smalltalk)]
+
+
+def build_generation_chain_async(query: str, context: str, context_messages: List[Dict[str, str]],
+                                 is_mood_query: bool, has_good_context: bool,
+                                 is_smalltalk: bool = False) -> List[AsyncGenerationStep]:
+    """Та же цепочка, что build_generation_chain, из корутин (те же промпты и параметры модели)"""
+    async def mood() -> str:
+        return await _completion_to_answer_async(
+            _mood_messages(query, context, context_messages), label="mood", max_len=1200,
+            temperature=0.3, max_tokens=400)
+
+    async def rag() -> str:
+        return await _completion_to_answer_async(_rag_messages(query, context, context_messages), label="rag")
+
+    async def compact() -> str:
+        return await _completion_to_answer_async(
+            _compact_messages(query, context_messages), label="compact", temperature=0.25, max_tokens=700)
+
+    async def persona() -> str:
+        return await _completion_to_answer_async(_persona_messages(query, context_messages), label="persona")
+
+    steps = {"mood": mood, "rag": rag, "compact": compact, "persona": persona}
+    return [(name, steps[name]) for name in _generation_plan(is_mood_query, has_good_context, is_smalltalk)]
+
+
+# --- Метрики пайплайна (экспортируются через /metrics RAG-сервиса) ---
+STAGE_DURATION = REGISTRY.histogram(
+    "rag_stage_duration_seconds", "Длительность этапа пайплайна ответа", ("stage",))
+REQUEST_DURATION = REGISTRY.histogram(
+    "rag_request_duration_seconds", "Полная длительность пайплайна ответа по исходу", ("outcome",))
+REQUESTS_TOTAL = REGISTRY.counter("rag_requests_total", "Запросы по исходу", ("outcome",))
+GENERATION_ATTEMPTS = REGISTRY.counter(
+    "rag_generation_attempts_total", "Запуски стратегий генерации (primary/fallback/hedge)", ("strategy", "reason"))
+GENERATION_WINNERS = REGISTRY.counter(
+    "rag_generation_winner_total", "Стратегия, давшая ответ (none — цепочка не дала ответа)", ("strategy",))
+INTENT_TOTAL = REGISTRY.counter("rag_intent_total", "Результаты роутера намерений", ("intent", "via"))
+CACHE_REQUESTS = REGISTRY.counter(
+    "rag_cache_requests_total", "Обращения к кешам (vectorstore, эмбеддинг запроса из роутера)", ("cache", "result"))
+
+
+def _finish_request_metrics(timer: StageTimer, meta: Dict[str, Any], outcome: str) -> Dict[str, float]:
+    """Фиксирует тайминги запроса в meta и гистограммах; возвращает timings_ms для аудита"""
+    for stage, seconds in timer.timings.items():
+        STAGE_DURATION.observe(seconds, stage=stage)
+    REQUEST_DURATION.observe(timer.total(), outcome=outcome)
+    REQUESTS_TOTAL.inc(outcome=outcome)
+    timings_ms = timer.as_ms()
+    meta["timings_ms"] = timings_ms
+    return timings_ms
+
+
+def _record_generation_metrics(gen_info: Dict[str, Any]):
+    for attempt in gen_info.get("attempts", []):
+        GENERATION_ATTEMPTS.inc(strategy=attempt.get("name", ""), reason=attempt.get("reason", ""))
+    GENERATION_WINNERS.inc(strategy=gen_info.get("winner") or "none")
+
+
+def _deadline_exceeded_response(user_id: int, user_text: str, meta: Dict[str, Any], stage: str,
+                                timer: StageTimer) -> Tuple[str, dict]:
+    """Вызывающая сторона уже не ждёт ответ — прекращаем работу и не тратим квоту на следующие этапы"""
+    logger.warning("Request deadline exceeded at stage %s (user_id=%s)", stage, user_id)
+    meta["deadline_exceeded"] = {"stage": stage}
+    _finish_request_metrics(timer, meta, "deadline_exceeded")
+    audit_log({"user_id": user_id, "action": "deadline_exceeded", "query": user_text, "meta": meta})
+    return ("Извините, ответ занял слишком много времени. Попробуйте ещё раз.", {"blocked": False, **meta})
+
+
+def _check_rate_limit(user_id: int) -> Tuple[bool, float, str]:
     try:
-        allowed, wait_s, reason = RATE_LIMITER.is_allowed(user_id)
+        return RATE_LIMITER.is_allowed(user_id)
     except Exception as e:
         # не блокируем при внутренней ошибке лимитера
         logger.exception("RateLimiter error: %s", e)
-        allowed, wait_s, reason = True, 0.0, "error"
+        return True, 0.0, "error"
+
+
+def _rate_limited_response(user_id: int, user_text: str, meta: Dict[str, Any], timer: StageTimer,
+                           wait_s: float, reason: str) -> Tuple[str, dict]:
+    wait_sec_int = int(wait_s) if wait_s == int(wait_s) else int(wait_s) + 1
+    msg = (
+        f"Слишком много запросов. Пожалуйста, подождите {wait_sec_int} сек и повторите. "
+        f"(лимит: {_RPM} в {_WIN} сек, кулдаун {_CD} сек)"
+    )
+    meta["rate_limited"] = {"reason": reason, "wait_seconds": wait_sec_int}
+    _finish_request_metrics(timer, meta, "blocked_rate_limit")
+    audit_log({"user_id": user_id, "action": "blocked_rate_limit", "query": user_text, "meta": meta})
+    return msg, {"blocked": True, **meta}
+
+
+def _unpack_pre_moderation(ok_pre_res: Any) -> Tuple[bool, Any]:
+    if not isinstance(ok_pre_res, tuple) or len(ok_pre_res) != 2:
+        logger.warning("pre_moderate_input returned unexpected: %r", ok_pre_res)
+        return True, {"via": "fallback", "reason": "pre_moderation_bad_return"}
+    return ok_pre_res
+
+
+# Модерацию не удалось выполнить (перегрузка Yandex API): текст заблокирован, но не «запрещён»
+_MODERATION_UNAVAILABLE_ANSWER = "Сервис сейчас перегружен. Попробуйте повторить запрос через минуту."
+
 
+def _blocked_pre_response(user_id: int, user_text: str, meta: Dict[str, Any], timer: StageTimer,
+                          pre_meta: Any) -> Tuple[str, dict]:
+    timings_ms = _finish_request_metrics(timer, meta, "blocked_pre")
+    audit_log({"user_id": user_id, "action": "blocked_pre", "query": user_text, "meta": pre_meta,
+               "timings_ms": timings_ms})
+    if moderation_unavailable(pre_meta):
+        return (_MODERATION_UNAVAILABLE_ANSWER, {"blocked": True, "reason": pre_meta})
+    return ("Извините, я не могу помочь с этим запросом.", {"blocked": True, "reason": pre_meta})
+
+
+def _history_context(user_id: int, history, meta: Dict[str, Any]) -> List[Dict[str, str]]:
+    """Последние пары дословно в пределах бюджета токенов, более старые — кешированной сводкой"""
+    context_messages, context_info = CONTEXT_BUILDER.build(user_id, history)
+    meta["history_messages_count"] = context_info["pairs_verbatim"]
+    meta["context"] = context_info
+    return context_messages
+
+
+def _history_failed(meta: Dict[str, Any], e: Exception) -> List[Dict[str, str]]:
+    logger.exception("Failed to get message history: %s", e)
+    meta["history_messages_count"] = 0
+    return []
+
+
+def _intent_fallback() -> Dict[str, Any]:
+    return {"intent": INTENT_UNKNOWN, "confidence": 0.0, "via": "fallback", "scores": {}}
+
+
+def _intent_use_embedding() -> bool:
+    return _INTENT_ROUTER_MODE == "embedding" and _RETRIEVAL_MODE != "never"
+
+
+def start_intent_router() -> bool:
+    """
+    Фоновое построение центроидов роутера намерений при старте сервиса — до этого запросы
+    маршрутизируются keyword pre-pass'ом, а не ждут построения. False — если роутер не используется.
+    """
+    if not _intent_use_embedding():
+        return False
+    return INTENT_ROUTER.start_background_build()
+
+
+def _retrieval_decision(user_text: str, context_messages: List[Dict[str, str]], intent: Dict[str, Any],
+                        meta: Dict[str, Any]) -> Tuple[bool, str]:
+    """Фиксирует намерение в meta/метриках и решает, нужен ли RAG-поиск"""
+    meta["intent"] = intent
+    INTENT_TOTAL.inc(intent=intent["intent"], via=intent["via"])
+    need_rag, rag_reason = should_use_retrieval(user_text, context_messages)
+    if _RETRIEVAL_MODE == "auto" and not need_rag and intent["intent"] in RETRIEVAL_INTENTS:
+        need_rag, rag_reason = True, f"intent_{intent['intent']}"
+    meta["retrieval_decision"] = {"need_rag": need_rag, "reason": rag_reason, "mode": _RETRIEVAL_MODE}
+    return need_rag, rag_reason
+
+
+def _relevant_docs(docs: List[Dict[str, Any]], query_embedding, meta: Dict[str, Any]) -> List[Dict[str, Any]]:
+    meta["retrieved_count"] = len(docs)
+    meta["query_embedding_reused"] = query_embedding is not None
+    CACHE_REQUESTS.inc(cache="query_embedding", result="hit" if query_embedding is not None else "miss")
+    return [d for d in docs if d.get("score", 0) > 0.3]
+
+
+def _context_for_model(relevant_docs: List[Dict[str, Any]]) -> str:
+    context_parts = []
+    for d in relevant_docs:
+        src = d.get("meta", {}).get("source", d.get("id", "unknown"))
+        txt = d.get("text", "")
+        context_parts.append(f"Источник: {src}\n{txt}")
+    return "\n\n---\n\n".join(context_parts)
+
+
+def _generation_budget(is_mood_query: bool, need_rag: bool, has_good_context: bool, rag_reason: str) -> float:
+    if is_mood_query:
+        # Настроенческий ответ без RAG, но можем дать контекст если он уже найден
+        logger.info("Используем mood-генерацию (need_rag=%s, good_ctx=%s)", need_rag, has_good_context)
+    elif not has_good_context:
+        logger.info("RAG пропущен (reason=%s). Отвечаем без контекста.", rag_reason)
+    # Бюджет генерации не больше остатка дедлайна запроса (с запасом на пост-модерацию)
+    gen_budget = GENERATION_BUDGET_SECONDS
+    rem = request_deadline.remaining()
+    if rem is not None:
+        gen_budget = max(0.0, min(gen_budget, rem - _POST_MODERATION_RESERVE_SECONDS))
+    return gen_budget
+
+
+def _generation_failed_answer(meta: Dict[str, Any]) -> str:
+    """
+    Ответ, когда ни одна стратегия генерации не сработала; при открытом circuit breaker или
+    заполненном пуле генерации — деградированный
+    """
+    if YANDEX_GUARDS["completion"].is_open:
+        meta["degraded"] = "circuit_open"
+        return "Сервис генерации сейчас перегружен. Попробуйте повторить запрос через минуту."
+    if (meta.get("generation") or {}).get("rejected"):
+        meta["degraded"] = "generation_overloaded"
+        return "Сервис генерации сейчас перегружен. Попробуйте повторить запрос через минуту."
+    return "Извините, не удалось сформировать ответ."
+
+
+def _blocked_post_response(user_id: int, user_text: str, meta: Dict[str, Any], timer: StageTimer,
+                           answer: str, post_meta: Any) -> Tuple[str, dict]:
+    timings_ms = _finish_request_metrics(timer, meta, "blocked_post")
+    audit_log({"user_id": user_id, "action": "blocked_post", "query": user_text, "raw_answer": (answer or "")[:400],
+               "meta": post_meta, "timings_ms": timings_ms})
+    if moderation_unavailable(post_meta):
+        return (_MODERATION_UNAVAILABLE_ANSWER, {"blocked": True, "reason": post_meta})
+    return ("Извините, я не могу предоставить этот ответ по соображениям безопасности.",
+            {"blocked": True, "reason": post_meta})
+
+
+def _answered_response(user_id: int, user_text: str, meta: Dict[str, Any], timer: StageTimer,
+                       answer: str, docs: List[Dict[str, Any]]) -> Tuple[str, dict]:
+    _finish_request_metrics(timer, meta, "answered")
+    audit_log({"user_id": user_id, "action": "answered", "query": user_text, "retrieved": [d.get("id") for d in docs],
+               "meta": meta})
+    return (answer, {"blocked": False, **meta})
+
+
+def answer_user_query_sync(user_text: str, user_id: int, k: int = 3) -> Tuple[str, dict]:
+    meta: Dict[str, Any] = {"user_id": user_id, "query": user_text}
+    timer = StageTimer(span_prefix="rag")
+
+    # 0) rate limiting & cooldowns
+    with timer.stage("rate_limit"):
+        allowed, wait_s, reason = _check_rate_limit(user_id)
     if not allowed:
-        wait_sec_int = int(wait_s) if wait_s == int(wait_s) else int(wait_s) + 1
-        msg = (
-            f"Слишком много запросов. Пожалуйста, подождите {wait_sec_int} сек и повторите. "
-            f"(лимит: {_RPM} в {_WIN} сек, кулдаун {_CD} сек)"
-        )
-        meta["rate_limited"] = {"reason": reason, "wait_seconds": wait_sec_int}
-        audit_log({"user_id": user_id, "action": "blocked_rate_limit", "query": user_text, "meta": meta})
-        return msg, {"blocked": True, **meta}
+        return _rate_limited_response(user_id, user_text, meta, timer, wait_s, reason)
 
     # 1) pre-moderation
-    try:
-        ok_pre_res = pre_moderate_input(user_text)
-        if not isinstance(ok_pre_res, tuple) or len(ok_pre_res) != 2:
-            logger.warning("pre_moderate_input returned unexpected: %r", ok_pre_res)
-            ok_pre, pre_meta = True, {"via": "fallback", "reason": "pre_moderation_bad_return"}
-        else:
-            ok_pre, pre_meta = ok_pre_res
-    except Exception as e:
-        logger.exception("pre_moderate_input raised: %s", e)
-        ok_pre, pre_meta = True, {"via": "exception", "error": str(e)}
+    with timer.stage("pre_moderation"):
+        try:
+            ok_pre, pre_meta = _unpack_pre_moderation(pre_moderate_input(user_text))
+        except Exception as e:
+            logger.exception("pre_moderate_input raised: %s", e)
+            ok_pre, pre_meta = True, {"via": "exception", "error": str(e)}
 
     meta["pre_moderation"] = pre_meta
     if not ok_pre:
-        audit_log({"user_id": user_id, "action": "blocked_pre", "query": user_text, "meta": pre_meta})
-        return ("Извините, я не могу помочь с этим запросом.", {"blocked": True, "reason": pre_meta})
+        return _blocked_pre_response(user_id, user_text, meta, timer, pre_meta)
+    if request_deadline.expired():
+        return _deadline_exceeded_response(user_id, user_text, meta, "pre_moderation", timer)
 
     # 2) Получаем историю сообщений пользователя для контекста
-    try:
-        context_messages = MESSAGE_HISTORY.get_context_messages(user_id)
-        meta["history_messages_count"] = len(context_messages) // 2  # делим на 2, так как пары user-assistant
-    except Exception as e:
-        logger.exception("Failed to get message history: %s", e)
-        context_messages = []
-        meta["history_messages_count"] = 0
-
-    # 3) Классификация намерения + решение об использовании RAG
-    mood_keywords = ["настроение", "веселое", "спокойное", "энергичное", "романтичное",
-                     "уверенное", "расслабленное", "грустн", "радост", "злост",
-                     "устал", "стресс", "расслаб", "отдохн", "релакс"]
-    is_mood_query = any(keyword in (user_text or "").lower() for keyword in mood_keywords) or \
-                    any(emoji in (user_text or "") for emoji in ["😊", "😌", "🔥", "💭", "😎", "🌊"])
+    with timer.stage("history"):
+        try:
+            context_messages = _history_context(user_id, MESSAGE_HISTORY.get_history(user_id), meta)
+        except Exception as e:
+            context_messages = _history_failed(meta, e)
 
-    need_rag, rag_reason = should_use_retrieval(user_text, context_messages)
-    meta["retrieval_decision"] = {"need_rag": need_rag, "reason": rag_reason, "mode": _RETRIEVAL_MODE}
+    # 3) Классификация намерения (keyword pre-pass + центроиды) + решение об использовании RAG
+    # Этап "intent" включает "embedding" (эмбеддинг запроса считается внутри роутера)
+    query_embedding = None
+    with timer.stage("intent"):
+        try:
+            intent, query_embedding = INTENT_ROUTER.route(user_text, use_embedding=_intent_use_embedding(), timer=timer)
+        except Exception as e:
+            logger.exception("Intent router failed: %s", e)
+            intent = _intent_fallback()
+    is_mood_query = intent["intent"] == INTENT_MOOD
+    is_smalltalk = intent["intent"] == INTENT_SMALLTALK
+    need_rag, rag_reason = _retrieval_decision(user_text, context_messages, intent, meta)
 
     # 4) Опционально: RAG-поиск (только если нужно)
     docs: List[Dict[str, Any]] = []
     relevant_docs: List[Dict[str, Any]] = []
-    has_good_context = False
 
     if need_rag:
-        try:
-            docs = semantic_search_in_memory(user_text, k=k)
-        except Exception as e:
-            logger.exception("semantic_search_in_memory failed: %s", e)
-            docs = []
-        meta["retrieved_count"] = len(docs)
-        relevant_docs = [d for d in docs if d.get("score", 0) > 0.3]
-        has_good_context = len(relevant_docs) > 0
+        with timer.stage("retrieval"):
+            try:
+                docs = semantic_search_in_memory(user_text, k=k, query_embedding=query_embedding)
+            except Exception as e:
+                logger.exception("semantic_search_in_memory failed: %s", e)
+                docs = []
+        relevant_docs = _relevant_docs(docs, query_embedding, meta)
     else:
         meta["retrieval_skipped"] = True
+    has_good_context = len(relevant_docs) > 0
+    if request_deadline.expired():
+        return _deadline_exceeded_response(user_id, user_text, meta, "retrieval", timer)
 
     # 5) Построение контекста для модели (если был найден)
-    context_for_model = ""
-    if has_good_context:
-        context_parts = []
-        for d in relevant_docs:
-            src = d.get("meta", {}).get("source", d.get("id", "unknown"))
-            txt = d.get("text", "")
-            context_parts.append(f"Источник: {src}\n{txt}")
-        context_for_model = "\n\n---\n\n".join(context_parts)
-
-    # 6) Выбор стратегии ответа
-    if is_mood_query:
-        # Настроенческий ответ без RAG, но можем дать контекст если он уже найден
-        logger.info("Используем mood-генерацию (need_rag=%s, good_ctx=%s)", need_rag, has_good_context)
-        answer = generate_mood_based_cocktail_with_history(user_text, context_for_model, context_messages)
-        if not answer:
-            answer = generate_compact_cocktail_with_history(user_text, context_messages)
-        if not answer:
-            answer = "Извините, не удалось сформировать ответ."
+    context_for_model = _context_for_model(relevant_docs) if has_good_context else ""
+
+    # 6) Выбор стратегии ответа: цепочка fallback-генераций с общим дедлайном и хеджированием
+    chain = build_generation_chain(user_text, context_for_model, context_messages,
+                                   is_mood_query=is_mood_query, has_good_context=has_good_context,
+                                   is_smalltalk=is_smalltalk)
+    gen_budget = _generation_budget(is_mood_query, need_rag, has_good_context, rag_reason)
+    with timer.stage("generation"):
+        answer, gen_info = GENERATION_ORCHESTRATOR.run(chain, gen_budget)
+    meta["generation"] = gen_info
+    _record_generation_metrics(gen_info)
+    if not answer and request_deadline.expired():
+        return _deadline_exceeded_response(user_id, user_text, meta, "generation", timer)
+    if not answer:
+        answer = _generation_failed_answer(meta)
+
+    meta["raw_response_preview"] = (answer or "")[:500]
+    meta["used_mood_generation"] = bool(is_mood_query)
+    meta["used_retrieval"] = bool(has_good_context)
+
+    # 7) post moderation
+    with timer.stage("post_moderation"):
+        ok_post, post_meta = post_moderate_output(answer)
+    meta["post_moderation"] = post_meta
+    if not ok_post:
+        return _blocked_post_response(user_id, user_text, meta, timer, answer, post_meta)
+
+    # 8) Сохраняем сообщение в историю
+    with timer.stage("history_save"):
+        try:
+            MESSAGE_HISTORY.add_message(user_id, user_text, answer)
+            logger.debug("Added message to history for user %s", user_id)
+        except Exception as e:
+            logger.exception("Failed to save message to history: %s", e)
+
+    # 9) success
+    return _answered_response(user_id, user_text, meta, timer, answer, docs)
+
+
+async def _store_call(store: Any, fn, *args):
+    """
+    Вызов лимитера/истории из event loop: Redis-бэкенд — в потоке (сетевой round-trip,
+    to_thread копирует контекст), хранилище в памяти процесса — на месте (микросекунды).
+    """
+    if getattr(store, "name", "") == "redis":
+        return await asyncio.to_thread(fn, *args)
+    return fn(*args)
+
+
+async def semantic_search_in_memory_async(query: str, k: int = 3, embedding_model_uri: Optional[str] = None,
+                                          query_embedding: Optional[List[float]] = None) -> List[Dict]:
+    """
+    Асинхронный semantic_search_in_memory: эмбеддинг запроса (если не передан) — через async-клиент,
+    сам поиск (чтение индекса, FAISS/numpy) — в потоке, уже без сетевых ожиданий.
+    """
+    if query_embedding is None or len(query_embedding) == 0:
+        emb_list = await yandex_batch_embeddings_async([query], model_uri=embedding_model_uri)
+        if not emb_list or not emb_list[0]:
+            logger.error("semantic_search_in_memory_async: пустой эмбеддинг запроса; возвращаю []")
+            return []
+        query_embedding = emb_list[0]
+    return await asyncio.to_thread(semantic_search_in_memory, query, k, embedding_model_uri, query_embedding)
+
+
+async def answer_user_query_async(user_text: str, user_id: int, k: int = 3) -> Tuple[str, dict]:
+    """
+    Тот же пайплайн, что answer_user_query_sync (те же решения, meta, метрики и аудит), но на asyncio:
+    вызовы Yandex API — через httpx.AsyncClient, ожидание ответа не занимает поток, поэтому один
+    процесс держит сотни одновременных диалогов. В потоки уходят только короткие блокирующие
+    операции: Redis-лимитер/история и чтение индекса.
+    """
+    meta: Dict[str, Any] = {"user_id": user_id, "query": user_text}
+    timer = StageTimer(span_prefix="rag")
+
+    # 0) rate limiting & cooldowns
+    with timer.stage("rate_limit"):
+        allowed, wait_s, reason = await _store_call(RATE_LIMITER, _check_rate_limit, user_id)
+    if not allowed:
+        return _rate_limited_response(user_id, user_text, meta, timer, wait_s, reason)
+
+    # 1) pre-moderation
+    with timer.stage("pre_moderation"):
+        try:
+            ok_pre, pre_meta = _unpack_pre_moderation(await pre_moderate_input_async(user_text))
+        except Exception as e:
+            logger.exception("pre_moderate_input_async raised: %s", e)
+            ok_pre, pre_meta = True, {"via": "exception", "error": str(e)}
+
+    meta["pre_moderation"] = pre_meta
+    if not ok_pre:
+        return _blocked_pre_response(user_id, user_text, meta, timer, pre_meta)
+    if request_deadline.expired():
+        return _deadline_exceeded_response(user_id, user_text, meta, "pre_moderation", timer)
+
+    # 2) История сообщений пользователя для контекста
+    with timer.stage("history"):
+        try:
+            history = await _store_call(MESSAGE_HISTORY, MESSAGE_HISTORY.get_history, user_id)
+            context_messages = _history_context(user_id, history, meta)
+        except Exception as e:
+            context_messages = _history_failed(meta, e)
+
+    # 3) Намерение + решение об использовании RAG
+    query_embedding = None
+    with timer.stage("intent"):
+        try:
+            intent, query_embedding = await INTENT_ROUTER.route_async(
+                user_text, use_embedding=_intent_use_embedding(), timer=timer)
+        except Exception as e:
+            logger.exception("Intent router failed: %s", e)
+            intent = _intent_fallback()
+    is_mood_query = intent["intent"] == INTENT_MOOD
+    is_smalltalk = intent["intent"] == INTENT_SMALLTALK
+    need_rag, rag_reason = _retrieval_decision(user_text, context_messages, intent, meta)
+
+    # 4) Опционально: RAG-поиск
+    docs: List[Dict[str, Any]] = []
+    relevant_docs: List[Dict[str, Any]] = []
+
+    if need_rag:
+        with timer.stage("retrieval"):
+            try:
+                docs = await semantic_search_in_memory_async(user_text, k=k, query_embedding=query_embedding)
+            except Exception as e:
+                logger.exception("semantic_search_in_memory_async failed: %s", e)
+                docs = []
+        relevant_docs = _relevant_docs(docs, query_embedding, meta)
     else:
-        if has_good_context:
-            # Стандартная RAG-ветка с историей
-            messages = []
-            messages.append({"role": "system", "text": SYSTEM_PROMPT_BARTENDER})
-            messages.extend(context_messages)
-            context_part = f"\n\nКонтекст документов:\n{context_for_model}\n\n" if context_for_model else "\n\n"
-            current_prompt = f"{context_part}Вопрос пользователя: {user_text}\nОтветь как профессиональный бармен: рекомендации, рецепты, советы."
-            messages.append({"role": "user", "text": current_prompt})
-
-            yresp = yandex_completion(messages)
-            answer = "Извините, сейчас модель недоступна."
-            if not yresp.get("error"):
-                raw = extract_text_from_yandex_completion(yresp)
-                if raw:
-                    answer = _normalize_bartender_format(raw)
-                if not answer:
-                    answer = generate_compact_cocktail_with_history(user_text, context_messages)
-                if not answer:
-                    answer = "Извините, не удалось сформировать ответ."
-        else:
-            # Без RAG: короткий рецепт/совет с учётом истории
-            logger.info("RAG пропущен (reason=%s). Отвечаем без контекста.", rag_reason)
-            answer = generate_compact_cocktail_with_history(user_text, context_messages)
-            if not answer:
-                # Фолбэк: общий ответ персоны бармена без контекста
-                messages = [{"role": "system", "text": SYSTEM_PROMPT_BARTENDER},
-                            {"role": "user", "text": user_text}]
-                yresp = yandex_completion(messages)
-                if not yresp.get("error"):
-                    raw = extract_text_from_yandex_completion(yresp)
-                    if raw:
-                        answer = _normalize_bartender_format(raw)
-            if not answer:
-                answer = "Извините, не удалось сформировать ответ."
+        meta["retrieval_skipped"] = True
+    has_good_context = len(relevant_docs) > 0
+    if request_deadline.expired():
+        return _deadline_exceeded_response(user_id, user_text, meta, "retrieval", timer)
+
+    # 5-6) Контекст для модели и цепочка генераций (асинхронный оркестратор отменяет проигравших)
+    context_for_model = _context_for_model(relevant_docs) if has_good_context else ""
+    chain = build_generation_chain_async(user_text, context_for_model, context_messages,
+                                         is_mood_query=is_mood_query, has_good_context=has_good_context,
+                                         is_smalltalk=is_smalltalk)
+    gen_budget = _generation_budget(is_mood_query, need_rag, has_good_context, rag_reason)
+    with timer.stage("generation"):
+        answer, gen_info = await GENERATION_ORCHESTRATOR.run_async(chain, gen_budget)
+    meta["generation"] = gen_info
+    _record_generation_metrics(gen_info)
+    if not answer and request_deadline.expired():
+        return _deadline_exceeded_response(user_id, user_text, meta, "generation", timer)
+    if not answer:
+        answer = _generation_failed_answer(meta)
 
     meta["raw_response_preview"] = (answer or "")[:500]
     meta["used_mood_generation"] = bool(is_mood_query)
     meta["used_retrieval"] = bool(has_good_context)
 
     # 7) post moderation
-    ok_post, post_meta = post_moderate_output(answer)
+    with timer.stage("post_moderation"):
+        ok_post, post_meta = await post_moderate_output_async(answer)
     meta["post_moderation"] = post_meta
     if not ok_post:
-        audit_log({"user_id": user_id, "action": "blocked_post", "query": user_text, "raw_answer": (answer or "")[:400],
-                   "meta": post_meta})
-        return ("Извините, я не могу предоставить этот ответ по соображениям безопасности.",
-                {"blocked": True, "reason": post_meta})
+        return _blocked_post_response(user_id, user_text, meta, timer, answer, post_meta)
 
     # 8) Сохраняем сообщение в историю
-    try:
-        MESSAGE_HISTORY.add_message(user_id, user_text, answer)
-        logger.debug("Added message to history for user %s", user_id)
-    except Exception as e:
-        logger.exception("Failed to save message to history: %s", e)
+    with timer.stage("history_save"):
+        try:
+            await _store_call(MESSAGE_HISTORY, MESSAGE_HISTORY.add_message, user_id, user_text, answer)
+            logger.debug("Added message to history for user %s", user_id)
+        except Exception as e:
+            logger.exception("Failed to save message to history: %s", e)
 
     # 9) success
-    audit_log({"user_id": user_id, "action": "answered", "query": user_text, "retrieved": [d.get("id") for d in docs],
-               "meta": meta})
-    return (answer, {"blocked": False, **meta})
+    return _answered_response(user_id, user_text, meta, timer, answer, docs)
+
+
+_COMPACT_FAILURE_TEXT = "Извините, не удалось сформировать рецепт."
 
 
 def generate_compact_cocktail(query: str, max_tokens: int = 700, temp: float = 0.25) -> str:
@@ -812,18 +1147,15 @@ def generate_compact_cocktail(query: str, max_tokens: int = 700, temp: float = 0
     ], temperature=temp, max_tokens=max_tokens)
     if resp.get("error"):
         logger.error("generate_compact_cocktail: completion error %s", resp)
-        return "Извините, не удалось сформировать рецепт."
+        return _COMPACT_FAILURE_TEXT
     text = extract_text_from_yandex_completion(resp)
     if not text:
-        return "Извините, не удалось сформировать рецепт."
+        return _COMPACT_FAILURE_TEXT
     return _normalize_bartender_format(text)
 
 
-def generate_compact_cocktail_with_history(query: str, context_messages: List[Dict[str, str]] = None, max_tokens: int = 700, temp: float = 0.25) -> str:
-    """
-    Возвращает подробный, красиво оформленный рецепт, учитывая историю сообщений.
-    Формат — как у SYSTEM_PROMPT_BARTENDER.
-    """
+def _compact_messages(query: str, context_messages: Optional[List[Dict[str, str]]] = None) -> List[Dict[str, str]]:
+    """Промпт подробного рецепта с учётом истории сообщений"""
     if context_messages is None:
         context_messages = []
 
@@ -843,27 +1175,57 @@ def generate_compact_cocktail_with_history(query: str, context_messages: List[Di
         f"Запрос пользователя: {query}"
     )
     messages.append({"role": "user", "text": user_prompt})
+    return messages
 
-    resp = yandex_completion(messages, temperature=temp, max_tokens=max_tokens)
-    if resp.get("error"):
-        logger.error("generate_compact_cocktail_with_history: completion error %s", resp)
-        return "Извините, не удалось сформировать рецепт."
-    text = extract_text_from_yandex_completion(resp)
-    if not text:
-        return "Извините, не удалось сформировать рецепт."
-    return _normalize_bartender_format(text)
+
+def generate_compact_cocktail_with_history(query: str, context_messages: List[Dict[str, str]] = None, max_tokens: int = 700, temp: float = 0.25) -> str:
+    """
+    Возвращает подробный, красиво оформленный рецепт, учитывая историю сообщений.
+    Формат — как у SYSTEM_PROMPT_BARTENDER.
+    """
+    resp = yandex_completion(_compact_messages(query, context_messages), temperature=temp, max_tokens=max_tokens)
+    return _answer_from_completion(resp, "generate_compact_cocktail_with_history") or _COMPACT_FAILURE_TEXT
+
+
+# Выделенный пул для пайплайна ответа: не делит потоки с дефолтным executor'ом asyncio,
+# а при заполненной очереди запрос отклоняется сразу (ExecutorOverloaded -> 503 + Retry-After)
+try:
+    _ANSWER_WORKERS = int(os.getenv("RAG_ANSWER_WORKERS", "16"))
+except Exception:
+    _ANSWER_WORKERS = 16
+try:
+    _ANSWER_QUEUE = int(os.getenv("RAG_ANSWER_QUEUE", "32"))
+except Exception:
+    _ANSWER_QUEUE = 32
+
+ANSWER_EXECUTOR = BoundedExecutor("rag_answer", max_workers=_ANSWER_WORKERS, max_queue=_ANSWER_QUEUE)
+
+# RAG_ASYNC_PIPELINE=true — answer_user_query_async в event loop (по умолчанию),
+# false — прежний answer_user_query_sync в ANSWER_EXECUTOR
+RAG_ASYNC_PIPELINE = os.getenv("RAG_ASYNC_PIPELINE", "true").lower() == "true"
+# Потоков асинхронный пайплайн не держит, но число одновременных запросов всё равно ограничено
+try:
+    _ASYNC_MAX_INFLIGHT = int(os.getenv("RAG_ASYNC_MAX_INFLIGHT", "512"))
+except Exception:
+    _ASYNC_MAX_INFLIGHT = 512
+
+ANSWER_INFLIGHT = InflightLimiter("rag_answer_async", max_inflight=_ASYNC_MAX_INFLIGHT)
 
 
 async def async_answer_user_query(user_text: str, user_id: int, k: int = 3) -> Tuple[str, dict]:
     """
-    Async wrapper: выполняет синхронную работу в ThreadPoolExecutor,
-    безопасно вызывается из async handle_message.
+    Точка входа для async-обработчиков: асинхронный пайплайн (RAG_ASYNC_PIPELINE) или синхронный
+    в выделенном ограниченном пуле. При перегрузке в обоих режимах — ExecutorOverloaded.
     """
-    loop = asyncio.get_running_loop()
-    return await loop.run_in_executor(None, answer_user_query_sync, user_text, user_id, k)
+    if RAG_ASYNC_PIPELINE:
+        return await ANSWER_INFLIGHT.run(answer_user_query_async, user_text, user_id, k)
+    # Копируем контекст, чтобы дедлайн запроса был виден в рабочем потоке
+    ctx = contextvars.copy_context()
+    return await ANSWER_EXECUTOR.run(ctx.run, answer_user_query_sync, user_text, user_id, k)
 
 
 # --- Small utility for testing: add docs and build index ---
+@priority(BULK)  # индексация расходует только свободную квоту Yandex API
 def build_index_from_plain_texts(text_docs: List[Tuple[str, str]], embedding_model_uri: Optional[str] = None):
     """
     text_docs: list of (id, text). Stores meta minimal.
@@ -876,67 +1238,30 @@ def build_index_from_plain_texts(text_docs: List[Tuple[str, str]], embedding_mod
 
 
 # --- Message History Storage ---
-class MessageHistory:
-    """Хранилище истории сообщений пользователей с автоочисткой старых записей"""
-
-    def __init__(self, max_messages: int = 10, cleanup_hours: int = 24):
-        self.max_messages = max_messages
-        self.cleanup_hours = cleanup_hours
-        self._lock = threading.Lock()
-        # {user_id: [(timestamp, user_message, bot_response), ...]}
-        self._history: Dict[Union[str, int], List[Tuple[datetime, str, str]]] = {}
-
-    def add_message(self, user_id: Union[str, int], user_message: str, bot_response: str):
-        """Добавляет новое сообщение в историю пользователя"""
-        now = datetime.now()
-        with self._lock:
-            if user_id not in self._history:
-                self._history[user_id] = []
-
-            # Добавляем новое сообщение
-            self._history[user_id].append((now, user_message, bot_response))
-
-            # Оставляем только последние max_messages сообщений
-            if len(self._history[user_id]) > self.max_messages:
-                self._history[user_id] = self._history[user_id][-self.max_messages:]
-
-            # Очищаем старые записи (старше cleanup_hours часов)
-            cutoff_time = now - timedelta(hours=self.cleanup_hours)
-            self._history[user_id] = [
-                (ts, um, br) for ts, um, br in self._history[user_id]
-                if ts > cutoff_time
-            ]
-
-    def get_history(self, user_id: Union[str, int]) -> List[Tuple[datetime, str, str]]:
-        """Возвращает историю сообщений пользователя"""
-        with self._lock:
-            return self._history.get(user_id, []).copy()
-
-    def get_context_messages(self, user_id: Union[str, int]) -> List[Dict[str, str]]:
-        """Возвращает историю в формате для передачи в модель"""
-        history = self.get_history(user_id)
-        messages = []
-
-        for _, user_msg, bot_resp in history[-9:]:  # Берем последние 9 пар (оставляем место для текущего)
-            messages.append({"role": "user", "text": user_msg})
-            messages.append({"role": "assistant", "text": bot_resp})
-
-        return messages
-
-    def cleanup_old_users(self):
-        """Удаляет пользователей без активности более cleanup_hours часов"""
-        cutoff_time = datetime.now() - timedelta(hours=self.cleanup_hours)
-        with self._lock:
-            users_to_remove = []
-            for user_id, history in self._history.items():
-                if not history or (history and history[-1][0] < cutoff_time):
-                    users_to_remove.append(user_id)
-
-            for user_id in users_to_remove:
-                del self._history[user_id]
-
-# Глобальный объект для хранения истории
-MESSAGE_HISTORY = MessageHistory(
-    max_messages=int(os.getenv("MESSAGE_HISTORY_MAX", "10")),
-    cleanup_hours=int(os.getenv("MESSAGE_HISTORY_CLEANUP_HOURS", "24"))
+# Глобальный объект для хранения истории: MESSAGE_HISTORY_BACKEND=memory (процесс) или redis (общая для реплик)
+MESSAGE_HISTORY = create_history_backend()
+
+
+SUMMARY_SYSTEM_PROMPT = (
+    "Ты ведёшь краткие заметки о диалоге бармена с гостем. Обнови сводку: сохрани предпочтения гостя "
+    "(вкусы, крепость, аллергии, настроение), упомянутые напитки и незакрытые вопросы. "
+    "Без приветствий и рецептов целиком, 2-5 предложений, только факты."
 )
+
+
+def summarize_conversation(previous_summary: str, pairs) -> str:
+    """Инкрементальная сводка: предыдущая сводка + пары, выпавшие из окна контекста"""
+    dialog = "\n\n".join(f"Гость: {user_msg[:600]}\nБармен: {bot_resp[:600]}" for _, user_msg, bot_resp in pairs)
+    prompt = (f"Текущая сводка:\n{previous_summary}\n\n" if previous_summary else "") + f"Новые реплики:\n{dialog}"
+    resp = yandex_completion([
+        {"role": "system", "text": SUMMARY_SYSTEM_PROMPT},
+        {"role": "user", "text": prompt},
+    ], temperature=0.1, max_tokens=max(64, CONTEXT_SUMMARY_MAX_TOKENS), task=TASK_SUMMARY)
+    if resp.get("error"):
+        logger.warning("summarize_conversation: completion error %s", resp.get("error"))
+        return ""
+    return extract_text_from_yandex_completion(resp) or ""
+
+
+# Сборщик контекста диалога (бюджет токенов + сводка старых реплик вне критического пути)
+CONTEXT_BUILDER = ContextBuilder(summarizer=summarize_conversation)
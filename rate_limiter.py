@@ -0,0 +1,199 @@
+# rate_limiter.py - пер-пользовательский лимит запросов по GCRA: Redis (общий для реплик) или память процесса
+import os
+import time
+import logging
+from typing import Optional, Tuple, Union
+
+from redis_outage import RedisOutageGuard
+from user_state import StripedUserStore, UserRecord
+
+logger = logging.getLogger(__name__)
+
+try:
+    import redis  # type: ignore
+except Exception:
+    redis = None
+
+UserId = Union[str, int]
+
+
+class _RateState(UserRecord):
+    __slots__ = ("tat",)
+
+    def __init__(self):
+        super().__init__()
+        self.tat: Optional[float] = None  # отрицательное значение — идёт кулдаун
+
+RATE_LIMIT_BACKEND = os.getenv("RAG_RATE_LIMIT_BACKEND", "memory").lower()
+RATE_LIMIT_REDIS_URL = os.getenv("RAG_RATE_LIMIT_REDIS_URL", os.getenv("REDIS_URL", "redis://redis:6379/0"))
+RATE_LIMIT_KEY_PREFIX = os.getenv("RAG_RATE_LIMIT_KEY_PREFIX", "rag:rl:")
+# После стольких ошибок Redis подряд лимиты считаются только в памяти процесса,
+# а Redis проверяется одним пробным вызовом раз в RAG_RATE_LIMIT_REDIS_RETRY_SECONDS
+try:
+    RATE_LIMIT_REDIS_FAILURES = int(os.getenv("RAG_RATE_LIMIT_REDIS_FAILURES", "3"))
+except Exception:
+    RATE_LIMIT_REDIS_FAILURES = 3
+try:
+    RATE_LIMIT_REDIS_RETRY_SECONDS = float(os.getenv("RAG_RATE_LIMIT_REDIS_RETRY_SECONDS", "30"))
+except Exception:
+    RATE_LIMIT_REDIS_RETRY_SECONDS = 30.0
+
+
+class GCRALimiter:
+    """
+    Generic Cell Rate Algorithm: на пользователя хранится одно число — TAT (theoretical arrival time).
+    Интервал между запросами T = window / rpm, допуск всплеска tau = T * (rpm - 1): подряд
+    проходит до rpm запросов, дальше — по одному на T, что эквивалентно «rpm за окно».
+    Запрос допускается, если now >= TAT - tau; тогда TAT = max(TAT, now) + T.
+
+    Кулдаун (как у прежнего лимитера): при превышении TAT сдвигается так, что следующий
+    запрос пройдёт не раньше чем через cooldown секунд. Отказы в это время — reason="cooldown",
+    кулдаун они не продлевают. Признак кулдауна хранится знаком того же числа (-TAT).
+
+    Базовый класс хранит TAT в памяти процесса — в хранилище с блокировками по полосам
+    (user_state.py), истёкшие записи вытесняются фоновым потоком;
+    RedisGCRALimiter выполняет тот же расчёт атомарно Lua-скриптом.
+    """
+
+    name = "memory"
+
+    def __init__(self, rpm: int = 10, window_seconds: float = 60, cooldown_seconds: float = 15):
+        self.rpm = max(1, int(rpm))
+        self.window = max(1.0, float(window_seconds))
+        self.cooldown = max(0.0, float(cooldown_seconds))
+        self.interval = self.window / self.rpm
+        self.tolerance = self.interval * (self.rpm - 1)
+        # TAT в прошлом эквивалентен отсутствию записи — такие записи удаляются
+        self._store: StripedUserStore[_RateState] = StripedUserStore(
+            _RateState, sweep_interval=self.window, name="rate-limiter",
+            is_idle=lambda r, now: r.tat is None or abs(r.tat) <= now,
+        )
+
+    def _now(self) -> float:
+        return time.time()
+
+    def _decide(self, stored: Optional[float], now: float) -> Tuple[bool, float, str, float]:
+        """(allowed, wait_seconds, reason, новое хранимое значение) — тот же расчёт, что в Lua-скрипте"""
+        cooling = stored is not None and stored < 0
+        tat = abs(stored) if stored is not None else now
+        if tat < now:
+            tat = now
+        allow_at = tat - self.tolerance
+        if now >= allow_at:
+            return True, 0.0, "ok", tat + self.interval
+        wait = allow_at - now
+        if cooling:
+            return False, wait, "cooldown", -tat
+        if self.cooldown <= 0:
+            return False, wait, "rate_limit", tat
+        # Превышение лимита — ставим кулдаун
+        tat = max(tat, now + self.cooldown + self.tolerance)
+        return False, tat - self.tolerance - now, "rate_limit", -tat
+
+    def is_allowed(self, user_id: UserId) -> Tuple[bool, float, str]:
+        """
+        Возвращает (allowed, wait_seconds, reason).
+        - allowed: можно ли пропускать запрос сейчас
+        - wait_seconds: сколько подождать до следующей попытки
+        - reason: причина блокировки ("cooldown" или "rate_limit") или "ok"
+        """
+        now = self._now()
+        with self._store.locked(user_id) as state:
+            allowed, wait, reason, state.tat = self._decide(state.tat, now)
+        return allowed, wait, reason
+
+    def tracked_users(self) -> int:
+        return len(self._store)
+
+
+# KEYS[1] — ключ пользователя; ARGV: interval, tolerance, cooldown (секунды).
+# Время берётся с сервера Redis (TIME), чтобы у всех реплик были одни часы.
+# Числа возвращаются строками: Lua-числа в ответе Redis усекаются до целых.
+_GCRA_LUA = """
+local t = redis.call('TIME')
+local now = tonumber(t[1]) + tonumber(t[2]) / 1000000
+local interval = tonumber(ARGV[1])
+local tolerance = tonumber(ARGV[2])
+local cooldown = tonumber(ARGV[3])
+local stored = tonumber(redis.call('GET', KEYS[1]))
+local cooling = stored ~= nil and stored < 0
+local tat = now
+if stored ~= nil then
+  tat = math.abs(stored)
+end
+if tat < now then
+  tat = now
+end
+local allow_at = tat - tolerance
+if now >= allow_at then
+  local new_tat = tat + interval
+  redis.call('SET', KEYS[1], string.format('%.6f', new_tat), 'PX', math.ceil((new_tat - now) * 1000) + 1000)
+  return {1, '0', 'ok'}
+end
+local wait = allow_at - now
+if cooling then
+  return {0, string.format('%.6f', wait), 'cooldown'}
+end
+if cooldown <= 0 then
+  return {0, string.format('%.6f', wait), 'rate_limit'}
+end
+tat = math.max(tat, now + cooldown + tolerance)
+redis.call('SET', KEYS[1], string.format('%.6f', -tat), 'PX', math.ceil((tat - now) * 1000) + 1000)
+return {0, string.format('%.6f', tat - tolerance - now), 'rate_limit'}
+"""
+
+
+class RedisGCRALimiter(GCRALimiter):
+    """
+    GCRA в Redis: один ключ со строкой-TAT и TTL до его истечения на пользователя, решение
+    принимается атомарно Lua-скриптом (EVALSHA) — лимит общий для всех воркеров и реплик.
+    При недоступности Redis решение принимает лимитер в памяти процесса; после серии ошибок
+    подряд Redis не вызывается, пока пробный вызов не покажет, что он восстановился (redis_outage.py).
+    """
+
+    name = "redis"
+
+    def __init__(self, rpm: int = 10, window_seconds: float = 60, cooldown_seconds: float = 15,
+                 url: str = RATE_LIMIT_REDIS_URL, key_prefix: str = RATE_LIMIT_KEY_PREFIX,
+                 failure_threshold: int = RATE_LIMIT_REDIS_FAILURES,
+                 retry_seconds: float = RATE_LIMIT_REDIS_RETRY_SECONDS):
+        super().__init__(rpm, window_seconds, cooldown_seconds)
+        if redis is None:
+            raise RuntimeError("redis package is not installed")
+        self.url = url
+        self.key_prefix = key_prefix
+        self._client = redis.Redis.from_url(url, decode_responses=True, socket_timeout=0.5,
+                                            socket_connect_timeout=0.5, health_check_interval=30)
+        self._script = self._client.register_script(_GCRA_LUA)
+        self._guard = RedisOutageGuard("rate limiter", "in-process limits", failure_threshold, retry_seconds)
+
+    @property
+    def errors(self) -> int:
+        return self._guard.errors
+
+    def is_allowed(self, user_id: UserId) -> Tuple[bool, float, str]:
+        if not self._guard.allow():
+            return super().is_allowed(user_id)
+        try:
+            allowed, wait, reason = self._script(
+                keys=[f"{self.key_prefix}{user_id}"],
+                args=[repr(self.interval), repr(self.tolerance), repr(self.cooldown)],
+            )
+        except Exception as e:
+            self._guard.record_error("eval", e)
+            return super().is_allowed(user_id)
+        self._guard.record_ok()
+        return bool(int(allowed)), float(wait), str(reason)
+
+
+def create_rate_limiter(rpm: int, window_seconds: float, cooldown_seconds: float,
+                        backend: str = RATE_LIMIT_BACKEND) -> GCRALimiter:
+    """Лимитер по RAG_RATE_LIMIT_BACKEND (memory | redis); при ошибке настройки Redis — память"""
+    if backend == "redis":
+        try:
+            return RedisGCRALimiter(rpm, window_seconds, cooldown_seconds)
+        except Exception as e:
+            logger.warning("Redis rate limiter unavailable (%s) — using in-process limits", e)
+    elif backend != "memory":
+        logger.warning("Unknown RAG_RATE_LIMIT_BACKEND=%s — using in-process limits", backend)
+    return GCRALimiter(rpm, window_seconds, cooldown_seconds)
@@ -0,0 +1,72 @@
+# redis_outage.py - отключение Redis после серии ошибок подряд (история диалога, лимитер запросов)
+import time
+import logging
+import threading
+from typing import Any, Dict
+
+logger = logging.getLogger(__name__)
+
+
+class RedisOutageGuard:
+    """
+    Хранилища с резервом в памяти процесса (RedisHistory, RedisGCRALimiter) при сбое Redis всё равно
+    платили бы таймаут сокета на каждом вызове. После failure_threshold ошибок подряд allow()
+    возвращает False — вызывающий сразу идёт в резерв; раз в retry_seconds пропускается один
+    пробный вызов, и первый же успех возвращает Redis в работу.
+    """
+
+    def __init__(self, name: str, fallback: str, failure_threshold: int = 3, retry_seconds: float = 30.0):
+        self.name = name
+        self.fallback = fallback
+        self.failure_threshold = max(1, int(failure_threshold))
+        self.retry_seconds = max(0.0, float(retry_seconds))
+        self._lock = threading.Lock()
+        self._consecutive_failures = 0
+        self._retry_at = 0.0
+        self.errors = 0
+        self.skipped = 0
+        self._last_error_log = 0.0
+
+    @property
+    def available(self) -> bool:
+        """False — Redis отключён после серии ошибок (ждёт пробного вызова)"""
+        return self._consecutive_failures < self.failure_threshold
+
+    def allow(self) -> bool:
+        """Можно ли сейчас обращаться к Redis: да, если он не отключён или пора пробному вызову"""
+        with self._lock:
+            if self._consecutive_failures < self.failure_threshold:
+                return True
+            now = time.monotonic()
+            if now < self._retry_at:
+                self.skipped += 1
+                return False
+            # Одна пробная попытка на интервал: остальные вызовы сразу идут в резерв
+            self._retry_at = now + self.retry_seconds
+            return True
+
+    def record_ok(self):
+        if self._consecutive_failures:
+            with self._lock:
+                if self._consecutive_failures >= self.failure_threshold:
+                    logger.info("Redis %s is available again — leaving %s", self.name, self.fallback)
+                self._consecutive_failures = 0
+
+    def record_error(self, op: str, e: Exception):
+        with self._lock:
+            self.errors += 1
+            self._consecutive_failures += 1
+            if self._consecutive_failures == self.failure_threshold:
+                self._retry_at = time.monotonic() + self.retry_seconds
+                logger.warning("Redis %s disabled for %.0fs after %d consecutive errors (%s: %s) — using %s",
+                               self.name, self.retry_seconds, self._consecutive_failures, op, e, self.fallback)
+                return
+        # Не засоряем лог: одно предупреждение в минуту
+        now = time.monotonic()
+        if now - self._last_error_log > 60.0:
+            self._last_error_log = now
+            logger.warning("Redis %s %s failed (%s) — using %s; errors so far: %d",
+                           self.name, op, e, self.fallback, self.errors)
+
+    def stats(self) -> Dict[str, Any]:
+        return {"errors": self.errors, "available": self.available, "skipped": self.skipped}
@@ -0,0 +1,126 @@
+# request_deadline.py - сквозной дедлайн запроса (Telegram -> Gateway -> RAG/Validation -> Yandex API)
+import os
+import time
+import threading
+import contextvars
+from typing import Dict, Mapping, Optional
+
+# Заголовок несёт ОСТАВШИЙСЯ бюджет в миллисекундах на момент отправки (как grpc-timeout),
+# поэтому не зависит от рассинхронизации часов между контейнерами.
+DEADLINE_HEADER = "X-Deadline-Ms"
+
+# Запас на сетевой хоп: нижестоящий сервис получает чуть меньше, чем осталось у вызывающего
+try:
+    HOP_MARGIN_SECONDS = max(0.0, float(os.getenv("DEADLINE_HOP_MARGIN_MS", "50")) / 1000.0)
+except Exception:
+    HOP_MARGIN_SECONDS = 0.05
+
+# Абсолютный дедлайн текущего запроса по time.monotonic() (None — без ограничения)
+_deadline: contextvars.ContextVar[Optional[float]] = contextvars.ContextVar("request_deadline", default=None)
+# Отмена работы, результат которой больше не ждут (проигравшая хедж-ветка): после set() бюджет считается исчерпанным
+_abandoned: contextvars.ContextVar[Optional[threading.Event]] = contextvars.ContextVar("request_abandoned", default=None)
+
+
+class DeadlineExceeded(Exception):
+    """Бюджет запроса исчерпан — вызывающая сторона уже не ждёт результат"""
+
+
+def set_budget(seconds: Optional[float]) -> contextvars.Token:
+    """Устанавливает дедлайн текущего контекста через `seconds` секунд. Возвращает токен для reset()."""
+    if seconds is None:
+        return _deadline.set(None)
+    return _deadline.set(time.monotonic() + max(0.0, float(seconds)))
+
+
+def reset(token: contextvars.Token):
+    _deadline.reset(token)
+
+
+def set_abandon_event(event: Optional[threading.Event]) -> contextvars.Token:
+    """
+    Связывает текущий контекст с событием отмены: после event.set() remaining() == 0 и expired() == True,
+    поэтому вызовы Yandex API в этом контексте прекращаются на ближайшей проверке дедлайна.
+    """
+    return _abandoned.set(event)
+
+
+def _is_abandoned() -> bool:
+    event = _abandoned.get()
+    return event is not None and event.is_set()
+
+
+def budget_from_headers(headers: Mapping[str, str], default_seconds: Optional[float] = None) -> Optional[float]:
+    """Читает бюджет из заголовка; без заголовка — default_seconds (бюджет «на краю» системы)"""
+    raw = headers.get(DEADLINE_HEADER) or headers.get(DEADLINE_HEADER.lower())
+    if raw:
+        try:
+            return max(0.0, float(raw) / 1000.0)
+        except (TypeError, ValueError):
+            pass
+    return default_seconds
+
+
+def remaining() -> Optional[float]:
+    """Оставшееся время в секундах или None, если дедлайн не задан"""
+    dl = _deadline.get()
+    if _is_abandoned():
+        return 0.0
+    if dl is None:
+        return None
+    return max(0.0, dl - time.monotonic())
+
+
+def expired() -> bool:
+    dl = _deadline.get()
+    return (dl is not None and time.monotonic() >= dl) or _is_abandoned()
+
+
+def check(stage: str = ""):
+    """Бросает DeadlineExceeded, если бюджет исчерпан"""
+    if expired():
+        raise DeadlineExceeded(f"deadline exceeded{' at ' + stage if stage else ''}")
+
+
+def clamp_timeout(timeout: float, floor: float = 0.05) -> float:
+    """Сужает локальный таймаут до оставшегося бюджета (но не ниже floor)"""
+    rem = remaining()
+    if rem is None:
+        return timeout
+    return max(floor, min(float(timeout), rem))
+
+
+def outgoing_headers(timeout: Optional[float] = None) -> Dict[str, str]:
+    """
+    Заголовок для исходящего вызова. Если передан timeout вызова — бюджет не больше него,
+    чтобы нижестоящий сервис не работал дольше, чем мы готовы ждать.
+    """
+    rem = remaining()
+    if timeout is not None:
+        rem = timeout if rem is None else min(rem, timeout)
+    if rem is None:
+        return {}
+    return {DEADLINE_HEADER: str(int(max(0.0, rem - HOP_MARGIN_SECONDS) * 1000))}
+
+
+def install_deadline(app, default_seconds: Optional[float] = None, expired_content: Optional[Dict] = None):
+    """
+    HTTP-middleware сервиса: дедлайн запроса из заголовка вызывающего сервиса, без заголовка —
+    default_seconds (бюджет «на краю» системы, как в gateway). Запрос с уже истёкшим бюджетом
+    не выполняется: сразу 504 с телом expired_content.
+    """
+    from fastapi.responses import JSONResponse  # только в HTTP-сервисах
+
+    content = expired_content or {"detail": "Дедлайн запроса истёк"}
+
+    @app.middleware("http")
+    async def deadline_middleware(request, call_next):
+        budget = budget_from_headers(request.headers, default_seconds)
+        if budget is not None and budget <= 0:
+            return JSONResponse(status_code=504, content=content)
+        token = set_budget(budget)
+        try:
+            return await call_next(request)
+        finally:
+            reset(token)
+
+    return deadline_middleware
@@ -8,17 +8,27 @@ Gateway Service - единый входной бэкенд для всех ми
 import asyncio
 import logging
 import os
+import time
 import traceback
-from typing import List, Dict, Optional
+from collections import deque
+from typing import Any, Deque, List, Dict, Optional
 from datetime import datetime
 
 import httpx
 from fastapi import FastAPI, HTTPException, Body, Query
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, PlainTextResponse
 from pydantic import BaseModel, Field
 import uvicorn
 
+# Общие модули проекта
+import sys
+sys.path.append(os.path.dirname(os.path.dirname(os.path.dirname(__file__))))
+
+import request_deadline
+import tracing
+from pipeline_metrics import REGISTRY, PROMETHEUS_CONTENT_TYPE
+
 # Настройка логирования
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -68,6 +78,43 @@ SERVICES_CONFIG = {
     }
 }
 
+# Бюджет запроса по умолчанию, если вызывающая сторона не прислала дедлайн
+try:
+    GATEWAY_REQUEST_BUDGET_SECONDS = float(os.getenv("GATEWAY_REQUEST_BUDGET_SECONDS", "55"))
+except Exception:
+    GATEWAY_REQUEST_BUDGET_SECONDS = 55.0
+
+# Пулы соединений к сервисам: у каждого сервиса свой пул, health-check и логирование —
+# в отдельных пулах, чтобы не отнимать соединения у пользовательского трафика.
+# Переопределение для конкретного пула: GATEWAY_POOL_<NAME>_MAX_CONNECTIONS (NAME: RAG, HEALTH, ...)
+def _env_float(name: str, default: float) -> float:
+    try:
+        return float(os.getenv(name, str(default)))
+    except Exception:
+        return default
+
+POOL_MAX_CONNECTIONS = int(_env_float("GATEWAY_POOL_MAX_CONNECTIONS", 100))
+POOL_MAX_KEEPALIVE = int(_env_float("GATEWAY_POOL_MAX_KEEPALIVE", 20))
+POOL_KEEPALIVE_EXPIRY = _env_float("GATEWAY_POOL_KEEPALIVE_EXPIRY_SECONDS", 30.0)
+# Сколько ждать свободное соединение из пула; дольше — отвечаем 503, а не копим очередь в клиенте
+POOL_ACQUIRE_TIMEOUT = _env_float("GATEWAY_POOL_ACQUIRE_TIMEOUT_SECONDS", 2.0)
+HEALTH_POOL_MAX_CONNECTIONS = int(_env_float("GATEWAY_POOL_HEALTH_MAX_CONNECTIONS", 10))
+LOGGING_POOL_MAX_CONNECTIONS = int(_env_float("GATEWAY_POOL_LOGGING_MAX_CONNECTIONS", 10))
+
+# Фоновая отправка логов в logging-сервис пачками (не на критическом пути запроса)
+LOG_SHIPPER_QUEUE_SIZE = int(_env_float("GATEWAY_LOG_QUEUE_SIZE", 10000))
+LOG_SHIPPER_BATCH_SIZE = int(_env_float("GATEWAY_LOG_BATCH_SIZE", 200))
+LOG_SHIPPER_FLUSH_INTERVAL = _env_float("GATEWAY_LOG_FLUSH_INTERVAL_MS", 200.0) / 1000.0
+
+# HTTP/2 включается только если установлен пакет h2 (httpx[http2]).
+# httpx согласует HTTP/2 через ALPN, т.е. для https-адресов сервисов; для http:// остаётся HTTP/1.1.
+try:
+    import h2  # noqa: F401
+    _H2_AVAILABLE = True
+except Exception:
+    _H2_AVAILABLE = False
+GATEWAY_HTTP2 = os.getenv("GATEWAY_HTTP2", "true").lower() == "true" and _H2_AVAILABLE
+
 # При необходимости включаем lockbox сервис в маршрутизацию и health-check
 if os.getenv("EXPOSE_LOCKBOX_PROXY", "false").lower() == "true":
     SERVICES_CONFIG["lockbox"] = {
@@ -108,18 +155,92 @@ class SystemHealthResponse(BaseModel):
     services: List[ServiceHealthStatus]
     timestamp: datetime
 
+# ========================
+# Трассировка и дедлайн запроса
+# ========================
+
+tracing.install_tracing(app, "gateway")
+
+# Дедлайн из заголовка клиента (Telegram сервис) или бюджет по умолчанию на краю системы
+request_deadline.install_deadline(app, GATEWAY_REQUEST_BUDGET_SECONDS,
+                                  expired_content={"error": "Дедлайн запроса истёк", "status_code": 504})
+
 # ========================
 # HTTP клиент для сервисов
 # ========================
 
+UPSTREAM_IN_FLIGHT = REGISTRY.gauge("gateway_upstream_in_flight", "Запросы к сервисам в полёте по пулу", ("pool",))
+UPSTREAM_IN_FLIGHT_PEAK = REGISTRY.gauge(
+    "gateway_upstream_in_flight_peak", "Пиковое число запросов в полёте по пулу", ("pool",))
+UPSTREAM_POOL_LIMIT = REGISTRY.gauge("gateway_upstream_pool_max_connections", "Лимит соединений пула", ("pool",))
+UPSTREAM_SATURATED = REGISTRY.counter(
+    "gateway_upstream_pool_saturated_total", "Запросы, заставшие пул заполненным (ждут соединение)", ("pool",))
+UPSTREAM_POOL_TIMEOUTS = REGISTRY.counter(
+    "gateway_upstream_pool_timeouts_total", "Не дождались свободного соединения из пула", ("pool",))
+UPSTREAM_DURATION = REGISTRY.histogram(
+    "gateway_upstream_duration_seconds", "Длительность вызова сервиса", ("service", "pool"))
+
 class ServiceClient:
     def __init__(self):
-        self.client = httpx.AsyncClient()
+        # Клиенты создаются лениво — внутри работающего event loop
+        self._clients: Dict[str, httpx.AsyncClient] = {}
+        self._limits: Dict[str, int] = {}
+        self._in_flight: Dict[str, int] = {}
+        self._peak: Dict[str, int] = {}
+
+    def _pool_max_connections(self, pool: str) -> int:
+        default = {"health": HEALTH_POOL_MAX_CONNECTIONS, "logging": LOGGING_POOL_MAX_CONNECTIONS}.get(
+            pool, POOL_MAX_CONNECTIONS)
+        return max(1, int(_env_float(f"GATEWAY_POOL_{pool.upper()}_MAX_CONNECTIONS", default)))
+
+    def _client(self, pool: str) -> httpx.AsyncClient:
+        client = self._clients.get(pool)
+        if client is None:
+            max_connections = self._pool_max_connections(pool)
+            limits = httpx.Limits(
+                max_connections=max_connections,
+                max_keepalive_connections=min(POOL_MAX_KEEPALIVE, max_connections),
+                keepalive_expiry=POOL_KEEPALIVE_EXPIRY,
+            )
+            client = httpx.AsyncClient(limits=limits, http2=GATEWAY_HTTP2)
+            self._clients[pool] = client
+            self._limits[pool] = max_connections
+            UPSTREAM_POOL_LIMIT.set(max_connections, pool=pool)
+            logger.info(f"Пул соединений {pool}: max_connections={max_connections}, http2={GATEWAY_HTTP2}")
+        return client
+
+    def _acquire(self, pool: str):
+        in_flight = self._in_flight.get(pool, 0)
+        if in_flight >= self._limits.get(pool, POOL_MAX_CONNECTIONS):
+            UPSTREAM_SATURATED.inc(pool=pool)
+        in_flight += 1
+        self._in_flight[pool] = in_flight
+        if in_flight > self._peak.get(pool, 0):
+            self._peak[pool] = in_flight
+            UPSTREAM_IN_FLIGHT_PEAK.set(in_flight, pool=pool)
+        UPSTREAM_IN_FLIGHT.set(in_flight, pool=pool)
+
+    def _release(self, pool: str):
+        in_flight = max(0, self._in_flight.get(pool, 0) - 1)
+        self._in_flight[pool] = in_flight
+        UPSTREAM_IN_FLIGHT.set(in_flight, pool=pool)
+
+    def pool_stats(self) -> Dict[str, Dict[str, int]]:
+        return {pool: {"max_connections": self._limits[pool], "in_flight": self._in_flight.get(pool, 0),
+                       "peak": self._peak.get(pool, 0)} for pool in self._clients}
+
+    async def aclose(self):
+        clients, self._clients = list(self._clients.values()), {}
+        for client in clients:
+            try:
+                await client.aclose()
+            except Exception as e:
+                logger.warning(f"Ошибка закрытия HTTP клиента: {e}")
 
     async def call_service(self, service_name: str, endpoint: str, method: str = "GET",
                           data: Optional[Dict] = None, params: Optional[Dict] = None,
-                          headers: Optional[Dict[str, str]] = None) -> Dict:
-        """Вызов микросервиса"""
+                          headers: Optional[Dict[str, str]] = None, pool: Optional[str] = None) -> Dict:
+        """Вызов микросервиса (pool — имя пула соединений; по умолчанию пул сервиса)"""
         if service_name not in SERVICES_CONFIG:
             raise HTTPException(status_code=500, detail=f"Неизвестный сервис: {service_name}")
 
@@ -129,56 +250,85 @@ class ServiceClient:
         path = str(endpoint).lstrip("/")
         url = f"{base}/{path}"
 
-        try:
-            if method.upper() == "GET":
-                response = await self.client.get(url, params=params, headers=headers, timeout=config["timeout"])
-            elif method.upper() == "POST":
-                response = await self.client.post(url, json=data, params=params, headers=headers, timeout=config["timeout"])
-            elif method.upper() == "PUT":
-                response = await self.client.put(url, json=data, params=params, headers=headers, timeout=config["timeout"])
-            elif method.upper() == "DELETE":
-                response = await self.client.delete(url, params=params, headers=headers, timeout=config["timeout"])
-            else:
-                raise HTTPException(status_code=400, detail=f"Неподдерживаемый HTTP метод: {method}")
-
-            # пробуем распарсить JSON, даже если статус не 2xx
+        # Не вызываем сервис, если вызывающая сторона уже не ждёт ответ
+        if request_deadline.expired():
+            logger.warning(f"Дедлайн запроса истёк до вызова {service_name} {endpoint}")
+            raise HTTPException(status_code=504, detail=f"Дедлайн запроса истёк до вызова {service_name}")
+        timeout = request_deadline.clamp_timeout(config["timeout"])
+        headers = {**(headers or {}), **request_deadline.outgoing_headers(timeout)}
+        pool = pool or service_name
+        client = self._client(pool)
+        # Ожидание соединения из пула ограничено отдельно от таймаута запроса
+        http_timeout = httpx.Timeout(timeout, pool=min(POOL_ACQUIRE_TIMEOUT, timeout))
+
+        # Клиентский спан хопа; traceparent передаёт его как родителя вызываемому сервису
+        with tracing.start_span(f"{service_name} {method.upper()} /{path}", kind="client",
+                                attributes={"peer.service": service_name, "http.method": method.upper()},
+                                require_parent=True) as span:
+            headers.update(tracing.outgoing_headers())
+            self._acquire(pool)
+            started = time.perf_counter()
             try:
-                payload = response.json()
-            except Exception:
-                payload = None
-
-            # Если статус не 2xx — пробрасываем как HTTPException с деталями
-            if response.status_code < 200 or response.status_code >= 300:
-                detail = None
-                if isinstance(payload, dict):
-                    # стандартные поля
-                    detail = payload.get("detail") or payload.get("error") or str(payload)
-                if not detail:
-                    detail = response.text.strip() or f"HTTP {response.status_code}"
-                logger.error(f"{service_name} {endpoint} -> {response.status_code}: {detail}")
-                raise HTTPException(status_code=response.status_code, detail=detail)
-
-            return payload if payload is not None else {}
-
-        except httpx.TimeoutException:
-            logger.error(f"Таймаут при обращении к сервису {service_name}")
-            raise HTTPException(status_code=504, detail=f"Таймаут сервиса {service_name}")
-        except httpx.HTTPError as e:
-            logger.error(f"HTTP ошибка при обращении к сервису {service_name}: {e}")
-            raise HTTPException(status_code=503, detail=f"Сервис {service_name} недоступен")
-        except HTTPException:
-            # уже подготовленный осмысленный HTTPException
-            raise
-        except Exception as e:
-            logger.error(f"Ошибка при обращении к сервису {service_name}: {e}")
-            raise HTTPException(status_code=500, detail=f"Ошибка вызова сервиса {service_name}")
+                if method.upper() == "GET":
+                    response = await client.get(url, params=params, headers=headers, timeout=http_timeout)
+                elif method.upper() == "POST":
+                    response = await client.post(url, json=data, params=params, headers=headers, timeout=http_timeout)
+                elif method.upper() == "PUT":
+                    response = await client.put(url, json=data, params=params, headers=headers, timeout=http_timeout)
+                elif method.upper() == "DELETE":
+                    response = await client.delete(url, params=params, headers=headers, timeout=http_timeout)
+                else:
+                    raise HTTPException(status_code=400, detail=f"Неподдерживаемый HTTP метод: {method}")
+                span.set_attribute("http.status_code", response.status_code)
+
+                # пробуем распарсить JSON, даже если статус не 2xx
+                try:
+                    payload = response.json()
+                except Exception:
+                    payload = None
+
+                # Если статус не 2xx — пробрасываем как HTTPException с деталями
+                if response.status_code < 200 or response.status_code >= 300:
+                    detail = None
+                    if isinstance(payload, dict):
+                        # стандартные поля
+                        detail = payload.get("detail") or payload.get("error") or str(payload)
+                    if not detail:
+                        detail = response.text.strip() or f"HTTP {response.status_code}"
+                    logger.error(f"{service_name} {endpoint} -> {response.status_code}: {detail}")
+                    # Retry-After перегруженного сервиса (429/503) передаём клиенту как есть
+                    retry_after = response.headers.get("Retry-After")
+                    raise HTTPException(status_code=response.status_code, detail=detail,
+                                        headers={"Retry-After": retry_after} if retry_after else None)
+
+                return payload if payload is not None else {}
+
+            except httpx.PoolTimeout:
+                UPSTREAM_POOL_TIMEOUTS.inc(pool=pool)
+                logger.error(f"Пул соединений {pool} исчерпан при обращении к сервису {service_name}")
+                raise HTTPException(status_code=503, detail=f"Gateway перегружен: нет свободных соединений к {service_name}")
+            except httpx.TimeoutException:
+                logger.error(f"Таймаут при обращении к сервису {service_name}")
+                raise HTTPException(status_code=504, detail=f"Таймаут сервиса {service_name}")
+            except httpx.HTTPError as e:
+                logger.error(f"HTTP ошибка при обращении к сервису {service_name}: {e}")
+                raise HTTPException(status_code=503, detail=f"Сервис {service_name} недоступен")
+            except HTTPException:
+                # уже подготовленный осмысленный HTTPException
+                raise
+            except Exception as e:
+                logger.error(f"Ошибка при обращении к сервису {service_name}: {e}")
+                raise HTTPException(status_code=500, detail=f"Ошибка вызова сервиса {service_name}")
+            finally:
+                self._release(pool)
+                UPSTREAM_DURATION.observe(time.perf_counter() - started, service=service_name, pool=pool)
 
     async def check_service_health(self, service_name: str) -> ServiceHealthStatus:
         """Проверка здоровья сервиса"""
         start_time = datetime.now()
 
         try:
-            await self.call_service(service_name, "/health")
+            await self.call_service(service_name, "/health", pool="health")
             response_time = (datetime.now() - start_time).total_seconds()
 
             return ServiceHealthStatus(
@@ -196,21 +346,138 @@ class ServiceClient:
 # Глобальный клиент
 service_client = ServiceClient()
 
-# Безопасное логирование: ошибки логов не должны ломать основной поток
+LOG_SHIPPER_ENQUEUED = REGISTRY.counter("gateway_log_shipper_enqueued_total", "Записи лога, поставленные в очередь")
+LOG_SHIPPER_SENT = REGISTRY.counter("gateway_log_shipper_sent_total", "Записи лога, доставленные в logging-сервис")
+LOG_SHIPPER_DROPPED = REGISTRY.counter(
+    "gateway_log_shipper_dropped_total", "Потерянные записи лога (queue_full — вытеснены старые, send_failed)",
+    ("reason",))
+LOG_SHIPPER_QUEUE_DEPTH = REGISTRY.gauge("gateway_log_shipper_queue_depth", "Записи лога в очереди на отправку")
+
+class LogShipper:
+    """
+    Фоновая отправка логов: safe_log только кладёт запись в ограниченную очередь,
+    фоновая задача отправляет пачки в /log/batch logging-сервиса.
+    При переполнении вытесняются самые старые записи (свежие логи ценнее).
+    Если logging-сервис ещё не умеет /log/batch (404/405) — отправляем по одной записи в /log.
+    """
+
+    def __init__(self, client: ServiceClient, max_queue: int = 10000, batch_size: int = 200,
+                 flush_interval: float = 0.2):
+        self.client = client
+        self.batch_size = max(1, batch_size)
+        self.flush_interval = max(0.01, flush_interval)
+        self._queue: Deque[Dict[str, Any]] = deque(maxlen=max(1, max_queue))
+        self._wakeup: Optional[asyncio.Event] = None
+        self._task: Optional[asyncio.Task] = None
+        self._batch_supported = True
+
+    def start(self):
+        if self._task is None:
+            self._wakeup = asyncio.Event()
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self, timeout: float = 5.0):
+        """Останавливает фоновую задачу и пытается отправить остаток очереди"""
+        task, self._task = self._task, None
+        if task is not None:
+            task.cancel()
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+        try:
+            await asyncio.wait_for(self._flush_all(), timeout=timeout)
+        except asyncio.TimeoutError:
+            logger.warning(f"Не успели отправить {len(self._queue)} записей лога при остановке")
+
+    def enqueue(self, entry: Dict[str, Any]):
+        if len(self._queue) == self._queue.maxlen:
+            LOG_SHIPPER_DROPPED.inc(reason="queue_full")
+        self._queue.append(entry)
+        LOG_SHIPPER_ENQUEUED.inc()
+        LOG_SHIPPER_QUEUE_DEPTH.set(len(self._queue))
+        if self._wakeup is not None and len(self._queue) >= self.batch_size:
+            self._wakeup.set()
+
+    def _take_batch(self) -> List[Dict[str, Any]]:
+        batch = []
+        while self._queue and len(batch) < self.batch_size:
+            batch.append(self._queue.popleft())
+        LOG_SHIPPER_QUEUE_DEPTH.set(len(self._queue))
+        return batch
+
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            await self._flush_all()
+
+    async def _flush_all(self):
+        while self._queue:
+            await self._send(self._take_batch())
+
+    async def _send(self, batch: List[Dict[str, Any]]):
+        if not batch:
+            return
+        if self._batch_supported:
+            try:
+                await self.client.call_service("logging", "/log/batch", "POST", data={"entries": batch},
+                                               pool="logging")
+                LOG_SHIPPER_SENT.inc(len(batch))
+                return
+            except HTTPException as e:
+                if e.status_code not in (404, 405):
+                    LOG_SHIPPER_DROPPED.inc(len(batch), reason="send_failed")
+                    logger.warning(f"Логирование недоступно: {e.detail}")
+                    return
+                logger.info("logging-сервис не поддерживает /log/batch — отправляем записи по одной")
+                self._batch_supported = False
+            except Exception as e:
+                LOG_SHIPPER_DROPPED.inc(len(batch), reason="send_failed")
+                logger.warning(f"Логирование недоступно: {e}")
+                return
+        for entry in batch:
+            try:
+                await self.client.call_service("logging", "/log", "POST", data=entry, pool="logging")
+                LOG_SHIPPER_SENT.inc()
+            except Exception as e:
+                LOG_SHIPPER_DROPPED.inc(reason="send_failed")
+                logger.warning(f"Логирование недоступно: {e}")
+
+    def stats(self) -> Dict[str, Any]:
+        return {"queued": len(self._queue), "batch_endpoint": self._batch_supported}
+
+log_shipper = LogShipper(service_client, max_queue=LOG_SHIPPER_QUEUE_SIZE, batch_size=LOG_SHIPPER_BATCH_SIZE,
+                         flush_interval=LOG_SHIPPER_FLUSH_INTERVAL)
+
+# Безопасное логирование: запись уходит в фоновую очередь и не задерживает ответ пользователю
 async def safe_log(level: str, message: str, service: str = "gateway", **extra):
     try:
-        await service_client.call_service(
-            "logging", "/log", "POST",
-            data={
-                "level": level,
-                "message": message,
-                "service": service,
-                **({"user_id": extra.get("user_id")} if extra.get("user_id") is not None else {})
-            }
-        )
+        log_shipper.enqueue({
+            "level": level,
+            "message": message,
+            "service": service,
+            # Время фиксируем в момент события, а не доставки
+            "timestamp": datetime.now().isoformat(),
+            "request_id": tracing.current_trace_id(),
+            **({"user_id": extra.get("user_id")} if extra.get("user_id") is not None else {})
+        })
     except Exception as e:
         logger.warning(f"Логирование недоступно: {e}")
 
+@app.on_event("startup")
+async def startup_event():
+    log_shipper.start()
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    """Досылаем логи и закрываем пулы соединений к сервисам"""
+    await log_shipper.stop()
+    await service_client.aclose()
+
 # ========================
 # API Эндпоинты
 # ========================
@@ -225,6 +492,16 @@ async def root():
         "timestamp": datetime.now().isoformat()
     }
 
+@app.get("/metrics", response_class=PlainTextResponse)
+async def metrics():
+    """Метрики пулов соединений к сервисам в формате Prometheus"""
+    return PlainTextResponse(REGISTRY.render(), media_type=PROMETHEUS_CONTENT_TYPE)
+
+@app.get("/pools")
+async def pools():
+    """Состояние пулов соединений: лимит, запросы в полёте, пик"""
+    return {"http2": GATEWAY_HTTP2, "pools": service_client.pool_stats(), "log_shipper": log_shipper.stats()}
+
 @app.get("/health", response_model=SystemHealthResponse)
 async def health_check():
     """Проверка здоровья всей системы"""
@@ -265,6 +542,13 @@ async def health_check():
         timestamp=datetime.now()
     )
 
+def _moderation_blocked_message(moderation_result: Dict[str, Any], default: str) -> str:
+    """Модерация не выполнена из-за перегрузки Yandex API (reason UNAVAILABLE:...) — просим повторить позже"""
+    if str(moderation_result.get("reason") or "").startswith("UNAVAILABLE"):
+        return "Сервис сейчас перегружен. Попробуйте повторить запрос через минуту."
+    return default
+
+
 @app.post("/bartender/ask", response_model=BartenderResponse)
 async def ask_bartender(request: BartenderQuery):
     """Основной эндпоинт для общения с ИИ барменом"""
@@ -283,7 +567,8 @@ async def ask_bartender(request: BartenderQuery):
 
             if not moderation_result.get("is_safe", True):
                 processing_time = (datetime.now() - start_time).total_seconds()
-                blocked_msg = "Извините, ваш запрос не прошел модерацию. Пожалуйста, перефразируйте вопрос."
+                blocked_msg = _moderation_blocked_message(
+                    moderation_result, "Извините, ваш запрос не прошел модерацию. Пожалуйста, перефразируйте вопрос.")
                 # Логируем исходящее сообщение пользователю
                 await safe_log("INFO", f"Бот -> {request.user_id}: {blocked_msg}", user_id=request.user_id)
                 return BartenderResponse(
@@ -316,7 +601,8 @@ async def ask_bartender(request: BartenderQuery):
 
             if not moderation_result.get("is_safe", True):
                 processing_time = (datetime.now() - start_time).total_seconds()
-                blocked_msg = "Извините, сгенерированный ответ не прошел модерацию."
+                blocked_msg = _moderation_blocked_message(
+                    moderation_result, "Извините, сгенерированный ответ не прошел модерацию.")
                 # Логируем исходящее сообщение пользователю
                 await safe_log("INFO", f"Бот -> {request.user_id}: {blocked_msg}", user_id=request.user_id)
                 return BartenderResponse(
@@ -5,16 +5,27 @@ Logging Service - централизованное логирование для
 """
 
 import os
+import io
+import csv
+import asyncio
 import logging
 import json
+import heapq
+import itertools
+import bisect
+import threading
+from collections import OrderedDict
 from datetime import datetime
-from typing import List, Optional, Dict, Any
+from typing import Callable, List, Optional, Dict, Any, Iterator, Sequence, Tuple
 from enum import Enum
 
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, Request
+from fastapi.responses import PlainTextResponse, StreamingResponse
 from pydantic import BaseModel, Field
 import uvicorn
 
+from segment_store import SegmentStore, record_timestamp
+
 # Настройка логирования
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -47,6 +58,18 @@ class LogEntry(BaseModel):
     request_id: Optional[str] = Field(None, description="ID запроса")
     metadata: Optional[Dict[str, Any]] = Field(None, description="Дополнительные метаданные")
 
+class LogBatch(BaseModel):
+    """Пачка записей лога (/log/batch)"""
+    entries: List[LogEntry] = Field(..., description="Записи лога", max_length=5000)
+
+class LogBatchResponse(BaseModel):
+    """Ответ на пакетное логирование"""
+    success: bool
+    accepted: int
+    first_log_id: Optional[str] = None
+    last_log_id: Optional[str] = None
+    timestamp: datetime
+
 class LogResponse(BaseModel):
     """Ответ на запрос логирования"""
     success: bool
@@ -60,25 +83,188 @@ class LogQuery(BaseModel):
     start_time: Optional[datetime] = Field(None, description="Начальное время")
     end_time: Optional[datetime] = Field(None, description="Конечное время")
     user_id: Optional[str] = Field(None, description="Фильтр по пользователю")
+    request_id: Optional[str] = Field(None, description="Фильтр по ID запроса (trace_id)")
     limit: int = Field(100, description="Лимит записей", ge=1, le=1000)
 
 # ========================
 # Хранилище логов в памяти
 # ========================
 
+class _SeqIndex:
+    """
+    Возрастающий список seq записей с «головой»: вытесненные из кольца seq отбрасываются
+    сдвигом head (O(1) амортизированно), список уплотняется, когда мёртвая часть больше живой.
+    """
+
+    __slots__ = ("seqs", "head")
+
+    def __init__(self):
+        self.seqs: List[int] = []
+        self.head = 0
+
+    def __len__(self) -> int:
+        return len(self.seqs) - self.head
+
+    def append(self, seq: int):
+        self.seqs.append(seq)
+
+    def evict_before(self, start: int):
+        seqs = self.seqs
+        head = self.head
+        while head < len(seqs) and seqs[head] < start:
+            head += 1
+        if head > 1024 and head * 2 > len(seqs):
+            del seqs[:head]
+            head = 0
+        self.head = head
+
+    def range(self, lo: int, hi: int) -> "_SeqSlice":
+        """seq в диапазоне [lo, hi) по возрастанию (без копирования списка)"""
+        left = bisect.bisect_left(self.seqs, lo, self.head)
+        right = bisect.bisect_left(self.seqs, hi, left)
+        return _SeqSlice(self.seqs, left, right)
+
+
+class _SeqSlice:
+    """Срез списка seq без копирования: запрос с limit обычно читает только хвост"""
+
+    __slots__ = ("seqs", "left", "right")
+
+    def __init__(self, seqs: List[int], left: int, right: int):
+        self.seqs, self.left, self.right = seqs, left, right
+
+    def __len__(self) -> int:
+        return self.right - self.left
+
+    def __iter__(self) -> Iterator[int]:
+        seqs = self.seqs
+        return (seqs[i] for i in range(self.left, self.right))
+
+    def __reversed__(self) -> Iterator[int]:
+        seqs = self.seqs
+        return (seqs[i] for i in range(self.right - 1, self.left - 1, -1))
+
+
 class LogStorage:
-    """Простое хранилище логов в памяти (для продакшена нужна БД)"""
+    """
+    Хранилище логов в памяти (для продакшена нужна БД).
+    Кольцевой буфер фиксированной ёмкости: запись с порядковым номером seq лежит в слоте
+    seq % max_entries, вставка и вытеснение самой старой записи — O(1), без копирования списка.
 
-    def __init__(self, max_entries: int = 10000):
-        self.logs: List[Dict] = []
-        self.max_entries = max_entries
-        self._counter = 0
+    Индексы поддерживаются инкрементально при вставке/вытеснении:
+      - service / user_id / level / request_id -> возрастающие списки seq;
+      - счётчики по сервисам и уровням для /stats и /services;
+      - «порядковое время» order_ts[seq] = max(order_ts[seq-1], timestamp) — неубывающее,
+        по нему диапазон времени ищется бисекцией. Время записи может отставать от order_ts
+        не более чем на max_skew (клиенты присылают время события, а не приёма), это учитывается
+        в границах поиска, после чего записи точно фильтруются по своему timestamp.
+    """
 
-    def add_log(self, entry: LogEntry) -> str:
-        """Добавление записи в лог"""
-        self._counter += 1
-        log_id = f"log_{self._counter}"
+    _INDEXED_FIELDS = ("service", "user_id", "level", "request_id")
+
+    def __init__(self, max_entries: int = 10000,
+                 sink: Optional[Callable[[List[Tuple[int, Dict]]], None]] = None,
+                 listener: Optional[Callable[[List[Dict]], None]] = None):
+        self.max_entries = max(1, max_entries)
+        self._lock = threading.Lock()
+        self._id_counter = 0
+        # Получатель новых записей (seq, запись) — очередь дискового хранилища; вызывается под блокировкой,
+        # чтобы порядок на диске совпадал с порядком seq (запись на диск — в фоновом потоке)
+        self._sink = sink
+        # Подписчик на новые записи (live-tail); вызывается уже после снятия блокировки
+        self._listener = listener
+        self._reset()
+
+    def resume_ids(self, last_id: int):
+        """Продолжает нумерацию после перезапуска (id уже записанных на диск логов)"""
+        with self._lock:
+            self._id_counter = max(self._id_counter, int(last_id))
+
+    def oldest_id(self) -> Optional[int]:
+        """Номер самой старой записи в памяти (log_<N>)"""
+        with self._lock:
+            return self._oldest_id()
+
+    def _oldest_id(self) -> Optional[int]:
+        if self._counter == self._start:
+            return None
+        return int(self._slots[self._start % self.max_entries]["id"][4:])
+
+    def _reset(self):
+        self._slots: List[Optional[Dict]] = [None] * self.max_entries
+        self._order_ts: List[float] = [0.0] * self.max_entries
+        self._counter = 0  # seq следующей записи
+        self._start = 0    # seq самой старой хранимой записи
+        self._max_skew = 0.0
+        self._indexes: Dict[str, Dict[str, _SeqIndex]] = {f: {} for f in self._INDEXED_FIELDS}
+        self._by_service: Dict[str, int] = {}
+        self._by_level: Dict[str, int] = {}
+
+    def __len__(self) -> int:
+        return self._counter - self._start
+
+    @property
+    def logs(self) -> List[Dict]:
+        """Снимок хранимых записей от старых к новым"""
+        with self._lock:
+            return [self._slots[seq % self.max_entries] for seq in range(self._start, self._counter)]
+
+    def last(self) -> Optional[Dict]:
+        with self._lock:
+            if self._counter == self._start:
+                return None
+            return self._slots[(self._counter - 1) % self.max_entries]
+
+    def _insert(self, log_dict: Dict):
+        seq = self._counter
+        slot = seq % self.max_entries
+        if seq - self._start >= self.max_entries:
+            self._evict(self._slots[slot])
+            self._start += 1
+
+        ts = log_dict["timestamp"].timestamp()
+        prev = self._order_ts[(seq - 1) % self.max_entries] if seq > self._start else ts
+        order_ts = ts if ts > prev else prev
+        if order_ts - ts > self._max_skew:
+            self._max_skew = order_ts - ts
+        self._slots[slot] = log_dict
+        self._order_ts[slot] = order_ts
+        self._counter = seq + 1
 
+        for field in self._INDEXED_FIELDS:
+            value = log_dict.get(field)
+            if value is None:
+                continue
+            index = self._indexes[field].get(value)
+            if index is None:
+                index = self._indexes[field][value] = _SeqIndex()
+            index.append(seq)
+        self._by_service[log_dict["service"]] = self._by_service.get(log_dict["service"], 0) + 1
+        self._by_level[log_dict["level"]] = self._by_level.get(log_dict["level"], 0) + 1
+
+    def _evict(self, log_dict: Dict):
+        """Обновляет индексы и счётчики для вытесняемой записи (seq == self._start)"""
+        start = self._start + 1
+        for field in self._INDEXED_FIELDS:
+            value = log_dict.get(field)
+            if value is None:
+                continue
+            index = self._indexes[field].get(value)
+            if index is None:
+                continue
+            index.evict_before(start)
+            if not len(index):
+                del self._indexes[field][value]
+        for counts, key in ((self._by_service, log_dict["service"]), (self._by_level, log_dict["level"])):
+            left = counts.get(key, 0) - 1
+            if left > 0:
+                counts[key] = left
+            else:
+                counts.pop(key, None)
+
+    def _append(self, entry: LogEntry) -> Tuple[int, Dict]:
+        self._id_counter += 1
+        log_id = f"log_{self._id_counter}"
         log_dict = {
             "id": log_id,
             "level": entry.level.value,
@@ -89,13 +275,10 @@ class LogStorage:
             "request_id": entry.request_id,
             "metadata": entry.metadata or {}
         }
+        self._insert(log_dict)
+        return self._id_counter, log_dict
 
-        self.logs.append(log_dict)
-
-        # Ограничиваем размер хранилища
-        if len(self.logs) > self.max_entries:
-            self.logs = self.logs[-self.max_entries:]
-
+    def _echo(self, entry: LogEntry):
         # Логируем в стандартный logger
         python_logger = logging.getLogger(entry.service)
         log_level = getattr(logging, entry.level.value)
@@ -105,73 +288,487 @@ class LogStorage:
             "metadata": entry.metadata
         })
 
-        return log_id
+    def add_log(self, entry: LogEntry) -> str:
+        """Добавление записи в лог"""
+        with self._lock:
+            item = self._append(entry)
+            if self._sink is not None:
+                self._sink([item])
+        if self._listener is not None:
+            self._listener([item[1]])
+        self._echo(entry)
+        return item[1]["id"]
 
-    def query_logs(self, query: LogQuery) -> List[Dict]:
-        """Поиск логов по критериям"""
-        filtered_logs = self.logs.copy()
+    def add_logs(self, entries: List[LogEntry]) -> List[str]:
+        """Пакетное добавление: одна блокировка на всю пачку"""
+        with self._lock:
+            items = [self._append(entry) for entry in entries]
+            if self._sink is not None:
+                self._sink(items)
+        if self._listener is not None:
+            self._listener([log_dict for _, log_dict in items])
+        for entry in entries:
+            self._echo(entry)
+        return [log_dict["id"] for _, log_dict in items]
+
+    def clear(self, service: Optional[str] = None) -> int:
+        """
+        Очистка всех записей или записей одного сервиса (O(n), редкая операция).
+        Возвращает номер последней выданной записи — водяной знак очистки для дискового хранилища.
+        """
+        with self._lock:
+            kept = []
+            if service:
+                kept = [self._slots[seq % self.max_entries] for seq in range(self._start, self._counter)]
+                kept = [log for log in kept if log["service"] != service]
+            self._reset()
+            for log in kept:
+                self._insert(log)
+            return self._id_counter
 
-        # Фильтрация по сервису
-        if query.service:
-            filtered_logs = [log for log in filtered_logs if log["service"] == query.service]
+    def _bisect_order(self, value: float, lo: int, hi: int, right: bool = False) -> int:
+        """Бисекция по неубывающему order_ts в диапазоне seq [lo, hi)"""
+        order, cap = self._order_ts, self.max_entries
+        while lo < hi:
+            mid = (lo + hi) // 2
+            key = order[mid % cap]
+            if key < value or (right and key == value):
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
 
-        # Фильтрация по уровню
-        if query.level:
-            filtered_logs = [log for log in filtered_logs if log["level"] == query.level.value]
+    def _seq_range(self, start_time: Optional[datetime], end_time: Optional[datetime]) -> Tuple[int, int]:
+        lo, hi = self._start, self._counter
+        if start_time is not None:
+            # timestamp <= order_ts, поэтому все подходящие записи не раньше этой границы
+            lo = self._bisect_order(start_time.timestamp(), lo, hi)
+        if end_time is not None:
+            # timestamp >= order_ts - max_skew
+            hi = self._bisect_order(end_time.timestamp() + self._max_skew, lo, hi, right=True)
+        return lo, hi
 
-        # Фильтрация по времени
-        if query.start_time:
-            filtered_logs = [log for log in filtered_logs if log["timestamp"] >= query.start_time]
+    def _candidates(self, lo: int, hi: int, **filters: Optional[str]) -> Tuple[Sequence[int], List[Tuple[str, str]]]:
+        """
+        Кандидаты из самого селективного индекса в [lo, hi) по возрастанию seq и список
+        проверок (поле, значение), которые нужно применить к каждой записи.
+        """
+        checks = [(f, v) for f, v in filters.items() if v is not None]
+        candidates: Optional[_SeqSlice] = None
+        for field, value in filters.items():
+            if value is None:
+                continue
+            index = self._indexes[field].get(value)
+            if index is None:
+                return [], checks
+            seqs = index.range(lo, hi)
+            if candidates is None or len(seqs) < len(candidates):
+                candidates = seqs
+        if candidates is None:
+            return range(lo, hi), checks
+        return candidates, checks
 
-        if query.end_time:
-            filtered_logs = [log for log in filtered_logs if log["timestamp"] <= query.end_time]
+    def query_logs(self, query: LogQuery) -> List[Dict]:
+        """Поиск логов по критериям: индексы + бисекция по времени, новые сначала"""
+        return self.query_window(query)[0]
+
+    def query_window(self, query: LogQuery) -> Tuple[List[Dict], Optional[int]]:
+        """
+        query_logs() и номер самой старой записи в памяти из одного снимка под блокировкой:
+        граница для чтения истории с диска, без повторов записей, вытесненных между вызовами
+        """
+        with self._lock:
+            oldest = self._oldest_id()
+            lo, hi = self._seq_range(query.start_time, query.end_time)
+            seqs, checks = self._candidates(
+                lo, hi,
+                service=query.service,
+                level=query.level.value if query.level else None,
+                user_id=query.user_id,
+                request_id=query.request_id,
+            )
 
-        # Фильтрация по пользователю
-        if query.user_id:
-            filtered_logs = [log for log in filtered_logs if log["user_id"] == query.user_id]
+            cap = self.max_entries
+            top: List[Tuple[datetime, int]] = []  # мин-куча (timestamp, seq) лучших limit записей
+            # Идём от новых к старым и останавливаемся, как только лучше уже не будет
+            for seq in reversed(seqs):
+                # Дальше order_ts только меньше, а timestamp <= order_ts
+                if len(top) >= query.limit and self._order_ts[seq % cap] < top[0][0].timestamp():
+                    break
+                log = self._slots[seq % cap]
+                if checks and not all(log.get(f) == v for f, v in checks):
+                    continue
+                ts = log["timestamp"]
+                if query.start_time and ts < query.start_time:
+                    continue
+                if query.end_time and ts > query.end_time:
+                    continue
+                if len(top) < query.limit:
+                    heapq.heappush(top, (ts, seq))
+                elif (ts, seq) > top[0]:
+                    heapq.heapreplace(top, (ts, seq))
+            result = [self._slots[seq % cap] for _, seq in sorted(top, key=lambda x: x[1])]
 
         # Сортировка по времени (новые сначала)
-        filtered_logs.sort(key=lambda x: x["timestamp"], reverse=True)
+        result.sort(key=lambda x: x["timestamp"], reverse=True)
+        return result, oldest
+
+    def logs_for(self, **filters: Optional[str]) -> List[Dict]:
+        """Записи по точным значениям индексируемых полей, от старых к новым"""
+        with self._lock:
+            seqs, checks = self._candidates(self._start, self._counter, **filters)
+            logs = (self._slots[seq % self.max_entries] for seq in seqs)
+            return [log for log in logs if all(log.get(f) == v for f, v in checks)]
+
+    def iter_logs(self, start_time: Optional[datetime] = None, end_time: Optional[datetime] = None,
+                  chunk_size: int = 1000, **filters: Optional[str]) -> Iterator[Dict]:
+        """
+        Записи от старых к новым порциями: блокировка берётся на порцию, а не на весь экспорт,
+        поэтому медленный потребитель не задерживает приём логов. Записи, пришедшие после начала
+        обхода, не включаются; вытесненные из кольца за время обхода — пропускаются.
+        """
+        with self._lock:
+            stop = self._counter
+        next_seq = 0
+        scan_budget = max(1, chunk_size) * 8
+        while True:
+            chunk: List[Dict] = []
+            with self._lock:
+                lo, hi = self._seq_range(start_time, end_time)
+                lo, hi = max(lo, next_seq), min(hi, stop)
+                if lo >= hi:
+                    return
+                seqs, checks = self._candidates(lo, hi, **filters)
+                next_seq = hi
+                scanned = 0
+                for seq in seqs:
+                    scanned += 1
+                    log = self._slots[seq % self.max_entries]
+                    if checks and not all(log.get(f) == v for f, v in checks):
+                        pass
+                    elif start_time and log["timestamp"] < start_time:
+                        pass
+                    elif end_time and log["timestamp"] > end_time:
+                        pass
+                    else:
+                        chunk.append(log)
+                    if len(chunk) >= chunk_size or scanned >= scan_budget:
+                        next_seq = seq + 1
+                        break
+            yield from chunk
 
-        # Лимит
-        return filtered_logs[:query.limit]
+    def services(self) -> List[str]:
+        with self._lock:
+            return list(self._by_service)
 
     def get_stats(self) -> Dict[str, Any]:
-        """Получение статистики логов"""
-        if not self.logs:
+        """Получение статистики логов (счётчики поддерживаются при вставке/вытеснении)"""
+        with self._lock:
+            if self._counter == self._start:
+                return {
+                    "total_logs": 0,
+                    "by_service": {},
+                    "by_level": {},
+                    "last_log_time": None
+                }
             return {
-                "total_logs": 0,
-                "by_service": {},
-                "by_level": {},
-                "last_log_time": None
+                "total_logs": self._counter - self._start,
+                "by_service": dict(self._by_service),
+                "by_level": dict(self._by_level),
+                # Неубывающее order_ts последней записи — максимальное время среди принятых записей
+                "last_log_time": datetime.fromtimestamp(self._order_ts[(self._counter - 1) % self.max_entries])
             }
 
-        stats = {
-            "total_logs": len(self.logs),
-            "by_service": {},
-            "by_level": {},
-            "last_log_time": max(log["timestamp"] for log in self.logs)
-        }
+class SpanBatch(BaseModel):
+    """Пачка спанов от экспортёра tracing.py"""
+    spans: List[Dict[str, Any]] = Field(..., description="Спаны (trace_id, span_id, parent_id, name, start, duration_ms)")
 
-        # Подсчет по сервисам
-        for log in self.logs:
-            service = log["service"]
-            stats["by_service"][service] = stats["by_service"].get(service, 0) + 1
+class TraceStorage:
+    """Спаны последних трасс в памяти; самые старые трассы вытесняются целиком"""
 
-        # Подсчет по уровням
-        for log in self.logs:
-            level = log["level"]
-            stats["by_level"][level] = stats["by_level"].get(level, 0) + 1
+    def __init__(self, max_traces: int = 2000, max_spans_per_trace: int = 500):
+        self.max_traces = max_traces
+        self.max_spans_per_trace = max_spans_per_trace
+        self._traces: "OrderedDict[str, List[Dict[str, Any]]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.dropped_spans = 0
 
-        return stats
+    def add_spans(self, spans: List[Dict[str, Any]]) -> int:
+        accepted = 0
+        with self._lock:
+            for span in spans:
+                trace_id = span.get("trace_id")
+                if not trace_id or not span.get("span_id"):
+                    self.dropped_spans += 1
+                    continue
+                trace = self._traces.get(trace_id)
+                if trace is None:
+                    trace = []
+                    self._traces[trace_id] = trace
+                    while len(self._traces) > self.max_traces:
+                        self._traces.popitem(last=False)
+                if len(trace) >= self.max_spans_per_trace:
+                    self.dropped_spans += 1
+                    continue
+                trace.append(span)
+                accepted += 1
+        return accepted
+
+    def get_trace(self, trace_id: str) -> List[Dict[str, Any]]:
+        with self._lock:
+            return list(self._traces.get(trace_id, ()))
+
+    def recent(self, limit: int = 50) -> List[Dict[str, Any]]:
+        with self._lock:
+            items = list(self._traces.items())[-limit:]
+        summaries = []
+        for trace_id, spans in reversed(items):
+            root = _root_span(spans)
+            start = min(float(s.get("start") or 0) for s in spans)
+            end = max(float(s.get("start") or 0) + float(s.get("duration_ms") or 0) / 1000.0 for s in spans)
+            summaries.append({
+                "trace_id": trace_id,
+                "root": root.get("name") if root else None,
+                "services": sorted({s.get("service", "unknown") for s in spans}),
+                "spans": len(spans),
+                "errors": sum(1 for s in spans if s.get("status") == "error"),
+                "start": datetime.fromtimestamp(start),
+                "duration_ms": round((end - start) * 1000.0, 1),
+            })
+        return summaries
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {"traces": len(self._traces), "spans": sum(len(t) for t in self._traces.values()),
+                    "dropped_spans": self.dropped_spans}
+
+def _root_span(spans: List[Dict[str, Any]]) -> Optional[Dict[str, Any]]:
+    """Корень — спан без родителя среди полученных (или самый ранний, если корень ещё не пришёл)"""
+    ids = {s.get("span_id") for s in spans}
+    roots = [s for s in spans if not s.get("parent_id") or s.get("parent_id") not in ids]
+    return min(roots or spans, key=lambda s: float(s.get("start") or 0)) if spans else None
+
+def build_waterfall(spans: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """Спаны в порядке обхода дерева (родитель перед детьми) со смещением от начала трассы и глубиной"""
+    if not spans:
+        return []
+    trace_start = min(float(s.get("start") or 0) for s in spans)
+    ids = {s.get("span_id") for s in spans}
+    children: Dict[Optional[str], List[Dict[str, Any]]] = {}
+    for s in spans:
+        parent = s.get("parent_id") if s.get("parent_id") in ids else None
+        children.setdefault(parent, []).append(s)
+    for lst in children.values():
+        lst.sort(key=lambda s: float(s.get("start") or 0))
+
+    rows: List[Dict[str, Any]] = []
+    stack = [(s, 0) for s in reversed(children.get(None, []))]
+    while stack:
+        span, depth = stack.pop()
+        rows.append({
+            "span_id": span.get("span_id"),
+            "parent_id": span.get("parent_id"),
+            "name": span.get("name"),
+            "service": span.get("service"),
+            "depth": depth,
+            "offset_ms": round((float(span.get("start") or 0) - trace_start) * 1000.0, 1),
+            "duration_ms": span.get("duration_ms"),
+            "status": span.get("status"),
+            "attributes": span.get("attributes") or {},
+        })
+        for child in reversed(children.get(span.get("span_id"), [])):
+            stack.append((child, depth + 1))
+    return rows
+
+def render_waterfall_text(rows: List[Dict[str, Any]], width: int = 60) -> str:
+    """Текстовый водопад: отступ по глубине и полоса на общей шкале времени трассы"""
+    if not rows:
+        return ""
+    total = max(r["offset_ms"] + float(r["duration_ms"] or 0) for r in rows) or 1.0
+    label_width = max(len("  " * r["depth"] + f"{r['service']}: {r['name']}") for r in rows)
+    lines = []
+    for r in rows:
+        label = "  " * r["depth"] + f"{r['service']}: {r['name']}"
+        begin = int(r["offset_ms"] / total * width)
+        length = max(1, int(float(r["duration_ms"] or 0) / total * width))
+        bar = " " * begin + ("x" if r["status"] == "error" else "#") * length
+        lines.append(f"{label.ljust(label_width)} |{bar.ljust(width)}| {r['offset_ms']:>9.1f} +{float(r['duration_ms'] or 0):.1f} ms")
+    return "\n".join(lines) + "\n"
+
+_LEVEL_ORDER = {level.value: i for i, level in enumerate(LogLevel)}
+
+class TailSubscriber:
+    """Подписчик /tail: фильтры и ограниченная очередь новых записей"""
+
+    __slots__ = ("queue", "filters", "min_level", "contains", "dropped")
+
+    def __init__(self, queue_size: int, filters: Dict[str, str], min_level: Optional[str], contains: Optional[str]):
+        self.queue: "asyncio.Queue[Dict]" = asyncio.Queue(maxsize=queue_size)
+        self.filters = filters
+        self.min_level = _LEVEL_ORDER.get(min_level, 0) if min_level else 0
+        self.contains = contains.lower() if contains else None
+        self.dropped = 0
+
+    def matches(self, log: Dict) -> bool:
+        for field, value in self.filters.items():
+            if log.get(field) != value:
+                return False
+        if self.min_level and _LEVEL_ORDER.get(log.get("level"), 0) < self.min_level:
+            return False
+        if self.contains and self.contains not in str(log.get("message", "")).lower():
+            return False
+        return True
+
+class LogTail:
+    """
+    Рассылка новых записей подписчикам live-tail.
+    Фильтры применяются на сервере; очередь подписчика ограничена — медленный клиент
+    теряет записи (и получает счётчик пропущенных), но не тормозит приём логов.
+    """
+
+    def __init__(self, queue_size: int = 1000, max_subscribers: int = 50):
+        self.queue_size = max(1, queue_size)
+        self.max_subscribers = max(1, max_subscribers)
+        self._subscribers: List[TailSubscriber] = []
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+
+    def subscribe(self, filters: Dict[str, str], min_level: Optional[str] = None,
+                  contains: Optional[str] = None) -> Optional[TailSubscriber]:
+        if len(self._subscribers) >= self.max_subscribers:
+            return None
+        self._loop = asyncio.get_running_loop()
+        sub = TailSubscriber(self.queue_size, filters, min_level, contains)
+        self._subscribers.append(sub)
+        return sub
+
+    def unsubscribe(self, sub: TailSubscriber):
+        try:
+            self._subscribers.remove(sub)
+        except ValueError:
+            pass
+
+    def publish(self, logs: List[Dict]):
+        """Вызывается хранилищем после вставки; из чужого потока — через call_soon_threadsafe"""
+        if not self._subscribers or self._loop is None:
+            return
+        try:
+            running = asyncio.get_running_loop()
+        except RuntimeError:
+            running = None
+        if running is self._loop:
+            self._dispatch(logs)
+        elif not self._loop.is_closed():
+            self._loop.call_soon_threadsafe(self._dispatch, list(logs))
+
+    def _dispatch(self, logs: List[Dict]):
+        for sub in list(self._subscribers):
+            for log in logs:
+                if not sub.matches(log):
+                    continue
+                try:
+                    sub.queue.put_nowait(log)
+                except asyncio.QueueFull:
+                    sub.dropped += 1
+
+    def stats(self) -> Dict[str, Any]:
+        return {"subscribers": len(self._subscribers),
+                "queued": sum(s.queue.qsize() for s in self._subscribers)}
 
 # Глобальное хранилище
-log_storage = LogStorage()
+try:
+    LOGGING_MAX_ENTRIES = int(os.getenv("LOGGING_MAX_ENTRIES", "10000"))
+except Exception:
+    LOGGING_MAX_ENTRIES = 10000
+# Дисковое хранилище: сжатые сегменты с разреженным индексом времени и ретеншном
+LOGGING_SEGMENTS_ENABLED = os.getenv("LOGGING_SEGMENTS_ENABLED", "true").lower() == "true"
+LOGGING_DATA_DIR = os.getenv("LOGGING_DATA_DIR", os.path.join(os.getcwd(), "logs", "segments"))
+
+def _env_float(name: str, default: float) -> float:
+    try:
+        return float(os.getenv(name, str(default)))
+    except Exception:
+        return default
+
+segment_store: Optional[SegmentStore] = None
+if LOGGING_SEGMENTS_ENABLED:
+    try:
+        segment_store = SegmentStore(
+            LOGGING_DATA_DIR,
+            segment_max_bytes=int(_env_float("LOGGING_SEGMENT_MAX_MB", 16) * 1024 * 1024),
+            segment_max_age=_env_float("LOGGING_SEGMENT_MAX_AGE_MINUTES", 60) * 60,
+            block_bytes=int(_env_float("LOGGING_BLOCK_KB", 64) * 1024),
+            flush_interval=_env_float("LOGGING_FLUSH_INTERVAL_SECONDS", 1.0),
+            retention_seconds=_env_float("LOGGING_RETENTION_DAYS", 7) * 86400,
+            retention_max_bytes=int(_env_float("LOGGING_RETENTION_MAX_MB", 1024) * 1024 * 1024),
+            fsync=os.getenv("LOGGING_FSYNC", "false").lower() == "true",
+            queue_max_entries=int(_env_float("LOGGING_WRITE_QUEUE_MAX_ENTRIES", 100000)),
+        )
+    except Exception as e:
+        logger.error(f"Дисковое хранилище логов недоступно ({LOGGING_DATA_DIR}): {e}")
+        segment_store = None
+
+log_tail = LogTail(queue_size=int(_env_float("LOGGING_TAIL_QUEUE_SIZE", 1000)),
+                   max_subscribers=int(_env_float("LOGGING_TAIL_MAX_SUBSCRIBERS", 50)))
+LOGGING_TAIL_HEARTBEAT_SECONDS = _env_float("LOGGING_TAIL_HEARTBEAT_SECONDS", 15.0)
+log_storage = LogStorage(max_entries=LOGGING_MAX_ENTRIES,
+                         sink=segment_store.append_many if segment_store else None,
+                         listener=log_tail.publish)
+if segment_store is not None:
+    log_storage.resume_ids(segment_store.last_seq)
+trace_storage = TraceStorage()
+
+def query_with_history(query: LogQuery) -> List[Dict]:
+    """
+    Запрос к памяти, дополненный историей с диска (записи старше окна памяти).
+    Сегменты читаются от новых к старым; блоки, целиком более старые, чем худший из уже
+    найденных limit результатов, пропускаются по разреженному индексу.
+    """
+    recent, oldest_in_memory = log_storage.query_window(query)
+    if segment_store is None:
+        return recent
+
+    level = query.level.value if query.level else None
+
+    def predicate(record: Dict) -> bool:
+        return ((query.service is None or record.get("service") == query.service)
+                and (level is None or record.get("level") == level)
+                and (query.user_id is None or record.get("user_id") == query.user_id)
+                and (query.request_id is None or record.get("request_id") == query.request_id))
+
+    top: List[Tuple[float, int, Dict]] = [(record_timestamp(log["timestamp"]), i, log) for i, log in enumerate(recent)]
+    heapq.heapify(top)
+    order = len(top)
+    for record in segment_store.scan(
+        start_ts=query.start_time.timestamp() if query.start_time else None,
+        end_ts=query.end_time.timestamp() if query.end_time else None,
+        before_seq=oldest_in_memory,
+        predicate=predicate,
+        stop_below_ts=lambda: top[0][0] if len(top) >= query.limit else None,
+    ):
+        # На диске timestamp может остаться строкой (_decode не разобрал формат) — не падаем
+        item = (record_timestamp(record.get("timestamp")), order, record)
+        order += 1
+        if len(top) < query.limit:
+            heapq.heappush(top, item)
+        elif item[0] > top[0][0]:
+            heapq.heapreplace(top, item)
+    return [log for _, _, log in sorted(top, key=lambda x: (-x[0], x[1]))]
 
 # ========================
 # API эндпоинты
 # ========================
 
+@app.on_event("startup")
+async def startup_event():
+    if segment_store is not None:
+        segment_store.start()
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    """Сбрасываем незаписанный блок на диск"""
+    if segment_store is not None:
+        segment_store.close()
+
 @app.get("/")
 async def root():
     """Корневой эндпоинт"""
@@ -179,17 +776,19 @@ async def root():
         "service": "Logging Service",
         "version": "1.0.0",
         "status": "active",
-        "total_logs": len(log_storage.logs)
+        "total_logs": len(log_storage)
     }
 
 @app.get("/health")
 async def health_check():
     """Проверка здоровья сервиса"""
+    last_log = log_storage.last()
     return {
         "status": "healthy",
-        "storage": "memory",
-        "logs_count": len(log_storage.logs),
-        "last_log": log_storage.logs[-1]["timestamp"] if log_storage.logs else None
+        "storage": "memory+segments" if segment_store is not None else "memory",
+        "logs_count": len(log_storage),
+        "capacity": log_storage.max_entries,
+        "last_log": last_log["timestamp"] if last_log else None
     }
 
 @app.post("/log", response_model=LogResponse)
@@ -208,11 +807,30 @@ async def add_log(entry: LogEntry):
         logger.error(f"Ошибка добавления лога: {e}")
         raise HTTPException(status_code=500, detail=f"Ошибка логирования: {str(e)}")
 
+@app.post("/log/batch", response_model=LogBatchResponse)
+async def add_log_batch(batch: LogBatch):
+    """Пакетное добавление записей (фоновые отправители логов сервисов)"""
+    try:
+        ids = log_storage.add_logs(batch.entries)
+
+        return LogBatchResponse(
+            success=True,
+            accepted=len(ids),
+            first_log_id=ids[0] if ids else None,
+            last_log_id=ids[-1] if ids else None,
+            timestamp=datetime.now()
+        )
+
+    except Exception as e:
+        logger.error(f"Ошибка пакетного добавления логов: {e}")
+        raise HTTPException(status_code=500, detail=f"Ошибка логирования: {str(e)}")
+
 @app.post("/query")
 async def query_logs(query: LogQuery):
     """Поиск логов по критериям"""
     try:
-        logs = log_storage.query_logs(query)
+        # Чтение сегментов с диска — в пуле потоков, чтобы не блокировать приём логов
+        logs = await asyncio.to_thread(query_with_history, query)
 
         return {
             "logs": logs,
@@ -228,7 +846,11 @@ async def query_logs(query: LogQuery):
 async def get_stats():
     """Получение статистики логирования"""
     try:
-        return log_storage.get_stats()
+        stats = log_storage.get_stats()
+        if segment_store is not None:
+            stats["disk"] = segment_store.stats()
+        stats["tail"] = log_tail.stats()
+        return stats
     except Exception as e:
         logger.error(f"Ошибка получения статистики: {e}")
         raise HTTPException(status_code=500, detail=str(e))
@@ -236,9 +858,7 @@ async def get_stats():
 @app.get("/services")
 async def get_services():
     """Получение списка сервисов, которые логируются"""
-    services = set()
-    for log in log_storage.logs:
-        services.add(log["service"])
+    services = log_storage.services()
 
     return {
         "services": list(services),
@@ -247,63 +867,236 @@ async def get_services():
 
 @app.delete("/clear")
 async def clear_logs(service: Optional[str] = None):
-    """Очистка логов (всех или конкретного сервиса)"""
+    """Очистка логов (всех или конкретного сервиса) — в памяти и в истории на диске"""
     try:
+        cleared_through = log_storage.clear(service)
+        if segment_store is not None:
+            # Сегменты append-only: очищенные записи скрываются водяным знаком, который учитывает scan()
+            segment_store.clear(cleared_through, service)
         if service:
-            log_storage.logs = [log for log in log_storage.logs if log["service"] != service]
             message = f"Логи сервиса {service} очищены"
         else:
-            log_storage.logs.clear()
             message = "Все логи очищены"
 
         return {
             "success": True,
             "message": message,
-            "remaining_logs": len(log_storage.logs)
+            "remaining_logs": len(log_storage)
         }
 
     except Exception as e:
         logger.error(f"Ошибка очистки логов: {e}")
         raise HTTPException(status_code=500, detail=str(e))
 
+# ========================
+# Трассировка
+# ========================
+
+@app.post("/traces/spans")
+async def ingest_spans(batch: SpanBatch):
+    """Приём спанов от сервисов (фоновый экспортёр tracing.py)"""
+    accepted = trace_storage.add_spans(batch.spans)
+    return {"success": True, "accepted": accepted}
+
+@app.get("/traces")
+async def list_traces(limit: int = 50):
+    """Последние трассы: корневой спан, сервисы, длительность"""
+    limit = max(1, min(limit, 500))
+    return {"traces": trace_storage.recent(limit), **trace_storage.stats()}
+
+@app.get("/traces/{trace_id}")
+async def get_trace(trace_id: str, format: str = "json"):
+    """Водопад трассы и связанные логи (request_id == trace_id)"""
+    spans = trace_storage.get_trace(trace_id)
+    if not spans:
+        raise HTTPException(status_code=404, detail=f"Трасса {trace_id} не найдена")
+    rows = build_waterfall(spans)
+    if format.lower() == "text":
+        return PlainTextResponse(render_waterfall_text(rows))
+    logs = log_storage.logs_for(request_id=trace_id)
+    root = _root_span(spans)
+    return {
+        "trace_id": trace_id,
+        "root": root.get("name") if root else None,
+        "duration_ms": max((r["offset_ms"] + float(r["duration_ms"] or 0) for r in rows), default=0.0),
+        "spans": rows,
+        "logs": logs,
+    }
+
 # ========================
 # Экспорт логов
 # ========================
 
-@app.get("/export")
-async def export_logs(format: str = "json", service: Optional[str] = None):
-    """Экспорт логов в различных форматах"""
-    try:
-        logs = log_storage.logs
+_EXPORT_CSV_COLUMNS = ["timestamp", "level", "service", "message", "user_id", "request_id", "id", "metadata"]
+_EXPORT_MEDIA_TYPES = {"json": "application/json", "ndjson": "application/x-ndjson", "csv": "text/csv; charset=utf-8"}
+# Размер порции ответа: строки копятся в буфер и отдаются кусками, а не по одной
+_EXPORT_CHUNK_BYTES = 64 * 1024
 
-        if service:
-            logs = [log for log in logs if log["service"] == service]
+def _json_default(value: Any):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    return str(value)
 
-        if format.lower() == "json":
-            return {
-                "format": "json",
-                "logs": logs,
-                "count": len(logs),
-                "exported_at": datetime.now()
-            }
-        elif format.lower() == "csv":
-            # Простой CSV формат
-            csv_lines = ["timestamp,level,service,message,user_id"]
-            for log in logs:
-                line = f"{log['timestamp']},{log['level']},{log['service']},\"{log['message']}\",{log['user_id'] or ''}"
-                csv_lines.append(line)
+def _to_json(log: Dict) -> str:
+    return json.dumps(log, ensure_ascii=False, default=_json_default)
 
-            return {
-                "format": "csv",
-                "data": "\n".join(csv_lines),
-                "count": len(logs)
-            }
+def iter_export_records(source: str, start_time: Optional[datetime], end_time: Optional[datetime],
+                        **filters: Optional[str]) -> Iterator[Dict]:
+    """
+    Записи для экспорта от старых к новым, без материализации списка.
+    source=all при включённом дисковом хранилище читает сегменты (там есть и записи памяти,
+    и ещё не сброшенный блок — снимок на момент начала); иначе — кольцевой буфер в памяти.
+    """
+    if source == "all" and segment_store is not None:
+        checks = [(f, v) for f, v in filters.items() if v is not None]
+        yield from segment_store.scan(
+            start_ts=start_time.timestamp() if start_time else None,
+            end_ts=end_time.timestamp() if end_time else None,
+            predicate=(lambda r: all(r.get(f) == v for f, v in checks)) if checks else None,
+            newest_first=False,
+        )
+    else:
+        yield from log_storage.iter_logs(start_time=start_time, end_time=end_time, **filters)
+
+def render_export(records: Iterator[Dict], fmt: str) -> Iterator[str]:
+    """Ленивая сериализация в json / ndjson / csv порциями ~_EXPORT_CHUNK_BYTES"""
+    buf = io.StringIO()
+    writer = csv.writer(buf) if fmt == "csv" else None
+    count = 0
+    if fmt == "json":
+        buf.write('{"format": "json", "logs": [')
+    elif writer is not None:
+        writer.writerow(_EXPORT_CSV_COLUMNS)
+
+    for log in records:
+        if fmt == "ndjson":
+            buf.write(_to_json(log))
+            buf.write("\n")
+        elif writer is not None:
+            row = []
+            for col in _EXPORT_CSV_COLUMNS:
+                value = log.get(col)
+                if col == "metadata":
+                    value = _to_json(value) if value else ""
+                elif isinstance(value, datetime):
+                    value = value.isoformat()
+                row.append("" if value is None else value)
+            writer.writerow(row)
         else:
-            raise HTTPException(status_code=400, detail="Поддерживаемые форматы: json, csv")
+            if count:
+                buf.write(", ")
+            buf.write(_to_json(log))
+        count += 1
+        if buf.tell() >= _EXPORT_CHUNK_BYTES:
+            yield buf.getvalue()
+            buf.seek(0)
+            buf.truncate()
 
-    except Exception as e:
-        logger.error(f"Ошибка экспорта логов: {e}")
-        raise HTTPException(status_code=500, detail=str(e))
+    if fmt == "json":
+        buf.write(f'], "count": {count}, "exported_at": {json.dumps(datetime.now().isoformat())}}}')
+    if buf.tell():
+        yield buf.getvalue()
+
+@app.get("/export")
+async def export_logs(format: str = "json", service: Optional[str] = None, level: Optional[LogLevel] = None,
+                      user_id: Optional[str] = None, request_id: Optional[str] = None,
+                      start_time: Optional[datetime] = None, end_time: Optional[datetime] = None,
+                      source: str = "all", limit: Optional[int] = None):
+    """
+    Потоковый экспорт логов (json / ndjson / csv).
+    Ответ формируется лениво порциями (chunked transfer): ни список записей, ни весь CSV
+    не собираются в памяти. source=all — вместе с историей на диске, source=memory — только буфер.
+    """
+    fmt = format.lower()
+    if fmt not in _EXPORT_MEDIA_TYPES:
+        raise HTTPException(status_code=400, detail="Поддерживаемые форматы: json, ndjson, csv")
+    if source not in ("all", "memory"):
+        raise HTTPException(status_code=400, detail="source: all или memory")
+    if limit is not None and limit < 1:
+        raise HTTPException(status_code=400, detail="limit должен быть положительным")
+
+    records = iter_export_records(
+        source, start_time, end_time,
+        service=service,
+        level=level.value if level else None,
+        user_id=user_id,
+        request_id=request_id,
+    )
+    if limit is not None:
+        records = itertools.islice(records, limit)
+
+    def body() -> Iterator[str]:
+        try:
+            yield from render_export(records, fmt)
+        except Exception as e:
+            # Заголовки уже отправлены — остаётся записать ошибку и оборвать поток
+            logger.error(f"Ошибка экспорта логов: {e}")
+            raise
+
+    filename = f"logs_{datetime.now().strftime('%Y%m%d_%H%M%S')}.{fmt}"
+    # Синхронный генератор Starlette обходит в пуле потоков: чтение сегментов не блокирует event loop
+    return StreamingResponse(body(), media_type=_EXPORT_MEDIA_TYPES[fmt],
+                             headers={"Content-Disposition": f'attachment; filename="{filename}"'})
+
+# ========================
+# Live-tail (Server-Sent Events)
+# ========================
+
+def _sse_event(log: Dict) -> str:
+    return f"id: {log['id']}\nevent: log\ndata: {_to_json(log)}\n\n"
+
+@app.get("/tail")
+async def tail_logs(request: Request, service: Optional[str] = None, level: Optional[LogLevel] = None,
+                    min_level: Optional[LogLevel] = None, user_id: Optional[str] = None,
+                    request_id: Optional[str] = None, contains: Optional[str] = None, backlog: int = 0):
+    """
+    Поток новых записей в формате SSE (text/event-stream) с фильтрами на сервере.
+    backlog — сколько последних подходящих записей отправить сразу после подключения.
+    Если клиент не успевает читать, записи отбрасываются и приходит событие dropped.
+    """
+    filters = {k: v for k, v in (("service", service), ("level", level.value if level else None),
+                                 ("user_id", user_id), ("request_id", request_id)) if v is not None}
+    sub = log_tail.subscribe(filters, min_level.value if min_level else None, contains)
+    if sub is None:
+        raise HTTPException(status_code=503, detail="Слишком много подписчиков live-tail")
+
+    history: List[Dict] = []
+    if backlog > 0:
+        # Подписка оформлена до чтения истории: новые записи не потеряются, дубли отсекаются по id
+        recent = log_storage.query_logs(LogQuery(
+            service=service, level=level, user_id=user_id, request_id=request_id, limit=min(backlog, 1000)))
+        history = [log for log in reversed(recent) if sub.matches(log)]
+    last_seen = max((int(log["id"][4:]) for log in history), default=0)
+
+    async def stream():
+        try:
+            yield ": connected\n\n"
+            for log in history:
+                yield _sse_event(log)
+            while True:
+                try:
+                    log = await asyncio.wait_for(sub.queue.get(), timeout=LOGGING_TAIL_HEARTBEAT_SECONDS)
+                except asyncio.TimeoutError:
+                    if await request.is_disconnected():
+                        break
+                    yield ": keepalive\n\n"
+                    continue
+                # Забираем всё накопившееся одной порцией
+                batch = [log]
+                while not sub.queue.empty():
+                    batch.append(sub.queue.get_nowait())
+                parts = []
+                if sub.dropped:
+                    parts.append(f"event: dropped\ndata: {json.dumps({'dropped': sub.dropped})}\n\n")
+                    sub.dropped = 0
+                parts.extend(_sse_event(item) for item in batch if int(item["id"][4:]) > last_seen)
+                if parts:
+                    yield "".join(parts)
+        finally:
+            log_tail.unsubscribe(sub)
+
+    return StreamingResponse(stream(), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
 
 # ========================
 # Запуск приложения
@@ -0,0 +1,512 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Сегментированное хранилище логов на диске (append-only).
+
+Формат:
+  <first_seq>.seg — последовательность сжатых блоков: заголовок BLOCK_HEADER + zlib(JSON-строки записей);
+  <first_seq>.idx — разреженный индекс: по одной записи INDEX_ENTRY на блок (смещение, время, seq).
+
+append_many() только ставит записи в ограниченную очередь; кодирование, сжатие и запись на диск
+выполняет фоновый поток: блок сбрасывается при заполнении или по таймеру.
+Очистка (/clear) необратимо скрывает записи через «водяные знаки» в clears.json: все записи
+с seq <= cleared_seq и записи сервиса с seq <= cleared_services[service].
+Сегмент закрывается по размеру или возрасту; старые сегменты удаляются по возрасту/суммарному размеру.
+Чтение — через mmap только тех блоков, чей диапазон времени пересекается с запросом.
+Если .idx повреждён или отстаёт от .seg (падение между записями), индекс восстанавливается по заголовкам блоков.
+"""
+
+import os
+import json
+import mmap
+import time
+import zlib
+import struct
+import logging
+import threading
+from collections import deque
+from datetime import datetime
+from typing import Any, Callable, Deque, Dict, Iterator, List, Optional
+
+logger = logging.getLogger(__name__)
+
+# length, count, min_ts, max_ts, first_seq, last_seq
+BLOCK_HEADER = struct.Struct("<IIddqq")
+# offset + поля заголовка блока
+INDEX_ENTRY = struct.Struct("<QIIddqq")
+# Водяные знаки очистки
+CLEARS_FILE = "clears.json"
+
+
+class BlockMeta:
+    __slots__ = ("offset", "length", "count", "min_ts", "max_ts", "first_seq", "last_seq")
+
+    def __init__(self, offset: int, length: int, count: int, min_ts: float, max_ts: float,
+                 first_seq: int, last_seq: int):
+        self.offset = offset
+        self.length = length
+        self.count = count
+        self.min_ts = min_ts
+        self.max_ts = max_ts
+        self.first_seq = first_seq
+        self.last_seq = last_seq
+
+    @property
+    def end(self) -> int:
+        return self.offset + BLOCK_HEADER.size + self.length
+
+
+class Segment:
+    def __init__(self, directory: str, first_seq: int):
+        self.first_seq = first_seq
+        base = os.path.join(directory, f"{first_seq:020d}")
+        self.data_path = base + ".seg"
+        self.index_path = base + ".idx"
+        self.blocks: List[BlockMeta] = []
+        self.created = time.time()
+
+    @property
+    def size(self) -> int:
+        return self.blocks[-1].end if self.blocks else 0
+
+    @property
+    def min_ts(self) -> float:
+        return min(b.min_ts for b in self.blocks) if self.blocks else 0.0
+
+    @property
+    def max_ts(self) -> float:
+        return max(b.max_ts for b in self.blocks) if self.blocks else 0.0
+
+    def load(self):
+        """Читает индекс, проверяет его по .seg и дочитывает неиндексированные блоки"""
+        data_size = os.path.getsize(self.data_path) if os.path.exists(self.data_path) else 0
+        blocks: List[BlockMeta] = []
+        if os.path.exists(self.index_path):
+            with open(self.index_path, "rb") as f:
+                raw = f.read()
+            for pos in range(0, len(raw) - INDEX_ENTRY.size + 1, INDEX_ENTRY.size):
+                meta = BlockMeta(*INDEX_ENTRY.unpack_from(raw, pos))
+                if meta.offset != (blocks[-1].end if blocks else 0) or meta.end > data_size:
+                    break
+                blocks.append(meta)
+
+        recovered = 0
+        offset = blocks[-1].end if blocks else 0
+        with open(self.data_path, "rb") as f:
+            while offset + BLOCK_HEADER.size <= data_size:
+                f.seek(offset)
+                header = BLOCK_HEADER.unpack(f.read(BLOCK_HEADER.size))
+                meta = BlockMeta(offset, *header)
+                if meta.end > data_size:
+                    break
+                blocks.append(meta)
+                recovered += 1
+                offset = meta.end
+        self.blocks = blocks
+
+        if offset < data_size:
+            logger.warning(f"Сегмент {self.data_path}: обрезаем неполный блок ({data_size - offset} байт)")
+            with open(self.data_path, "r+b") as f:
+                f.truncate(offset)
+        if recovered:
+            logger.warning(f"Сегмент {self.data_path}: индекс восстановлен по {recovered} блокам")
+            with open(self.index_path, "wb") as f:
+                for b in blocks:
+                    f.write(INDEX_ENTRY.pack(b.offset, b.length, b.count, b.min_ts, b.max_ts, b.first_seq, b.last_seq))
+        if blocks:
+            self.created = blocks[0].min_ts
+
+    def read_block(self, mm: mmap.mmap, meta: BlockMeta) -> List[Dict[str, Any]]:
+        start = meta.offset + BLOCK_HEADER.size
+        payload = zlib.decompress(mm[start:start + meta.length])
+        return [json.loads(line) for line in payload.split(b"\n") if line]
+
+
+class SegmentStore:
+    """Потокобезопасное append-only хранилище записей лога на диске"""
+
+    def __init__(self, directory: str, segment_max_bytes: int = 16 * 1024 * 1024,
+                 segment_max_age: float = 3600.0, block_bytes: int = 64 * 1024,
+                 flush_interval: float = 1.0, retention_seconds: float = 7 * 86400.0,
+                 retention_max_bytes: int = 1024 * 1024 * 1024, fsync: bool = False,
+                 queue_max_entries: int = 100000):
+        self.directory = directory
+        self.segment_max_bytes = segment_max_bytes
+        self.segment_max_age = segment_max_age
+        self.block_bytes = block_bytes
+        self.flush_interval = flush_interval
+        self.retention_seconds = retention_seconds
+        self.retention_max_bytes = retention_max_bytes
+        self.fsync = fsync
+        self.queue_max_entries = max(1, int(queue_max_entries))
+
+        self._lock = threading.RLock()
+        self._segments: List[Segment] = []
+        self._active: Optional[Segment] = None
+        self._pending: List[bytes] = []
+        self._pending_bytes = 0
+        self._pending_meta: Optional[List[float]] = None  # [min_ts, max_ts, first_seq, last_seq]
+        self._pending_records: List[Dict[str, Any]] = []
+        self.last_seq = 0
+        # Очередь записей к фоновому писателю; порядок — порядок seq (append_many вызывается под блокировкой LogStorage)
+        self._queue: Deque[tuple] = deque()
+        self._queue_cond = threading.Condition()
+        self.dropped = 0
+        self._last_drop_log = 0.0
+        self.cleared_seq = 0
+        self.cleared_services: Dict[str, int] = {}
+        self._stop = threading.Event()
+        self._flusher: Optional[threading.Thread] = None
+
+        os.makedirs(directory, exist_ok=True)
+        self._load()
+
+    # ---------- жизненный цикл ----------
+
+    def _load(self):
+        names = sorted(n for n in os.listdir(self.directory) if n.endswith(".seg"))
+        for name in names:
+            try:
+                seg = Segment(self.directory, int(name[:-4]))
+                seg.load()
+            except Exception as e:
+                logger.error(f"Не удалось загрузить сегмент {name}: {e}")
+                continue
+            if seg.blocks:
+                self._segments.append(seg)
+                self.last_seq = max(self.last_seq, seg.blocks[-1].last_seq)
+        if self._segments:
+            logger.info(f"Загружено сегментов логов: {len(self._segments)}, последний seq={self.last_seq}")
+        self._load_clears()
+
+    def start(self):
+        if self._flusher is None:
+            self._stop.clear()
+            self._flusher = threading.Thread(target=self._write_loop, name="segment-writer", daemon=True)
+            self._flusher.start()
+
+    def close(self):
+        self._stop.set()
+        with self._queue_cond:
+            self._queue_cond.notify_all()
+        if self._flusher is not None:
+            self._flusher.join(timeout=5.0)
+            self._flusher = None
+        self.flush()
+
+    def _write_loop(self):
+        next_flush = time.monotonic() + self.flush_interval
+        while not self._stop.is_set():
+            with self._queue_cond:
+                if not self._queue:
+                    self._queue_cond.wait(max(0.0, next_flush - time.monotonic()))
+            try:
+                self._drain()
+                if time.monotonic() >= next_flush:
+                    next_flush = time.monotonic() + self.flush_interval
+                    self.flush()
+                    self.enforce_retention()
+            except Exception as e:
+                logger.error(f"Ошибка записи сегмента логов: {e}")
+
+    # ---------- запись ----------
+
+    def append(self, seq: int, record: Dict[str, Any]) -> bool:
+        return self.append_many([(seq, record)])
+
+    def append_many(self, items: List[tuple]) -> bool:
+        """
+        items — пары (seq, запись); seq должны возрастать. Только постановка в очередь фонового
+        писателя (вызывается на пути запроса). При переполнении очереди пачка на диск не попадает
+        (остаётся в памяти сервиса) — False.
+        """
+        with self._queue_cond:
+            if len(self._queue) + len(items) > self.queue_max_entries:
+                self.dropped += len(items)
+                now = time.monotonic()
+                if now - self._last_drop_log > 60.0:
+                    self._last_drop_log = now
+                    logger.warning(f"Очередь записи логов на диск переполнена; отброшено записей: {self.dropped}")
+                return False
+            self._queue.extend(items)
+            self._queue_cond.notify()
+        return True
+
+    def _drain(self):
+        """Переносит очередь в текущий блок (кодирование и сжатие — уже вне пути запроса)"""
+        with self._lock:
+            with self._queue_cond:
+                items = list(self._queue)
+                self._queue.clear()
+            for seq, record in items:
+                ts = record_timestamp(record.get("timestamp"))
+                line = json.dumps(record, ensure_ascii=False, default=_json_default).encode("utf-8")
+                self._pending.append(line)
+                self._pending_records.append(record)
+                self._pending_bytes += len(line) + 1
+                if self._pending_meta is None:
+                    self._pending_meta = [ts, ts, seq, seq]
+                else:
+                    meta = self._pending_meta
+                    meta[0] = min(meta[0], ts)
+                    meta[1] = max(meta[1], ts)
+                    meta[3] = seq
+                self.last_seq = max(self.last_seq, seq)
+                if self._pending_bytes >= self.block_bytes:
+                    self._flush_block()
+
+    def flush(self):
+        with self._lock:
+            self._drain()
+            if self._pending:
+                self._flush_block()
+
+    def _flush_block(self):
+        payload = zlib.compress(b"\n".join(self._pending) + b"\n", 6)
+        min_ts, max_ts, first_seq, last_seq = self._pending_meta
+        count = len(self._pending)
+
+        seg = self._active
+        if seg is None or seg.size >= self.segment_max_bytes or time.time() - seg.created >= self.segment_max_age:
+            seg = self._roll(int(first_seq))
+
+        meta = BlockMeta(seg.size, len(payload), count, min_ts, max_ts, int(first_seq), int(last_seq))
+        with open(seg.data_path, "ab") as f:
+            f.write(BLOCK_HEADER.pack(meta.length, meta.count, meta.min_ts, meta.max_ts, meta.first_seq, meta.last_seq))
+            f.write(payload)
+            if self.fsync:
+                f.flush()
+                os.fsync(f.fileno())
+        # Индекс пишется после данных: при падении между ними он восстановится по .seg
+        with open(seg.index_path, "ab") as f:
+            f.write(INDEX_ENTRY.pack(meta.offset, meta.length, meta.count, meta.min_ts, meta.max_ts,
+                                     meta.first_seq, meta.last_seq))
+        seg.blocks.append(meta)
+
+        self._pending = []
+        self._pending_records = []
+        self._pending_bytes = 0
+        self._pending_meta = None
+
+    def _roll(self, first_seq: int) -> Segment:
+        seg = Segment(self.directory, first_seq)
+        # Имя занято (seq начался заново после потери данных) — берём следующее свободное
+        while os.path.exists(seg.data_path) and os.path.getsize(seg.data_path) > 0:
+            first_seq += 1
+            seg = Segment(self.directory, first_seq)
+        open(seg.data_path, "ab").close()
+        self._segments.append(seg)
+        self._active = seg
+        return seg
+
+    # ---------- очистка ----------
+
+    def _load_clears(self):
+        path = os.path.join(self.directory, CLEARS_FILE)
+        if not os.path.exists(path):
+            return
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+            self.cleared_seq = int(data.get("cleared_seq", 0))
+            self.cleared_services = {str(k): int(v) for k, v in (data.get("services") or {}).items()}
+        except Exception as e:
+            logger.error(f"Не удалось прочитать {path}: {e}")
+
+    def clear(self, through_seq: int, service: Optional[str] = None):
+        """
+        Скрывает записи с seq <= through_seq (все или одного сервиса) из всех последующих scan().
+        Водяной знак сохраняется на диск до возврата, поэтому очистка переживает перезапуск.
+        """
+        through_seq = int(through_seq)
+        with self._lock:
+            if service:
+                if through_seq > max(self.cleared_seq, self.cleared_services.get(service, 0)):
+                    self.cleared_services[service] = through_seq
+            else:
+                self.cleared_seq = max(self.cleared_seq, through_seq)
+                # Знаки сервисов, перекрытые общим, больше не нужны
+                self.cleared_services = {k: v for k, v in self.cleared_services.items() if v > self.cleared_seq}
+            path = os.path.join(self.directory, CLEARS_FILE)
+            tmp = path + ".tmp"
+            with open(tmp, "w", encoding="utf-8") as f:
+                json.dump({"cleared_seq": self.cleared_seq, "services": self.cleared_services}, f)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp, path)
+
+    # ---------- ретеншн ----------
+
+    def enforce_retention(self) -> int:
+        """Удаляет самые старые закрытые сегменты сверх лимита возраста/размера"""
+        removed = 0
+        with self._lock:
+            now = time.time()
+            total = sum(s.size for s in self._segments)
+            while len(self._segments) > 1 and self._segments[0] is not self._active:
+                oldest = self._segments[0]
+                too_old = self.retention_seconds > 0 and oldest.max_ts < now - self.retention_seconds
+                too_big = self.retention_max_bytes > 0 and total > self.retention_max_bytes
+                if not (too_old or too_big):
+                    break
+                self._segments.pop(0)
+                total -= oldest.size
+                for path in (oldest.data_path, oldest.index_path):
+                    try:
+                        os.remove(path)
+                    except FileNotFoundError:
+                        pass
+                removed += 1
+        if removed:
+            logger.info(f"Ретеншн логов: удалено сегментов {removed}")
+        return removed
+
+    # ---------- чтение ----------
+
+    def scan(self, start_ts: Optional[float] = None, end_ts: Optional[float] = None,
+             before_seq: Optional[int] = None,
+             predicate: Optional[Callable[[Dict[str, Any]], bool]] = None,
+             stop_below_ts: Optional[Callable[[], Optional[float]]] = None,
+             newest_first: bool = True) -> Iterator[Dict[str, Any]]:
+        """
+        Записи от новых блоков к старым (внутри блока — от новых к старым),
+        с newest_first=False — в порядке записи (потоковый экспорт).
+        Блоки вне [start_ts, end_ts] и с seq >= before_seq пропускаются по разреженному индексу.
+        stop_below_ts() — граница от вызывающего: блоки, целиком более старые, уже не нужны.
+        """
+        with self._lock:
+            with self._queue_cond:
+                queued = list(self._queue)
+            pending = list(self._pending_records) + [record for _, record in queued]
+            pending_meta = list(self._pending_meta) if self._pending_meta else None
+            if queued:
+                queued_ts = [record_timestamp(record.get("timestamp")) for _, record in queued]
+                if pending_meta is None:
+                    pending_meta = [min(queued_ts), max(queued_ts), queued[0][0], queued[-1][0]]
+                else:
+                    pending_meta = [min(pending_meta[0], min(queued_ts)), max(pending_meta[1], max(queued_ts)),
+                                    pending_meta[2], queued[-1][0]]
+            segments = [(seg, list(seg.blocks)) for seg in self._segments]
+            cleared_seq = self.cleared_seq
+            cleared_services = dict(self.cleared_services)
+
+        def wanted(ts: float, seq: Optional[int], record: Dict[str, Any]) -> bool:
+            if start_ts is not None and ts < start_ts:
+                return False
+            if end_ts is not None and ts > end_ts:
+                return False
+            if before_seq is not None and seq is not None and seq >= before_seq:
+                return False
+            if seq is not None and (seq <= cleared_seq or seq <= cleared_services.get(record.get("service"), 0)):
+                return False
+            return predicate(record) if predicate else True
+
+        def block_relevant(min_ts: float, max_ts: float, first_seq: int, last_seq: int) -> bool:
+            if start_ts is not None and max_ts < start_ts:
+                return False
+            if end_ts is not None and min_ts > end_ts:
+                return False
+            if before_seq is not None and first_seq >= before_seq:
+                return False
+            if last_seq <= cleared_seq:
+                return False
+            floor = stop_below_ts() if stop_below_ts else None
+            return floor is None or max_ts >= floor
+
+        def ordered(items):
+            return reversed(items) if newest_first else iter(items)
+
+        def read_pending() -> Iterator[Dict[str, Any]]:
+            if pending_meta and block_relevant(pending_meta[0], pending_meta[1], int(pending_meta[2]),
+                                               int(pending_meta[3])):
+                for record in ordered(pending):
+                    ts = record_timestamp(record.get("timestamp"))
+                    if wanted(ts, _seq(record), record):
+                        yield _decode(dict(record))
+
+        if newest_first:
+            yield from read_pending()
+
+        for seg, blocks in ordered(segments):
+            if not blocks:
+                continue
+            try:
+                f = open(seg.data_path, "rb")
+            except FileNotFoundError:
+                continue  # удалён ретеншном во время чтения
+            with f:
+                size = os.fstat(f.fileno()).st_size
+                if size == 0:
+                    continue
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                    for meta in ordered(blocks):
+                        if meta.end > size or not block_relevant(meta.min_ts, meta.max_ts, meta.first_seq,
+                                                                 meta.last_seq):
+                            continue
+                        for record in ordered(seg.read_block(mm, meta)):
+                            ts = record_timestamp(record.get("timestamp"))
+                            if wanted(ts, _seq(record), record):
+                                yield _decode(record)
+
+        if not newest_first:
+            yield from read_pending()
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            segments = list(self._segments)
+            with self._queue_cond:
+                pending = len(self._pending) + len(self._queue)
+        blocks = [b for s in segments for b in s.blocks]
+        return {
+            "directory": self.directory,
+            "segments": len(segments),
+            "bytes": sum(s.size for s in segments),
+            "entries": sum(b.count for b in blocks) + pending,
+            "pending_entries": pending,
+            "oldest": datetime.fromtimestamp(min(b.min_ts for b in blocks)) if blocks else None,
+            "newest": datetime.fromtimestamp(max(b.max_ts for b in blocks)) if blocks else None,
+            "last_seq": self.last_seq,
+            "dropped": self.dropped,
+            "cleared_seq": self.cleared_seq,
+            "cleared_services": dict(self.cleared_services),
+        }
+
+
+def _json_default(value: Any):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    return str(value)
+
+
+def record_timestamp(value: Any) -> float:
+    """Время записи в секундах: datetime, ISO-строка (как на диске) или число; иначе 0"""
+    if isinstance(value, datetime):
+        return value.timestamp()
+    if isinstance(value, str):
+        try:
+            return datetime.fromisoformat(value).timestamp()
+        except ValueError:
+            return 0.0
+    if isinstance(value, (int, float)):
+        return float(value)
+    return 0.0
+
+
+def _seq(record: Dict[str, Any]) -> Optional[int]:
+    log_id = record.get("id")
+    if isinstance(log_id, str) and log_id.startswith("log_"):
+        try:
+            return int(log_id[4:])
+        except ValueError:
+            return None
+    return None
+
+
+def _decode(record: Dict[str, Any]) -> Dict[str, Any]:
+    ts = record.get("timestamp")
+    if isinstance(ts, str):
+        try:
+            record["timestamp"] = datetime.fromisoformat(ts)
+        except ValueError:
+            pass
+    return record
@@ -12,6 +12,7 @@ from datetime import datetime
 
 import numpy as np
 from fastapi import FastAPI, HTTPException, BackgroundTasks
+from fastapi.responses import PlainTextResponse
 from pydantic import BaseModel, Field
 import uvicorn
 import zlib  # добавлено для стабильного хеширования user_id
@@ -20,11 +21,16 @@ import zlib  # добавлено для стабильного хеширова
 import sys
 sys.path.append(os.path.dirname(os.path.dirname(os.path.dirname(__file__))))
 
-from rag_yandex_nofaiss import load_vectorstore, build_index_from_bucket
+from rag_yandex_nofaiss import load_vectorstore, build_index_from_bucket, start_intent_router
 from faiss_index_yandex import semantic_search  # оставим только при необходимости
 from bartender_file_handler import build_bartender_index_from_bucket
 from incremental_rag import update_rag_incremental
 from settings import VECTORSTORE_DIR, S3_BUCKET, S3_PREFIX
+from request_deadline import install_deadline
+from pipeline_metrics import REGISTRY, PROMETHEUS_CONTENT_TYPE
+from bounded_executor import ExecutorOverloaded
+from yandex_api_async import aclose_async_client
+import tracing
 
 # Настройка логирования
 logging.basicConfig(level=logging.INFO)
@@ -92,6 +98,9 @@ class IndexRebuildRequest(BaseModel):
 _vectorstore_cache = None
 _last_index_load = None
 
+VECTORSTORE_CACHE_REQUESTS = REGISTRY.counter(
+    "rag_cache_requests_total", "Обращения к кешам (vectorstore, эмбеддинг запроса из роутера)", ("cache", "result"))
+
 # ========================
 # Вспомогательные функции
 # ========================
@@ -106,10 +115,13 @@ async def get_vectorstore():
             _last_index_load is None or
             (current_time - _last_index_load).total_seconds() > 3600):
 
+            VECTORSTORE_CACHE_REQUESTS.inc(cache="vectorstore", result="miss")
             logger.info("Загрузка векторного хранилища...")
             _vectorstore_cache = load_vectorstore()
             _last_index_load = current_time
             logger.info("Векторное хранилище загружено")
+        else:
+            VECTORSTORE_CACHE_REQUESTS.inc(cache="vectorstore", result="hit")
 
         return _vectorstore_cache
     except Exception as e:
@@ -122,6 +134,24 @@ def invalidate_vectorstore_cache():
     _vectorstore_cache = None
     _last_index_load = None
 
+# ========================
+# Трассировка и дедлайн запроса
+# ========================
+
+tracing.install_tracing(app, "rag")
+
+install_deadline(app)
+
+@app.on_event("startup")
+async def startup_event():
+    """Центроиды роутера намерений строятся в фоне: первые запросы не ждут вызовов эмбеддингов"""
+    start_intent_router()
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    """Закрываем соединения асинхронного клиента Yandex API"""
+    await aclose_async_client()
+
 # ========================
 # API эндпоинты
 # ========================
@@ -156,6 +186,11 @@ async def health_check():
             "error": str(e)
         }
 
+@app.get("/metrics", response_class=PlainTextResponse)
+async def metrics():
+    """Метрики пайплайна в формате Prometheus (тайминги этапов, исходы, fallback/хеджи, кеши)"""
+    return PlainTextResponse(REGISTRY.render(), media_type=PROMETHEUS_CONTENT_TYPE)
+
 @app.post("/answer", response_model=QueryResponse)
 async def generate_answer(request: QueryRequest):
     """Генерация ответа с использованием RAG"""
@@ -185,6 +220,9 @@ async def generate_answer(request: QueryRequest):
 
         processing_time = (datetime.now() - start_time).total_seconds()
 
+        if meta.get("deadline_exceeded"):
+            raise HTTPException(status_code=504, detail=f"Дедлайн запроса истёк ({meta['deadline_exceeded'].get('stage')})")
+
         response = QueryResponse(
             answer=answer,
             retrieved_count=meta.get("retrieved_count", 0),
@@ -195,6 +233,13 @@ async def generate_answer(request: QueryRequest):
         logger.info(f"Ответ сформирован за {processing_time:.2f}s")
         return response
 
+    except ExecutorOverloaded as e:
+        # Очередь пайплайна заполнена: отказываем сразу, а не копим запросы до таймаута gateway
+        logger.warning(f"Перегрузка: {e}; Retry-After={e.retry_after_header}s")
+        raise HTTPException(status_code=503, detail="RAG сервис перегружен, повторите запрос позже",
+                            headers={"Retry-After": e.retry_after_header})
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Ошибка генерации ответа: {e}\n{traceback.format_exc()}")
         raise HTTPException(status_code=500, detail=f"Ошибка генерации ответа: {str(e)}")
@@ -206,9 +251,9 @@ async def semantic_search_endpoint(request: SearchRequest):
 
     try:
         # Используем устойчивый поиск из rag_yandex_nofaiss
-        from rag_yandex_nofaiss import semantic_search_in_memory
+        from rag_yandex_nofaiss import semantic_search_in_memory_async
 
-        results = semantic_search_in_memory(request.query, k=request.k)
+        results = await semantic_search_in_memory_async(request.query, k=request.k)
 
         # Применяем порог, если указан
         filtered = [r for r in results if float(r.get("score", 0.0)) >= float(request.threshold or 0.0)]
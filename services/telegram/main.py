@@ -36,7 +36,17 @@ try:
 except Exception:
     TELEGRAM_TOKEN = os.getenv("TELEGRAM_TOKEN")
 
+from request_deadline import set_budget, reset as reset_deadline, outgoing_headers, clamp_timeout
+import tracing
+
+tracing.init_tracing("telegram")
+
 GATEWAY_URL = os.getenv("GATEWAY_URL", "http://gateway:8000")
+# Общий бюджет на ответ пользователю; передаётся дальше по цепочке в заголовке дедлайна
+try:
+    REQUEST_BUDGET_SECONDS = float(os.getenv("TELEGRAM_REQUEST_BUDGET_SECONDS", "60"))
+except Exception:
+    REQUEST_BUDGET_SECONDS = 60.0
 REDIS_URL = os.getenv("REDIS_URL", "redis://redis:6379/0")
 
 # Режим работы: polling (локально) или webhook (в облаке). По умолчанию — polling
@@ -154,22 +164,31 @@ class GatewayClient:
 
     async def ask_bartender(self, query: str, user_id: str) -> dict:
         """Отправка запроса к барменскому ИИ через Gateway"""
+        # Край системы: здесь начинается дедлайн запроса пользователя
+        token = set_budget(REQUEST_BUDGET_SECONDS)
         try:
-            response = await self.client.post(
-                f"{self.gateway_url}/bartender/ask",
-                json={
-                    "query": query,
-                    "user_id": user_id,
-                    "k": 3,
-                    "with_moderation": True
-                },
-                timeout=60.0
-            )
-            response.raise_for_status()
-            return response.json()
+            timeout = clamp_timeout(REQUEST_BUDGET_SECONDS)
+            with tracing.start_span("gateway POST /bartender/ask", kind="client",
+                                    attributes={"peer.service": "gateway"}) as span:
+                response = await self.client.post(
+                    f"{self.gateway_url}/bartender/ask",
+                    json={
+                        "query": query,
+                        "user_id": user_id,
+                        "k": 3,
+                        "with_moderation": True
+                    },
+                    headers={**outgoing_headers(timeout), **tracing.outgoing_headers()},
+                    timeout=timeout
+                )
+                span.set_attribute("http.status_code", response.status_code)
+                response.raise_for_status()
+                return response.json()
         except Exception as e:
-            logger.error(f"Ошибка обращения к Gateway: {e}")
+            logger.error(f"Ошибка обращения к Gateway (trace_id={tracing.current_trace_id()}): {e}")
             raise
+        finally:
+            reset_deadline(token)
 
 gateway_client = GatewayClient()
 
@@ -292,7 +311,13 @@ async def on_terms_decision(update: Update, context: ContextTypes.DEFAULT_TYPE)
         await query.answer()
 
 async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    """Обработчик текстовых сообщений"""
+    """Обработчик текстовых сообщений: здесь начинается трасса пользовательского запроса"""
+    user = update.effective_user
+    with tracing.start_span("telegram handle_message", kind="server",
+                            attributes={"user_id": str(user.id) if user else None}):
+        await _handle_message(update, context)
+
+async def _handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     user = update.effective_user
     message = update.message
 
@@ -377,6 +402,18 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
         else:
             await message.reply_text(formatted_answer, parse_mode='MarkdownV2')
 
+    except httpx.HTTPStatusError as e:
+        status = e.response.status_code
+        logger.error(f"Ошибка при обработке сообщения: HTTP {status}")
+        if status in (429, 503):
+            # Сервис отклонил запрос из-за перегрузки — подсказываем, когда повторить
+            retry_after = e.response.headers.get("Retry-After", "")
+            wait_hint = f" через {retry_after} сек." if retry_after.isdigit() else " через несколько секунд."
+            await message.reply_text(f"🍸 Бармен сейчас очень занят. Попробуйте еще раз{wait_hint}")
+        else:
+            await message.reply_text(
+                "😔 Произошла ошибка при обработке запроса. Попробуйте еще раз через несколько секунд."
+            )
     except Exception as e:
         logger.error(f"Ошибка при обработке сообщения: {e}")
         await message.reply_text(
@@ -5,9 +5,11 @@ Validation Service - сервис валидации и модерации ко
 """
 
 import os
+import time
+import asyncio
 import logging
 import traceback
-from typing import Optional
+from typing import Dict, List, Optional, Tuple
 
 from fastapi import FastAPI, HTTPException
 from pydantic import BaseModel, Field
@@ -17,7 +19,16 @@ import uvicorn
 import sys
 sys.path.append(os.path.dirname(os.path.dirname(os.path.dirname(__file__))))
 
-from moderation_yandex import pre_moderate_input, post_moderate_output
+from moderation_yandex import (
+    pre_moderate_input,
+    post_moderate_output,
+    quick_check,
+    quick_check_output,
+    llm_moderation_yandex_batch,
+)
+import request_deadline
+from request_deadline import install_deadline, set_budget
+import tracing
 
 # Настройка логирования
 logging.basicConfig(level=logging.INFO)
@@ -56,6 +67,144 @@ class ValidationResponse(BaseModel):
     errors: list = Field(default_factory=list, description="Список ошибок")
     suggestions: list = Field(default_factory=list, description="Предложения по исправлению")
 
+# ========================
+# Микробатчинг LLM-модерации
+# ========================
+
+MODERATION_BATCHING = os.getenv("VALIDATION_MODERATION_BATCHING", "true").lower() in {"1", "true", "yes"}
+try:
+    BATCH_WINDOW_MS = max(0.0, float(os.getenv("VALIDATION_BATCH_WINDOW_MS", "15")))
+except Exception:
+    BATCH_WINDOW_MS = 15.0
+try:
+    BATCH_MAX_SIZE = max(1, int(os.getenv("VALIDATION_BATCH_MAX_SIZE", "8")))
+except Exception:
+    BATCH_MAX_SIZE = 8
+
+
+class ModerationBatcher:
+    """
+    Собирает тексты на модерацию в течение нескольких миллисекунд и отправляет их
+    одним пронумерованным промптом (llm_moderation_yandex_batch).
+    Одинаковые тексты внутри пачки проверяются один раз.
+    Ошибка пакетного вызова передаётся каждому ожидающему (fail closed), а не превращается в SAFE.
+    """
+
+    def __init__(self, window_ms: float = 15.0, max_batch: int = 8):
+        self.window = window_ms / 1000.0
+        self.max_batch = max(1, int(max_batch))
+        self._queue: Optional[asyncio.Queue] = None
+        self._task: Optional[asyncio.Task] = None
+        self._inflight: set = set()
+        self.stats: Dict[str, int] = {
+            "submitted": 0,
+            "batches": 0,
+            "llm_calls_saved": 0,
+            "errors": 0,
+        }
+
+    @property
+    def running(self) -> bool:
+        return self._task is not None and not self._task.done()
+
+    def start(self):
+        if self.running:
+            return
+        self._queue = asyncio.Queue()
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        if self._inflight:
+            await asyncio.gather(*self._inflight, return_exceptions=True)
+
+    async def submit(self, text: str) -> Tuple[bool, str]:
+        """Ставит текст в очередь и ждёт вердикт своей пачки"""
+        if not self.running:
+            results = await asyncio.to_thread(llm_moderation_yandex_batch, [text])
+            return results[0]
+        fut = asyncio.get_running_loop().create_future()
+        self.stats["submitted"] += 1
+        rem = request_deadline.remaining()
+        deadline = None if rem is None else time.monotonic() + rem
+        await self._queue.put((text, fut, deadline))
+        if rem is None:
+            return await fut
+        try:
+            # wait_for отменяет future по таймауту — такая пачка пропустит этот текст
+            return await asyncio.wait_for(fut, rem)
+        except asyncio.TimeoutError:
+            raise request_deadline.DeadlineExceeded("moderation batch")
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self._queue.get()]
+            deadline = loop.time() + self.window
+            while len(batch) < self.max_batch:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            # Отправляем пачку в фоне, чтобы сразу начать собирать следующую
+            task = asyncio.create_task(self._flush(batch))
+            self._inflight.add(task)
+            task.add_done_callback(self._inflight.discard)
+
+    async def _flush(self, batch: List[Tuple[str, asyncio.Future, Optional[float]]]):
+        # Вызывающие, которые уже не ждут (дедлайн истёк), не тратят квоту
+        batch = [item for item in batch if not item[1].done()]
+        if not batch:
+            return
+        unique: List[str] = []
+        positions: Dict[str, int] = {}
+        for text, _, _ in batch:
+            if text not in positions:
+                positions[text] = len(unique)
+                unique.append(text)
+
+        # Дедлайн пачки — самый поздний из дедлайнов её участников
+        deadlines = [d for _, _, d in batch]
+        if all(d is not None for d in deadlines):
+            set_budget(max(deadlines) - time.monotonic())
+
+        try:
+            results = await asyncio.to_thread(llm_moderation_yandex_batch, unique)
+        except Exception as e:
+            # Не пропускаем тексты без проверки: ошибка доходит до /moderate (500), и gateway блокирует
+            logger.error(f"Ошибка пакетной модерации: {e}")
+            self.stats["errors"] += 1
+            for _, fut, _ in batch:
+                if not fut.done():
+                    fut.set_exception(e)
+            return
+
+        self.stats["batches"] += 1
+        self.stats["llm_calls_saved"] += len(batch) - 1
+        for text, fut, _ in batch:
+            if not fut.done():
+                fut.set_result(results[positions[text]])
+
+
+moderation_batcher = ModerationBatcher(window_ms=BATCH_WINDOW_MS, max_batch=BATCH_MAX_SIZE)
+
+# ========================
+# Трассировка и дедлайн запроса
+# ========================
+
+tracing.install_tracing(app, "validation")
+
+install_deadline(app)
+
 # ========================
 # Валидационные функции
 # ========================
@@ -133,7 +282,14 @@ async def health_check():
     return {
         "status": "healthy",
         "moderation": "available",
-        "validation": "available"
+        "validation": "available",
+        "moderation_batching": {
+            "enabled": MODERATION_BATCHING,
+            "running": moderation_batcher.running,
+            "window_ms": BATCH_WINDOW_MS,
+            "max_batch": BATCH_MAX_SIZE,
+            **moderation_batcher.stats
+        }
     }
 
 @app.post("/moderate", response_model=ModerationResponse)
@@ -142,16 +298,27 @@ async def moderate_text(request: ModerationRequest):
     try:
         logger.info(f"Модерация текста: {'входящий' if request.is_input else 'исходящий'}")
 
-        if request.is_input:
-            is_safe, reason = pre_moderate_input(request.text)
+        if not MODERATION_BATCHING:
+            if request.is_input:
+                is_safe, reason = await asyncio.to_thread(pre_moderate_input, request.text)
+            else:
+                is_safe, reason = await asyncio.to_thread(post_moderate_output, request.text)
         else:
-            is_safe, reason = post_moderate_output(request.text)
+            # Быстрые паттерны — сразу, LLM-проверка — через микробатчинг
+            if request.is_input:
+                is_safe, reason = quick_check(request.text)
+            else:
+                is_safe, reason = quick_check_output(request.text)
+            if is_safe:
+                is_safe, reason = await moderation_batcher.submit(request.text)
 
         return ModerationResponse(
             is_safe=is_safe,
             reason=reason if not is_safe else None
         )
 
+    except request_deadline.DeadlineExceeded:
+        raise HTTPException(status_code=504, detail="Дедлайн запроса истёк во время модерации")
     except Exception as e:
         logger.error(f"Ошибка модерации: {e}\n{traceback.format_exc()}")
         raise HTTPException(status_code=500, detail=f"Ошибка модерации: {str(e)}")
@@ -217,6 +384,22 @@ async def validate_and_moderate(text: str, is_input: bool = True, validation_typ
         logger.error(f"Ошибка комбинированной проверки: {e}")
         raise HTTPException(status_code=500, detail=str(e))
 
+# ========================
+# События жизненного цикла
+# ========================
+
+@app.on_event("startup")
+async def startup_event():
+    """События при запуске"""
+    if MODERATION_BATCHING:
+        moderation_batcher.start()
+        logger.info(f"Микробатчинг модерации включён: окно {BATCH_WINDOW_MS} мс, до {BATCH_MAX_SIZE} текстов")
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    """События при остановке"""
+    await moderation_batcher.stop()
+
 # ========================
 # Запуск приложения
 # ========================
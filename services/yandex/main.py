@@ -5,20 +5,38 @@ Yandex API Service - сервис для взаимодействия с API Я
 """
 
 import os
+import time
+import asyncio
 import logging
 import traceback
-from typing import List, Optional
+from contextlib import asynccontextmanager
+from typing import Any, AsyncIterator, Dict, List, Optional
 
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, Request
+from fastapi.responses import JSONResponse, PlainTextResponse, Response
 from pydantic import BaseModel, Field
 import uvicorn
 
+try:
+    import orjson  # type: ignore
+except Exception:
+    orjson = None
+
 # Импорты из оригинального проекта
 import sys
 sys.path.append(os.path.dirname(os.path.dirname(os.path.dirname(__file__))))
 
-from yandex_api import yandex_completion, yandex_text_embedding, yandex_batch_embeddings
+from yandex_api_async import (yandex_completion_async, yandex_text_embedding_async, aclose_async_client,
+                              EMBEDDING_FLIGHT, COMPLETION_FLIGHT)
+from embedding_codec import (ENCODINGS, ENCODING_JSON, OCTET_STREAM, binary_headers, dedupe, dtype_for,
+                             encode_base64, to_matrix)
 from moderation_yandex import extract_text_from_yandex_completion  # добавлено
+from request_deadline import install_deadline, clamp_timeout
+from pipeline_metrics import REGISTRY, PROMETHEUS_CONTENT_TYPE
+from yandex_resilience import GUARDS, guard_stats
+from quota_scheduler import PRIORITIES, priority, quota_stats
+from model_routing import TASK_GENERATION, TASK_PROFILES, task_stats
+import tracing
 
 # Настройка логирования
 logging.basicConfig(level=logging.INFO)
@@ -31,6 +49,166 @@ app = FastAPI(
     version="1.0.0"
 )
 
+def _env_float(name: str, default: float) -> float:
+    try:
+        return float(os.getenv(name, str(default)))
+    except Exception:
+        return default
+
+
+# Вызовы Yandex API идут через асинхронный клиент (yandex_api_async): ожидание ответа не блокирует
+# event loop. Лимит одновременных вызовов — на эндпоинт, чтобы пакетные эмбеддинги не вытесняли генерацию.
+ENDPOINT_CONCURRENCY = {
+    "completion": int(_env_float("YANDEX_SERVICE_COMPLETION_CONCURRENCY", 32)),
+    "embedding": int(_env_float("YANDEX_SERVICE_EMBEDDING_CONCURRENCY", 64)),
+    "batch_embedding": int(_env_float("YANDEX_SERVICE_BATCH_EMBEDDING_CONCURRENCY", 4)),
+}
+# Сколько ждать свободный слот; дольше — 503 + Retry-After, а не очередь до таймаута клиента
+ENDPOINT_ACQUIRE_TIMEOUT = _env_float("YANDEX_SERVICE_ACQUIRE_TIMEOUT_SECONDS", 2.0)
+# Общая квота одновременных вызовов Yandex API для всех /batch_embedding: тексты пакета уходят
+# параллельно, но несколько больших пакетов вместе не займут больше этого числа соединений
+BATCH_FANOUT_QUOTA = int(_env_float("YANDEX_SERVICE_BATCH_FANOUT_QUOTA", 16))
+# /health проверяет Yandex API не чаще раза в N секунд (результат кешируется)
+HEALTH_CACHE_SECONDS = _env_float("YANDEX_HEALTH_CACHE_SECONDS", 30.0)
+
+ENDPOINT_IN_FLIGHT = REGISTRY.gauge(
+    "yandex_endpoint_in_flight", "Выполняющиеся вызовы Yandex API по эндпоинту", ("endpoint",))
+ENDPOINT_WAITING = REGISTRY.gauge(
+    "yandex_endpoint_waiting", "Запросы, ждущие свободного слота эндпоинта", ("endpoint",))
+ENDPOINT_REJECTED = REGISTRY.counter(
+    "yandex_endpoint_rejected_total", "Запросы, отклонённые (503) из-за лимита эндпоинта", ("endpoint",))
+ENDPOINT_DURATION = REGISTRY.histogram(
+    "yandex_endpoint_duration_seconds", "Длительность вызова Yandex API по эндпоинту", ("endpoint",))
+BATCH_DUPLICATES = REGISTRY.counter(
+    "yandex_batch_duplicate_texts_total", "Повторы текстов в /batch_embedding, не отправленные в Yandex API")
+
+
+class EndpointLimiter:
+    """
+    Семафор эндпоинта: не больше limit одновременных вызовов Yandex API.
+    Запрос ждёт слот не дольше acquire_timeout (и не дольше дедлайна запроса), затем получает 503.
+    """
+
+    def __init__(self, name: str, limit: int, acquire_timeout: float = ENDPOINT_ACQUIRE_TIMEOUT):
+        self.name = name
+        self.limit = max(1, int(limit))
+        self.acquire_timeout = max(0.0, float(acquire_timeout))
+        self._sem = asyncio.Semaphore(self.limit)
+        self.in_flight = 0
+        self.waiting = 0
+        self.peak = 0
+        self.rejected = 0
+
+    @asynccontextmanager
+    async def slot(self) -> AsyncIterator[None]:
+        self.waiting += 1
+        ENDPOINT_WAITING.set(self.waiting, endpoint=self.name)
+        try:
+            await asyncio.wait_for(self._sem.acquire(), timeout=clamp_timeout(self.acquire_timeout, floor=0.0))
+        except asyncio.TimeoutError:
+            self.rejected += 1
+            ENDPOINT_REJECTED.inc(endpoint=self.name)
+            raise HTTPException(status_code=503, detail=f"Эндпоинт {self.name} перегружен, повторите запрос позже",
+                                headers={"Retry-After": "1"})
+        finally:
+            self.waiting -= 1
+            ENDPOINT_WAITING.set(self.waiting, endpoint=self.name)
+
+        self.in_flight += 1
+        self.peak = max(self.peak, self.in_flight)
+        ENDPOINT_IN_FLIGHT.set(self.in_flight, endpoint=self.name)
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            ENDPOINT_DURATION.observe(time.monotonic() - start, endpoint=self.name)
+            self.in_flight -= 1
+            ENDPOINT_IN_FLIGHT.set(self.in_flight, endpoint=self.name)
+            self._sem.release()
+
+    def stats(self) -> Dict[str, int]:
+        return {"limit": self.limit, "in_flight": self.in_flight, "waiting": self.waiting,
+                "peak": self.peak, "rejected": self.rejected}
+
+
+LIMITERS: Dict[str, EndpointLimiter] = {name: EndpointLimiter(name, limit)
+                                        for name, limit in ENDPOINT_CONCURRENCY.items()}
+
+
+class HealthCache:
+    """Результат проверки Yandex API на ttl секунд; одновременные /health ждут одну проверку"""
+
+    def __init__(self, ttl: float = HEALTH_CACHE_SECONDS):
+        self.ttl = max(0.0, float(ttl))
+        self._result: Optional[Dict[str, Any]] = None
+        self._checked_at = 0.0
+        self._lock: Optional[asyncio.Lock] = None
+
+    @property
+    def age(self) -> float:
+        return time.monotonic() - self._checked_at
+
+    async def get(self) -> Dict[str, Any]:
+        if self._result is not None and time.monotonic() - self._checked_at < self.ttl:
+            return self._result
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        async with self._lock:
+            if self._result is None or time.monotonic() - self._checked_at >= self.ttl:
+                self._result = await self._check()
+                self._checked_at = time.monotonic()
+            return self._result
+
+    async def _check(self) -> Dict[str, Any]:
+        try:
+            # Проверяем доступность API простым запросом
+            test_embedding = await yandex_text_embedding_async("test", max_retries=1)
+            return {
+                "status": "healthy",
+                "yandex_api": "available" if test_embedding else "unavailable",
+                "embedding_dimension": len(test_embedding) if test_embedding else None
+            }
+        except Exception as e:
+            logger.error(f"Health check failed: {e}")
+            return {
+                "status": "unhealthy",
+                "error": str(e)
+            }
+
+
+health_cache = HealthCache()
+
+_batch_fanout: Optional[asyncio.Semaphore] = None
+
+
+async def embed_unique_texts(texts: List[str], model_uri: Optional[str]) -> List[List[float]]:
+    """Эмбеддинги уникальных текстов пакета параллельно, в пределах общей квоты BATCH_FANOUT_QUOTA"""
+    global _batch_fanout
+    if _batch_fanout is None:
+        _batch_fanout = asyncio.Semaphore(max(1, BATCH_FANOUT_QUOTA))
+    quota = _batch_fanout
+
+    async def one(text: str) -> List[float]:
+        async with quota:
+            return await yandex_text_embedding_async(text, model_uri)
+
+    return list(await asyncio.gather(*(one(t) for t in texts)))
+
+
+def _raise_if_circuit_open(endpoint: str):
+    """Пустой результат из-за открытого circuit breaker — 503 с Retry-After вместо 500"""
+    breaker = GUARDS[endpoint].breaker
+    if GUARDS[endpoint].is_open:
+        raise HTTPException(status_code=503, detail=f"Yandex API {endpoint} временно недоступен",
+                            headers={"Retry-After": str(int(breaker.retry_after()))})
+
+
+def _json_response(content: Dict[str, Any]) -> Response:
+    """JSON без валидации pydantic; orjson сериализует списки float в разы быстрее json"""
+    if orjson is not None:
+        return Response(content=orjson.dumps(content), media_type="application/json")
+    return JSONResponse(content=content)
+
 # ========================
 # Pydantic модели
 # ========================
@@ -39,8 +217,9 @@ class CompletionRequest(BaseModel):
     """Модель запроса генерации текста"""
     prompt: str = Field(..., description="Промпт для генерации", min_length=1)
     model_uri: Optional[str] = Field(None, description="URI модели")
-    max_tokens: Optional[int] = Field(2000, description="Максимальное количество токенов", ge=1, le=8000)
+    max_tokens: Optional[int] = Field(None, description="Максимальное количество токенов (по умолчанию — лимит задачи)", ge=1, le=8000)
     temperature: Optional[float] = Field(0.3, description="Температура генерации", ge=0.0, le=1.0)
+    task: str = Field(TASK_GENERATION, description=f"Задача: {' | '.join(TASK_PROFILES)} (модель и лимит токенов)")
 
 class CompletionResponse(BaseModel):
     """Модель ответа генерации текста"""
@@ -63,14 +242,40 @@ class BatchEmbeddingRequest(BaseModel):
     """Модель запроса пакетного эмбеддинга"""
     texts: List[str] = Field(..., description="Список текстов для эмбеддинга")
     model_uri: Optional[str] = Field(None, description="URI модели эмбеддинга")
+    encoding: str = Field(ENCODING_JSON, description="Формат векторов: json | base64_f32 | base64_f16")
 
 class BatchEmbeddingResponse(BaseModel):
     """Модель ответа пакетного эмбеддинга"""
-    embeddings: List[List[float]] = Field(..., description="Список векторных представлений")
+    embeddings: List[List[float]] = Field(default_factory=list, description="Список векторных представлений (encoding=json)")
+    embeddings_b64: Optional[str] = Field(None, description="Матрица count x dimension в base64 (little-endian)")
+    dtype: Optional[str] = Field(None, description="Тип элементов embeddings_b64: float32 | float16")
     dimension: int = Field(..., description="Размерность векторов")
     count: int = Field(..., description="Количество обработанных текстов")
+    unique_count: Optional[int] = Field(None, description="Сколько уникальных текстов отправлено в Yandex API")
     model_uri: Optional[str] = Field(None, description="Использованная модель")
 
+# ========================
+# Трассировка и дедлайн запроса
+# ========================
+
+tracing.install_tracing(app, "yandex")
+
+install_deadline(app)
+
+@app.middleware("http")
+async def priority_middleware(request, call_next):
+    """Класс квоты Yandex API из заголовка X-Yandex-Priority (interactive | moderation | bulk)"""
+    cls = request.headers.get("x-yandex-priority", "").lower()
+    if cls not in PRIORITIES:
+        return await call_next(request)
+    with priority(cls):
+        return await call_next(request)
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    """Закрываем соединения асинхронного клиента Yandex API"""
+    await aclose_async_client()
+
 # ========================
 # API эндпоинты
 # ========================
@@ -91,36 +296,36 @@ async def root():
 
 @app.get("/health")
 async def health_check():
-    """Проверка здоровья сервиса"""
-    try:
-        # Проверяем доступность API простым запросом
-        test_embedding = yandex_text_embedding("test")
-
-        return {
-            "status": "healthy",
-            "yandex_api": "available" if test_embedding else "unavailable",
-            "embedding_dimension": len(test_embedding) if test_embedding else None
-        }
-    except Exception as e:
-        logger.error(f"Health check failed: {e}")
-        return {
-            "status": "unhealthy",
-            "error": str(e)
-        }
+    """Проверка здоровья сервиса (проверка Yandex API кешируется на YANDEX_HEALTH_CACHE_SECONDS)"""
+    result = await health_cache.get()
+    return {**result, "checked_seconds_ago": round(health_cache.age, 1)}
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def metrics():
+    """Метрики эндпоинтов в формате Prometheus (выполняющиеся, ожидающие, отказы, длительность)"""
+    return PlainTextResponse(REGISTRY.render(), media_type=PROMETHEUS_CONTENT_TYPE)
 
 @app.post("/completion", response_model=CompletionResponse)
 async def generate_completion(request: CompletionRequest):
-    """Генерация текста через Yandex GPT"""
+    """Генерация текста через Yandex GPT (модель и лимит токенов — по задаче request.task)"""
+    if request.task not in TASK_PROFILES:
+        raise HTTPException(status_code=400, detail=f"Неизвестная задача: {request.task} (допустимо: {', '.join(TASK_PROFILES)})")
     try:
-        logger.info(f"Генерация текста, длина промпта: {len(request.prompt)}")
-
-        response = yandex_completion(
-            prompt=request.prompt,
-            model_uri=request.model_uri,
-            max_tokens=request.max_tokens,
-            temperature=request.temperature
-        )
-
+        logger.info(f"Генерация текста ({request.task}), длина промпта: {len(request.prompt)}")
+
+        async with LIMITERS["completion"].slot():
+            response = await yandex_completion_async(
+                prompt=request.prompt,
+                model_uri=request.model_uri,
+                max_tokens=request.max_tokens,
+                temperature=request.temperature,
+                task=request.task
+            )
+
+        if isinstance(response, dict) and response.get("degraded"):
+            # Вызов отклонён лимитом или circuit breaker: вызывающий должен повторить позже, а не сразу
+            raise HTTPException(status_code=503, detail="Yandex GPT временно недоступен",
+                                headers={"Retry-After": str(max(1, int(response.get("retry_after") or 1)))})
         if not response or isinstance(response, dict) and response.get("error"):
             raise HTTPException(status_code=500, detail="Не удалось получить ответ от Yandex GPT")
 
@@ -147,9 +352,11 @@ async def create_embedding(request: EmbeddingRequest):
     try:
         logger.info(f"Создание эмбеддинга, длина текста: {len(request.text)}")
 
-        embedding = yandex_text_embedding(request.text, request.model_uri)
+        async with LIMITERS["embedding"].slot():
+            embedding = await yandex_text_embedding_async(request.text, request.model_uri)
 
         if not embedding:
+            _raise_if_circuit_open("embedding")
             raise HTTPException(status_code=500, detail="Не удалось получить эмбеддинг")
 
         return EmbeddingResponse(
@@ -158,30 +365,58 @@ async def create_embedding(request: EmbeddingRequest):
             model_uri=request.model_uri
         )
 
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Ошибка создания эмбеддинга: {e}\n{traceback.format_exc()}")
         raise HTTPException(status_code=500, detail=f"Ошибка создания эмбеддинга: {str(e)}")
 
 @app.post("/batch_embedding", response_model=BatchEmbeddingResponse)
-async def create_batch_embeddings(request: BatchEmbeddingRequest):
-    """Создание эмбеддингов для множества текстов"""
+async def create_batch_embeddings(request: BatchEmbeddingRequest, http_request: Request):
+    """
+    Создание эмбеддингов для множества текстов. Повторяющиеся тексты запрашиваются один раз.
+    encoding=base64_f32/base64_f16 — матрица в embeddings_b64; Accept: application/octet-stream —
+    сырые байты матрицы с заголовками X-Embedding-Shape ("строки,столбцы") и X-Embedding-Dtype.
+    """
+    if request.encoding not in ENCODINGS:
+        raise HTTPException(status_code=400, detail=f"Неизвестный encoding: {request.encoding} (допустимо: {', '.join(ENCODINGS)})")
     try:
-        logger.info(f"Создание пакетных эмбеддингов для {len(request.texts)} текстов")
+        unique, index = dedupe(request.texts)
+        logger.info(f"Создание пакетных эмбеддингов для {len(request.texts)} текстов ({len(unique)} уникальных)")
+        if len(unique) < len(request.texts):
+            BATCH_DUPLICATES.inc(len(request.texts) - len(unique))
 
-        embeddings = yandex_batch_embeddings(request.texts, request.model_uri)
+        async with LIMITERS["batch_embedding"].slot():
+            vectors = await embed_unique_texts(unique, request.model_uri)
 
-        if not embeddings or len(embeddings) != len(request.texts):
+        if not vectors or not all(vectors):
+            _raise_if_circuit_open("embedding")
             raise HTTPException(status_code=500, detail="Не удалось получить все эмбеддинги")
+        dimension = len(vectors[0])
+        if any(len(v) != dimension for v in vectors):
+            raise HTTPException(status_code=500, detail="Эмбеддинги разной размерности")
+
+        count = len(index)
+        binary = OCTET_STREAM in http_request.headers.get("accept", "")
+        if binary or request.encoding != ENCODING_JSON:
+            dtype = dtype_for(request.encoding)
+            # Строки уникальных векторов раскладываются в исходный порядок текстов (с повторами)
+            matrix = to_matrix(vectors, dtype)[index]
+            if binary:
+                headers = {**binary_headers(matrix, dtype), "X-Embedding-Unique": str(len(unique))}
+                return Response(content=matrix.tobytes(), media_type=OCTET_STREAM, headers=headers)
+            return _json_response({
+                "embeddings": [], "embeddings_b64": encode_base64(matrix), "dtype": dtype,
+                "dimension": dimension, "count": count, "unique_count": len(unique), "model_uri": request.model_uri,
+            })
+
+        return _json_response({
+            "embeddings": [vectors[i] for i in index], "embeddings_b64": None, "dtype": None,
+            "dimension": dimension, "count": count, "unique_count": len(unique), "model_uri": request.model_uri,
+        })
 
-        dimension = len(embeddings[0]) if embeddings else 0
-
-        return BatchEmbeddingResponse(
-            embeddings=embeddings,
-            dimension=dimension,
-            count=len(embeddings),
-            model_uri=request.model_uri
-        )
-
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Ошибка создания пакетных эмбеддингов: {e}\n{traceback.format_exc()}")
         raise HTTPException(status_code=500, detail=f"Ошибка создания эмбеддингов: {str(e)}")
@@ -235,6 +470,12 @@ async def get_stats():
     """Получение статистики использования сервиса"""
     return {
         "stats": request_stats,
+        "endpoints": {name: limiter.stats() for name, limiter in LIMITERS.items()},
+        "batch_fanout_quota": BATCH_FANOUT_QUOTA,
+        "singleflight": [EMBEDDING_FLIGHT.stats(), COMPLETION_FLIGHT.stats()],
+        "yandex_client": guard_stats(),
+        "yandex_quota": quota_stats(),
+        "tasks": task_stats(),
         "uptime": "N/A"  # Можно добавить подсчет uptime
     }
 
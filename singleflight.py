@@ -0,0 +1,156 @@
+# singleflight.py - объединение одновременных одинаковых вызовов: один запрос к API, результат — всем ждущим
+import json
+import asyncio
+import logging
+import threading
+from typing import Any, Awaitable, Callable, Dict, Optional, Tuple
+
+from pipeline_metrics import REGISTRY
+from request_deadline import remaining as deadline_remaining
+
+logger = logging.getLogger(__name__)
+
+SINGLEFLIGHT_CALLS = REGISTRY.counter(
+    "singleflight_calls_total",
+    "Вызовы через singleflight: leader — выполнил запрос, shared — ждал чужой, retry — чужой результат неудачен, "
+    "запрос выполнен заново", ["group", "role"])
+
+
+def flight_key(*parts: Any) -> str:
+    """Ключ по нормализованному содержимому запроса: канонический JSON (порядок ключей не важен)"""
+    return json.dumps(parts, sort_keys=True, ensure_ascii=False, separators=(",", ":"), default=str)
+
+
+class _Call:
+    __slots__ = ("event", "result", "ok")
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.result: Any = None
+        # Результат можно раздать ожидающим (вызов завершился без исключения и прошёл shareable)
+        self.ok = False
+
+
+class SingleFlight:
+    """
+    Singleflight для потоков: пока вызов с ключом key выполняется, остальные вызовы с тем же ключом
+    не идут в API, а ждут и получают тот же результат (или то же исключение). Результат не кешируется —
+    следующий вызов после завершения выполняется заново. Результат общий: вызывающие не должны его менять.
+    Ожидающий не ждёт дольше своего дедлайна: по его истечении выполняет fn сам (fn учитывает дедлайн).
+    Вызов идёт под дедлайном ведущего, поэтому неудачный результат (исключение или не прошедший
+    shareable — ошибка, отказ защиты API, истёкший дедлайн ведущего) не раздаётся: ожидающие
+    выполняют fn сами, со своим бюджетом.
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        self._lock = threading.Lock()
+        self._calls: Dict[str, _Call] = {}
+        self.leaders = 0
+        self.shared = 0
+
+    def do(self, key: str, fn: Callable[..., Any], *args,
+           shareable: Optional[Callable[[Any], bool]] = None) -> Tuple[Any, bool]:
+        """(результат fn(*args), получен ли он от чужого вызова); shareable — можно ли отдать результат другим"""
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+                self.leaders += 1
+            else:
+                self.shared += 1
+        SINGLEFLIGHT_CALLS.inc(group=self.name, role="leader" if leader else "shared")
+
+        if not leader:
+            if not call.event.wait(timeout=deadline_remaining()):
+                return fn(*args), False
+            if not call.ok:
+                SINGLEFLIGHT_CALLS.inc(group=self.name, role="retry")
+                return fn(*args), False
+            return call.result, True
+
+        try:
+            call.result = fn(*args)
+            call.ok = shareable is None or shareable(call.result)
+            return call.result, False
+        finally:
+            with self._lock:
+                self._calls.pop(key, None)
+            call.event.set()
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            in_flight = len(self._calls)
+        return {"name": self.name, "in_flight": in_flight, "leaders": self.leaders, "shared": self.shared}
+
+
+class _AsyncCall:
+    __slots__ = ("task", "loop", "waiters")
+
+    def __init__(self, task: "asyncio.Task", loop: asyncio.AbstractEventLoop):
+        self.task = task
+        self.loop = loop
+        self.waiters = 0
+
+
+class AsyncSingleFlight:
+    """
+    Singleflight для корутин. Запрос выполняется отдельной задачей (с контекстом первого вызова —
+    его дедлайном и трассировкой); вызывающие ждут её через shield, поэтому отмена одного из них
+    (например, проигравшей хедж-ветки) не отменяет запрос для остальных. Задача отменяется,
+    только когда её перестали ждать все. Вызовы из разных event loop не объединяются.
+    Как и в SingleFlight, неудачный результат ведущего не раздаётся: ожидающие выполняют fn сами.
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        self._calls: Dict[str, _AsyncCall] = {}
+        self.leaders = 0
+        self.shared = 0
+
+    def _forget(self, key: str, call: _AsyncCall):
+        if self._calls.get(key) is call:
+            del self._calls[key]
+
+    async def do(self, key: str, fn: Callable[..., Awaitable[Any]], *args,
+                 shareable: Optional[Callable[[Any], bool]] = None) -> Tuple[Any, bool]:
+        """(результат await fn(*args), получен ли он от чужого вызова); shareable — как в SingleFlight.do"""
+        loop = asyncio.get_running_loop()
+        call = self._calls.get(key)
+        leader = call is None or call.loop is not loop or call.task.done()
+        if leader:
+            call = self._calls[key] = _AsyncCall(loop.create_task(fn(*args)), loop)
+            call.task.add_done_callback(lambda _t, k=key, c=call: self._forget(k, c))
+            self.leaders += 1
+        else:
+            self.shared += 1
+        SINGLEFLIGHT_CALLS.inc(group=self.name, role="leader" if leader else "shared")
+
+        call.waiters += 1
+        try:
+            result = await asyncio.wait_for(asyncio.shield(call.task), timeout=deadline_remaining())
+        except asyncio.TimeoutError:
+            if leader and call.task.done():
+                raise
+            # Свой дедлайн истёк раньше, чем чужой запрос завершился: fn сама вернёт ответ по дедлайну
+            return await fn(*args), False
+        except asyncio.CancelledError:
+            if call.waiters == 1 and not call.task.done():
+                call.task.cancel()
+            raise
+        except Exception:
+            if leader:
+                raise
+            # Исключение чужого вызова не раздаём: выполняем запрос сами
+            SINGLEFLIGHT_CALLS.inc(group=self.name, role="retry")
+            return await fn(*args), False
+        finally:
+            call.waiters -= 1
+        if leader or shareable is None or shareable(result):
+            return result, not leader
+        SINGLEFLIGHT_CALLS.inc(group=self.name, role="retry")
+        return await fn(*args), False
+
+    def stats(self) -> Dict[str, Any]:
+        return {"name": self.name, "in_flight": len(self._calls), "leaders": self.leaders, "shared": self.shared}
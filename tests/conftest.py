@@ -0,0 +1,7 @@
+# conftest.py - модули проекта лежат в корне репозитория (как в Dockerfile сервисов)
+import os
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
@@ -0,0 +1,47 @@
+# Отменённые в очереди задачи освобождают место: пул не начинает отказывать без реальной нагрузки
+import asyncio
+import threading
+
+import pytest
+
+from bounded_executor import BoundedExecutor, ExecutorOverloaded
+
+
+def test_rejects_when_workers_and_queue_are_full():
+    executor = BoundedExecutor("test_full", max_workers=1, max_queue=1)
+    release = threading.Event()
+    running = executor.submit(release.wait, 5.0)
+    queued = executor.submit(lambda: "ok")
+    with pytest.raises(ExecutorOverloaded):
+        executor.submit(lambda: "rejected")
+    release.set()
+    assert running.result(timeout=5.0) is True
+    assert queued.result(timeout=5.0) == "ok"
+    assert executor.stats()["queued"] == 0
+
+
+def test_cancelled_queued_run_releases_capacity():
+    executor = BoundedExecutor("test_cancel", max_workers=1, max_queue=2)
+    release = threading.Event()
+
+    async def scenario():
+        busy = asyncio.ensure_future(executor.run(release.wait, 5.0))
+        await asyncio.sleep(0.05)
+        waiting = [asyncio.ensure_future(executor.run(lambda: "never")) for _ in range(2)]
+        await asyncio.sleep(0.05)
+        assert executor.stats()["queued"] == 2
+        for task in waiting:
+            task.cancel()
+        await asyncio.gather(*waiting, return_exceptions=True)
+        assert executor.stats()["queued"] == 0
+
+        # Место в очереди вернулось: две новые задачи принимаются, пока первая ещё выполняется
+        accepted = [asyncio.ensure_future(executor.run(lambda i=i: i)) for i in range(2)]
+        await asyncio.sleep(0)
+        release.set()
+        assert await busy is True
+        assert await asyncio.gather(*accepted) == [0, 1]
+
+    asyncio.run(scenario())
+    stats = executor.stats()
+    assert stats["queued"] == 0 and stats["active"] == 0 and stats["rejected"] == 0
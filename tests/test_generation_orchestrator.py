@@ -0,0 +1,42 @@
+# Цепочка генераций: ограниченный пул и остановка брошенных шагов по дедлайну
+import time
+
+import request_deadline
+from generation_orchestrator import GenerationOrchestrator, LatencyTracker
+
+
+def _orchestrator(workers=2, queue=0):
+    return GenerationOrchestrator(max_workers=workers, max_queue=queue, min_hedge_delay=0.1,
+                                  tracker=LatencyTracker(default_p95=0.1))
+
+
+def test_hedged_loser_stops_at_next_deadline_check():
+    stopped = []
+
+    def slow():
+        # Как yandex_completion: дедлайн проверяется перед каждой попыткой
+        for _ in range(100):
+            if request_deadline.expired():
+                stopped.append(True)
+                return ""
+            time.sleep(0.02)
+        return "slow"
+
+    def fast():
+        time.sleep(0.05)
+        return "fast"
+
+    answer, info = _orchestrator().run([("primary", slow), ("fallback", fast)], 5.0)
+    assert (answer, info["winner"], info["hedged"]) == ("fast", "fallback", 1)
+    time.sleep(0.2)
+    assert stopped == [True]
+
+
+def test_full_pool_rejects_steps_instead_of_queueing():
+    orchestrator = _orchestrator(workers=1, queue=0)
+    busy = orchestrator._executor.submit(time.sleep, 0.5)
+    time.sleep(0.05)
+    answer, info = orchestrator.run([("primary", lambda: "x"), ("fallback", lambda: "y")], 1.0)
+    assert answer == ""
+    assert info["rejected"] == 2
+    busy.result()
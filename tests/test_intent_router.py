@@ -0,0 +1,76 @@
+# Центроиды роутера строятся в фоне (запросы до готовности — fallback без ожидания), эмбеддинг запроса кешируется
+import threading
+import time
+
+import pytest
+
+np = pytest.importorskip("numpy")
+pytest.importorskip("requests")
+
+import intent_router
+from intent_router import INTENT_RECIPE, INTENT_SMALLTALK, IntentRouter
+
+SEEDS = {
+    INTENT_RECIPE: ["рецепт мохито"],
+    INTENT_SMALLTALK: ["привет"],
+}
+VECTORS = {
+    "рецепт мохито": [1.0, 0.0],
+    "привет": [0.0, 1.0],
+    "как сделать мохито": [0.9, 0.1],
+}
+
+
+@pytest.fixture
+def embeddings(monkeypatch):
+    calls = []
+    release = threading.Event()
+
+    def fake_batch_embeddings(texts, model_uri=None):
+        calls.append(list(texts))
+        if texts[0] in SEEDS[INTENT_RECIPE] or texts[0] in SEEDS[INTENT_SMALLTALK]:
+            release.wait(5.0)
+        return [VECTORS[t] for t in texts]
+
+    monkeypatch.setattr(intent_router, "yandex_batch_embeddings", fake_batch_embeddings)
+    return calls, release
+
+
+def _wait_ready(router: IntentRouter, timeout: float = 5.0):
+    stop = time.monotonic() + timeout
+    while not router.ready():
+        assert time.monotonic() < stop, "центроиды не построены"
+        time.sleep(0.01)
+
+
+def test_route_falls_back_while_centroids_build(embeddings):
+    calls, release = embeddings
+    router = IntentRouter(SEEDS, model_uri="emb://test", cache_file=None)
+
+    start = time.monotonic()
+    result, q_emb = router.route("как сделать мохито")
+    assert time.monotonic() - start < 0.5
+    assert result["via"] == "fallback" and q_emb is None
+    # Построение уже идёт — повторный запуск не нужен
+    assert router.start_background_build() is False
+
+    release.set()
+    _wait_ready(router)
+    result, q_emb = router.route("как сделать мохито")
+    assert result["intent"] == INTENT_RECIPE and result["via"] == "embedding"
+    assert q_emb is not None
+
+
+def test_query_embedding_is_cached(embeddings):
+    calls, release = embeddings
+    release.set()
+    router = IntentRouter(SEEDS, model_uri="emb://test", cache_file=None)
+    assert router.start_background_build() is True
+    _wait_ready(router)
+    seeds_calls = len(calls)
+
+    first, emb1 = router.route("как сделать мохито")
+    second, emb2 = router.route("как сделать мохито")
+    assert len(calls) == seeds_calls + 1
+    assert first["intent"] == second["intent"] == INTENT_RECIPE
+    assert np.array_equal(emb1, emb2)
@@ -0,0 +1,123 @@
+# /clear необратим и для истории на диске; история не повторяет записи памяти; запись в сегменты — в фоне
+import asyncio
+import importlib
+import os
+import sys
+from datetime import datetime, timedelta
+
+import pytest
+
+LOGGING_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "services", "logging")
+if LOGGING_DIR not in sys.path:
+    sys.path.insert(0, LOGGING_DIR)
+
+from segment_store import SegmentStore
+
+
+def _record(seq: int, service: str, ts: datetime):
+    return {"id": f"log_{seq}", "level": "INFO", "message": f"m{seq}", "service": service,
+            "timestamp": ts, "user_id": None, "request_id": None, "metadata": {}}
+
+
+def _ids(store: SegmentStore):
+    return sorted(int(r["id"][4:]) for r in store.scan())
+
+
+def test_append_only_enqueues_until_writer_drains(tmp_path):
+    store = SegmentStore(str(tmp_path), block_bytes=1)
+    now = datetime.now()
+    assert store.append_many([(1, _record(1, "rag", now)), (2, _record(2, "rag", now))])
+    # Ничего не записано на диск на пути запроса, но scan уже видит записи из очереди
+    assert not [n for n in os.listdir(tmp_path) if n.endswith(".seg")]
+    assert _ids(store) == [1, 2]
+    store.flush()
+    assert [n for n in os.listdir(tmp_path) if n.endswith(".seg")]
+    assert _ids(store) == [1, 2]
+
+
+def test_full_queue_drops_instead_of_blocking(tmp_path):
+    store = SegmentStore(str(tmp_path), queue_max_entries=2)
+    now = datetime.now()
+    assert store.append_many([(1, _record(1, "rag", now)), (2, _record(2, "rag", now))])
+    assert not store.append(3, _record(3, "rag", now))
+    assert store.dropped == 1
+
+
+def test_clear_watermark_hides_records_and_survives_restart(tmp_path):
+    store = SegmentStore(str(tmp_path))
+    now = datetime.now()
+    store.append_many([(1, _record(1, "rag", now)), (2, _record(2, "gateway", now)),
+                       (3, _record(3, "rag", now))])
+    store.flush()
+    store.clear(3, service="rag")
+    assert _ids(store) == [2]
+    store.append(4, _record(4, "rag", now))
+    assert _ids(store) == [2, 4]
+    store.clear(4)
+    assert _ids(store) == []
+    store.append(5, _record(5, "gateway", now))
+    store.close()
+
+    reopened = SegmentStore(str(tmp_path))
+    assert _ids(reopened) == [5]
+
+
+def test_string_timestamp_does_not_break_scan(tmp_path):
+    store = SegmentStore(str(tmp_path))
+    record = _record(1, "rag", datetime.now())
+    record["timestamp"] = "вчера"
+    store.append(1, record)
+    store.flush()
+    assert [r["timestamp"] for r in store.scan()] == ["вчера"]
+
+
+@pytest.fixture
+def logging_main(tmp_path, monkeypatch):
+    pytest.importorskip("fastapi")
+    monkeypatch.setenv("LOGGING_DATA_DIR", str(tmp_path))
+    monkeypatch.setenv("LOGGING_MAX_ENTRIES", "2")
+    sys.modules.pop("main", None)
+    main = importlib.import_module("main")
+    yield main
+    main.segment_store.close()
+    sys.modules.pop("main", None)
+
+
+def test_clear_then_query_with_history(logging_main):
+    main = logging_main
+    base = datetime.now() - timedelta(minutes=5)
+    entries = [main.LogEntry(level="INFO", message=f"m{i}", service="rag" if i % 2 else "gateway",
+                             timestamp=base + timedelta(seconds=i)) for i in range(6)]
+    main.log_storage.add_logs(entries)
+    main.segment_store.flush()
+    # Окно памяти — 2 записи, остальное — история на диске
+    assert len(main.query_with_history(main.LogQuery(limit=100))) == 6
+
+    asyncio.run(main.clear_logs("rag"))
+    assert {log["service"] for log in main.query_with_history(main.LogQuery(limit=100))} == {"gateway"}
+
+    asyncio.run(main.clear_logs())
+    assert main.query_with_history(main.LogQuery(limit=100)) == []
+    assert list(main.iter_export_records("all", None, None)) == []
+
+    main.log_storage.add_log(main.LogEntry(level="INFO", message="после очистки", service="rag"))
+    assert [log["message"] for log in main.query_with_history(main.LogQuery(limit=100))] == ["после очистки"]
+
+
+def test_history_has_no_duplicates_when_records_are_evicted_during_query(logging_main, monkeypatch):
+    main = logging_main
+    base = datetime.now() - timedelta(minutes=5)
+    entry = lambda i: main.LogEntry(level="INFO", message=f"m{i}", service="rag", timestamp=base + timedelta(seconds=i))
+    main.log_storage.add_logs([entry(i) for i in range(4)])
+    snapshot = main.log_storage.query_window
+
+    def query_then_ingest(query):
+        result = snapshot(query)
+        # Поток приёма вытесняет из кольца записи, уже попавшие в снимок памяти
+        main.log_storage.add_logs([entry(i) for i in range(4, 6)])
+        main.segment_store.flush()
+        return result
+
+    monkeypatch.setattr(main.log_storage, "query_window", query_then_ingest)
+    ids = [log["id"] for log in main.query_with_history(main.LogQuery(limit=100))]
+    assert len(ids) == len(set(ids)) == 4
@@ -0,0 +1,74 @@
+# При сбое Redis история уходит в память процесса, а Redis после серии ошибок не вызывается на каждый запрос
+import types
+
+import pytest
+
+import message_history
+from message_history import HistoryBackend, RedisHistory
+
+
+class _DownRedis:
+    """Клиент недоступного Redis: каждый вызов — ошибка соединения"""
+
+    def __init__(self):
+        self.calls = 0
+        self.up = False
+
+    def _call(self, result=None):
+        self.calls += 1
+        if not self.up:
+            raise ConnectionError("redis is down")
+        return result
+
+    def pipeline(self, transaction=False):
+        client = self
+
+        class _Pipe:
+            def __getattr__(self, name):
+                return lambda *args, **kwargs: None
+
+            def execute(self):
+                return client._call([])
+
+        return _Pipe()
+
+    def lrange(self, key, start, stop):
+        return self._call([])
+
+    def delete(self, key):
+        return self._call(1)
+
+    def close(self):
+        pass
+
+
+@pytest.fixture
+def redis_down(monkeypatch):
+    client = _DownRedis()
+    fake = types.SimpleNamespace(Redis=types.SimpleNamespace(from_url=lambda *args, **kwargs: client))
+    monkeypatch.setattr(message_history, "redis", fake)
+    return client
+
+
+def test_history_backend_is_abstract():
+    with pytest.raises(TypeError):
+        HistoryBackend()
+
+
+def test_redis_outage_falls_back_to_memory_without_calling_redis(redis_down, monkeypatch):
+    history = RedisHistory(failure_threshold=3, retry_seconds=30)
+    for i in range(10):
+        history.add_message(1, f"вопрос {i}", f"ответ {i}")
+    # Только первые failure_threshold вызовов дошли до Redis (и заплатили таймаут)
+    assert redis_down.calls == 3
+    assert not history.available
+    assert [u for _, u, _ in history.get_history(1)][-1] == "вопрос 9"
+    assert redis_down.calls == 3
+
+    # По истечении интервала — один пробный вызов; Redis поднялся — снова работаем через него
+    redis_down.up = True
+    monkeypatch.setattr(history._guard, "_retry_at", 0.0)
+    history.get_history(1)
+    assert redis_down.calls == 4
+    assert history.available
+    history.close()
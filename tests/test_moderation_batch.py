@@ -0,0 +1,89 @@
+# Пакетная модерация: разбор вердиктов по номерам; микробатчер дедуплицирует тексты и не пропускает их при ошибке
+import asyncio
+import importlib
+import os
+import sys
+
+import pytest
+
+pytest.importorskip("requests")
+
+from moderation_yandex import _parse_batch_verdicts  # noqa: E402
+
+VALIDATION_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "services", "validation")
+
+
+def test_parse_all_verdicts():
+    assert _parse_batch_verdicts("1: SAFE\n2: unsafe\n3. SAFE", 3) == {1: "SAFE", 2: "UNSAFE", 3: "SAFE"}
+
+
+def test_parse_missing_item_returns_none():
+    assert _parse_batch_verdicts("1: SAFE\n3: SAFE", 3) is None
+
+
+def test_parse_duplicate_index_keeps_first_and_still_needs_every_item():
+    assert _parse_batch_verdicts("1: UNSAFE\n1: SAFE\n2: SAFE", 2) == {1: "UNSAFE", 2: "SAFE"}
+    assert _parse_batch_verdicts("1: SAFE\n1: SAFE", 2) is None
+
+
+def test_parse_ignores_extra_text_and_out_of_range_items():
+    txt = "Вот результаты проверки:\n1: SAFE — обычный вопрос\n2) UNSAFE\n5: SAFE\nГотово."
+    assert _parse_batch_verdicts(txt, 2) == {1: "SAFE", 2: "UNSAFE"}
+
+
+def test_parse_empty_answer_returns_none():
+    assert _parse_batch_verdicts("", 1) is None
+
+
+@pytest.fixture
+def validation_main():
+    pytest.importorskip("fastapi")
+    sys.path.insert(0, VALIDATION_DIR)
+    sys.modules.pop("main", None)
+    try:
+        yield importlib.import_module("main")
+    finally:
+        sys.modules.pop("main", None)
+        sys.path.remove(VALIDATION_DIR)
+
+
+def test_batcher_dedupes_texts_and_spreads_results(validation_main, monkeypatch):
+    calls = []
+
+    def batch(texts):
+        calls.append(list(texts))
+        return [(t != "плохо", "SAFE" if t != "плохо" else "UNSAFE") for t in texts]
+
+    monkeypatch.setattr(validation_main, "llm_moderation_yandex_batch", batch)
+    batcher = validation_main.ModerationBatcher(window_ms=20, max_batch=8)
+
+    async def scenario():
+        batcher.start()
+        try:
+            return await asyncio.gather(*(batcher.submit(t) for t in ["мохито", "плохо", "мохито", "джин"]))
+        finally:
+            await batcher.stop()
+
+    results = asyncio.run(scenario())
+    assert calls == [["мохито", "плохо", "джин"]]
+    assert results == [(True, "SAFE"), (False, "UNSAFE"), (True, "SAFE"), (True, "SAFE")]
+    assert batcher.stats["llm_calls_saved"] == 3
+
+
+def test_batcher_error_fails_every_caller(validation_main, monkeypatch):
+    def batch(texts):
+        raise RuntimeError("completion failed")
+
+    monkeypatch.setattr(validation_main, "llm_moderation_yandex_batch", batch)
+    batcher = validation_main.ModerationBatcher(window_ms=20, max_batch=8)
+
+    async def scenario():
+        batcher.start()
+        try:
+            return await asyncio.gather(*(batcher.submit(t) for t in ["раз", "два"]), return_exceptions=True)
+        finally:
+            await batcher.stop()
+
+    results = asyncio.run(scenario())
+    assert all(isinstance(r, RuntimeError) for r in results)
+    assert batcher.stats["errors"] == 1
@@ -0,0 +1,72 @@
+# Модерация не должна пропускать тексты, если вызов модели не выполнен (перегрузка API, circuit breaker)
+import pytest
+
+pytest.importorskip("requests")
+
+import moderation_yandex  # noqa: E402
+from yandex_api import degraded_response  # noqa: E402
+from yandex_resilience import EndpointGuard, YandexUnavailable  # noqa: E402
+
+
+def _circuit_open():
+    return degraded_response(YandexUnavailable("completion", "circuit_open", retry_after=15.0))
+
+
+def test_single_moderation_blocks_when_degraded(monkeypatch):
+    monkeypatch.setattr(moderation_yandex, "yandex_completion", lambda *a, **kw: _circuit_open())
+    ok, reason = moderation_yandex.llm_moderation_yandex("как приготовить мохито")
+    assert ok is False
+    assert moderation_yandex.moderation_unavailable(reason)
+
+
+def test_batch_moderation_blocks_every_item_when_degraded(monkeypatch):
+    calls = []
+
+    def completion(*args, **kwargs):
+        calls.append(args)
+        return _circuit_open()
+
+    monkeypatch.setattr(moderation_yandex, "yandex_completion", completion)
+    results = moderation_yandex.llm_moderation_yandex_batch(["текст 1", "текст 2", "текст 3"])
+    assert [ok for ok, _ in results] == [False, False, False]
+    assert all(moderation_yandex.moderation_unavailable(reason) for _, reason in results)
+    # Без отката на одиночные вызовы: они упёрлись бы в тот же открытый breaker
+    assert len(calls) == 1
+
+
+def test_pre_moderation_blocks_when_degraded(monkeypatch):
+    monkeypatch.setattr(moderation_yandex, "yandex_completion", lambda *a, **kw: _circuit_open())
+    ok, reason = moderation_yandex.pre_moderate_input("привет, как дела")
+    assert ok is False
+    assert moderation_yandex.moderation_unavailable(reason)
+
+
+def test_api_error_keeps_previous_safe_fallback(monkeypatch):
+    monkeypatch.setattr(moderation_yandex, "yandex_completion", lambda *a, **kw: {"error": "HTTP 400: bad request"})
+    assert moderation_yandex.llm_moderation_yandex("текст") == (True, "SAFE:completion_error")
+
+
+def test_open_breaker_rejects_with_degraded_response():
+    guard = EndpointGuard("test_open")
+    guard.breaker._open(0.0)
+    guard.breaker._opened_at = float("inf")
+    with pytest.raises(YandexUnavailable) as e:
+        with guard.attempt():
+            pass
+    assert e.value.reason == "circuit_open"
+
+
+def test_moderation_blocks_when_deadline_expired(monkeypatch):
+    import request_deadline
+    import yandex_api
+
+    # Настоящий yandex_completion: при истёкшем дедлайне он не вызывает API и возвращает deadline_exceeded
+    monkeypatch.setattr(yandex_api, "_get_sdk", lambda: pytest.fail("API must not be called after the deadline"))
+    token = request_deadline.set_budget(0)
+    try:
+        ok, reason = moderation_yandex.llm_moderation_yandex("текст")
+        batch = moderation_yandex.llm_moderation_yandex_batch(["текст 1", "текст 2"])
+    finally:
+        request_deadline.reset(token)
+    assert (ok, reason) == (False, "UNAVAILABLE:deadline_exceeded")
+    assert batch == [(False, "UNAVAILABLE:deadline_exceeded")] * 2
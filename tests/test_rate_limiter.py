@@ -0,0 +1,79 @@
+# GCRA: всплеск до rpm, кулдаун после превышения (не продлевается отказами); Redis-лимитер при сбое — в память
+import types
+
+import pytest
+
+import rate_limiter
+from rate_limiter import GCRALimiter, RedisGCRALimiter
+
+NOW = 1000.0
+
+
+def _limiter(**kwargs) -> GCRALimiter:
+    # rpm=5 за 60 с: интервал 12 с, допуск всплеска 48 с
+    return GCRALimiter(**{"rpm": 5, "window_seconds": 60, "cooldown_seconds": 15, **kwargs})
+
+
+def test_burst_of_rpm_then_rate_limit():
+    limiter = _limiter(cooldown_seconds=0)
+    stored = None
+    for _ in range(5):
+        allowed, wait, reason, stored = limiter._decide(stored, NOW)
+        assert (allowed, wait, reason) == (True, 0.0, "ok")
+    allowed, wait, reason, after = limiter._decide(stored, NOW)
+    assert (allowed, reason) == (False, "rate_limit")
+    assert wait == pytest.approx(12.0)
+    # Без кулдауна отказ не меняет состояние
+    assert after == stored
+
+
+def test_exceeding_the_limit_starts_cooldown():
+    limiter = _limiter()
+    stored = None
+    for _ in range(5):
+        _, _, _, stored = limiter._decide(stored, NOW)
+    allowed, wait, reason, stored = limiter._decide(stored, NOW)
+    assert (allowed, reason) == (False, "rate_limit")
+    assert wait == pytest.approx(15.0)
+    assert stored < 0
+
+
+def test_cooldown_is_not_extended_by_further_denials():
+    limiter = _limiter()
+    stored = None
+    for _ in range(6):
+        _, _, _, stored = limiter._decide(stored, NOW)
+    cooling = stored
+    for t in (NOW + 1, NOW + 5, NOW + 14.9):
+        allowed, wait, reason, stored = limiter._decide(stored, t)
+        assert (allowed, reason) == (False, "cooldown")
+        assert wait == pytest.approx(NOW + 15 - t)
+        assert stored == cooling
+    allowed, _, reason, stored = limiter._decide(stored, NOW + 15)
+    assert (allowed, reason) == (True, "ok")
+    assert stored > 0
+
+
+class _DownScript:
+    def __init__(self):
+        self.calls = 0
+
+    def __call__(self, keys, args):
+        self.calls += 1
+        raise ConnectionError("redis is down")
+
+
+def test_redis_outage_stops_calling_redis(monkeypatch):
+    script = _DownScript()
+    client = types.SimpleNamespace(register_script=lambda lua: script)
+    fake = types.SimpleNamespace(Redis=types.SimpleNamespace(from_url=lambda *args, **kwargs: client))
+    monkeypatch.setattr(rate_limiter, "redis", fake)
+
+    limiter = RedisGCRALimiter(rpm=5, window_seconds=60, cooldown_seconds=15,
+                               failure_threshold=3, retry_seconds=30)
+    results = [limiter.is_allowed("u1") for _ in range(7)]
+    # Решения принимает лимитер в памяти: 5 запросов проходят, шестой — превышение
+    assert [allowed for allowed, _, _ in results] == [True] * 5 + [False, False]
+    # До Redis дошли только первые failure_threshold вызовов
+    assert script.calls == 3
+    assert limiter.errors == 3
@@ -0,0 +1,107 @@
+# Singleflight не раздаёт неудачный результат ведущего (например, истёкший дедлайн) ожидающим со своим бюджетом
+import asyncio
+import threading
+import time
+
+import request_deadline
+from singleflight import AsyncSingleFlight, SingleFlight
+
+
+def _shareable(result):
+    return isinstance(result, dict) and not result.get("error")
+
+
+def _call_under_own_deadline(calls, leader_started):
+    """Как _yandex_completion: при истёкшем дедлайне — ошибка без вызова API"""
+    calls.append(request_deadline.remaining())
+    if leader_started is not None:
+        leader_started.set()
+        time.sleep(0.1)
+    if request_deadline.expired():
+        return {"error": "deadline_exceeded"}
+    return {"result": "ok"}
+
+
+def test_waiter_retries_when_leader_deadline_expired():
+    flight = SingleFlight("test_sync")
+    calls = []
+    leader_started = threading.Event()
+    results = {}
+
+    def leader():
+        token = request_deadline.set_budget(0)
+        try:
+            results["leader"] = flight.do("k", _call_under_own_deadline, calls, leader_started, shareable=_shareable)
+        finally:
+            request_deadline.reset(token)
+
+    def waiter():
+        token = request_deadline.set_budget(10)
+        try:
+            results["waiter"] = flight.do("k", _call_under_own_deadline, calls, None, shareable=_shareable)
+        finally:
+            request_deadline.reset(token)
+
+    t_leader = threading.Thread(target=leader)
+    t_leader.start()
+    assert leader_started.wait(1.0)
+    t_waiter = threading.Thread(target=waiter)
+    t_waiter.start()
+    t_leader.join()
+    t_waiter.join()
+
+    assert results["leader"] == ({"error": "deadline_exceeded"}, False)
+    assert results["waiter"] == ({"result": "ok"}, False)
+    assert len(calls) == 2
+
+
+def test_successful_result_is_shared():
+    flight = SingleFlight("test_sync_ok")
+    calls = []
+    leader_started = threading.Event()
+    results = {}
+
+    def run(name, started):
+        results[name] = flight.do("k", _call_under_own_deadline, calls, started, shareable=_shareable)
+
+    t_leader = threading.Thread(target=run, args=("leader", leader_started))
+    t_leader.start()
+    assert leader_started.wait(1.0)
+    t_waiter = threading.Thread(target=run, args=("waiter", None))
+    t_waiter.start()
+    t_leader.join()
+    t_waiter.join()
+
+    assert results["waiter"] == ({"result": "ok"}, True)
+    assert len(calls) == 1
+
+
+def test_async_waiter_retries_when_leader_deadline_expired():
+    flight = AsyncSingleFlight("test_async")
+    calls = []
+
+    async def fn():
+        calls.append(request_deadline.remaining())
+        await asyncio.sleep(0.05)
+        if request_deadline.expired():
+            return {"error": "deadline_exceeded"}
+        return {"result": "ok"}
+
+    async def with_budget(seconds):
+        token = request_deadline.set_budget(seconds)
+        try:
+            return await flight.do("k", fn, shareable=_shareable)
+        finally:
+            request_deadline.reset(token)
+
+    async def scenario():
+        leader = asyncio.create_task(with_budget(0.01))
+        await asyncio.sleep(0)
+        waiter = asyncio.create_task(with_budget(10))
+        return await leader, await waiter
+
+    leader_result, waiter_result = asyncio.run(scenario())
+    assert leader_result == ({"error": "deadline_exceeded"}, False)
+    assert waiter_result == ({"result": "ok"}, False)
+    # Ожидающий выполнил запрос сам, со своим бюджетом
+    assert max(calls) > 1.0
@@ -0,0 +1,28 @@
+# require_parent без родителя: спан не экспортируется и не становится родителем вложенных спанов
+import tracing
+
+
+def test_require_parent_without_parent_is_noop(monkeypatch):
+    exported = []
+    monkeypatch.setattr(tracing.EXPORTER, "export", exported.append)
+    monkeypatch.setattr(tracing, "TRACING_ENABLED", True)
+
+    with tracing.start_span("yandex.embedding", require_parent=True) as span:
+        span.set_attribute("text_len", 10)
+        assert isinstance(span, tracing.NoopSpan)
+        assert tracing.current_trace_id() is None
+        assert tracing.outgoing_headers() == {}
+        with tracing.start_span("yandex.completion", require_parent=True) as child:
+            assert isinstance(child, tracing.NoopSpan)
+    assert exported == []
+
+
+def test_require_parent_with_parent_is_exported(monkeypatch):
+    exported = []
+    monkeypatch.setattr(tracing.EXPORTER, "export", exported.append)
+    monkeypatch.setattr(tracing, "TRACING_ENABLED", True)
+
+    with tracing.start_span("POST /answer", kind="server") as root:
+        with tracing.start_span("yandex.embedding", require_parent=True) as child:
+            assert child.parent_id == root.span_id
+    assert [s["name"] for s in exported] == ["yandex.embedding", "POST /answer"]
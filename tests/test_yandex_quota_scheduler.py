@@ -0,0 +1,103 @@
+# Квота Yandex API по классам приоритета: резерв индексации, приоритет ожидающих, овердрафт после QUOTA_MAX_WAIT
+import types
+
+import pytest
+
+import quota_scheduler
+from quota_scheduler import BULK, INTERACTIVE, MODERATION, QuotaScheduler
+
+
+class _Clock:
+    """Детерминированное время: sleep() сдвигает monotonic() вместо реального ожидания"""
+
+    def __init__(self):
+        self.now = 1000.0
+        self.slept = []
+
+    def monotonic(self) -> float:
+        return self.now
+
+    def sleep(self, seconds: float):
+        self.slept.append(seconds)
+        self.now += seconds
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = _Clock()
+    monkeypatch.setattr(quota_scheduler, "time", types.SimpleNamespace(monotonic=clock.monotonic, sleep=clock.sleep))
+    return clock
+
+
+def _scheduler() -> QuotaScheduler:
+    # 10 токенов/с, ведро на 2 с — 20 токенов; резерв индексации — половина ведра, модерации — 10%
+    return QuotaScheduler("test", rate=10.0, burst_seconds=2.0)
+
+
+def _take_all(q: QuotaScheduler, cls: str) -> int:
+    taken = 0
+    while q._try_take(cls) == 0.0:
+        taken += 1
+    return taken
+
+
+def test_bulk_stops_at_its_reserve(clock):
+    q = _scheduler()
+    assert _take_all(q, BULK) == 10
+    assert q._try_take(BULK) == pytest.approx(0.1)
+    # Остаток ведра доступен более важным классам
+    assert _take_all(q, MODERATION) == 8
+    assert _take_all(q, INTERACTIVE) == 2
+
+
+def test_waiting_interactive_blocks_lower_classes(clock):
+    q = _scheduler()
+    q._set_waiting(INTERACTIVE, 1)
+    try:
+        assert q._try_take(BULK) == pytest.approx(0.1)
+        assert q._try_take(MODERATION) == pytest.approx(0.1)
+        assert q._try_take(INTERACTIVE) == 0.0
+    finally:
+        q._set_waiting(INTERACTIVE, -1)
+    assert q.granted[BULK] == q.granted[MODERATION] == 0
+    assert q._try_take(BULK) == 0.0
+
+
+def test_waiting_moderation_blocks_bulk_but_not_interactive(clock):
+    q = _scheduler()
+    q._set_waiting(MODERATION, 1)
+    try:
+        assert q._try_take(BULK) > 0.0
+        assert q._try_take(INTERACTIVE) == 0.0
+    finally:
+        q._set_waiting(MODERATION, -1)
+
+
+def test_interactive_waits_for_refill_within_max_wait(clock):
+    q = _scheduler()
+    _take_all(q, INTERACTIVE)
+    waited = q.acquire(INTERACTIVE)
+    assert waited == pytest.approx(0.1)
+    assert q.overdraft[INTERACTIVE] == 0
+    assert q.stats()["waiting"][INTERACTIVE] == 0
+
+
+def test_max_wait_falls_back_to_overdraft(clock, monkeypatch):
+    monkeypatch.setitem(quota_scheduler.QUOTA_MAX_WAIT, INTERACTIVE, 0.05)
+    q = _scheduler()
+    _take_all(q, INTERACTIVE)
+    granted = q.granted[INTERACTIVE]
+    waited = q.acquire(INTERACTIVE)
+    # Ожидание токена превысило бы QUOTA_MAX_WAIT — вызов уходит сразу, без токена
+    assert waited == 0.0 and clock.slept == []
+    assert q.overdraft[INTERACTIVE] == 1
+    assert q.granted[INTERACTIVE] == granted
+
+
+def test_bulk_has_no_max_wait(clock):
+    q = _scheduler()
+    _take_all(q, BULK)
+    waited = q.acquire(BULK)
+    assert waited == pytest.approx(0.1)
+    assert q.overdraft[BULK] == 0
+    assert q.granted[BULK] == 11
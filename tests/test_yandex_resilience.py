@@ -0,0 +1,54 @@
+# Адаптивный лимит: сверх лимита вызов коротко ждёт освобождения слота, а не отклоняется сразу
+import asyncio
+import threading
+import time
+
+from yandex_resilience import AdaptiveLimiter, EndpointGuard, YandexUnavailable
+
+
+def test_acquire_waits_for_released_slot():
+    limiter = AdaptiveLimiter("test_wait", initial=1, min_limit=1, max_wait=2.0)
+    assert limiter.acquire()
+    threading.Timer(0.1, limiter.release, args=(0.1, False)).start()
+    started = time.monotonic()
+    assert limiter.acquire()
+    assert 0.05 < time.monotonic() - started < 1.5
+    assert limiter.rejected == 0
+
+
+def test_acquire_rejects_after_max_wait():
+    limiter = AdaptiveLimiter("test_reject", initial=1, min_limit=1, max_wait=0.05)
+    assert limiter.acquire()
+    assert not limiter.acquire()
+    assert limiter.rejected == 1
+
+
+def test_acquire_async_waits_without_blocking_loop():
+    limiter = AdaptiveLimiter("test_async", initial=1, min_limit=1, max_wait=2.0)
+
+    async def scenario():
+        assert await limiter.acquire_async()
+        asyncio.get_running_loop().call_later(0.1, limiter.release, 0.1, False)
+        return await limiter.acquire_async()
+
+    assert asyncio.run(scenario())
+
+
+def test_burst_over_limit_is_queued_not_shed():
+    guard = EndpointGuard("test_burst")
+    guard.limiter = AdaptiveLimiter("test_burst", initial=2, min_limit=2, max_wait=2.0)
+    rejected = []
+
+    def call():
+        try:
+            with guard.attempt():
+                time.sleep(0.05)
+        except YandexUnavailable:
+            rejected.append(1)
+
+    threads = [threading.Thread(target=call) for _ in range(6)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert not rejected
@@ -0,0 +1,315 @@
+# tracing.py - распределённая трассировка запросов (Telegram -> Gateway -> RAG/Validation -> Yandex API)
+import os
+import json
+import time
+import queue
+import atexit
+import logging
+import secrets
+import threading
+import contextvars
+import urllib.request
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, List, Mapping, Optional
+
+logger = logging.getLogger(__name__)
+
+# W3C Trace Context: traceparent = "00-<trace_id 32 hex>-<span_id 16 hex>-<flags>"
+TRACEPARENT_HEADER = "traceparent"
+
+TRACING_ENABLED = os.getenv("TRACING_ENABLED", "true").lower() == "true"
+# Куда экспортировать спаны: коллектор в logging-сервисе и/или локальный JSONL-файл
+TRACE_COLLECTOR_URL = os.getenv(
+    "TRACE_COLLECTOR_URL",
+    os.getenv("LOGGING_SERVICE_URL", "http://logging-service:8005").rstrip("/") + "/traces/spans",
+)
+TRACE_FILE = os.getenv("TRACE_FILE", "")
+try:
+    TRACE_QUEUE_SIZE = int(os.getenv("TRACE_QUEUE_SIZE", "10000"))
+except Exception:
+    TRACE_QUEUE_SIZE = 10000
+try:
+    TRACE_BATCH_SIZE = int(os.getenv("TRACE_BATCH_SIZE", "200"))
+except Exception:
+    TRACE_BATCH_SIZE = 200
+try:
+    TRACE_FLUSH_INTERVAL_SECONDS = float(os.getenv("TRACE_FLUSH_INTERVAL_SECONDS", "1.0"))
+except Exception:
+    TRACE_FLUSH_INTERVAL_SECONDS = 1.0
+
+SERVICE_NAME = os.getenv("SERVICE_NAME", "unknown")
+
+
+class SpanContext:
+    __slots__ = ("trace_id", "span_id")
+
+    def __init__(self, trace_id: str, span_id: str):
+        self.trace_id = trace_id
+        self.span_id = span_id
+
+
+class Span:
+    """Один участок работы: имя, родитель, время начала и длительность, атрибуты"""
+
+    def __init__(self, name: str, trace_id: str, parent_id: Optional[str],
+                 attributes: Optional[Dict[str, Any]] = None, kind: str = "internal"):
+        self.name = name
+        self.trace_id = trace_id
+        self.span_id = secrets.token_hex(8)
+        self.parent_id = parent_id
+        self.kind = kind
+        self.attributes: Dict[str, Any] = dict(attributes or {})
+        self.status = "ok"
+        self.start = time.time()
+        self._start_perf = time.perf_counter()
+        self.duration_ms: Optional[float] = None
+
+    @property
+    def context(self) -> SpanContext:
+        return SpanContext(self.trace_id, self.span_id)
+
+    def set_attribute(self, key: str, value: Any):
+        self.attributes[key] = value
+
+    def set_error(self, error: Any):
+        self.status = "error"
+        self.attributes["error"] = str(error)[:500]
+
+    def end(self):
+        if self.duration_ms is None:
+            self.duration_ms = round((time.perf_counter() - self._start_perf) * 1000.0, 3)
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "trace_id": self.trace_id,
+            "span_id": self.span_id,
+            "parent_id": self.parent_id,
+            "name": self.name,
+            "service": SERVICE_NAME,
+            "kind": self.kind,
+            "start": self.start,
+            "duration_ms": self.duration_ms,
+            "status": self.status,
+            "attributes": self.attributes,
+        }
+
+
+class NoopSpan(Span):
+    """Спан вне трассы (require_parent без родителя): принимает атрибуты, но не экспортируется"""
+
+    def __init__(self, name: str, attributes: Optional[Dict[str, Any]] = None, kind: str = "internal"):
+        super().__init__(name, "", None, attributes, kind)
+
+
+# Текущий спан контекста (наследуется asyncio-задачами и ctx.run в пулах потоков)
+_current: contextvars.ContextVar[Optional[SpanContext]] = contextvars.ContextVar("trace_span", default=None)
+
+
+class SpanExporter:
+    """
+    Фоновый экспорт спанов пачками: запись не блокирует обработку запроса.
+    При переполнении очереди спаны отбрасываются (трассировка не должна влиять на латентность).
+    """
+
+    def __init__(self, collector_url: str = "", file_path: str = "", queue_size: int = 10000,
+                 batch_size: int = 200, flush_interval: float = 1.0):
+        self.collector_url = collector_url
+        self.file_path = file_path
+        self.batch_size = max(1, int(batch_size))
+        self.flush_interval = max(0.05, float(flush_interval))
+        self._queue: "queue.Queue[Dict[str, Any]]" = queue.Queue(maxsize=max(1, int(queue_size)))
+        self._thread: Optional[threading.Thread] = None
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self.dropped = 0
+        self.exported = 0
+        self.failed = 0
+        self._last_error_log = 0.0
+
+    def _ensure_started(self):
+        if self._thread is not None:
+            return
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="span-exporter", daemon=True)
+                self._thread.start()
+                atexit.register(self.shutdown)
+
+    def export(self, span: Dict[str, Any]):
+        if not (self.collector_url or self.file_path):
+            return
+        self._ensure_started()
+        try:
+            self._queue.put_nowait(span)
+        except queue.Full:
+            self.dropped += 1
+
+    def _drain(self, first: Optional[Dict[str, Any]] = None) -> List[Dict[str, Any]]:
+        batch: List[Dict[str, Any]] = [first] if first is not None else []
+        while len(batch) < self.batch_size:
+            try:
+                batch.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                first = self._queue.get(timeout=self.flush_interval)
+            except queue.Empty:
+                continue
+            self._write(self._drain(first))
+        # Финальный сброс остатка
+        batch = self._drain()
+        while batch:
+            self._write(batch)
+            batch = self._drain()
+
+    def _write(self, batch: List[Dict[str, Any]]):
+        if not batch:
+            return
+        if self.file_path:
+            try:
+                with open(self.file_path, "a", encoding="utf-8") as f:
+                    for span in batch:
+                        f.write(json.dumps(span, ensure_ascii=False, default=str) + "\n")
+            except Exception as e:
+                self._report_failure(f"file {self.file_path}: {e}", len(batch))
+        if self.collector_url:
+            try:
+                body = json.dumps({"spans": batch}, ensure_ascii=False, default=str).encode("utf-8")
+                req = urllib.request.Request(self.collector_url, data=body, method="POST",
+                                             headers={"Content-Type": "application/json"})
+                with urllib.request.urlopen(req, timeout=2.0) as resp:
+                    resp.read()
+            except Exception as e:
+                self._report_failure(f"collector {self.collector_url}: {e}", len(batch))
+                return
+        self.exported += len(batch)
+
+    def _report_failure(self, what: str, count: int):
+        self.failed += count
+        # Не засоряем лог: одно предупреждение в минуту
+        now = time.monotonic()
+        if now - self._last_error_log > 60.0:
+            self._last_error_log = now
+            logger.warning("Span export failed (%s); failed spans so far: %d", what, self.failed)
+
+    def shutdown(self, timeout: float = 2.0):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout=timeout)
+
+    def stats(self) -> Dict[str, int]:
+        return {"queued": self._queue.qsize(), "exported": self.exported,
+                "dropped": self.dropped, "failed": self.failed}
+
+
+EXPORTER = SpanExporter(
+    collector_url=TRACE_COLLECTOR_URL if TRACING_ENABLED else "",
+    file_path=TRACE_FILE if TRACING_ENABLED else "",
+    queue_size=TRACE_QUEUE_SIZE,
+    batch_size=TRACE_BATCH_SIZE,
+    flush_interval=TRACE_FLUSH_INTERVAL_SECONDS,
+)
+
+
+def init_tracing(service_name: str):
+    """Имя сервиса, которым помечаются спаны процесса"""
+    global SERVICE_NAME
+    SERVICE_NAME = os.getenv("SERVICE_NAME", service_name)
+
+
+def new_trace_id() -> str:
+    return secrets.token_hex(16)
+
+
+def parse_traceparent(value: Optional[str]) -> Optional[SpanContext]:
+    if not value:
+        return None
+    parts = value.strip().split("-")
+    if len(parts) != 4 or len(parts[1]) != 32 or len(parts[2]) != 16:
+        return None
+    try:
+        int(parts[1], 16)
+        int(parts[2], 16)
+    except ValueError:
+        return None
+    if parts[1] == "0" * 32 or parts[2] == "0" * 16:
+        return None
+    return SpanContext(parts[1], parts[2])
+
+
+def extract(headers: Mapping[str, str]) -> Optional[SpanContext]:
+    """Контекст вызывающего сервиса из входящих заголовков"""
+    return parse_traceparent(headers.get(TRACEPARENT_HEADER) or headers.get("Traceparent"))
+
+
+def current_trace_id() -> Optional[str]:
+    ctx = _current.get()
+    return ctx.trace_id if ctx is not None else None
+
+
+def outgoing_headers() -> Dict[str, str]:
+    """Заголовок traceparent для исходящего вызова (родитель — текущий спан)"""
+    ctx = _current.get()
+    if ctx is None:
+        return {}
+    return {TRACEPARENT_HEADER: f"00-{ctx.trace_id}-{ctx.span_id}-01"}
+
+
+@contextmanager
+def start_span(name: str, attributes: Optional[Dict[str, Any]] = None, kind: str = "internal",
+               parent: Optional[SpanContext] = None, require_parent: bool = False) -> Iterator[Span]:
+    """
+    Открывает спан — дочерний к текущему (или к parent из входящих заголовков).
+    Без родителя начинается новая трасса; с require_parent=True вместо неё — NoopSpan: он не
+    экспортируется и не меняет текущий контекст, поэтому фоновые вызовы вне запроса
+    (health-check, перестройка индекса) не плодят трасс и «осиротевших» дочерних спанов.
+    Исключение внутри блока помечает спан как error.
+    """
+    parent = parent or _current.get()
+    if parent is None and require_parent:
+        yield NoopSpan(name, attributes, kind)
+        return
+    span = Span(name, parent.trace_id if parent else new_trace_id(), parent.span_id if parent else None,
+                attributes, kind)
+    token = _current.set(span.context)
+    try:
+        yield span
+    except BaseException as e:
+        span.set_error(repr(e))
+        raise
+    finally:
+        _current.reset(token)
+        span.end()
+        if TRACING_ENABLED:
+            EXPORTER.export(span.to_dict())
+
+
+# Служебные эндпоинты не трассируем (health-check опрашивается постоянно)
+UNTRACED_PATHS = frozenset({"/health", "/metrics"})
+
+
+def install_tracing(app, service_name: str, untraced_paths=UNTRACED_PATHS):
+    """
+    Трассировка HTTP-сервиса: имя сервиса для спанов процесса и middleware с серверным спаном
+    запроса. Родитель — traceparent вызывающего сервиса; без него здесь начинается трасса.
+    """
+    init_tracing(service_name)
+
+    @app.middleware("http")
+    async def tracing_middleware(request, call_next):
+        if request.url.path in untraced_paths:
+            return await call_next(request)
+        with start_span(f"{request.method} {request.url.path}", kind="server",
+                        parent=extract(request.headers)) as span:
+            response = await call_next(request)
+            span.set_attribute("http.status_code", response.status_code)
+            if response.status_code >= 500:
+                span.status = "error"
+            response.headers["X-Trace-Id"] = span.trace_id
+            return response
+
+    return tracing_middleware
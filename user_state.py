@@ -0,0 +1,140 @@
+# user_state.py - пер-пользовательское состояние RAG-воркера с блокировками по полосам (lock striping)
+import os
+import time
+import logging
+import threading
+from contextlib import contextmanager
+from typing import Callable, Dict, Generic, Hashable, Iterator, List, Optional, TypeVar
+
+logger = logging.getLogger(__name__)
+
+
+def _env_float(name: str, default: float) -> float:
+    try:
+        return float(os.getenv(name, str(default)))
+    except Exception:
+        return default
+
+
+USER_STATE_STRIPES = int(_env_float("USER_STATE_STRIPES", 64))
+
+
+class UserRecord:
+    """Базовая запись состояния: время последнего обращения (monotonic) для вытеснения простаивающих"""
+
+    __slots__ = ("touched",)
+
+    def __init__(self):
+        self.touched = time.monotonic()
+
+
+R = TypeVar("R", bound=UserRecord)
+
+
+class _Stripe:
+    __slots__ = ("lock", "records")
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.records: Dict[Hashable, UserRecord] = {}
+
+
+class StripedUserStore(Generic[R]):
+    """
+    Словарь user_id -> запись, разбитый на N полос со своими блокировками (полоса — по хешу ключа).
+    Запросы разных пользователей почти никогда не ждут друг друга, в отличие от одного
+    глобального lock; операции над одним пользователем по-прежнему сериализуются.
+
+    Простаивающие записи удаляются фоновым потоком раз в sweep_interval — по полосе за раз,
+    чтобы не останавливать все запросы. Критерий простоя — is_idle(record, now) или
+    (по умолчанию) отсутствие обращений дольше idle_ttl секунд.
+    """
+
+    def __init__(self, factory: Callable[[], R], stripes: int = USER_STATE_STRIPES,
+                 idle_ttl: Optional[float] = None, sweep_interval: float = 60.0,
+                 is_idle: Optional[Callable[[R, float], bool]] = None, name: str = "user-state"):
+        # Число полос — степень двойки: номер полосы = hash & mask
+        n = 1
+        while n < max(1, int(stripes)):
+            n <<= 1
+        self._mask = n - 1
+        self._stripes: List[_Stripe] = [_Stripe() for _ in range(n)]
+        self._factory = factory
+        self.idle_ttl = idle_ttl
+        self.sweep_interval = max(0.5, float(sweep_interval))
+        self._is_idle = is_idle
+        self.name = name
+        self._sweeper: Optional[threading.Thread] = None
+        self._sweeper_lock = threading.Lock()
+        self._stop = threading.Event()
+        self.evicted = 0
+
+    @property
+    def stripes(self) -> int:
+        return len(self._stripes)
+
+    def _stripe(self, key: Hashable) -> _Stripe:
+        return self._stripes[hash(key) & self._mask]
+
+    @contextmanager
+    def locked(self, key: Hashable, create: bool = True) -> Iterator[Optional[R]]:
+        """Запись пользователя под блокировкой его полосы (None, если нет и create=False)"""
+        if self._sweeper is None and (self.idle_ttl is not None or self._is_idle is not None):
+            self._start_sweeper()
+        stripe = self._stripe(key)
+        with stripe.lock:
+            record = stripe.records.get(key)
+            if record is None and create:
+                record = stripe.records[key] = self._factory()
+            if record is not None:
+                record.touched = time.monotonic()
+            yield record
+
+    def pop(self, key: Hashable) -> Optional[R]:
+        stripe = self._stripe(key)
+        with stripe.lock:
+            return stripe.records.pop(key, None)
+
+    def __len__(self) -> int:
+        return sum(len(s.records) for s in self._stripes)
+
+    def __contains__(self, key: Hashable) -> bool:
+        stripe = self._stripe(key)
+        with stripe.lock:
+            return key in stripe.records
+
+    def _idle(self, record: R, now_wall: float, now_mono: float) -> bool:
+        if self._is_idle is not None:
+            return self._is_idle(record, now_wall)
+        return self.idle_ttl is not None and now_mono - record.touched > self.idle_ttl
+
+    def sweep(self) -> int:
+        """Удаляет простаивающие записи; блокирует по одной полосе за раз"""
+        removed = 0
+        for stripe in self._stripes:
+            now_wall, now_mono = time.time(), time.monotonic()
+            with stripe.lock:
+                stale = [k for k, r in stripe.records.items() if self._idle(r, now_wall, now_mono)]
+                for k in stale:
+                    del stripe.records[k]
+            removed += len(stale)
+        self.evicted += removed
+        return removed
+
+    def _start_sweeper(self):
+        with self._sweeper_lock:
+            if self._sweeper is None:
+                self._sweeper = threading.Thread(target=self._sweep_loop, name=f"{self.name}-sweeper", daemon=True)
+                self._sweeper.start()
+
+    def _sweep_loop(self):
+        while not self._stop.wait(self.sweep_interval):
+            try:
+                removed = self.sweep()
+                if removed:
+                    logger.debug("%s sweep: evicted %d idle users", self.name, removed)
+            except Exception as e:
+                logger.warning("%s sweep failed: %s", self.name, e)
+
+    def close(self):
+        self._stop.set()
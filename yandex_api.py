@@ -10,12 +10,31 @@ from settings import (
     FOLDER_ID,
     TEXT_MODEL_NAME,
     TEXT_MODEL_VERSION,
-    TEXT_MODEL_URI,
 )
 from yandex_jwt_auth import BASE_URL, get_headers, get_iam_token
+from request_deadline import clamp_timeout, expired as deadline_expired, remaining as deadline_remaining
+from tracing import Span, start_span
+from singleflight import SingleFlight, flight_key
+from yandex_resilience import GUARDS, YandexUnavailable
+from quota_scheduler import acquire_quota
+from model_routing import TASK_GENERATION, TaskProfile, completion_usage, record_task_call, task_profile
 
 logger = logging.getLogger(__name__)
 
+# Одинаковые одновременные эмбеддинги и модерационные completion выполняются одним запросом к API
+# (например, после рассылки много пользователей нажимают одну и ту же кнопку меню)
+YANDEX_SINGLEFLIGHT = os.getenv("YANDEX_SINGLEFLIGHT", "true").lower() == "true"
+EMBEDDING_FLIGHT = SingleFlight("embedding")
+COMPLETION_FLIGHT = SingleFlight("completion")
+
+
+def _shareable_completion(result: Any) -> bool:
+    """
+    Общий вызов идёт под дедлайном первого вызывающего: ошибку, отказ защиты API или истёкший
+    дедлайн отдавать остальным нельзя — они повторяют вызов сами, со своим бюджетом
+    """
+    return isinstance(result, dict) and not result.get("error")
+
 # --- ML SDK init (lazy) ---
 _SDK = None
 
@@ -58,34 +77,61 @@ def yandex_text_embedding(
     """
     Получение эмбеддинга текста с повторными попытками при ошибках сервера (REST API).
     """
+    with start_span("yandex.embedding", kind="client", require_parent=True,
+                    attributes={"text_len": len(text or "")}) as span:
+        if YANDEX_SINGLEFLIGHT:
+            key = flight_key("embedding", model_uri or EMB_MODEL_URI, text)
+            embedding, shared = EMBEDDING_FLIGHT.do(key, _yandex_text_embedding, text, model_uri, max_retries, delay,
+                                                    shareable=bool)
+            span.set_attribute("singleflight_shared", shared)
+        else:
+            embedding = _yandex_text_embedding(text, model_uri, max_retries, delay)
+        if not embedding:
+            span.status = "error"
+        return embedding
+
+
+def _yandex_text_embedding(text: str, model_uri: Optional[str], max_retries: int, delay: float) -> List[float]:
     uri = model_uri or EMB_MODEL_URI
     url = f"{BASE_URL}/textEmbedding"
     payload = {"modelUri": uri, "text": text}
 
     for attempt in range(max_retries):
+        # Вызывающая сторона уже не ждёт — не тратим квоту
+        if deadline_expired():
+            logger.warning("yandex_text_embedding: request deadline exceeded, skipping attempt %d", attempt + 1)
+            return []
         try:
-            headers = get_headers()
-            r = requests.post(url, headers=headers, json=payload, timeout=60)
+            # Квота — по классу приоритета вызывающего (индексация ждёт свободной ёмкости);
+            # повторы ограничены бюджетом, при открытом circuit breaker — сразу пустой ответ
+            acquire_quota("embedding")
+            with GUARDS["embedding"].attempt(retry=attempt > 0) as call:
+                headers = get_headers()
+                r = requests.post(url, headers=headers, json=payload, timeout=clamp_timeout(60))
+                call.record_status(r.status_code)
             if r.status_code == 200:
                 resp = r.json()
                 embedding = resp.get("embedding")
                 return [float(x) for x in embedding] if embedding else []
             logger.warning("yandex_text_embedding: HTTP %s %s", r.status_code, r.text)
-            if r.status_code >= 500 and attempt < max_retries - 1:
+            if r.status_code >= 500 and attempt < max_retries - 1 and _can_wait(delay):
                 time.sleep(delay)
                 delay *= 2
                 continue
             return []
+        except YandexUnavailable as e:
+            logger.warning("yandex_text_embedding: %s — degraded (empty) response", e)
+            return []
         except requests.exceptions.Timeout:
             logger.warning("yandex_text_embedding: timeout on attempt %d", attempt + 1)
-            if attempt < max_retries - 1:
+            if attempt < max_retries - 1 and _can_wait(delay):
                 time.sleep(delay)
                 delay *= 2
                 continue
             return []
         except Exception as e:
             logger.error("yandex_text_embedding error: %s", e)
-            if attempt < max_retries - 1:
+            if attempt < max_retries - 1 and _can_wait(delay):
                 time.sleep(delay)
                 delay *= 2
                 continue
@@ -93,12 +139,19 @@ def yandex_text_embedding(
     return []
 
 
+def _can_wait(delay: float) -> bool:
+    """Есть ли смысл ждать delay секунд перед повтором с учётом дедлайна запроса"""
+    rem = deadline_remaining()
+    return rem is None or rem > delay
+
+
 def yandex_batch_embeddings(texts: List[str], model_uri: Optional[str] = None) -> List[List[float]]:
     return [yandex_text_embedding(t, model_uri) for t in texts]
 
 
-def _normalize_sdk_alternatives(result) -> Dict[str, Any]:
-    """Нормализация результата SDK к формату {alternatives:[{message:{role,text}}]}"""
+def _normalize_sdk_alternatives(result, model_name: str = TEXT_MODEL_NAME,
+                                model_version: str = TEXT_MODEL_VERSION) -> Dict[str, Any]:
+    """Нормализация результата SDK к формату {alternatives:[{message:{role,text}}], usage}"""
     alternatives: List[Dict[str, Any]] = []
     try:
         for alt in result:
@@ -112,65 +165,165 @@ def _normalize_sdk_alternatives(result) -> Dict[str, Any]:
             alternatives.append({"message": {"role": role, "text": text or ""}})
     except Exception as e:
         logger.warning("Normalize SDK result failed: %s", e)
-    return {"alternatives": alternatives, "model": {"name": TEXT_MODEL_NAME, "version": TEXT_MODEL_VERSION}}
+    input_tokens, output_tokens = completion_usage(result)
+    return {"alternatives": alternatives, "model": {"name": model_name, "version": model_version},
+            "usage": {"inputTextTokens": input_tokens, "completionTokens": output_tokens}}
 
 
 def yandex_completion(
-    prompt, model_uri: Optional[str] = None, max_tokens: int = 2000, temperature: float = 0.3
+    prompt, model_uri: Optional[str] = None, max_tokens: Optional[int] = None, temperature: float = 0.3,
+    coalesce: bool = False, task: str = TASK_GENERATION,
 ) -> Dict[str, Any]:
     """
-    Генерация текста через Yandex Cloud ML SDK (llama/latest по умолчанию).
+    Генерация текста через Yandex Cloud ML SDK, при сбое — REST.
+    Модель и лимит токенов по умолчанию берутся из профиля задачи task (model_routing):
+    генерация — полная модель (TEXT_MODEL_NAME/VERSION, REST — TEXT_MODEL_URI), модерация и
+    классификация — облегчённая. Явный model_uri задаёт модель REST-вызова.
     Возвращает словарь с ключом 'alternatives' для совместимости с существующим кодом.
+    coalesce=True — одинаковые одновременные запросы (модерация) делят один вызов API и его результат.
     """
-    # Приводим промпт к messages
+    profile = task_profile(task)
+    max_tokens = max_tokens or profile.max_tokens
+    with start_span("yandex.completion", kind="client", require_parent=True,
+                    attributes={"max_tokens": max_tokens, "temperature": temperature, "task": profile.task}) as span:
+        if coalesce and YANDEX_SINGLEFLIGHT:
+            key = flight_key("completion", profile.task, model_uri, prompt_to_messages(prompt), max_tokens, temperature)
+            result, shared = COMPLETION_FLIGHT.do(key, _yandex_completion, prompt, model_uri, max_tokens,
+                                                  temperature, span, profile, shareable=_shareable_completion)
+            span.set_attribute("singleflight_shared", shared)
+        else:
+            result = _yandex_completion(prompt, model_uri, max_tokens, temperature, span, profile)
+        if result.get("error"):
+            span.set_error(result["error"])
+        return result
+
+
+def prompt_to_messages(prompt) -> List[Dict[str, str]]:
+    """Приводит промпт (строка или список {role, text}) к messages для completion API"""
     if isinstance(prompt, list):
         messages: List[Dict[str, str]] = []
         for msg in prompt:
             if isinstance(msg, dict) and "role" in msg and "text" in msg:
                 messages.append({"role": str(msg["role"]), "text": str(msg["text"])})
-    elif isinstance(prompt, str):
-        messages = [{"role": "user", "text": prompt}]
-    else:
-        messages = [{"role": "user", "text": str(prompt)}]
+        return messages
+    if isinstance(prompt, str):
+        return [{"role": "user", "text": prompt}]
+    return [{"role": "user", "text": str(prompt)}]
 
-    # Попытка SDK
+
+def completion_payload(model_uri: str, messages: List[Dict[str, str]], max_tokens: int,
+                       temperature: float) -> Dict[str, Any]:
+    """Тело запроса REST /completion"""
+    return {
+        "modelUri": model_uri,
+        "completionOptions": {
+            "stream": False,
+            "temperature": temperature,
+            "maxTokens": max_tokens,
+        },
+        "messages": messages,
+    }
+
+
+def degraded_response(e: YandexUnavailable) -> Dict[str, Any]:
+    """Ответ вместо вызова API, отклонённого лимитом или circuit breaker (формат ошибки completion)"""
+    return {"error": str(e), "degraded": True, "retry_after": e.retry_after}
+
+
+# Ошибка completion, когда дедлайн запроса истёк до вызова API
+DEADLINE_EXCEEDED = "deadline_exceeded"
+
+
+def is_deadline_exceeded(result: Any) -> bool:
+    return isinstance(result, dict) and result.get("error") == DEADLINE_EXCEEDED
+
+
+def is_degraded(result: Any) -> bool:
+    """Вызов не выполнен (лимит, circuit breaker, бюджет повторов): ответ модели отсутствует, а не пуст"""
+    return isinstance(result, dict) and bool(result.get("degraded"))
+
+
+def _yandex_completion(prompt, model_uri: Optional[str], max_tokens: int, temperature: float,
+                       span: Span, profile: TaskProfile) -> Dict[str, Any]:
+    messages = prompt_to_messages(prompt)
+
+    if deadline_expired():
+        logger.warning("yandex_completion: request deadline exceeded, skipping call")
+        return {"error": DEADLINE_EXCEEDED}
+
+    guard = GUARDS["completion"]
+    # Инициализация SDK (нет пакета, нет IAM-токена) — не сбой API: тогда REST — первичный вызов
+    model = None
+    sdk_error: Optional[Exception] = None
     try:
         sdk = _get_sdk()
-        model = sdk.models.completions(TEXT_MODEL_NAME, model_version=TEXT_MODEL_VERSION)
+        model = sdk.models.completions(profile.model_name, model_version=profile.model_version)
         try:
-            model = model.configure(temperature=temperature)
+            model = model.configure(temperature=temperature, max_tokens=max_tokens)
         except Exception:
             pass
-        logger.info("Using SDK completions model: name=%s, version=%s", TEXT_MODEL_NAME, TEXT_MODEL_VERSION)
-        result = model.run(messages)
-        return _normalize_sdk_alternatives(result)
     except Exception as e:
-        logger.exception("yandex_completion via SDK failed: %s", e)
-        # REST fallback
+        logger.warning("yandex_completion: SDK unavailable (%s), using REST", e)
+        sdk_error = e
+
+    # Попытка SDK
+    rest_is_retry = False
+    if model is not None:
+        sdk_label = f"{profile.model_name}/{profile.model_version}"
+        started = time.monotonic()
         try:
-            mu = model_uri or TEXT_MODEL_URI
-            if not mu:
-                return {"error": f"SDK error: {e}"}
-            url = f"{BASE_URL}/completion"
-            payload = {
-                "modelUri": mu,
-                "completionOptions": {
-                    "stream": False,
-                    "temperature": temperature,
-                    "maxTokens": max_tokens,
-                },
-                "messages": messages,
-            }
+            logger.info("Using SDK completions model: task=%s, name=%s, version=%s",
+                        profile.task, profile.model_name, profile.model_version)
+            acquire_quota("completion")
+            started = time.monotonic()
+            with guard.attempt():
+                result = model.run(messages, timeout=clamp_timeout(60))
+            span.set_attribute("via", "sdk")
+            span.set_attribute("model", sdk_label)
+            normalized = _normalize_sdk_alternatives(result, profile.model_name, profile.model_version)
+            record_task_call(profile, sdk_label, time.monotonic() - started, normalized)
+            return normalized
+        except YandexUnavailable as e:
+            logger.warning("yandex_completion: %s — degraded response", e)
+            return degraded_response(e)
+        except Exception as e:
+            record_task_call(profile, sdk_label, time.monotonic() - started, {"error": str(e)})
+            logger.exception("yandex_completion via SDK failed: %s", e)
+            sdk_error = e
+            # REST после сбоя вызова SDK — повтор того же запроса, он тратит бюджет повторов
+            rest_is_retry = True
+
+    # REST fallback — та же задача: модель профиля и лимит токенов
+    try:
+        mu = model_uri or profile.rest_model_uri
+        if not mu:
+            return {"error": f"SDK error: {sdk_error}"}
+        if deadline_expired():
+            return {"error": DEADLINE_EXCEEDED}
+        url = f"{BASE_URL}/completion"
+        payload = completion_payload(mu, messages, max_tokens, temperature)
+        logger.info("Using REST completions: task=%s, modelUri=%s", profile.task, mu)
+        span.set_attribute("via", "rest")
+        span.set_attribute("model", mu)
+        acquire_quota("completion")
+        started = time.monotonic()
+        with guard.attempt(retry=rest_is_retry) as call:
             headers = get_headers()
-            logger.info("Using REST completions modelUri: %s", mu)
-            resp = requests.post(url, headers=headers, json=payload, timeout=60)
-            if resp.status_code == 200:
-                return resp.json()
+            resp = requests.post(url, headers=headers, json=payload, timeout=clamp_timeout(60))
+            call.record_status(resp.status_code)
+        if resp.status_code == 200:
+            result = resp.json()
+        else:
             logger.error("yandex_completion REST fallback: HTTP %s %s", resp.status_code, resp.text)
-            return {"error": f"HTTP {resp.status_code}: {resp.text}"}
-        except Exception as e2:
-            logger.error("yandex_completion REST fallback failed: %s", e2)
-            return {"error": str(e)}
+            result = {"error": f"HTTP {resp.status_code}: {resp.text}"}
+        record_task_call(profile, mu, time.monotonic() - started, result)
+        return result
+    except YandexUnavailable as e:
+        logger.warning("yandex_completion REST fallback: %s — degraded response", e)
+        return degraded_response(e)
+    except Exception as e2:
+        logger.error("yandex_completion REST fallback failed: %s", e2)
+        return {"error": str(sdk_error or e2)}
 
 
 def yandex_classify(text: str, model_uri: Optional[str] = None, examples: Optional[List[dict]] = None) -> dict:
@@ -180,8 +333,9 @@ def yandex_classify(text: str, model_uri: Optional[str] = None, examples: Option
     if examples:
         payload["examples"] = examples
     try:
-        headers = get_headers()
-        resp = requests.post(url, headers=headers, json=payload, timeout=15)
+        with start_span("yandex.classify", kind="client", require_parent=True):
+            headers = get_headers()
+            resp = requests.post(url, headers=headers, json=payload, timeout=clamp_timeout(15))
         if resp.status_code != 200:
             logger.error("yandex_classify error %s %s", resp.status_code, resp.text)
             return {"error": True, "status_code": resp.status_code, "text": resp.text}
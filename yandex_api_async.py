@@ -0,0 +1,270 @@
+# yandex_api_async.py - асинхронный клиент Yandex Foundation Models (httpx) для пайплайна на asyncio
+import os
+import time
+import asyncio
+import logging
+from typing import Any, Dict, List, Optional
+
+try:
+    import httpx  # type: ignore
+except Exception:
+    httpx = None
+
+from settings import EMB_MODEL_URI
+from yandex_jwt_auth import BASE_URL, get_headers
+from yandex_api import (YANDEX_SINGLEFLIGHT, DEADLINE_EXCEEDED, completion_payload, degraded_response,
+                        prompt_to_messages, _can_wait, _shareable_completion)
+from yandex_resilience import GUARDS, YandexUnavailable
+from quota_scheduler import acquire_quota_async
+from model_routing import TASK_GENERATION, TaskProfile, record_task_call, task_profile
+from request_deadline import clamp_timeout, expired as deadline_expired
+from tracing import Span, start_span
+from singleflight import AsyncSingleFlight, flight_key
+
+logger = logging.getLogger(__name__)
+
+# Без httpx клиент не создаётся (RuntimeError), а except по пустому кортежу ничего не ловит
+_TIMEOUT_ERRORS = (httpx.TimeoutException,) if httpx is not None else ()
+
+
+def _env_float(name: str, default: float) -> float:
+    try:
+        return float(os.getenv(name, str(default)))
+    except Exception:
+        return default
+
+
+YANDEX_ASYNC_MAX_CONNECTIONS = int(_env_float("YANDEX_ASYNC_MAX_CONNECTIONS", 100))
+YANDEX_ASYNC_MAX_KEEPALIVE = int(_env_float("YANDEX_ASYNC_MAX_KEEPALIVE", 20))
+# Сколько ждать свободное соединение из пула (сверх этого — ошибка, а не бесконечная очередь)
+YANDEX_ASYNC_POOL_TIMEOUT = _env_float("YANDEX_ASYNC_POOL_TIMEOUT_SECONDS", 5.0)
+# Заголовки авторизации (IAM-токен живёт часы) кешируются, чтобы не ходить в метаданные на каждый вызов
+YANDEX_HEADERS_TTL_SECONDS = _env_float("YANDEX_HEADERS_TTL_SECONDS", 300.0)
+# Сколько эмбеддингов одного пакета запрашивать одновременно (остальные ждут, а не занимают весь пул)
+YANDEX_BATCH_EMBEDDING_CONCURRENCY = int(_env_float("YANDEX_BATCH_EMBEDDING_CONCURRENCY", 8))
+
+# HTTP/2 (мультиплексирование запросов в одном соединении) — только если установлен пакет h2
+try:
+    import h2  # noqa: F401
+    _H2_AVAILABLE = True
+except Exception:
+    _H2_AVAILABLE = False
+YANDEX_ASYNC_HTTP2 = os.getenv("YANDEX_ASYNC_HTTP2", "true").lower() == "true" and _H2_AVAILABLE
+
+# Объединение одинаковых одновременных вызовов (см. YANDEX_SINGLEFLIGHT в yandex_api)
+EMBEDDING_FLIGHT = AsyncSingleFlight("embedding_async")
+COMPLETION_FLIGHT = AsyncSingleFlight("completion_async")
+
+
+class AsyncYandexClient:
+    """
+    Общий httpx.AsyncClient для вызовов Yandex API из event loop: пул keep-alive соединений,
+    ожидание ответа не занимает поток. Заголовки авторизации получаются синхронным get_headers()
+    в потоке и кешируются на YANDEX_HEADERS_TTL_SECONDS; при 401 кеш сбрасывается.
+    """
+
+    def __init__(self, base_url: str = BASE_URL, max_connections: int = YANDEX_ASYNC_MAX_CONNECTIONS,
+                 max_keepalive: int = YANDEX_ASYNC_MAX_KEEPALIVE, http2: bool = YANDEX_ASYNC_HTTP2,
+                 headers_ttl: float = YANDEX_HEADERS_TTL_SECONDS):
+        if httpx is None:
+            raise RuntimeError("httpx package is not installed")
+        self.base_url = base_url.rstrip("/")
+        self.headers_ttl = max(0.0, float(headers_ttl))
+        limits = httpx.Limits(max_connections=max(1, int(max_connections)),
+                              max_keepalive_connections=max(0, min(int(max_keepalive), int(max_connections))))
+        self._http = httpx.AsyncClient(limits=limits, http2=http2,
+                                       timeout=httpx.Timeout(60.0, pool=YANDEX_ASYNC_POOL_TIMEOUT))
+        self._headers: Optional[Dict[str, str]] = None
+        self._headers_expire = 0.0
+        self._headers_lock = asyncio.Lock()
+
+    async def headers(self) -> Dict[str, str]:
+        if self._headers is not None and time.monotonic() < self._headers_expire:
+            return self._headers
+        async with self._headers_lock:
+            # Один запрос токена на всех ожидающих
+            if self._headers is None or time.monotonic() >= self._headers_expire:
+                self._headers = await asyncio.to_thread(get_headers)
+                self._headers_expire = time.monotonic() + self.headers_ttl
+            return self._headers
+
+    async def post(self, path: str, payload: Dict[str, Any], timeout: float = 60.0) -> "httpx.Response":
+        headers = await self.headers()
+        resp = await self._http.post(f"{self.base_url}{path}", headers=headers, json=payload,
+                                     timeout=clamp_timeout(timeout))
+        if resp.status_code == 401:
+            self._headers = None
+        return resp
+
+    @property
+    def closed(self) -> bool:
+        return self._http.is_closed
+
+    async def aclose(self):
+        await self._http.aclose()
+
+
+# Клиент привязан к event loop, в котором создан (соединения httpx нельзя делить между loop'ами)
+_client: Optional[AsyncYandexClient] = None
+_client_loop: Optional[asyncio.AbstractEventLoop] = None
+
+
+def get_async_client() -> AsyncYandexClient:
+    global _client, _client_loop
+    loop = asyncio.get_running_loop()
+    if _client is None or _client_loop is not loop or _client.closed:
+        _client, _client_loop = AsyncYandexClient(), loop
+        logger.info("Async Yandex client: max_connections=%d, http2=%s",
+                    YANDEX_ASYNC_MAX_CONNECTIONS, YANDEX_ASYNC_HTTP2)
+    return _client
+
+
+async def aclose_async_client():
+    """Закрывает соединения клиента (вызывается при остановке сервиса)"""
+    global _client, _client_loop
+    if _client is not None:
+        client, _client, _client_loop = _client, None, None
+        await client.aclose()
+
+
+async def yandex_text_embedding_async(
+    text: str, model_uri: Optional[str] = None, max_retries: int = 3, delay: float = 1.0
+) -> List[float]:
+    """Асинхронный аналог yandex_text_embedding: те же повторы, дедлайн и спан"""
+    with start_span("yandex.embedding", kind="client", require_parent=True,
+                    attributes={"text_len": len(text or ""), "async": True}) as span:
+        if YANDEX_SINGLEFLIGHT:
+            key = flight_key("embedding", model_uri or EMB_MODEL_URI, text)
+            embedding, shared = await EMBEDDING_FLIGHT.do(key, _yandex_text_embedding_async, text, model_uri,
+                                                          max_retries, delay, shareable=bool)
+            span.set_attribute("singleflight_shared", shared)
+        else:
+            embedding = await _yandex_text_embedding_async(text, model_uri, max_retries, delay)
+        if not embedding:
+            span.status = "error"
+        return embedding
+
+
+async def _yandex_text_embedding_async(text: str, model_uri: Optional[str], max_retries: int,
+                                       delay: float) -> List[float]:
+    payload = {"modelUri": model_uri or EMB_MODEL_URI, "text": text}
+
+    for attempt in range(max_retries):
+        # Вызывающая сторона уже не ждёт — не тратим квоту
+        if deadline_expired():
+            logger.warning("yandex_text_embedding_async: request deadline exceeded, skipping attempt %d", attempt + 1)
+            return []
+        retryable = True
+        try:
+            # Квота, лимит, circuit breaker и бюджет повторов — общие с синхронным клиентом
+            await acquire_quota_async("embedding")
+            async with GUARDS["embedding"].attempt_async(retry=attempt > 0) as call:
+                r = await get_async_client().post("/textEmbedding", payload)
+                call.record_status(r.status_code)
+            if r.status_code == 200:
+                embedding = r.json().get("embedding")
+                return [float(x) for x in embedding] if embedding else []
+            logger.warning("yandex_text_embedding_async: HTTP %s %s", r.status_code, r.text)
+            retryable = r.status_code >= 500
+        except YandexUnavailable as e:
+            logger.warning("yandex_text_embedding_async: %s — degraded (empty) response", e)
+            return []
+        except _TIMEOUT_ERRORS:
+            logger.warning("yandex_text_embedding_async: timeout on attempt %d", attempt + 1)
+        except Exception as e:
+            logger.error("yandex_text_embedding_async error: %s", e)
+        if retryable and attempt < max_retries - 1 and _can_wait(delay):
+            await asyncio.sleep(delay)
+            delay *= 2
+            continue
+        return []
+    return []
+
+
+async def yandex_batch_embeddings_async(texts: List[str], model_uri: Optional[str] = None,
+                                        concurrency: int = YANDEX_BATCH_EMBEDDING_CONCURRENCY) -> List[List[float]]:
+    """Эмбеддинги нескольких текстов, не больше concurrency одновременно; порядок совпадает с texts"""
+    if len(texts) <= 1:
+        return [await yandex_text_embedding_async(t, model_uri) for t in texts]
+    sem = asyncio.Semaphore(max(1, int(concurrency)))
+
+    async def one(text: str) -> List[float]:
+        async with sem:
+            return await yandex_text_embedding_async(text, model_uri)
+
+    return list(await asyncio.gather(*(one(t) for t in texts)))
+
+
+async def yandex_completion_async(
+    prompt, model_uri: Optional[str] = None, max_tokens: Optional[int] = None, temperature: float = 0.3,
+    coalesce: bool = False, task: str = TASK_GENERATION,
+) -> Dict[str, Any]:
+    """
+    Асинхронный аналог yandex_completion. SDK синхронный (gRPC), поэтому здесь только REST:
+    сначала модель, которую использовал бы SDK для задачи task, затем REST-модель профиля —
+    тот же порядок, что SDK -> REST fallback в yandex_completion. Формат ответа — как у REST.
+    coalesce=True — как в yandex_completion: одинаковые одновременные запросы делят один вызов.
+    """
+    profile = task_profile(task)
+    max_tokens = max_tokens or profile.max_tokens
+    with start_span("yandex.completion", kind="client", require_parent=True,
+                    attributes={"max_tokens": max_tokens, "temperature": temperature, "task": profile.task,
+                                "async": True}) as span:
+        if coalesce and YANDEX_SINGLEFLIGHT:
+            key = flight_key("completion", profile.task, model_uri, prompt_to_messages(prompt), max_tokens, temperature)
+            result, shared = await COMPLETION_FLIGHT.do(key, _yandex_completion_async, prompt, model_uri,
+                                                         max_tokens, temperature, span, profile,
+                                                         shareable=_shareable_completion)
+            span.set_attribute("singleflight_shared", shared)
+        else:
+            result = await _yandex_completion_async(prompt, model_uri, max_tokens, temperature, span, profile)
+        if result.get("error"):
+            span.set_error(result["error"])
+        return result
+
+
+async def _yandex_completion_async(prompt, model_uri: Optional[str], max_tokens: int, temperature: float,
+                                   span: Span, profile: TaskProfile) -> Dict[str, Any]:
+    messages = prompt_to_messages(prompt)
+    candidates: List[str] = []
+    for uri in ([model_uri] if model_uri else [profile.sdk_model_uri, profile.rest_model_uri]):
+        if uri and uri not in candidates:
+            candidates.append(uri)
+    if not candidates:
+        return {"error": "model URI is not configured (FOLDER_ID / YAND_TEXT_MODEL_URI)"}
+
+    error: Any = None
+    # Следующая модель после перегрузки (таймаут, 429, 5xx) — повтор, он тратит бюджет повторов;
+    # после 4xx (модель недоступна для каталога) — обычный вызов
+    overloaded = False
+    for uri in candidates:
+        if deadline_expired():
+            logger.warning("yandex_completion_async: request deadline exceeded, skipping call")
+            return {"error": DEADLINE_EXCEEDED}
+        started = time.monotonic()
+        try:
+            span.set_attribute("via", "rest")
+            span.set_attribute("model_uri", uri)
+            await acquire_quota_async("completion")
+            started = time.monotonic()
+            async with GUARDS["completion"].attempt_async(retry=overloaded) as call:
+                resp = await get_async_client().post("/completion",
+                                                     completion_payload(uri, messages, max_tokens, temperature))
+                call.record_status(resp.status_code)
+            if resp.status_code == 200:
+                result = resp.json()
+                record_task_call(profile, uri, time.monotonic() - started, result)
+                return result
+            logger.error("yandex_completion_async %s: HTTP %s %s", uri, resp.status_code, resp.text)
+            error = f"HTTP {resp.status_code}: {resp.text}"
+            record_task_call(profile, uri, time.monotonic() - started, {"error": error})
+            overloaded = call.overloaded
+        except YandexUnavailable as e:
+            logger.warning("yandex_completion_async: %s — degraded response", e)
+            return degraded_response(e)
+        except Exception as e:
+            overloaded = True
+            logger.error("yandex_completion_async %s failed: %s", uri, e)
+            error = str(e)
+            record_task_call(profile, uri, time.monotonic() - started, {"error": error})
+    return {"error": error}
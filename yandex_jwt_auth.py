@@ -144,7 +144,8 @@ def get_headers():
     raise RuntimeError("No Yandex API credentials available")
 
 # Initialize constants that don't require API access
-BASE_URL = "https://llm.api.cloud.yandex.net/foundationModels/v1"
+# YANDEX_API_BASE_URL — для нагрузочных тестов против локального имитатора API
+BASE_URL = os.getenv("YANDEX_API_BASE_URL", "https://llm.api.cloud.yandex.net/foundationModels/v1")
 
 # Log configuration (but don't fail if API keys are missing)
 if SERVICE_ACCOUNT_ID and KEY_ID:
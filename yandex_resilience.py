@@ -0,0 +1,426 @@
+# yandex_resilience.py - защита от каскадных сбоев при вызовах Yandex API:
+# адаптивный лимит одновременных запросов (AIMD + Vegas), circuit breaker и бюджет повторов
+import os
+import time
+import asyncio
+import logging
+import threading
+from collections import deque
+from contextlib import asynccontextmanager, contextmanager
+from typing import Any, AsyncIterator, Deque, Dict, Iterator, Optional, Tuple
+
+from pipeline_metrics import REGISTRY
+from request_deadline import remaining as deadline_remaining
+
+logger = logging.getLogger(__name__)
+
+
+def _env_float(name: str, default: float) -> float:
+    try:
+        return float(os.getenv(name, str(default)))
+    except Exception:
+        return default
+
+
+YANDEX_RESILIENCE = os.getenv("YANDEX_RESILIENCE", "true").lower() == "true"
+# Адаптивный лимит одновременных вызовов на эндпоинт
+YANDEX_LIMIT_INITIAL = int(_env_float("YANDEX_LIMIT_INITIAL", 20))
+YANDEX_LIMIT_MIN = int(_env_float("YANDEX_LIMIT_MIN", 2))
+YANDEX_LIMIT_MAX = int(_env_float("YANDEX_LIMIT_MAX", 200))
+# Во сколько раз латентность может превысить минимальную, прежде чем лимит начнёт снижаться (Vegas)
+YANDEX_LIMIT_LATENCY_TOLERANCE = _env_float("YANDEX_LIMIT_LATENCY_TOLERANCE", 2.5)
+YANDEX_LIMIT_BACKOFF = _env_float("YANDEX_LIMIT_BACKOFF", 0.7)
+# Сколько вызов ждёт свободный слот лимита (не дольше дедлайна запроса), прежде чем получить отказ:
+# обычный всплеск переживается коротким ожиданием, а не деградированным ответом
+YANDEX_LIMIT_MAX_WAIT_SECONDS = _env_float("YANDEX_LIMIT_MAX_WAIT_SECONDS", 1.0)
+# Circuit breaker: доля ошибок в окне, после которой вызовы отклоняются сразу
+YANDEX_BREAKER_FAILURE_RATIO = _env_float("YANDEX_BREAKER_FAILURE_RATIO", 0.5)
+YANDEX_BREAKER_MIN_CALLS = int(_env_float("YANDEX_BREAKER_MIN_CALLS", 20))
+YANDEX_BREAKER_WINDOW_SECONDS = _env_float("YANDEX_BREAKER_WINDOW_SECONDS", 30.0)
+YANDEX_BREAKER_OPEN_SECONDS = _env_float("YANDEX_BREAKER_OPEN_SECONDS", 15.0)
+YANDEX_BREAKER_HALF_OPEN_PROBES = int(_env_float("YANDEX_BREAKER_HALF_OPEN_PROBES", 3))
+# Повторы (и SDK -> REST fallback) — не больше этой доли от числа первичных вызовов
+YANDEX_RETRY_BUDGET_RATIO = _env_float("YANDEX_RETRY_BUDGET_RATIO", 0.1)
+# Минимум повторов в секунду, чтобы при малом трафике повторы вообще были возможны
+YANDEX_RETRY_BUDGET_MIN_PER_SECOND = _env_float("YANDEX_RETRY_BUDGET_MIN_PER_SECOND", 1.0)
+YANDEX_RETRY_BUDGET_MAX = _env_float("YANDEX_RETRY_BUDGET_MAX", 20.0)
+
+CLIENT_LIMIT = REGISTRY.gauge(
+    "yandex_client_concurrency_limit", "Текущий адаптивный лимит одновременных вызовов Yandex API", ["endpoint"])
+CLIENT_IN_FLIGHT = REGISTRY.gauge(
+    "yandex_client_in_flight", "Выполняющиеся вызовы Yandex API (клиентская сторона)", ["endpoint"])
+CLIENT_REJECTED = REGISTRY.counter(
+    "yandex_client_rejected_total", "Вызовы Yandex API, отклонённые без запроса (limit/circuit_open/retry_budget)",
+    ["endpoint", "reason"])
+CIRCUIT_STATE = REGISTRY.gauge(
+    "yandex_circuit_state", "Состояние circuit breaker: 0 — closed, 1 — half_open, 2 — open", ["endpoint"])
+
+CLOSED, HALF_OPEN, OPEN = "closed", "half_open", "open"
+_STATE_VALUE = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+
+
+class YandexUnavailable(Exception):
+    """Вызов не выполнен, чтобы не добивать перегруженный API: вернуть деградированный ответ"""
+
+    def __init__(self, endpoint: str, reason: str, retry_after: float = 1.0):
+        super().__init__(f"Yandex API {endpoint}: {reason}")
+        self.endpoint = endpoint
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+class AdaptiveLimiter:
+    """
+    Лимит одновременных вызовов, подстраивающийся под состояние API.
+    AIMD: успешный вызов увеличивает лимит на 1/limit (примерно +1 за «окно» из limit вызовов),
+    перегрузка (таймаут, 429, 5xx) умножает его на backoff. Vegas: если латентность выросла больше
+    чем в tolerance раз относительно минимальной, очередь копится у API — лимит тоже снижается,
+    не дожидаясь ошибок. Сверх лимита вызов ждёт освобождения слота не дольше max_wait
+    (и оставшегося дедлайна запроса) и только потом отклоняется.
+    """
+
+    def __init__(self, name: str, initial: int = YANDEX_LIMIT_INITIAL, min_limit: int = YANDEX_LIMIT_MIN,
+                 max_limit: int = YANDEX_LIMIT_MAX, tolerance: float = YANDEX_LIMIT_LATENCY_TOLERANCE,
+                 backoff: float = YANDEX_LIMIT_BACKOFF, max_wait: float = YANDEX_LIMIT_MAX_WAIT_SECONDS):
+        self.name = name
+        self.min_limit = max(1, int(min_limit))
+        self.max_limit = max(self.min_limit, int(max_limit))
+        self.tolerance = max(1.0, float(tolerance))
+        self.backoff = min(0.95, max(0.1, float(backoff)))
+        self.max_wait = max(0.0, float(max_wait))
+        self._limit = float(min(self.max_limit, max(self.min_limit, int(initial))))
+        self._lock = threading.Lock()
+        # Освобождение слота будит ждущие потоки (корутины опрашивают, чтобы не блокировать event loop)
+        self._released = threading.Condition(self._lock)
+        self._in_flight = 0
+        # Минимальная латентность — оценка времени ответа без очереди; медленно «забывается»
+        self._min_rtt: Optional[float] = None
+        self.rejected = 0
+        CLIENT_LIMIT.set(self.limit, endpoint=name)
+
+    @property
+    def limit(self) -> int:
+        return int(self._limit)
+
+    def try_acquire(self) -> bool:
+        """Слот без ожидания"""
+        with self._lock:
+            if self._take():
+                return True
+            self.rejected += 1
+            return False
+
+    def _take(self) -> bool:
+        if self._in_flight >= self.limit:
+            return False
+        self._in_flight += 1
+        CLIENT_IN_FLIGHT.set(self._in_flight, endpoint=self.name)
+        return True
+
+    def _wait_budget(self) -> float:
+        rem = deadline_remaining()
+        return self.max_wait if rem is None else min(self.max_wait, rem)
+
+    def acquire(self) -> bool:
+        """Слот с ожиданием до max_wait (блокирует поток); False — лимит так и не освободился"""
+        wait_until = time.monotonic() + self._wait_budget()
+        with self._released:
+            while not self._take():
+                left = wait_until - time.monotonic()
+                if left <= 0:
+                    self.rejected += 1
+                    return False
+                self._released.wait(left)
+            return True
+
+    async def acquire_async(self) -> bool:
+        """acquire() для корутин: ожидание не блокирует event loop"""
+        wait_until = time.monotonic() + self._wait_budget()
+        while True:
+            with self._lock:
+                if self._take():
+                    return True
+                left = wait_until - time.monotonic()
+                if left <= 0:
+                    self.rejected += 1
+                    return False
+            await asyncio.sleep(min(left, 0.02))
+
+    def cancel(self):
+        """Слот взят, но вызов не состоялся: освобождаем без подстройки лимита"""
+        with self._lock:
+            self._in_flight -= 1
+            CLIENT_IN_FLIGHT.set(self._in_flight, endpoint=self.name)
+            self._released.notify()
+
+    def release(self, latency: float, overloaded: bool):
+        with self._lock:
+            self._in_flight -= 1
+            if overloaded:
+                self._limit = max(self.min_limit, self._limit * self.backoff)
+            else:
+                # Минимум медленно растёт, чтобы устаревшая оценка (другая модель, другой маршрут) забывалась
+                if self._min_rtt is None or latency < self._min_rtt:
+                    self._min_rtt = latency
+                else:
+                    self._min_rtt *= 1.001
+                # Пол в 50 мс: быстрые ответы (ошибки валидации, кеш) не делают порог недостижимо низким
+                if latency > max(self._min_rtt, 0.05) * self.tolerance:
+                    self._limit = max(self.min_limit, self._limit - 1.0 / self._limit)
+                elif self._in_flight + 1 >= self.limit:
+                    # Лимит растёт, только когда он действительно был исчерпан
+                    self._limit = min(self.max_limit, self._limit + 1.0 / self._limit)
+            CLIENT_IN_FLIGHT.set(self._in_flight, endpoint=self.name)
+            CLIENT_LIMIT.set(self.limit, endpoint=self.name)
+            # Лимит мог вырасти — будим всех, лишние снова уснут
+            self._released.notify_all()
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {"limit": self.limit, "in_flight": self._in_flight, "rejected": self.rejected,
+                    "min_latency": round(self._min_rtt, 3) if self._min_rtt is not None else None}
+
+
+class CircuitBreaker:
+    """
+    closed -> open: в окне window_seconds не меньше min_calls вызовов и доля ошибок >= failure_ratio.
+    open: вызовы отклоняются сразу open_seconds. half_open: пропускается до probes пробных вызовов;
+    все успешны — closed, любая ошибка — снова open.
+    """
+
+    def __init__(self, name: str, failure_ratio: float = YANDEX_BREAKER_FAILURE_RATIO,
+                 min_calls: int = YANDEX_BREAKER_MIN_CALLS, window_seconds: float = YANDEX_BREAKER_WINDOW_SECONDS,
+                 open_seconds: float = YANDEX_BREAKER_OPEN_SECONDS, probes: int = YANDEX_BREAKER_HALF_OPEN_PROBES):
+        self.name = name
+        self.failure_ratio = float(failure_ratio)
+        self.min_calls = max(1, int(min_calls))
+        self.window_seconds = float(window_seconds)
+        self.open_seconds = float(open_seconds)
+        self.probes = max(1, int(probes))
+        self._lock = threading.Lock()
+        self._outcomes: Deque[Tuple[float, bool]] = deque()
+        self._failures = 0
+        self.state = CLOSED
+        self._opened_at = 0.0
+        self._probes_started = 0
+        self._probes_ok = 0
+        self.opened = 0
+        CIRCUIT_STATE.set(0, endpoint=name)
+
+    def _set_state(self, state: str):
+        if state != self.state:
+            logger.warning("Yandex API %s circuit breaker: %s -> %s", self.name, self.state, state)
+        self.state = state
+        CIRCUIT_STATE.set(_STATE_VALUE[state], endpoint=self.name)
+
+    def _trim(self, now: float):
+        while self._outcomes and self._outcomes[0][0] < now - self.window_seconds:
+            _, ok = self._outcomes.popleft()
+            if not ok:
+                self._failures -= 1
+
+    def retry_after(self) -> float:
+        return max(1.0, self.open_seconds - (time.monotonic() - self._opened_at))
+
+    def allow(self) -> bool:
+        with self._lock:
+            if self.state == OPEN:
+                if time.monotonic() - self._opened_at < self.open_seconds:
+                    return False
+                self._set_state(HALF_OPEN)
+                self._probes_started = self._probes_ok = 0
+            if self.state == HALF_OPEN:
+                if self._probes_started >= self.probes:
+                    return False
+                self._probes_started += 1
+            return True
+
+    def record(self, ok: bool):
+        now = time.monotonic()
+        with self._lock:
+            if self.state == HALF_OPEN:
+                if not ok:
+                    self._open(now)
+                else:
+                    self._probes_ok += 1
+                    if self._probes_ok >= self.probes:
+                        self._outcomes.clear()
+                        self._failures = 0
+                        self._set_state(CLOSED)
+                return
+            if self.state == OPEN:
+                return
+            self._outcomes.append((now, ok))
+            if not ok:
+                self._failures += 1
+            self._trim(now)
+            total = len(self._outcomes)
+            if total >= self.min_calls and self._failures >= self.failure_ratio * total:
+                self._open(now)
+
+    def forget(self):
+        """Разрешённый вызов отменён до результата: в half_open освобождаем пробный слот"""
+        with self._lock:
+            if self.state == HALF_OPEN and self._probes_started > 0:
+                self._probes_started -= 1
+
+    def _open(self, now: float):
+        self._opened_at = now
+        self.opened += 1
+        self._set_state(OPEN)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            self._trim(time.monotonic())
+            return {"state": self.state, "window_calls": len(self._outcomes), "window_failures": self._failures,
+                    "opened": self.opened}
+
+
+class RetryBudget:
+    """
+    Повторы — не больше ratio от первичных вызовов: каждый первичный вызов добавляет ratio токена,
+    повтор забирает один. Плюс min_per_second токенов в секунду, чтобы повторы были возможны
+    при малом трафике. Когда API лежит, повторы быстро исчерпывают бюджет и прекращаются.
+    """
+
+    def __init__(self, name: str, ratio: float = YANDEX_RETRY_BUDGET_RATIO,
+                 min_per_second: float = YANDEX_RETRY_BUDGET_MIN_PER_SECOND, max_tokens: float = YANDEX_RETRY_BUDGET_MAX):
+        self.name = name
+        self.ratio = max(0.0, float(ratio))
+        self.min_per_second = max(0.0, float(min_per_second))
+        self.max_tokens = max(1.0, float(max_tokens))
+        self._lock = threading.Lock()
+        self._tokens = self.max_tokens
+        self._updated = time.monotonic()
+        self.exhausted = 0
+
+    def _refill(self, now: float):
+        self._tokens = min(self.max_tokens, self._tokens + (now - self._updated) * self.min_per_second)
+        self._updated = now
+
+    def deposit(self):
+        with self._lock:
+            self._refill(time.monotonic())
+            self._tokens = min(self.max_tokens, self._tokens + self.ratio)
+
+    def try_withdraw(self) -> bool:
+        with self._lock:
+            self._refill(time.monotonic())
+            if self._tokens >= 1.0:
+                self._tokens -= 1.0
+                return True
+            self.exhausted += 1
+            return False
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            self._refill(time.monotonic())
+            return {"tokens": round(self._tokens, 2), "ratio": self.ratio, "exhausted": self.exhausted}
+
+
+class _Attempt:
+    __slots__ = ("overloaded", "failed")
+
+    def __init__(self):
+        self.overloaded = False
+        self.failed = False
+
+    def record_status(self, status_code: int):
+        """429 и 5xx — признак перегрузки API; остальные 4xx — ошибка запроса, а не API"""
+        if status_code == 429 or status_code >= 500:
+            self.overloaded = self.failed = True
+
+
+class EndpointGuard:
+    """Лимит, circuit breaker и бюджет повторов одного эндпоинта Yandex API (общие для потоков и корутин)"""
+
+    def __init__(self, name: str):
+        self.name = name
+        self.limiter = AdaptiveLimiter(name)
+        self.breaker = CircuitBreaker(name)
+        self.retry_budget = RetryBudget(name)
+
+    def _reject(self, reason: str, retry_after: float = 1.0):
+        CLIENT_REJECTED.inc(endpoint=self.name, reason=reason)
+        raise YandexUnavailable(self.name, reason, retry_after)
+
+    @property
+    def is_open(self) -> bool:
+        return self.breaker.state == OPEN
+
+    def _admit_retry(self, retry: bool):
+        if retry:
+            if not self.retry_budget.try_withdraw():
+                self._reject("retry_budget")
+        else:
+            self.retry_budget.deposit()
+
+    def _admit_breaker(self):
+        # Breaker — после лимита: разрешение в half_open расходует пробный вызов, он должен состояться
+        if not self.breaker.allow():
+            self.limiter.cancel()
+            self._reject("circuit_open", self.breaker.retry_after())
+
+    @contextmanager
+    def _call(self) -> Iterator[_Attempt]:
+        attempt = _Attempt()
+        started = time.monotonic()
+        try:
+            yield attempt
+        except asyncio.CancelledError:
+            # Отменённая хедж-ветка или ушедший клиент ничего не говорят о состоянии API
+            self.limiter.cancel()
+            self.breaker.forget()
+            raise
+        except BaseException:
+            attempt.overloaded = attempt.failed = True
+            self._finish(attempt, started)
+            raise
+        else:
+            self._finish(attempt, started)
+
+    @contextmanager
+    def attempt(self, retry: bool = False) -> Iterator[_Attempt]:
+        """
+        Один вызов API. retry=True — повтор или fallback-вызов (тратит бюджет повторов).
+        Слот лимита ждётся не дольше YANDEX_LIMIT_MAX_WAIT_SECONDS (блокирует поток).
+        Без разрешения бросает YandexUnavailable. Исключение внутри блока считается перегрузкой
+        (таймауты, обрывы соединения); код ответа передаётся через record_status().
+        """
+        if not YANDEX_RESILIENCE:
+            yield _Attempt()
+            return
+        self._admit_retry(retry)
+        if not self.limiter.acquire():
+            self._reject("limit")
+        self._admit_breaker()
+        with self._call() as attempt:
+            yield attempt
+
+    @asynccontextmanager
+    async def attempt_async(self, retry: bool = False) -> AsyncIterator[_Attempt]:
+        """attempt() для корутин: ожидание слота лимита не блокирует event loop"""
+        if not YANDEX_RESILIENCE:
+            yield _Attempt()
+            return
+        self._admit_retry(retry)
+        if not await self.limiter.acquire_async():
+            self._reject("limit")
+        self._admit_breaker()
+        with self._call() as attempt:
+            yield attempt
+
+    def _finish(self, attempt: _Attempt, started: float):
+        self.limiter.release(time.monotonic() - started, attempt.overloaded)
+        self.breaker.record(not attempt.failed)
+
+    def stats(self) -> Dict[str, Any]:
+        return {"limiter": self.limiter.stats(), "breaker": self.breaker.stats(),
+                "retry_budget": self.retry_budget.stats()}
+
+
+GUARDS: Dict[str, EndpointGuard] = {name: EndpointGuard(name) for name in ("embedding", "completion")}
+
+
+def guard_stats() -> Dict[str, Any]:
+    return {name: guard.stats() for name, guard in GUARDS.items()}